@@ -23,6 +23,7 @@ SPINNAKER_GITHUB_IO_REPOSITORY_NAME = 'spinnaker.github.io'
 
 
 from buildtool.util import (
+    DATA_FORMAT_EXTENSIONS,
     DEFAULT_BUILD_NUMBER,
     add_parser_argument,
     unused_port,
@@ -32,7 +33,18 @@ from buildtool.util import (
     log_embedded_output,
 
     ensure_dir_exists,
-    write_to_path)
+    write_to_path,
+
+    available_data_formats,
+    get_intermediate_format,
+    set_intermediate_format,
+    intermediate_path,
+    data_format_for_path,
+    encode_data,
+    decode_data,
+    write_data_to_path,
+    find_data_path,
+    load_data_from_path)
 
 from buildtool.errors import (
     BuildtoolError,
@@ -54,19 +66,53 @@ from buildtool.errors import (
     # between validate_bom__deploy and image_commands
     scan_logs_for_install_errors)
 
+from buildtool.tracing import (
+    Span,
+    Tracer)
+
 from buildtool.subprocess_support import (
     start_subprocess,
     wait_subprocess,
     run_subprocess,
     check_subprocess,
+    check_subprocess_lines,
     check_subprocess_sequence,
     run_subprocess_sequence,
     check_subprocesses_to_logfile,
-    determine_subprocess_outcome_labels)
+    determine_subprocess_outcome_labels,
+    record_subprocess_resource_usage,
+    ResourceUsage,
+
+    SubprocessLimiter,
+    is_async_supported,
+    run_subprocess_async,
+    check_subprocess_async,
+    map_async)
+
+from buildtool.http_support import (
+    HttpClient,
+    HttpRequestError,
+    HttpResponse,
+    HttpStatusError)
+
+from buildtool.bom_index import (
+    BomIndex,
+    BomServiceRow)
+
+from buildtool.bom_table import (
+    BomServiceTable,
+    StringPool)
 
 from buildtool.git_support import (
+    GitCommitGraph,
+    GitCommitObject,
+    GitObject,
+    GitObjectReader,
+    GitRefTransaction,
     GitRepositorySpec,
     GitRunner,
+    GitTreeEntry,
+    RepositorySummaryCache,
 
     CommitMessage,
     CommitTag,
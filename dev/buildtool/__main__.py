@@ -18,14 +18,15 @@ This module is reponsible for determining the configuration
 then acquiring and dispatching commands.
 
 Commands are introduced into modules, and modules are explicitly
-plugged into the command_modules[] list in main() where they
-will be initialized and their commands registered into the registry.
-From there this module will be able to process arguments and
-dispatch commands.
+plugged into the COMMAND_MODULE_MANIFEST where they will be imported
+and their commands registered into the registry once one of their
+commands is needed. From there this module will be able to process
+arguments and dispatch commands.
 """
 
 import argparse
 import datetime
+from importlib import import_module
 import logging
 import os
 import sys
@@ -33,9 +34,14 @@ import time
 import yaml
 
 from buildtool.metrics import MetricsManager
+from buildtool.profiling import (
+    PROFILE_MODES,
+    make_profiler)
 from buildtool import (
     add_parser_argument,
+    available_data_formats,
     maybe_log_exception,
+    set_intermediate_format,
     GitRunner)
 
 
@@ -49,6 +55,39 @@ STANDARD_LOG_LEVELS = {
 # This is so tests can disable it
 CHECK_HOME_FOR_CONFIG = True
 
+# The module that registers each command.
+# Importing the command modules and building their argument parsers is a
+# noticeable part of the runtime of short commands, so only the module for
+# the selected command is imported. The main_test verifies this against
+# what the modules actually register.
+COMMAND_MODULE_MANIFEST = {
+    'build_apidocs': 'apidocs_commands',
+    'publish_apidocs': 'apidocs_commands',
+    'build_bom': 'bom_commands',
+    'publish_bom': 'bom_commands',
+    'build_changelog': 'changelog_commands',
+    'publish_changelog': 'changelog_commands',
+    'push_changelog_to_gist': 'changelog_commands',
+    'build_bom_containers': 'container_commands',
+    'build_halyard_containers': 'container_commands',
+    'build_debians': 'debian_commands',
+    'run_flow': 'flow_commands',
+    'build_halyard': 'halyard_commands',
+    'publish_halyard': 'halyard_commands',
+    'build_gce_component_images': 'image_commands',
+    'compact_metrics_journals': 'metrics_commands',
+    'build_rpms': 'rpm_commands',
+    'extract_source_info': 'source_commands',
+    'fetch_source': 'source_commands',
+    'new_release_branch': 'spinnaker_commands',
+    'publish_spinnaker': 'spinnaker_commands',
+    'audit_artifact_versions': 'inspection_commands',
+    'collect_artifact_versions': 'inspection_commands',
+    'collect_bom_versions': 'inspection_commands',
+    'build_spin': 'spin_commands',
+    'publish_spin': 'spin_commands',
+}
+
 
 def add_standard_parser_args(parser, defaults):
   """Init argparser with command-independent options.
@@ -79,6 +118,12 @@ def add_standard_parser_args(parser, defaults):
   add_parser_argument(
       parser, 'input_dir', defaults, 'source_code',
       help='Directory to cache input files, such as cloning git repos.')
+  add_parser_argument(
+      parser, 'intermediate_format', defaults, 'yaml',
+      choices=available_data_formats(),
+      help='The data format for intermediate files passed between commands'
+           ' such as the source_info and collected version files.'
+           ' Existing files in other formats can still be read.')
   add_parser_argument(
       parser, 'one_at_a_time', defaults, False, type=bool,
       help='Do not perform applicable concurrency, for debugging.')
@@ -86,6 +131,13 @@ def add_standard_parser_args(parser, defaults):
       parser, 'parent_invocation_id', defaults,
       '{:%y%m%d}.{}'.format(datetime.datetime.utcnow(), os.getpid()),
       help='For identifying the context of the metrics data to be produced.')
+  add_parser_argument(
+      parser, 'profile', defaults, None, choices=PROFILE_MODES,
+      help='Profile the command, writing pstats and collapsed flamegraph'
+           ' stacks into <output_dir>/profile/<command>.')
+  add_parser_argument(
+      parser, 'profile_interval_ms', defaults, 5, type=int,
+      help='The sampling interval when --profile=sampling.')
 
 
 def __load_defaults_from_path(path, visited=None):
@@ -165,6 +217,73 @@ def make_registry(command_modules, parser, defaults):
   return registry
 
 
+class LazyCommandRegistry(dict):
+  """A command registry that imports command modules as they are needed.
+
+  Looking up a command that is not yet registered imports the module
+  that the manifest says registers it, then registers all the commands
+  in that module. This is also how run_flow finds the commands for its
+  stages.
+  """
+
+  def __init__(self, manifest, subparsers, defaults,
+               import_func=import_module):
+    """Constructor.
+
+    Args:
+      manifest: [dict] The name of the module for each command name.
+         Each module has the register_commands function described in
+         make_registry.
+      subparsers: [ArgumentParser subparsers] To add the command parsers to.
+      defaults: [dict] Default values to specify when adding arguments.
+      import_func: [callable] Imports a module given its name.
+    """
+    super(LazyCommandRegistry, self).__init__()
+    self.__manifest = manifest
+    self.__subparsers = subparsers
+    self.__defaults = defaults
+    self.__import_func = import_func
+    self.__loaded_modules = set([])
+
+  def load_module(self, module_name):
+    """Imports the module and registers its commands if not yet loaded."""
+    if module_name in self.__loaded_modules:
+      return
+    self.__loaded_modules.add(module_name)
+    logging.debug('Loading commands from %s', module_name)
+    module = self.__import_func(module_name)
+    module.register_commands(self, self.__subparsers, self.__defaults)
+
+  def load_all(self):
+    """Registers all the commands in the manifest."""
+    for module_name in sorted(set(self.__manifest.values())):
+      self.load_module(module_name)
+
+  def __missing__(self, name):
+    module_name = self.__manifest.get(name)
+    if module_name is None or module_name in self.__loaded_modules:
+      raise KeyError(name)
+    self.load_module(module_name)
+    return self[name]
+
+  def get(self, name, default=None):
+    try:
+      return self[name]
+    except KeyError:
+      return default
+
+  def __contains__(self, name):
+    return self.get(name) is not None
+
+
+def find_command_name(args, command_names):
+  """Returns the first argument that names a command or None."""
+  for arg in args:
+    if not arg.startswith('-') and arg in command_names:
+      return arg
+  return None
+
+
 def add_monitoring_context_labels(options):
   option_dict = vars(options)
   version_name = option_dict.get('git_branch', None)
@@ -208,20 +327,62 @@ def init_options_and_registry(args, command_modules):
       registry: [dict] of (<command-name>: <CommandFactory>)
   """
   args, defaults = preprocess_args(args)
+  parser = make_standard_parser(defaults)
+  registry = make_registry(command_modules, parser, defaults)
+  return parse_options(parser, args), registry
+
+
+def init_options_and_lazy_registry(args, manifest,
+                                   import_func=import_module):
+  """Determine options from commandline, registering only needed commands.
+
+  This is like init_options_and_registry but only imports the module for
+  the command named in the args. If there is no command, such as with
+  --help, then all the commands are registered so they are listed.
+
+  Args:
+    args: [list of command-line arguments]
+    manifest: [dict] The name of the module for each command name.
+    import_func: [callable] Imports a module given its name.
+
+  Returns:
+    options, registry
+
+    Where:
+      options: [Namespace] From parsed args.
+      registry: [LazyCommandRegistry] keyed by command name.
+  """
+  args, defaults = preprocess_args(args)
+  parser = make_standard_parser(defaults)
+  subparsers = parser.add_subparsers(title='command', dest='command')
+  registry = LazyCommandRegistry(manifest, subparsers, defaults,
+                                 import_func=import_func)
+  command_name = find_command_name(args, manifest)
+  if command_name:
+    registry.load_module(manifest[command_name])
+  else:
+    registry.load_all()
+  return parse_options(parser, args), registry
+
 
+def make_standard_parser(defaults):
+  """Returns the parser with the command-independent options."""
   parser = argparse.ArgumentParser(prog='buildtool.sh')
   add_standard_parser_args(parser, defaults)
   MetricsManager.init_argument_parser(parser, defaults)
+  return parser
 
-  registry = make_registry(command_modules, parser, defaults)
+
+def parse_options(parser, args):
+  """Parses the args once the commands are registered into the parser."""
   options = parser.parse_args(args)
   options.program = 'buildtool'
+  set_intermediate_format(options.intermediate_format)
 
   # Determine the version for monitoring purposes.
   # Depending on the options defined, this is either the branch or bom prefix.
   add_monitoring_context_labels(options)
-
-  return options, registry
+  return options
 
 
 def main():
@@ -229,26 +390,9 @@ def main():
 
   start_time = time.time()
 
-  from importlib import import_module
-  command_modules = [
-      import_module(name + '_commands') for name in [
-          'apidocs',
-          'bom',
-          'changelog',
-          'container',
-          'debian',
-          'halyard',
-          'image',
-          'rpm',
-          'source',
-          'spinnaker',
-          'inspection',
-          'spin',
-      ]]
-
   GitRunner.stash_and_clear_auth_env_vars()
-  options, command_registry = init_options_and_registry(
-      sys.argv[1:], command_modules)
+  options, command_registry = init_options_and_lazy_registry(
+      sys.argv[1:], COMMAND_MODULE_MANIFEST)
 
   logging.basicConfig(
       format='%(levelname).1s %(asctime)s.%(msecs)03d'
@@ -269,12 +413,19 @@ def main():
   MetricsManager.startup_metrics(options)
   labels = {'command': options.command}
   success = False
+  profiler = make_profiler(options)
   try:
     command = factory.make_command(options)
-    command()
+    if profiler:
+      profiler.profile_call(command)
+    else:
+      command()
     success = True
   finally:
     labels['success'] = success
+    if profiler:
+      profiler.record_metrics(MetricsManager.singleton())
+    GitRunner.close_object_readers()
     MetricsManager.singleton().observe_timer(
         'BuildTool_Outcome', labels,
         time.time() - start_time)
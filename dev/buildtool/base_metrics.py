@@ -14,14 +14,21 @@
 
 """Base metrics support is extended for a concrete monitoring system."""
 
+import bisect
 import datetime
 import logging
+import math
 import re
 import sys
 import threading
 import time
 
 
+# The default histogram buckets for timers as <start>,<factor>,<count>.
+# These range from 10ms to about 1.5 hours.
+DEFAULT_TIMER_BUCKETS = '0.01,2,20'
+
+
 class Metric(object):
   """A metric with unique combination of name and bindings."""
 
@@ -118,8 +125,108 @@ class Gauge(Metric):
       self.touch(utc=utc)
 
 
+def exponential_bucket_bounds(start, factor, count):
+  """Returns the upper bounds of count exponentially growing buckets."""
+  return [start * factor ** index for index in range(count)]
+
+
+class QuantileSketch(object):
+  """A mergeable streaming sketch for estimating quantiles.
+
+  Positive values are counted in logarithmic bins so that every estimate is
+  within the relative_accuracy of an observed value no matter how skewed
+  the distribution is. Sketches with the same accuracy can be merged, such
+  as to combine the timings from several processes.
+  """
+
+  def __init__(self, relative_accuracy=0.01):
+    self.__relative_accuracy = relative_accuracy
+    self.__gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    self.__log_gamma = math.log(self.__gamma)
+    self.__bins = {}
+    self.__zero_count = 0
+    self.__count = 0
+    self.__max = None
+
+  @property
+  def relative_accuracy(self):
+    return self.__relative_accuracy
+
+  @property
+  def count(self):
+    return self.__count
+
+  @property
+  def max(self):
+    """The largest value added or None."""
+    return self.__max
+
+  def add(self, value):
+    """Adds a value to the sketch."""
+    self.__count += 1
+    if self.__max is None or value > self.__max:
+      self.__max = value
+    if value <= 0:
+      self.__zero_count += 1
+      return
+    index = int(math.ceil(math.log(value) / self.__log_gamma))
+    self.__bins[index] = self.__bins.get(index, 0) + 1
+
+  def merge(self, other):
+    """Adds all the values in another sketch to this one."""
+    if other.relative_accuracy != self.__relative_accuracy:
+      raise ValueError('Sketches have different accuracies.')
+    # pylint: disable=protected-access
+    for index, count in other.__bins.items():
+      self.__bins[index] = self.__bins.get(index, 0) + count
+    self.__zero_count += other.__zero_count
+    self.__count += other.__count
+    if other.max is not None and (self.__max is None or other.max > self.__max):
+      self.__max = other.max
+
+  def quantile(self, fraction):
+    """Returns the estimated value at the fraction (0..1) or None if empty."""
+    if not self.__count:
+      return None
+    rank = fraction * (self.__count - 1)
+    seen = self.__zero_count
+    if seen > rank:
+      return 0
+    for index in sorted(self.__bins.keys()):
+      seen += self.__bins[index]
+      if seen > rank:
+        estimate = 2 * self.__gamma ** index / (self.__gamma + 1)
+        return min(estimate, self.__max)
+    return self.__max
+
+  def to_dict(self):
+    """Returns the sketch as a JSON compatible dictionary."""
+    return {'relativeAccuracy': self.__relative_accuracy,
+            'bins': {str(index): count for index, count in self.__bins.items()},
+            'zeroCount': self.__zero_count,
+            'count': self.__count,
+            'max': self.__max}
+
+  @staticmethod
+  def from_dict(data):
+    """Returns the sketch written by to_dict."""
+    sketch = QuantileSketch(data['relativeAccuracy'])
+    # pylint: disable=protected-access
+    sketch.__bins = {int(index): count for index, count in data['bins'].items()}
+    sketch.__zero_count = data['zeroCount']
+    sketch.__count = data['count']
+    sketch.__max = data['max']
+    return sketch
+
+
 class Timer(Metric):
-  """Observes how long functions take to execute."""
+  """Observes how long functions take to execute.
+
+  In addition to the count and total, timers keep a histogram using the
+  registry's timer_bucket_bounds and a QuantileSketch of the timings.
+  """
+
+  QUANTILES = [('p50', 0.5), ('p90', 0.9), ('p99', 0.99)]
 
   @property
   def count(self):
@@ -131,16 +238,58 @@ class Timer(Metric):
     """The total time across all the captured timings."""
     return self.__total
 
+  @property
+  def max_seconds(self):
+    """The longest timing captured or None."""
+    return self.__sketch.max
+
+  @property
+  def bucket_bounds(self):
+    """The upper bounds of the histogram buckets.
+
+    There is an additional unbounded bucket after the last bound.
+    """
+    return self.__bucket_bounds
+
+  @property
+  def bucket_counts(self):
+    """The number of timings in each histogram bucket."""
+    with self.mutex:
+      return list(self.__bucket_counts)
+
+  @property
+  def sketch(self):
+    return self.__sketch
+
   def __init__(self, family, labels):
     super(Timer, self).__init__(family, labels)
     self.__count = 0
     self.__total = 0
+    self.__bucket_bounds = family.registry.timer_bucket_bounds
+    self.__bucket_counts = [0] * (len(self.__bucket_bounds) + 1)
+    self.__sketch = QuantileSketch()
+
+  def quantile(self, fraction):
+    """Returns the estimated timing at the fraction (0..1) or None."""
+    with self.mutex:
+      return self.__sketch.quantile(fraction)
+
+  def summarize_quantiles(self):
+    """Returns the QUANTILES and max keyed by their name."""
+    with self.mutex:
+      result = {name: self.__sketch.quantile(fraction)
+                for name, fraction in self.QUANTILES}
+      result['max'] = self.__sketch.max
+    return result
 
   def observe(self, seconds, utc=None):
     """Capture a timing observation."""
     with self.mutex:
       self.__count += 1
       self.__total += seconds
+      self.__bucket_counts[
+          bisect.bisect_left(self.__bucket_bounds, seconds)] += 1
+      self.__sketch.add(seconds)
       self.touch(utc=utc)
 
 
@@ -189,9 +338,24 @@ class MetricFamily(object):
     self.__registry = registry
     self.__family_type = family_type
 
-  def get(self, labels):
-    """Returns a metric instance with bound labels."""
-    key = ''.join('{0}={1}'.format(key, value) for key, value in labels.items())
+  @staticmethod
+  def make_key(labels):
+    """Returns the key identifying the instance with the given labels."""
+    return tuple(sorted(labels.items()))
+
+  def get(self, labels, key=None):
+    """Returns a metric instance with bound labels.
+
+    The key can be passed in if the caller already has it from make_key.
+    """
+    if key is None:
+      key = self.make_key(labels)
+
+    # Existing instances are never replaced so can be read without the lock.
+    got = self.__instances.get(key)
+    if got is not None:
+      return got
+
     with self.__mutex:
       got = self.__instances.get(key)
       if got is None:
@@ -200,6 +364,96 @@ class MetricFamily(object):
       return got
 
 
+class MetricHandle(object):
+  """A metric name and static label bindings resolved for repeated use.
+
+  Handles are returned by BaseMetricsRegistry.bind. The registry's context
+  labels are merged into the static labels once when the handle is made.
+  Metrics that are further distinguished by outcome labels are cached in the
+  handle by the key of those labels alone.
+
+  Handles are safe to share across threads.
+  """
+
+  @property
+  def name(self):
+    return self.__name
+
+  @property
+  def family_type(self):
+    return self.__family_type
+
+  @property
+  def labels(self):
+    """The normalized static labels bound into this handle."""
+    return self.__labels
+
+  def __init__(self, registry, family_type, name, labels):
+    self.__registry = registry
+    self.__family_type = family_type
+    self.__name = name
+    self.__labels = labels
+    self.__metrics = {}
+
+  def get(self, outcome_labels=None):
+    """Returns the metric instance with the static and outcome labels."""
+    key = MetricFamily.make_key(outcome_labels) if outcome_labels else ()
+    metric = self.__metrics.get(key)
+    if metric is None:
+      labels = self.__labels
+      if outcome_labels:
+        labels = dict(labels)
+        labels.update(outcome_labels)
+      # Racing threads will get the same instance back from the family.
+      metric = self.__registry.get_metric(self.__family_type, self.__name,
+                                          labels)
+      self.__metrics[key] = metric
+    return metric
+
+  def inc(self, **kwargs):
+    """Increments the bound counter or gauge."""
+    metric = self.get()
+    metric.inc(**kwargs)
+    return metric
+
+  def set(self, value):
+    """Sets the bound gauge to the value."""
+    metric = self.get()
+    metric.set(value)
+    return metric
+
+  def observe(self, seconds):
+    """Adds an observation to the bound timer."""
+    metric = self.get()
+    metric.observe(seconds)
+    return metric
+
+  def track(self, func, *pos_args, **kwargs):
+    """Track number of active calls to the given function."""
+    return self.get().track(func, *pos_args, **kwargs)
+
+  def time_call(self, label_func, time_func, *pos_args, **kwargs):
+    """Times the function call into the timer for the call's outcome.
+
+    The label_func is the same as for BaseMetricsRegistry.time_call, however
+    it is passed empty base labels since the static labels are already bound.
+    """
+    try:
+      start_time = time.time()
+      result = time_func(*pos_args, **kwargs)
+      outcome_labels = label_func(result, {})
+      return result
+    except:
+      try:
+        outcome_labels = label_func(None, {})
+      except Exception as ex:
+        logging.exception('label_func failed with %s', str(ex))
+        raise ex
+      raise
+    finally:
+      self.get(outcome_labels).observe(time.time() - start_time)
+
+
 class BaseMetricsRegistry(object):
   """Provides base class interface for metrics management.
 
@@ -213,6 +467,10 @@ class BaseMetricsRegistry(object):
   """
   # pylint: disable=too-many-public-methods
 
+  # The most handles bind_labels caches before starting over. Callers with
+  # labels such as the repository can bind an unbounded number of them.
+  MAX_CACHED_HANDLES = 4096
+
   @staticmethod
   def default_determine_outcome_labels(result, base_labels):
     """Return the outcome labels for a set of tracking labels."""
@@ -247,6 +505,11 @@ class BaseMetricsRegistry(object):
     """When the registry started -- values are relative to this utc time."""
     return self.__start_time
 
+  @property
+  def timer_bucket_bounds(self):
+    """The upper bounds of the histogram buckets for timers."""
+    return self.__timer_bucket_bounds
+
   @property
   def metric_family_list(self):
     """Return all the metric families."""
@@ -271,6 +534,18 @@ class BaseMetricsRegistry(object):
                 binding, ex))
     return labels
 
+  @staticmethod
+  def __make_timer_bucket_bounds(options):
+    spec = (getattr(options, 'metrics_timer_buckets', None)
+            or DEFAULT_TIMER_BUCKETS)
+    try:
+      start, factor, count = spec.split(',')
+      return exponential_bucket_bounds(float(start), float(factor), int(count))
+    except ValueError:
+      raise ValueError(
+          'Invalid metrics_timer_buckets "%s".'
+          ' Expected <start>,<factor>,<count>' % spec)
+
   def __init__(self, options):
     """Constructs registry with options from init_argument_parser."""
     self.__start_time = datetime.datetime.utcnow()
@@ -279,9 +554,11 @@ class BaseMetricsRegistry(object):
     self.__pusher_thread_event = threading.Event()
     self.__metric_families = {}
     self.__family_mutex = threading.Lock()
+    self.__handles = {}
     self.__updated_metrics = set([])
     self.__update_mutex = threading.Lock()
     self.__inject_labels = self.__make_context_labels(options)
+    self.__timer_bucket_bounds = self.__make_timer_bucket_bounds(options)
     if self.__inject_labels:
       logging.debug('Injecting additional metric labels %s',
                     self.__inject_labels)
@@ -304,11 +581,33 @@ class BaseMetricsRegistry(object):
     with self.__update_mutex:
       self.__updated_metrics.add(metric)
 
+  def bind(self, family_type, name, **static_labels):
+    """Returns the MetricHandle for the named metric with the static labels.
+
+    Handles are cached so binding the same metric and labels again returns
+    the same handle without normalizing the labels again. The cache is
+    cleared once it holds MAX_CACHED_HANDLES, so callers that want to keep
+    a handle for repeated use should hold onto it rather than rebind it.
+    """
+    return self.bind_labels(family_type, name, static_labels)
+
+  def bind_labels(self, family_type, name, labels):
+    """Same as bind but the static labels are given as a dictionary."""
+    key = (family_type, name, MetricFamily.make_key(labels))
+    handle = self.__handles.get(key)
+    if handle is None:
+      if len(self.__handles) >= self.MAX_CACHED_HANDLES:
+        # The metrics themselves are kept by their families so handles
+        # made again later still refer to the same metrics.
+        self.__handles.clear()
+      handle = self.__handles.setdefault(
+          key, MetricHandle(self, family_type, name,
+                            self.__normalize_labels(labels)))
+    return handle
+
   def inc_counter(self, name, labels, **kwargs):
     """Track number of completed calls to the given function."""
-    counter = self.get_metric(MetricFamily.COUNTER, name, labels)
-    counter.inc(**kwargs)
-    return counter
+    return self.bind_labels(MetricFamily.COUNTER, name, labels).inc(**kwargs)
 
   def count_call(self, name, labels, func, *pos_args, **kwargs):
     """Track number of completed calls to the given function."""
@@ -324,39 +623,26 @@ class BaseMetricsRegistry(object):
 
   def set(self, name, labels, value):
     """Sets the implied gauge with the specified value."""
-    gauge = self.get_metric(MetricFamily.GAUGE, name, labels)
-    gauge.set(value)
-    return gauge
+    return self.bind_labels(MetricFamily.GAUGE, name, labels).set(value)
 
   def track_call(self, name, labels, func, *pos_args, **kwargs):
     """Track number of active calls to the given function."""
-    gauge = self.get_metric(MetricFamily.GAUGE, name, labels)
+    gauge = self.bind_labels(MetricFamily.GAUGE, name, labels)
     return gauge.track(func, *pos_args, **kwargs)
 
   def observe_timer(self, name, labels, seconds):
     """Add an observation to the specified timer."""
-    timer = self.get_metric(MetricFamily.TIMER, name, labels)
-    timer.observe(seconds)
-    return timer
+    return self.bind_labels(MetricFamily.TIMER, name, labels).observe(seconds)
 
   def time_call(self, name, labels, label_func,
                 time_func, *pos_args, **kwargs):
-    """Track number of completed calls to the given function."""
-    try:
-      start_time = time.time()
-      result = time_func(*pos_args, **kwargs)
-      outcome_labels = label_func(result, labels)
-      return result
-    except:
-      try:
-        outcome_labels = label_func(None, labels)
-      except Exception as ex:
-        logging.exception('label_func failed with %s', str(ex))
-        raise ex
-      raise
-    finally:
-      timer = self.get_metric(MetricFamily.TIMER, name, outcome_labels)
-      timer.observe(time.time() - start_time)
+    """Track number of completed calls to the given function.
+
+    The labels are bound into a MetricHandle so label_func is passed empty
+    base labels and needs only return the outcome labels to add to them.
+    """
+    timer = self.bind_labels(MetricFamily.TIMER, name, labels)
+    return timer.time_call(label_func, time_func, *pos_args, **kwargs)
 
   def lookup_family_or_none(self, name):
     return self.__metric_families.get(name)
@@ -381,8 +667,7 @@ class BaseMetricsRegistry(object):
 
     family = self._do_make_family(family_type, name, labels.keys())
     with self.__family_mutex:
-      if name not in self.__metric_families:
-        self.__metric_families[name] = family
+      family = self.__metric_families.setdefault(name, family)
     return family.get(labels)
 
   def track_and_time_call(
@@ -393,13 +678,12 @@ class BaseMetricsRegistry(object):
     This will instrument both tracking of call counts in progress
     as well as the final outcomes in terms of performance and outcome.
     """
-    tracking_name = name + '_InProgress'
-    outcome_name = name + '_Outcome'
-
-    return self.track_call(
-        tracking_name, labels,
-        self.time_call,
-        outcome_name, labels, outcome_labels_func,
+    tracking = self.bind_labels(
+        MetricFamily.GAUGE, name + '_InProgress', labels)
+    outcome = self.bind_labels(
+        MetricFamily.TIMER, name + '_Outcome', labels)
+    return tracking.track(
+        outcome.time_call, outcome_labels_func,
         result_func, *pos_args, **kwargs)
 
   def start_pusher_thread(self):
@@ -15,9 +15,11 @@
 """Implements build_bom command for buildtool."""
 
 import datetime
+import io
 import logging
 import os
-import shutil
+import posixpath
+import tarfile
 import yaml
 
 import buildtool.container_commands
@@ -35,7 +37,6 @@ from buildtool import (
 
     HalRunner,
     GitRunner,
-    check_subprocess,
 
     check_path_exists,
     ensure_dir_exists,
@@ -325,6 +326,9 @@ class BuildBomCommandFactory(RepositoryCommandFactory):
 class PublishBomCommand(RepositoryCommandProcessor):
   """Implements publish_bom"""
 
+  # Like the kernel, give up on links that lead to more than this many links.
+  MAX_SYMLINK_DEPTH = 40
+
   def __init__(self, factory, options, **kwargs):
     options.github_disable_upstream_push = True
     super(PublishBomCommand, self).__init__(factory, options, **kwargs)
@@ -384,7 +388,11 @@ class PublishBomCommand(RepositoryCommandProcessor):
         self.source_repositories, publish_repo_config)
 
   def __collect_halconfig_files(self, repository):
-    """Gets the component config files and writes them into the output_dir."""
+    """Gets the component config files and writes them into the output_dir.
+
+    The files are read from the repository's HEAD commit through git rather
+    than from its working tree.
+    """
     name = repository.name
     if (name not in SPINNAKER_BOM_REPOSITORY_NAMES
         or name in ['spin']):
@@ -392,38 +400,128 @@ class PublishBomCommand(RepositoryCommandProcessor):
       return
 
     if name == 'spinnaker-monitoring':
-      config_root = os.path.join(
-          repository.git_dir, 'spinnaker-monitoring-daemon')
+      config_path = 'spinnaker-monitoring-daemon/halconfig'
     else:
-      config_root = repository.git_dir
+      config_path = 'halconfig'
 
     service_name = self.scm.repository_name_to_service_name(repository.name)
     target_dir = os.path.join(self.get_output_dir(), 'halconfig', service_name)
     ensure_dir_exists(target_dir)
 
-    config_path = os.path.join(config_root, 'halconfig')
-    logging.info('Copying configs from %s...', config_path)
-    for profile in os.listdir(config_path):
-      profile_path = os.path.join(config_path, profile)
-      if os.path.isfile(profile_path):
-        shutil.copyfile(profile_path, os.path.join(target_dir, profile))
+    git = self.source_code_manager.git
+    git_dir = repository.git_dir
+    commit = git.query_commit_object_or_none(git_dir)
+    entries = (git.list_tree_at_commit_or_none(
+        git_dir, commit.commit_id, config_path) if commit else None)
+    if entries is None:
+      raise_and_log_error(
+          ConfigError('{repo} has no "{path}" directory to copy configs from'
+                      .format(repo=name, path=config_path)))
+
+    logging.info('Copying configs from %s in %s...', config_path, git_dir)
+    for entry in entries:
+      profile_path = config_path + '/' + entry.name
+      # Profiles may be links to the files or directories to publish.
+      resolved_path, resolved = self.__resolve_symlink(
+          git, git_dir, commit, profile_path, entry)
+      if resolved is None:
+        logging.warning('%s is a link to nothing in %s -- ignoring',
+                        profile_path, name)
+        continue
+
+      if resolved.is_blob:
+        with open(os.path.join(target_dir, entry.name), 'wb') as stream:
+          stream.write(git.read_file_at_commit_or_none(
+              git_dir, commit.commit_id, resolved_path))
         logging.debug('Copied profile to %s', profile_path)
-      elif not os.path.isdir(profile_path):
+      elif not resolved.is_tree:
         logging.warning('%s is neither file nor directory -- ignoring',
                         profile_path)
         continue
       else:
         tar_path = os.path.join(
-            target_dir, '{profile}.tar.gz'.format(profile=profile))
-        file_list = ' '.join(os.listdir(profile_path))
+            target_dir, '{profile}.tar.gz'.format(profile=entry.name))
 
         # NOTE: For historic reasons this is not actually compressed
         # even though the tar_path says ".tar.gz"
-        check_subprocess(
-            'tar cf {path} -C {profile} {file_list}'.format(
-                path=tar_path, profile=profile_path, file_list=file_list))
+        with tarfile.open(tar_path, 'w') as tar:
+          self.__add_tree_to_tar(
+              git, git_dir, commit, resolved_path, '', tar)
         logging.debug('Copied profile to %s', tar_path)
 
+  def __resolve_symlink(self, git, git_dir, commit, path, entry):
+    """Follows a symbolic link entry to what it refers to at the commit.
+
+    Args:
+      git: [GitRunner] The git runner to read the links with.
+      git_dir: [path] The local repository.
+      commit: [GitCommitObject] The commit to resolve the link at.
+      path: [string] The path of the entry relative to the repository root.
+      entry: [GitTreeEntry] The entry at path, which need not be a link.
+
+    Returns:
+      The path and GitTreeEntry that the link refers to, following links to
+      other links, or (None, None) if it leads outside the repository or to
+      something that does not exist.
+    """
+    for _ in range(self.MAX_SYMLINK_DEPTH):
+      if entry.mode != '120000':
+        return path, entry
+      target = git.read_file_at_commit_or_none(
+          git_dir, commit.commit_id, path).decode('utf-8')
+      path = posixpath.normpath(
+          posixpath.join(posixpath.dirname(path), target))
+      if posixpath.isabs(target) or path == '..' or path.startswith('../'):
+        return None, None
+      parent, _, name = path.rpartition('/')
+      siblings = git.list_tree_at_commit_or_none(
+          git_dir, commit.commit_id, parent) or []
+      matches = [sibling for sibling in siblings if sibling.name == name]
+      if not matches:
+        return None, None
+      entry = matches[0]
+    return None, None
+
+  def __add_tree_to_tar(self, git, git_dir, commit, path, prefix, tar):
+    """Adds the files in the directory at the commit into the tar file.
+
+    Args:
+      git: [GitRunner] The git runner to read the files with.
+      git_dir: [path] The local repository.
+      commit: [GitCommitObject] The commit to read the files at.
+      path: [string] The directory relative to the repository root.
+      prefix: [string] The directory within the tar file to add them to.
+      tar: [TarFile] The tar file to add the files to.
+    """
+    # The committer header ends with "<timestamp> <timezone>".
+    mtime = int(commit.committer.split(' ')[-2])
+    for entry in git.list_tree_at_commit_or_none(
+        git_dir, commit.commit_id, path):
+      entry_path = path + '/' + entry.name
+      info = tarfile.TarInfo(prefix + entry.name)
+      info.mtime = mtime
+      if entry.is_tree:
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        tar.addfile(info)
+        self.__add_tree_to_tar(
+            git, git_dir, commit, entry_path, info.name + '/', tar)
+        continue
+
+      content = git.read_file_at_commit_or_none(
+          git_dir, commit.commit_id, entry_path)
+      if entry.is_blob:
+        info.mode = 0o755 if entry.mode == '100755' else 0o644
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+      elif entry.mode == '120000':
+        info.type = tarfile.SYMTYPE
+        info.linkname = content.decode('utf-8')
+        tar.addfile(info)
+      else:
+        logging.warning('%s is neither file nor directory -- ignoring',
+                        entry_path)
+
 
 class PublishBomCommandFactory(RepositoryCommandFactory):
   def __init__(self, **kwargs):
@@ -0,0 +1,273 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A persistent index of the services referenced by each published BOM."""
+
+import collections
+import json
+import logging
+import os
+import sqlite3
+
+from buildtool.errors import (
+    ConfigError,
+    raise_and_log_error)
+from buildtool.util import ensure_dir_exists
+
+
+BomServiceRow = collections.namedtuple(
+    'BomServiceRow',
+    ['bom_version', 'bom_timestamp', 'service',
+     'version', 'commit', 'buildnum', 'build_version'])
+
+
+class BomIndex(object):
+  """Records the service builds in each BOM so they need only be read once.
+
+  Each BOM is keyed by its url and remembers the storage generation it was
+  read from. A BOM is only re-read when its generation changes. BOMs that
+  could not be analyzed are remembered along with the reason so that they
+  are not retried until they change.
+
+  Mutations are not committed until commit() is called.
+  """
+
+  SCHEMA_VERSION = 1
+
+  _SCHEMA = [
+      """CREATE TABLE IF NOT EXISTS boms (
+           url TEXT PRIMARY KEY,
+           generation TEXT,
+           bom_version TEXT,
+           bom_timestamp TEXT,
+           nonstandard TEXT,
+           problem TEXT)""",
+      """CREATE TABLE IF NOT EXISTS bom_services (
+           url TEXT NOT NULL,
+           service TEXT NOT NULL,
+           version TEXT NOT NULL,
+           commit_id TEXT NOT NULL,
+           buildnum TEXT NOT NULL,
+           build_version TEXT NOT NULL)""",
+      'CREATE INDEX IF NOT EXISTS bom_services_by_url ON bom_services (url)',
+      'CREATE INDEX IF NOT EXISTS bom_services_by_service'
+      ' ON bom_services (service, version)',
+  ]
+
+  @staticmethod
+  def split_build_version(build_version):
+    """Returns the (version, buildnum) for a service version within a BOM."""
+    parts = build_version.split('-', 1)
+    if len(parts) == 1:
+      return parts[0], 'NotRecorded'
+    return parts[0], parts[1]
+
+  def __init__(self, path, discard_incompatible=False):
+    """Opens the index at path, creating it if it does not yet exist.
+
+    Args:
+      path: [path] The index file.
+      discard_incompatible: [bool] If the existing index has a different
+         schema version then empty it to be rebuilt rather than raising a
+         ConfigError. Only the process maintaining the index should do this.
+    """
+    ensure_dir_exists(os.path.dirname(os.path.abspath(path)))
+    self.__path = path
+    self.__db = sqlite3.connect(path)
+    version = self.__db.execute('PRAGMA user_version').fetchone()[0]
+    if version not in (0, self.SCHEMA_VERSION):
+      if not discard_incompatible:
+        self.__db.close()
+        raise_and_log_error(
+            ConfigError('BOM index {path} has schema version {have}'
+                        ' but expected {want}.'
+                        .format(path=path, have=version,
+                                want=self.SCHEMA_VERSION)))
+      logging.warning('Discarding BOM index %s with schema version %d',
+                      path, version)
+      self.__db.execute('DROP TABLE IF EXISTS boms')
+      self.__db.execute('DROP TABLE IF EXISTS bom_services')
+    for statement in self._SCHEMA:
+      self.__db.execute(statement)
+    self.__db.execute('PRAGMA user_version = %d' % self.SCHEMA_VERSION)
+    self.__db.commit()
+
+  @property
+  def path(self):
+    """The path to the index file."""
+    return self.__path
+
+  def commit(self):
+    """Commits the changes made so far."""
+    self.__db.commit()
+
+  def close(self):
+    """Commits outstanding changes and closes the index."""
+    self.__db.commit()
+    self.__db.close()
+
+  def find_stale_urls(self, url_generations):
+    """Determine which BOMs are not yet indexed at their current generation.
+
+    Args:
+      url_generations: [dict] The current generation keyed by BOM url.
+
+    Returns:
+      Sorted list of the urls that are new or changed.
+    """
+    known = dict(self.__db.execute('SELECT url, generation FROM boms'))
+    return sorted([url for url, generation in url_generations.items()
+                   if url not in known or known[url] != str(generation)])
+
+  def remove_missing_boms(self, url_prefix, existing_urls):
+    """Forget BOMs beginning with url_prefix that are not in existing_urls.
+
+    Returns:
+      The number of BOMs removed.
+    """
+    existing_urls = set(existing_urls)
+    missing = [(url,) for url in self.list_bom_urls(url_prefix)
+               if url not in existing_urls]
+    self.__db.executemany('DELETE FROM bom_services WHERE url = ?', missing)
+    self.__db.executemany('DELETE FROM boms WHERE url = ?', missing)
+    return len(missing)
+
+  def add_bom(self, url, generation, bom_info, services):
+    """Index the services in a BOM, replacing any prior entry for the url.
+
+    Args:
+      url: [string] The url the BOM was read from.
+      generation: [string] The storage generation of the BOM that was read.
+      bom_info: [dict] The bom_version and bom_timestamp identifying the BOM
+         plus any nonstandard artifactSources.
+      services: [dict] The BOM's services entry.
+    """
+    nonstandard = {key: value for key, value in bom_info.items()
+                   if key not in ('bom_version', 'bom_timestamp')}
+    self.__remove_url(url)
+    self.__db.execute(
+        'INSERT INTO boms VALUES (?, ?, ?, ?, ?, NULL)',
+        (url, str(generation), bom_info['bom_version'],
+         bom_info['bom_timestamp'],
+         json.dumps(nonstandard, sort_keys=True) if nonstandard else None))
+
+    rows = []
+    for name, entry in services.items():
+      if name == 'defaultArtifact':
+        continue
+      build_version = entry['version']
+      version, buildnum = self.split_build_version(build_version)
+      rows.append((url, name, version, entry.get('commit', 'NotRecorded'),
+                   buildnum, build_version))
+    self.__db.executemany(
+        'INSERT INTO bom_services VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+  def add_bad_bom(self, url, generation, problem):
+    """Remember a BOM that could not be analyzed, and why."""
+    self.__remove_url(url)
+    self.__db.execute(
+        'INSERT INTO boms VALUES (?, ?, NULL, NULL, NULL, ?)',
+        (url, str(generation), problem))
+
+  def __remove_url(self, url):
+    self.__db.execute('DELETE FROM bom_services WHERE url = ?', (url,))
+    self.__db.execute('DELETE FROM boms WHERE url = ?', (url,))
+
+  @staticmethod
+  def __prefix_clause(url_prefix, column='url'):
+    if not url_prefix:
+      return '', ()
+    return ' AND substr({0}, 1, ?) = ?'.format(column), (len(url_prefix),
+                                                         url_prefix)
+
+  def list_bom_urls(self, url_prefix=None):
+    """Returns the sorted urls of all the indexed BOMs, including bad ones."""
+    clause, params = self.__prefix_clause(url_prefix)
+    return [row[0] for row in self.__db.execute(
+        'SELECT url FROM boms WHERE 1' + clause + ' ORDER BY url', params)]
+
+  def list_bom_versions(self, url_prefix=None):
+    """Returns the set of versions of all the good BOMs."""
+    clause, params = self.__prefix_clause(url_prefix)
+    return set([row[0] for row in self.__db.execute(
+        'SELECT bom_version FROM boms WHERE problem IS NULL' + clause,
+        params)])
+
+  def bad_boms(self, url_prefix=None):
+    """Returns the problem with each bad BOM keyed by BOM name."""
+    clause, params = self.__prefix_clause(url_prefix)
+    return {
+        os.path.splitext(url[url.rfind('/') + 1:])[0]: problem
+        for url, problem in self.__db.execute(
+            'SELECT url, problem FROM boms WHERE problem IS NOT NULL' + clause,
+            params)
+    }
+
+  def nonstandard_boms(self, url_prefix=None):
+    """Returns the nonstandard artifactSources keyed by BOM version."""
+    clause, params = self.__prefix_clause(url_prefix)
+    return {
+        bom_version: json.loads(nonstandard)
+        for bom_version, nonstandard in self.__db.execute(
+            'SELECT bom_version, nonstandard FROM boms'
+            ' WHERE nonstandard IS NOT NULL' + clause,
+            params)
+    }
+
+  def lookup_bom_services(self, url):
+    """Returns the build version of each service in the BOM at url."""
+    return dict(self.__db.execute(
+        'SELECT service, build_version FROM bom_services WHERE url = ?',
+        (url,)))
+
+  def iter_service_rows(self, service=None, url_prefix=None):
+    """Yields a BomServiceRow for each service build in each BOM.
+
+    The rows are ordered by service, version, commit, buildnum then
+    bom_timestamp.
+    """
+    clause, params = self.__prefix_clause(url_prefix, column='s.url')
+    if service is not None:
+      clause += ' AND s.service = ?'
+      params += (service,)
+    cursor = self.__db.execute(
+        'SELECT b.bom_version, b.bom_timestamp, s.service, s.version,'
+        '       s.commit_id, s.buildnum, s.build_version'
+        ' FROM bom_services s JOIN boms b ON s.url = b.url'
+        ' WHERE 1' + clause +
+        ' ORDER BY s.service, s.version, s.commit_id, s.buildnum,'
+        '          b.bom_timestamp, b.bom_version',
+        params)
+    for row in cursor:
+      yield BomServiceRow(*row)
+
+  def to_service_map(self, url_prefix=None):
+    """Returns the inverse mapping of services to the BOMs they are in.
+
+    The result is a dictionary keyed by service, then version, then commit,
+    then buildnum whose values are lists of bom_info dictionaries sorted by
+    bom_timestamp.
+    """
+    nonstandard = self.nonstandard_boms(url_prefix)
+    result = {}
+    for row in self.iter_service_rows(url_prefix=url_prefix):
+      info = {'bom_version': row.bom_version,
+              'bom_timestamp': row.bom_timestamp}
+      info.update(nonstandard.get(row.bom_version, {}))
+      (result.setdefault(row.service, {})
+       .setdefault(row.version, {})
+       .setdefault(row.commit, {})
+       .setdefault(row.buildnum, [])
+       .append(info))
+    return result
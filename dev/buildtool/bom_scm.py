@@ -152,6 +152,12 @@ class BomSourceCodeManager(SpinnakerSourceCodeManager):
     if not have_git_dir:
       self.git.clone_repository_to_path(repository, commit=commit_id)
 
+  def refresh_git_path(self, repository):
+    """Implements SpinnakerSourceCodeManager interface."""
+    service_name = self.repository_name_to_service_name(repository.name)
+    commit_id = check_bom_service(self.__bom, service_name)['commit']
+    return self.git.fetch_and_reset(repository.git_dir, commit=commit_id)
+
   def determine_build_number(self, repository):
     service_name = self.repository_name_to_service_name(repository.name)
     if not service_name in self.__bom['services'].keys():
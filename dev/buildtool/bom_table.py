@@ -0,0 +1,290 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A compact table of which service builds appear in which BOMs."""
+
+from array import array
+
+
+class StringPool(object):
+  """Interns strings as small integer ids."""
+
+  def __init__(self):
+    self.__ids = {}
+    self.__values = []
+
+  def __len__(self):
+    return len(self.__values)
+
+  def __getitem__(self, string_id):
+    return self.__values[string_id]
+
+  def intern(self, value):
+    """Returns the id for value, assigning a new one if needed."""
+    string_id = self.__ids.get(value)
+    if string_id is None:
+      string_id = len(self.__values)
+      self.__ids[value] = string_id
+      self.__values.append(value)
+    return string_id
+
+  def lookup_or_none(self, value):
+    """Returns the id for value or None if it was never interned."""
+    return self.__ids.get(value)
+
+
+class BomServiceTable(object):
+  """An interned, column oriented table of the service builds in BOMs.
+
+  Each row is a (service, version, commit, buildnum, bom, timestamp) where
+  every value is the id of a string in a StringPool. The rows are indexed
+  by service and by bom.
+
+  This holds the same information as the nested service maps written by
+  collect_bom_versions but in a fraction of the memory, and supports
+  selecting and joining rows as sets. Tables returned by select_boms and
+  exclude_builds are read-only views sharing the columns of the table
+  they were derived from.
+  """
+
+  SERVICE, VERSION, COMMIT, BUILDNUM, BOM, TIMESTAMP = range(6)
+
+  def __init__(self):
+    self.__strings = StringPool()
+    self.__nonstandard = {}
+    self.__columns = tuple(array('i') for _ in range(6))
+    self.__rows = None  # All the rows in __columns, otherwise an array.
+    self.__rows_by_service = None
+    self.__rows_by_bom = None
+
+  @staticmethod
+  def from_rows(rows, nonstandard_boms=None):
+    """Creates a table from BomServiceRow.
+
+    Args:
+      rows: [iterable of BomServiceRow] The rows to add.
+      nonstandard_boms: [dict] Nonstandard artifactSources keyed by
+         bom version.
+    """
+    table = BomServiceTable()
+    for row in rows:
+      table.add(row.service, row.version, row.commit, row.buildnum,
+                row.bom_version, row.bom_timestamp)
+    for bom_version, sources in (nonstandard_boms or {}).items():
+      table.__nonstandard[table.__strings.intern(bom_version)] = sources
+    return table
+
+  @staticmethod
+  def from_service_map(service_map):
+    """Creates a table from a nested service map.
+
+    The service map is as written by collect_bom_versions, keyed by service,
+    version, commit, then buildnum, whose values are lists of bom_info.
+    """
+    table = BomServiceTable()
+    for service, versions in service_map.items():
+      for version, commits in (versions or {}).items():
+        for commit, buildnums in commits.items():
+          for buildnum, info_list in buildnums.items():
+            for info in info_list:
+              bom_id = table.add(service, version, commit, buildnum,
+                                 info['bom_version'], info['bom_timestamp'])
+              if len(info) > 2:
+                table.__nonstandard[bom_id] = {
+                    key: value for key, value in info.items()
+                    if key not in ('bom_version', 'bom_timestamp')}
+    return table
+
+  def __len__(self):
+    if self.__rows is None:
+      return len(self.__columns[self.BOM])
+    return len(self.__rows)
+
+  def __iter_rows(self):
+    if self.__rows is None:
+      return iter(range(len(self.__columns[self.BOM])))
+    return iter(self.__rows)
+
+  def add(self, service, version, commit, buildnum,
+          bom_version, bom_timestamp):
+    """Adds a row.
+
+    Returns:
+      The id of the bom_version.
+    """
+    if self.__rows is not None:
+      raise TypeError('Tables derived from another are read-only')
+    intern = self.__strings.intern
+    columns = self.__columns
+    bom_id = intern(bom_version)
+    columns[0].append(intern(service))
+    columns[1].append(intern(version))
+    columns[2].append(intern(commit))
+    columns[3].append(intern(buildnum))
+    columns[4].append(bom_id)
+    columns[5].append(intern(bom_timestamp))
+    self.__rows_by_service = None
+    self.__rows_by_bom = None
+    return bom_id
+
+  def __index(self):
+    """Builds the indexes by service and by bom if needed."""
+    if self.__rows_by_service is not None:
+      return
+    services = self.__columns[self.SERVICE]
+    boms = self.__columns[self.BOM]
+    by_service = {}
+    by_bom = {}
+    for row in self.__iter_rows():
+      rows = by_service.get(services[row])
+      if rows is None:
+        rows = array('i')
+        by_service[services[row]] = rows
+      rows.append(row)
+      rows = by_bom.get(boms[row])
+      if rows is None:
+        rows = array('i')
+        by_bom[boms[row]] = rows
+      rows.append(row)
+    self.__rows_by_service = by_service
+    self.__rows_by_bom = by_bom
+
+  def __derive(self, rows):
+    """Returns a view of the given rows of this table."""
+    table = BomServiceTable()
+    table.__strings = self.__strings
+    table.__nonstandard = self.__nonstandard
+    table.__columns = self.__columns
+    table.__rows = array('i', sorted(rows))
+    return table
+
+  def __build_keys(self, rows):
+    services, versions, commits, buildnums = self.__columns[:4]
+    return set([(services[row], versions[row], commits[row], buildnums[row])
+                for row in rows])
+
+  def build_keys(self):
+    """Returns the set of distinct (service, version, commit, buildnum) ids."""
+    return self.__build_keys(self.__iter_rows())
+
+  def service_names(self):
+    """Returns the set of services referenced by any bom."""
+    self.__index()
+    return set([self.__strings[service_id]
+                for service_id in self.__rows_by_service.keys()])
+
+  def bom_versions(self):
+    """Returns the set of boms in the table."""
+    self.__index()
+    return set([self.__strings[bom_id]
+                for bom_id in self.__rows_by_bom.keys()])
+
+  def has_service(self, service):
+    """Determine if any bom references the service."""
+    self.__index()
+    return self.__strings.lookup_or_none(service) in self.__rows_by_service
+
+  def __service_rows(self, service):
+    self.__index()
+    service_id = self.__strings.lookup_or_none(service)
+    return self.__rows_by_service.get(service_id, [])
+
+  def __builds_to_rows(self, service):
+    """Returns the rows of each distinct (version, buildnum) of a service."""
+    versions = self.__columns[self.VERSION]
+    buildnums = self.__columns[self.BUILDNUM]
+    result = {}
+    for row in self.__service_rows(service):
+      key = (versions[row], buildnums[row])
+      rows = result.get(key)
+      if rows is None:
+        rows = []
+        result[key] = rows
+      rows.append(row)
+    return result
+
+  def __build_version(self, key):
+    return '%s-%s' % (self.__strings[key[0]], self.__strings[key[1]])
+
+  def build_versions(self, service):
+    """Returns the set of "<version>-<buildnum>" for the service."""
+    return set([self.__build_version(key)
+                for key in self.__builds_to_rows(service).keys()])
+
+  def make_bom_info(self, bom_id, timestamp_id):
+    """Returns the bom_info dictionary used by the nested service maps."""
+    info = {'bom_version': self.__strings[bom_id],
+            'bom_timestamp': self.__strings[timestamp_id]}
+    info.update(self.__nonstandard.get(bom_id, {}))
+    return info
+
+  def __make_info_list(self, rows):
+    """Returns the bom_info for each row sorted by timestamp."""
+    strings = self.__strings
+    boms = self.__columns[self.BOM]
+    timestamps = self.__columns[self.TIMESTAMP]
+    ordered = sorted([(strings[timestamps[row]], strings[boms[row]], row)
+                      for row in rows])
+    return [self.make_bom_info(boms[row], timestamps[row])
+            for _, _, row in ordered]
+
+  def service_builds(self, service):
+    """Returns the boms containing each build of a service.
+
+    Returns:
+      A dictionary keyed by "<version>-<buildnum>" of the list of bom_info
+      for the boms containing that build sorted by timestamp.
+    """
+    return {self.__build_version(key): self.__make_info_list(rows)
+            for key, rows in self.__builds_to_rows(service).items()}
+
+  def select_boms(self, predicate):
+    """Returns a view of the rows whose bom_version satisfies predicate."""
+    self.__index()
+    rows = []
+    for bom_id, bom_rows in self.__rows_by_bom.items():
+      if predicate(self.__strings[bom_id]):
+        rows.extend(bom_rows)
+    return self.__derive(rows)
+
+  def exclude_builds(self, other):
+    """Returns a view of the rows whose build does not appear in other.
+
+    Both tables must have been derived from the same table.
+    """
+    if other.__strings is not self.__strings:
+      raise ValueError('Tables do not share a StringPool')
+    exclude = other.build_keys()
+    services, versions, commits, buildnums = self.__columns[:4]
+    return self.__derive([
+        row for row in self.__iter_rows()
+        if (services[row], versions[row], commits[row], buildnums[row])
+        not in exclude])
+
+  def to_service_map(self):
+    """Returns the equivalent nested service map."""
+    strings = self.__strings
+    services, versions, commits, buildnums = self.__columns[:4]
+    grouped = {}
+    for row in self.__iter_rows():
+      key = (services[row], versions[row], commits[row], buildnums[row])
+      grouped.setdefault(key, []).append(row)
+
+    result = {}
+    for key, rows in grouped.items():
+      (result.setdefault(strings[key[0]], {})
+       .setdefault(strings[key[1]], {})
+       .setdefault(strings[key[2]], {})
+       [strings[key[3]]]) = self.__make_info_list(rows)
+    return result
@@ -77,13 +77,9 @@ class BranchSourceCodeManager(SpinnakerSourceCodeManager):
       return self.git.make_ssh_url(origin_hostname, github_owner, name)
     return self.git.make_https_url(origin_hostname, github_owner, name)
 
-  def ensure_git_path(self, repository, **kwargs):
-    branch = kwargs.pop('branch', None)
-    check_kwargs_empty(kwargs)
+  def __determine_branch(self, repository, branch):
+    """Returns the branch to use and the fallback branch, if any."""
     options = self.options
-
-    git_dir = repository.git_dir
-    have_git_dir = os.path.exists(git_dir)
     if not branch:
       if hasattr(options, 'git_branch'):
         branch = options.git_branch
@@ -95,10 +91,31 @@ class BranchSourceCodeManager(SpinnakerSourceCodeManager):
     fallback_branch = (options.git_fallback_branch
                        if hasattr(options, 'git_fallback_branch')
                        else None)
+    return branch, fallback_branch
+
+  def ensure_git_path(self, repository, **kwargs):
+    branch = kwargs.pop('branch', None)
+    check_kwargs_empty(kwargs)
+
+    git_dir = repository.git_dir
+    have_git_dir = os.path.exists(git_dir)
+    branch, fallback_branch = self.__determine_branch(repository, branch)
     if not have_git_dir:
       self.git.clone_repository_to_path(
           repository, branch=branch, default_branch=fallback_branch)
 
+  def refresh_git_path(self, repository):
+    """Implements SpinnakerSourceCodeManager interface."""
+    commit = repository.commit_or_none()
+    if commit is not None:
+      return self.git.fetch_and_reset(repository.git_dir, commit=commit)
+
+    branch, fallback_branch = self.__determine_branch(repository, None)
+    branches = [branch]
+    if fallback_branch:
+      branches.append(fallback_branch)
+    return self.git.fetch_and_reset(repository.git_dir, branches=branches)
+
   def determine_build_number(self, repository):
     if hasattr(self.options, 'build_number') and self.options.build_number:
       build_number = self.options.build_number
@@ -77,7 +77,9 @@ class BuildContainerCommand(GradleCommandProcessor):
     gradle_dir = repository.gradle_dir
     logfile = self.get_logfile_path(name + '-docker-build')
     check_subprocesses_to_logfile(
-        name + ' docker build', logfile, cmds, cwd=gradle_dir)
+        name + ' docker build', logfile, cmds, cwd=gradle_dir,
+        resource_labels={'repository': name,
+                         'context': 'docker', 'target': 'build'})
 
   def __check_gcb_image(self, repository, version):
     """Determine if gcb image already exists."""
@@ -165,7 +167,9 @@ class BuildContainerCommand(GradleCommandProcessor):
     self.metrics.time_call(
         'GcrBuild', labels, self.metrics.default_determine_outcome_labels,
         check_subprocesses_to_logfile,
-        name + ' container build', logfile, [command], cwd=git_dir)
+        name + ' container build', logfile, [command], cwd=git_dir,
+        resource_labels={'repository': repository.name,
+                         'context': 'gcb', 'target': 'container'})
 
   def __make_gradle_gcb_step(self, name, env_vars_list):
     command_sequence = ['git rev-parse HEAD | xargs git checkout']
@@ -0,0 +1,493 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Implements the run_flow command for buildtool.
+
+A flow is a YAML file listing the commands to run as stages of a DAG:
+
+    args:                        # Option overrides for every stage.
+      bom_path: master-unbuilt-bom.yml
+    stages:
+      - command: fetch_source
+        resources: [git]
+      - command: build_bom_containers
+        requires: [fetch_source] # The same repository must finish first.
+        after: [build_bom]       # The entire stage must finish first.
+        resources: [gcloud]
+        args:                    # Option overrides for this stage.
+          ...
+
+Rather than running each command to completion before starting the next
+as flow_build.sh does, each (command, repository) unit is scheduled as soon
+as the units it depends on have finished. The number of units using a
+resource such as git, gradle or gcloud at the same time is limited across
+all the stages by --flow_resource_limits.
+"""
+
+import argparse
+import logging
+import os
+import threading
+import time
+import yaml
+
+from buildtool import (
+    CommandFactory,
+    CommandProcessor,
+    RepositoryCommandProcessor,
+    check_path_exists,
+    raise_and_log_error,
+    ConfigError,
+    ExecutionError,
+    UnexpectedError)
+from buildtool.base_metrics import MetricFamily
+from buildtool.tracing import Tracer
+
+
+class FlowTask(object):
+  """A unit of work run by a FlowScheduler."""
+
+  PENDING = 'PENDING'
+  RUNNING = 'RUNNING'
+  SUCCEEDED = 'SUCCEEDED'
+  FAILED = 'FAILED'
+  SKIPPED = 'SKIPPED'
+
+  def __init__(self, name, func, resources):
+    self.name = name
+    self.func = func
+    self.resources = list(resources)
+    self.requires = []
+    self.state = FlowTask.PENDING
+    self.result = None
+    self.error = None
+
+
+class FlowScheduler(object):
+  """Runs tasks as soon as the tasks they require have succeeded.
+
+  Tasks can add more tasks, or requirements to pending tasks, while they
+  run. A task requiring a task that did not succeed is skipped.
+  """
+
+  def __init__(self, max_concurrency, resource_limits=None):
+    """Constructor.
+
+    Args:
+      max_concurrency: [int] The maximum number of tasks running at a time.
+      resource_limits: [dict] The maximum number of running tasks using
+         a resource keyed by the resource name. Resources that are not
+         listed are not limited.
+    """
+    self.__max_concurrency = max(1, max_concurrency)
+    self.__available = dict(resource_limits or {})
+    self.__condition = threading.Condition()
+    self.__tasks = {}
+    self.__pending = []
+    self.__num_running = 0
+    self.__parent_span = None
+
+  def add_task(self, name, func, requires=None, resources=None):
+    """Adds a task to run once all the required tasks have succeeded.
+
+    Args:
+      name: [string] The unique name of the task.
+      func: [callable] The function to call to run the task.
+      requires: [list of string] The names of existing required tasks.
+      resources: [list of string] The resources used while running.
+    """
+    with self.__condition:
+      if name in self.__tasks:
+        raise_and_log_error(
+            UnexpectedError('Flow task "{name}" already exists.'
+                            .format(name=name)))
+      self.__tasks[name] = FlowTask(name, func, resources or [])
+      self.__pending.append(name)
+      self.add_requirements(name, requires or [])
+
+  def add_requirements(self, name, requires):
+    """Adds more requirements to a task that has not yet started."""
+    with self.__condition:
+      task = self.__tasks[name]
+      if task.state != FlowTask.PENDING:
+        raise_and_log_error(
+            UnexpectedError('Flow task "{name}" is already {state}.'
+                            .format(name=name, state=task.state)))
+      for required in requires:
+        if required not in self.__tasks:
+          raise_and_log_error(
+              UnexpectedError('Flow task "{name}" requires unknown "{req}".'
+                              .format(name=name, req=required)))
+        task.requires.append(required)
+      self.__condition.notify()
+
+  def get_task(self, name):
+    """Returns the FlowTask with the given name."""
+    with self.__condition:
+      return self.__tasks[name]
+
+  def run(self):
+    """Runs tasks until there are none left that can run.
+
+    Returns:
+      A dictionary of the FlowTask keyed by name.
+    """
+    self.__parent_span = Tracer.singleton().current_span()
+    with self.__condition:
+      while True:
+        self.__start_ready_tasks()
+        if self.__num_running == 0:
+          break
+        self.__condition.wait()
+
+      for name in self.__pending:
+        logging.error('Flow task %s could not run.', name)
+        self.__tasks[name].state = FlowTask.SKIPPED
+      self.__pending = []
+      return dict(self.__tasks)
+
+  def __can_acquire(self, task):
+    return all([self.__available.get(resource, 1) > 0
+                for resource in task.resources])
+
+  def __start_ready_tasks(self):
+    """Starts the pending tasks that can run, in the order they were added.
+
+    This is called with the condition held.
+    """
+    still_pending = []
+    skipped = False
+    for name in self.__pending:
+      task = self.__tasks[name]
+      states = [self.__tasks[required].state for required in task.requires]
+      if FlowTask.FAILED in states or FlowTask.SKIPPED in states:
+        logging.warning('Skipping flow task %s because a requirement failed.',
+                        name)
+        task.state = FlowTask.SKIPPED
+        skipped = True
+      elif (self.__num_running < self.__max_concurrency
+            and all([state == FlowTask.SUCCEEDED for state in states])
+            and self.__can_acquire(task)):
+        for resource in task.resources:
+          if resource in self.__available:
+            self.__available[resource] -= 1
+        task.state = FlowTask.RUNNING
+        self.__num_running += 1
+        thread = threading.Thread(
+            name=name, target=self.__run_task, args=[task])
+        thread.daemon = True
+        thread.start()
+      else:
+        still_pending.append(name)
+    self.__pending = still_pending
+    if skipped:
+      # Skipping may have cascaded to tasks earlier in the list.
+      self.__start_ready_tasks()
+
+  def __run_task(self, task):
+    """Runs the task on its own thread."""
+    # pylint: disable=broad-except
+    result = None
+    error = None
+    try:
+      with Tracer.singleton().span(task.name, 'flow',
+                                   parent=self.__parent_span):
+        result = task.func()
+    except BaseException as ex:
+      logging.error('Flow task %s failed: %s', task.name, ex)
+      error = ex
+      if not isinstance(ex, Exception):
+        raise
+    finally:
+      # This must happen even for a BaseException or run() waits forever.
+      with self.__condition:
+        task.result = result
+        task.error = error
+        task.state = FlowTask.SUCCEEDED if error is None else FlowTask.FAILED
+        for resource in task.resources:
+          if resource in self.__available:
+            self.__available[resource] += 1
+        self.__num_running -= 1
+        self.__condition.notify()
+
+
+class FlowStage(object):
+  """A command within a flow."""
+
+  def __init__(self, name, command_name, spec):
+    self.name = name
+    self.command_name = command_name
+    self.requires = spec.get('requires') or []
+    self.after = spec.get('after') or []
+    self.resources = spec.get('resources') or []
+    self.args = spec.get('args') or {}
+    self.command = None
+    self.start_time = None
+    self.finished = False
+    self.unit_by_repository = {}
+
+  @property
+  def start_task(self):
+    return self.name + ':start'
+
+  @property
+  def end_task(self):
+    return self.name + ':end'
+
+  def unit_task(self, repository_name):
+    return '{stage}:{repo}'.format(stage=self.name, repo=repository_name)
+
+
+def schedules_repositories(command):
+  """Determine if run_flow can schedule the command's repositories itself.
+
+  This is the case for RepositoryCommandProcessors that have not overriden
+  the standard _do_command.
+  """
+  if not isinstance(command, RepositoryCommandProcessor):
+    return False
+  get_func = lambda method: getattr(method, '__func__', method)
+  # pylint: disable=protected-access
+  return (get_func(type(command)._do_command)
+          is get_func(RepositoryCommandProcessor._do_command))
+
+
+def parse_resource_limits(text):
+  """Parse a comma-separated list of <resource>=<limit>."""
+  limits = {}
+  for binding in (text or '').split(','):
+    if not binding:
+      continue
+    name, _, value = binding.partition('=')
+    try:
+      limits[name.strip()] = int(value)
+    except ValueError:
+      limits[name.strip()] = 0
+    if limits[name.strip()] < 1:
+      raise_and_log_error(
+          ConfigError('Invalid flow resource limit "{binding}".'
+                      .format(binding=binding)))
+  return limits
+
+
+class RunFlowCommand(CommandProcessor):
+  """Implements the run_flow command."""
+
+  def __init__(self, factory, options):
+    super(RunFlowCommand, self).__init__(factory, options)
+    check_path_exists(options.flow_path, why='flow_path')
+    max_concurrency = 1 if options.one_at_a_time else options.flow_concurrency
+    self.__scheduler = FlowScheduler(
+        max_concurrency, parse_resource_limits(options.flow_resource_limits))
+    with open(options.flow_path, 'r') as stream:
+      flow = yaml.safe_load(stream) or {}
+    self.__flow_args = flow.get('args') or {}
+    self.__stages = self.load_stages(flow.get('stages') or [])
+
+  def load_stages(self, stage_specs):
+    """Returns the list of FlowStage after validating them."""
+    stages = []
+    stage_by_name = {}
+    for spec in stage_specs:
+      command_name = spec.get('command')
+      name = spec.get('name', command_name)
+      if self.factory.registry.get(command_name) is None:
+        raise_and_log_error(
+            ConfigError('Flow stage "{name}" has unknown command "{command}".'
+                        .format(name=name, command=command_name)))
+      if name in stage_by_name:
+        raise_and_log_error(
+            ConfigError('Flow stage "{name}" is not unique.'.format(name=name)))
+      stage = FlowStage(name, command_name, spec)
+      for dependency in stage.requires + stage.after:
+        if dependency not in stage_by_name:
+          raise_and_log_error(
+              ConfigError('Flow stage "{name}" depends on "{dependency}"'
+                          ' which is not an earlier stage.'
+                          .format(name=name, dependency=dependency)))
+      stage_by_name[name] = stage
+      stages.append(stage)
+    return stages
+
+  def make_stage_options(self, stage):
+    """Returns the options for running the stage's command."""
+    args = dict(self.__flow_args)
+    args.update(stage.args)
+    defaults = dict(self.factory.defaults)
+    defaults.update(args)
+
+    parser = argparse.ArgumentParser(prog=stage.command_name)
+    self.factory.registry[stage.command_name].init_argparser(parser, defaults)
+    options = parser.parse_args([])
+    stage_option_names = set(vars(options).keys())
+    for name, value in vars(self.options).items():
+      if name not in stage_option_names:
+        setattr(options, name, value)
+    for name, value in args.items():
+      if name not in stage_option_names:
+        setattr(options, name, value)
+    options.command = stage.command_name
+    return options
+
+  def __start_stage(self, stage, stage_by_name):
+    """Creates the stage's command then schedules its units."""
+    factory = self.factory.registry[stage.command_name]
+    stage.command = factory.make_command(self.make_stage_options(stage))
+    if not schedules_repositories(stage.command):
+      self.__scheduler.add_task(
+          stage.unit_task(stage.command_name), stage.command,
+          resources=stage.resources)
+      self.__scheduler.add_requirements(
+          stage.end_task, [stage.unit_task(stage.command_name)])
+      return
+
+    labels = stage.command.determine_metric_labels()
+    self.metrics.get_metric(
+        MetricFamily.GAUGE, 'RunCommand_InProgress', labels).inc()
+    stage.start_time = time.time()
+
+    # pylint: disable=protected-access
+    stage.command._do_preprocess()
+    command = stage.command
+    for repository in command.source_repositories:
+      unit_name = stage.unit_task(repository.name)
+      requires = []
+      for required_name in stage.requires:
+        required = stage_by_name[required_name]
+        requires.append(required.unit_by_repository.get(
+            repository.name, required.end_task))
+      self.__scheduler.add_task(
+          unit_name,
+          lambda repository=repository: command.process_repository(repository),
+          requires=requires, resources=stage.resources)
+      stage.unit_by_repository[repository.name] = unit_name
+    self.__scheduler.add_requirements(
+        stage.end_task, list(stage.unit_by_repository.values()))
+
+  def __end_stage(self, stage):
+    """Postprocesses the stage's units."""
+    if stage.start_time is None:
+      return self.__scheduler.get_task(
+          stage.unit_task(stage.command_name)).result
+
+    result_dict = {
+        name: self.__scheduler.get_task(unit_name).result
+        for name, unit_name in stage.unit_by_repository.items()}
+    exception_type = ''
+    try:
+      # pylint: disable=protected-access
+      return stage.command._do_postprocess(result_dict)
+    except Exception as ex:
+      exception_type = ex.__class__.__name__
+      raise
+    finally:
+      self.__finish_stage(stage, exception_type)
+
+  def __finish_stage(self, stage, exception_type):
+    """Records the RunCommand metrics for stages with scheduled units.
+
+    These are the same metrics CommandProcessor.__call__ records.
+    """
+    stage.finished = True
+    labels = stage.command.determine_metric_labels()
+    self.metrics.get_metric(
+        MetricFamily.GAUGE, 'RunCommand_InProgress', labels).dec()
+    labels.update({
+        'success': not exception_type,
+        'exception_type': exception_type
+    })
+    self.metrics.observe_timer(
+        'RunCommand_Outcome', labels, time.time() - stage.start_time)
+
+  def _do_command(self):
+    """Implements CommandProcessor interface."""
+    scheduler = self.__scheduler
+    stage_by_name = {}
+    for stage in self.__stages:
+      stage_by_name[stage.name] = stage
+      requires = ([stage_by_name[name].start_task for name in stage.requires]
+                  + [stage_by_name[name].end_task for name in stage.after])
+      scheduler.add_task(
+          stage.start_task,
+          lambda stage=stage: self.__start_stage(stage, stage_by_name),
+          requires=requires)
+      scheduler.add_task(
+          stage.end_task, lambda stage=stage: self.__end_stage(stage),
+          requires=[stage.start_task])
+
+    tasks = scheduler.run()
+    failed = []
+    for stage in self.__stages:
+      if stage.start_time is not None and not stage.finished:
+        errors = [task.error for name, task in sorted(tasks.items())
+                  if name.startswith(stage.name + ':') and task.error]
+        self.__finish_stage(
+            stage, errors[0].__class__.__name__ if errors else 'Skipped')
+      state = tasks[stage.end_task].state
+      logging.info('Flow stage %s %s', stage.name, state)
+      if state != FlowTask.SUCCEEDED:
+        failed.append(stage.name)
+
+    if failed:
+      raise_and_log_error(
+          ExecutionError('Flow stages did not succeed: {stages}'
+                         .format(stages=', '.join(failed))))
+    return {stage.name: tasks[stage.end_task].result
+            for stage in self.__stages}
+
+
+class RunFlowFactory(CommandFactory):
+  """Runs a DAG of commands, scheduling each repository independently."""
+
+  @property
+  def registry(self):
+    """The registry of all the commands the flow can run."""
+    return self.__registry
+
+  @property
+  def defaults(self):
+    """The default option values the commands were registered with."""
+    return self.__defaults
+
+  def __init__(self):
+    super(RunFlowFactory, self).__init__(
+        'run_flow', RunFlowCommand,
+        'Run a DAG of commands, starting each repository of a command as soon'
+        ' as the repositories it depends on are ready.')
+    self.__registry = {}
+    self.__defaults = {}
+
+  def register(self, registry, subparsers, defaults):
+    """Keeps the registry so the flow can run the other commands in it."""
+    super(RunFlowFactory, self).register(registry, subparsers, defaults)
+    self.__registry = registry
+    self.__defaults = defaults
+
+  def init_argparser(self, parser, defaults):
+    super(RunFlowFactory, self).init_argparser(parser, defaults)
+    self.add_argument(
+        parser, 'flow_path', defaults,
+        os.path.join(os.path.dirname(__file__), 'build_flow.yml'),
+        help='The path to the YAML file specifying the flow to run.')
+    self.add_argument(
+        parser, 'flow_concurrency', defaults, 16, type=int,
+        help='The maximum number of units to run at the same time.')
+    self.add_argument(
+        parser, 'flow_resource_limits', defaults, 'gcloud=8,git=16,gradle=4',
+        help='A comma-separated list of <resource>=<limit> for the maximum'
+             ' number of units that can use each resource at the same time.')
+
+
+def register_commands(registry, subparsers, defaults):
+  RunFlowFactory().register(registry, subparsers, defaults)
@@ -18,31 +18,54 @@
 
 # pylint: disable=logging-format-interpolation
 
+import atexit
+import binascii
 import collections
+import contextlib
+import fcntl
+import fnmatch
+import hashlib
 import logging
 import os
 import re
+import shutil
+import subprocess
 import tempfile
+import threading
 import time
 
-# pylint: disable=no-name-in-module
-# pylint: disable=import-error
-from distutils.version import LooseVersion
 import yaml
 
+from buildtool.metrics import MetricsManager
 from buildtool import (
     add_parser_argument,
     check_kwargs_empty,
     check_subprocess,
+    check_subprocess_async,
+    check_subprocess_lines,
     ensure_dir_exists,
     log_embedded_output,
     run_subprocess,
+    run_subprocess_async,
+    start_subprocess,
+    wait_subprocess,
     raise_and_log_error,
+    write_to_path,
     ConfigError,
     ExecutionError,
     UnexpectedError)
 
 
+def loose_version(vstring):
+  """Returns a distutils LooseVersion for comparing version strings."""
+  # Imported here because distutils is slow to import and most commands
+  # never compare tags, so this would dominate their startup time.
+  # pylint: disable=no-name-in-module
+  # pylint: disable=import-error
+  from distutils.version import LooseVersion
+  return LooseVersion(vstring)
+
+
 class GitRepositorySpec(object):
   """A reference to a git repository with local and origin locations.
 
@@ -274,7 +297,7 @@ class CommitTag(
     line_id = tokens[0]
     tag_parts = tokens[1].split('/')
     tag = tag_parts[len(tag_parts) - 1]
-    version = LooseVersion(tag)
+    version = loose_version(tag)
     return CommitTag(line_id, tag, version)
 
   @staticmethod
@@ -348,11 +371,31 @@ class CommitMessage(
     Args:
       response_text: [string] result of "git log --pretty=medium"
     """
-    all_entries = ('\n' + response_text.strip()).split('\ncommit ')[1:]
-    response = []
-    for entry in all_entries:
-      response.append(CommitMessage.make(entry))
-    return response
+    return list(CommitMessage.iter_from_lines(
+        response_text.strip().split('\n')))
+
+  @staticmethod
+  def iter_from_lines(lines):
+    """Yields a CommitMessage for each entry as its lines are consumed.
+
+    This only holds onto the lines of the current entry so can be used to
+    process very long histories directly from the git subprocess pipe.
+
+    Args:
+      lines: [iterable of string] The lines of "git log --pretty=medium"
+         with or without their trailing newlines.
+    """
+    entry_lines = None
+    for line in lines:
+      line = line.rstrip('\n')
+      if line.startswith('commit '):
+        if entry_lines is not None:
+          yield CommitMessage.make('\n'.join(entry_lines) + '\n')
+        entry_lines = [line[len('commit '):]]
+      elif entry_lines is not None:
+        entry_lines.append(line)
+    if entry_lines is not None:
+      yield CommitMessage.make('\n'.join(entry_lines) + '\n')
 
   @staticmethod
   def make(entry):
@@ -427,8 +470,7 @@ class CommitMessage(
         if text_before.strip():
           logging.info('Dropping commit message "%s" in favor of "%s"',
                        text_before, '\n'.join(pruned_lines))
-        result.extend(
-            CommitMessage.make_list_from_result('\n'.join(pruned_lines)))
+        result.extend(CommitMessage.iter_from_lines(pruned_lines))
     return result
 
   @staticmethod
@@ -591,16 +633,20 @@ class RepositorySummary(collections.namedtuple(
                   prev=self.prev_version, current=self.version)))
     return True
 
-  def to_yaml(self, with_commit_messages=True):
-    """Convert the summary to a yaml string."""
+  def to_dict(self, with_commit_messages=True):
+    """Convert the summary to a dictionary suitable for from_dict."""
     data = dict(self._asdict())
     if with_commit_messages:
       data['commit_messages'] = [dict(m._asdict())
                                  for m in data['commit_messages']]
     else:
       del data['commit_messages']
+    return data
 
-    return yaml.safe_dump(data, default_flow_style=False)
+  def to_yaml(self, with_commit_messages=True):
+    """Convert the summary to a yaml string."""
+    return yaml.safe_dump(self.to_dict(with_commit_messages),
+                          default_flow_style=False)
 
   def _asdict(self):
     """Override broken method in some Python3
@@ -616,11 +662,698 @@ class RepositorySummary(collections.namedtuple(
     ])
 
 
+class GitCommitGraph(object):
+  """An in-memory snapshot of a repository's refs and commit ancestry.
+
+  This is loaded with a couple of bulk git calls so that questions normally
+  answered by "git describe", "git merge-base", "git branch --contains" and
+  "git rev-list -n 1" can be answered without forking a process per question.
+
+  In a shallow clone the history stops at the shallow commits. Queries whose
+  answer could be different with the history beyond them set missing_history
+  so the caller can deepen the clone and ask again.
+  """
+
+  @staticmethod
+  def make_from_result(refs_text, history_text, shallow_text=''):
+    """Create a new instance from the raw git responses.
+
+    Args:
+      refs_text: [string] Result of "git show-ref --head -d"
+      history_text: [string] Result of "git rev-list --parents --timestamp --all"
+      shallow_text: [string] Content of the repository's .git/shallow file.
+    """
+    ref_to_commit = {}
+    for line in refs_text.split('\n'):
+      if not line:
+        continue
+      commit_id, ref = line.split(' ', 1)
+      if ref.endswith('^{}'):
+        # Annotated tags are followed by their dereferenced commit.
+        ref = ref[:-3]
+      ref_to_commit[ref] = commit_id
+
+    parents = {}
+    timestamps = {}
+    for line in history_text.split('\n'):
+      if not line:
+        continue
+      tokens = line.split(' ')
+      commit_id = tokens[1]
+      timestamps[commit_id] = int(tokens[0])
+      parents[commit_id] = tuple(tokens[2:])
+
+    shallow_commits = set([line for line in shallow_text.split('\n') if line])
+    return GitCommitGraph(ref_to_commit, parents, timestamps,
+                          shallow_commits=shallow_commits)
+
+  @property
+  def head_commit(self):
+    """The commit id at HEAD, if known."""
+    return self.__ref_to_commit.get('HEAD')
+
+  @property
+  def shallow_commits(self):
+    """The commits whose parents were not fetched into a shallow clone."""
+    return self.__shallow_commits
+
+  @property
+  def missing_history(self):
+    """True if an earlier answer may depend on history beyond a shallow commit.
+    """
+    return self.__missing_history
+
+  def __init__(self, ref_to_commit, parents, timestamps, shallow_commits=None):
+    """Constructor.
+
+    Args:
+      ref_to_commit: [dict] Fully qualified ref name to the commit id it is at.
+      parents: [dict] Commit id to the tuple of its parent commit ids.
+      timestamps: [dict] Commit id to its commit timestamp.
+      shallow_commits: [set] The commits whose parents are missing because
+          the repository is a shallow clone.
+    """
+    self.__ref_to_commit = ref_to_commit
+    self.__parents = parents
+    self.__timestamps = timestamps
+    self.__shallow_commits = shallow_commits or set([])
+    self.__missing_history = False
+    self.__ancestors = {}
+    self.__children = None
+    self.__commit_to_tags = {}
+    for ref, commit_id in ref_to_commit.items():
+      if ref.startswith('refs/tags/'):
+        self.__commit_to_tags.setdefault(commit_id, []).append(
+            ref[len('refs/tags/'):])
+
+  def commit_tags(self, tag_pattern):
+    """Returns the list of CommitTag matching the pattern, most recent first."""
+    matcher = re.compile(tag_pattern)
+    result = [CommitTag(commit_id, ref[len('refs/tags/'):],
+                        loose_version(ref[len('refs/tags/'):]))
+              for ref, commit_id in self.__ref_to_commit.items()
+              if ref.startswith('refs/tags/')
+              and matcher.match(ref[len('refs/tags/'):])]
+    return sorted(result, reverse=True)
+
+  def tag_commit_or_none(self, tag):
+    """Returns the commit a tag refers to, or None if the tag is not known."""
+    return self.__ref_to_commit.get('refs/tags/' + tag)
+
+  def ref_commit_or_none(self, name):
+    """Returns the commit id the named ref is at in "git show-ref" semantics.
+
+    That is, the first ref in sorted order that either is the name
+    or ends with a '/name' component.
+    """
+    found = sorted([ref for ref in self.__ref_to_commit.keys()
+                    if ref == name or ref.endswith('/' + name)])
+    return self.__ref_to_commit[found[0]] if found else None
+
+  def __note_shallow(self, commits):
+    """Notes if any of the commits are missing their history."""
+    if self.__shallow_commits and not self.__shallow_commits.isdisjoint(
+        commits):
+      self.__missing_history = True
+
+  def root_commits(self, commit_id):
+    """Returns the commits without parents that are ancestors of commit_id."""
+    result = sorted([ancestor for ancestor in self.ancestors(commit_id)
+                     if not self.__parents.get(ancestor)])
+    self.__note_shallow(result)
+    return result
+
+  def ancestors(self, commit_id):
+    """Returns the set of commits reachable from commit_id, including itself."""
+    result = self.__ancestors.get(commit_id)
+    if result is not None:
+      return result
+
+    result = set([])
+    remaining = [commit_id]
+    while remaining:
+      commit = remaining.pop()
+      if commit in result:
+        continue
+      result.add(commit)
+      remaining.extend(self.__parents.get(commit, ()))
+    self.__ancestors[commit_id] = result
+    return result
+
+  def is_ancestor(self, ancestor_id, commit_id):
+    """Determine if ancestor_id is reachable from commit_id."""
+    ancestors = self.ancestors(commit_id)
+    if ancestor_id in ancestors:
+      return True
+
+    # Commits before ancestor_id could not have led to it, so only the
+    # shallow commits made since then could be hiding it.
+    if self.__shallow_commits:
+      since = self.__timestamps.get(ancestor_id, 0)
+      self.__note_shallow([commit for commit in self.__shallow_commits
+                           if commit in ancestors
+                           and self.__timestamps.get(commit, 0) >= since])
+    return False
+
+  def remote_branches_containing(self, commit_id, remote_name='origin'):
+    """Returns the remote branch names whose history contains the commit.
+
+    The names are in the form "<remote>/<branch>" as in "git branch -r".
+    """
+    prefix = 'refs/remotes/%s/' % remote_name
+    return sorted([ref[len('refs/remotes/'):]
+                   for ref, tip in self.__ref_to_commit.items()
+                   if ref.startswith(prefix) and not ref.endswith('/HEAD')
+                   and self.is_ancestor(commit_id, tip)])
+
+  def merge_base(self, first_id, second_id):
+    """Returns the best common ancestor of two commits, or None if unrelated.
+
+    If there are multiple equally good common ancestors then the most recent
+    one is returned.
+    """
+    common = self.ancestors(first_id) & self.ancestors(second_id)
+    if not common:
+      self.__note_shallow(self.ancestors(first_id) | self.ancestors(second_id))
+      return None
+    if self.__children is None:
+      self.__children = {}
+      for commit, parent_ids in self.__parents.items():
+        for parent in parent_ids:
+          self.__children.setdefault(parent, []).append(commit)
+
+    best = [commit for commit in common
+            if not any(child in common
+                       for child in self.__children.get(commit, ()))]
+    result = max(best, key=lambda commit: (self.__timestamps.get(commit, 0),
+                                           commit))
+
+    # A better common ancestor would be a descendant of result, so could
+    # only be hidden behind a shallow commit that is not an ancestor of it.
+    if self.__shallow_commits:
+      self.__note_shallow(
+          (self.ancestors(first_id) | self.ancestors(second_id))
+          - self.ancestors(result))
+    return result
+
+  def describe_tag(self, commit_id, tag_pattern):
+    """Returns the closest tag reachable from commit_id, or None.
+
+    This is the same tag "git describe --abbrev=0 --tags --match" would find,
+    which is the tag with the fewest commits between it and commit_id.
+
+    Args:
+      commit_id: [string] The commit to search back from.
+      tag_pattern: [string] A glob that acceptable tags must match.
+    """
+    def matching_tags(commit):
+      return [tag for tag in self.__commit_to_tags.get(commit, [])
+              if fnmatch.fnmatchcase(tag, tag_pattern)]
+
+    # Find the nearest tagged commits along each path. Tags behind another
+    # tag are ancestors of it, so cannot be closer than the one in front.
+    candidates = []
+    visited = set([])
+    remaining = [commit_id]
+    while remaining:
+      commit = remaining.pop()
+      if commit in visited:
+        continue
+      visited.add(commit)
+      if matching_tags(commit):
+        candidates.append(commit)
+        continue
+      if commit in self.__shallow_commits:
+        self.__missing_history = True
+      remaining.extend(self.__parents.get(commit, ()))
+
+    if not candidates:
+      return None
+    if len(candidates) > 1:
+      # The distances compared below are only known with the full history.
+      for commit in candidates:
+        self.__note_shallow(self.ancestors(commit))
+
+    # The closest is the one leaving the fewest commits on top of it,
+    # which is the one with the most ancestors of its own.
+    best = max(candidates,
+               key=lambda commit: (len(self.ancestors(commit)),
+                                   self.__timestamps.get(commit, 0)))
+    return max(matching_tags(best), key=loose_version)
+
+
+class RepositorySummaryCache(object):
+  """A content-addressed directory of previously computed RepositorySummary.
+
+  Entries are keyed by everything the summary is derived from, so an entry
+  is valid for as long as it exists. The directory can be shared among
+  concurrent processes. Entries are written atomically and the least recently
+  used ones are evicted once there are more than max_entries.
+  """
+
+  # The refs whose state the summary depends on, in "git show-ref" form.
+  __KEY_REF_MATCHER = re.compile(
+      r'^[0-9a-f]+ (?:HEAD'
+      r'|refs/tags/version-[^ ]+'
+      r'|refs/heads/master'
+      r'|refs/remotes/origin/(?:master|release-[^ ]+))$')
+
+  @property
+  def cache_dir(self):
+    """The directory containing the cache entries."""
+    return self.__cache_dir
+
+  def __init__(self, cache_dir, max_entries=1000):
+    self.__cache_dir = cache_dir
+    self.__max_entries = max_entries
+
+  def make_key(self, repository_name, refs_text, base_commit_id=None):
+    """Returns the cache key for a repository summary.
+
+    Args:
+      repository_name: [string] The name of the repository being summarized.
+      refs_text: [string] The result of "git show-ref --head -d"
+      base_commit_id: [string] The base_commit_id the summary is relative to.
+    """
+    key_refs = sorted([line for line in refs_text.split('\n')
+                       if self.__KEY_REF_MATCHER.match(line)])
+    text = '\n'.join([repository_name, base_commit_id or ''] + key_refs)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+  def __key_to_path(self, key):
+    return os.path.join(self.__cache_dir, key + '.yml')
+
+  def lookup_or_none(self, key):
+    """Returns the cached RepositorySummary for the key, or None if missing."""
+    path = self.__key_to_path(key)
+    try:
+      with open(path, 'r') as stream:
+        content = yaml.safe_load(stream.read())
+      # Mark as recently used for the purposes of eviction.
+      os.utime(path, None)
+    except (IOError, OSError):
+      return None
+    return RepositorySummary.from_dict(content)
+
+  def store(self, key, summary):
+    """Adds the summary to the cache, evicting older entries if needed."""
+    ensure_dir_exists(self.__cache_dir)
+    path = self.__key_to_path(key)
+
+    # Use intermediate temp file so concurrent readers never see partial data.
+    # It is unique so that concurrent writers in this process do not collide.
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(path) + '.', suffix='.tmp',
+        dir=self.__cache_dir)
+    os.close(fd)
+    try:
+      write_to_path(summary.to_yaml(), tmp_path)
+      os.rename(tmp_path, path)
+    except:
+      os.remove(tmp_path)
+      raise
+    self.evict()
+
+  def evict(self):
+    """Removes the least recently used entries beyond max_entries."""
+    entries = []
+    for name in os.listdir(self.__cache_dir):
+      if not name.endswith('.yml'):
+        continue
+      path = os.path.join(self.__cache_dir, name)
+      try:
+        entries.append((os.path.getmtime(path), path))
+      except OSError:
+        pass  # Another process evicted it already.
+
+    if len(entries) <= self.__max_entries:
+      return
+
+    entries.sort()
+    for _, path in entries[:len(entries) - self.__max_entries]:
+      logging.debug('Evicting cached repository summary %s', path)
+      try:
+        os.remove(path)
+      except OSError:
+        pass  # Another process evicted it already.
+
+
+class GitMirrorCache(object):
+  """A directory of bare mirrors of remote repositories.
+
+  Each remote is mirrored once and refreshed with a single fetch the first
+  time this process needs it. Working trees are then cloned from the mirror
+  with --shared, so they borrow its objects through alternates rather than
+  fetching them over the network again.
+
+  The directory can be shared among concurrent processes. A mirror is only
+  created or fetched while holding an exclusive lock on it, and cloned from
+  while holding a shared lock. Unreachable objects are never pruned from the
+  mirrors because the working trees refer to them through alternates.
+  """
+
+  # The mirrors this process has already refreshed, shared by all instances.
+  __refreshed_paths = set([])
+  __refresh_locks = {}
+  __refresh_locks_mutex = threading.Lock()
+
+  @property
+  def mirror_dir(self):
+    """The directory containing the mirrors."""
+    return self.__mirror_dir
+
+  def __init__(self, mirror_dir, git_runner):
+    self.__mirror_dir = os.path.abspath(mirror_dir)
+    self.__git = git_runner
+
+  def mirror_path(self, url):
+    """Returns the path of the mirror for the remote url."""
+    name = url.rstrip('/').split('/')[-1].split(':')[-1]
+    if name.endswith('.git'):
+      name = name[:-len('.git')]
+    digest = hashlib.sha256(url.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(self.__mirror_dir,
+                        '{name}-{digest}.git'.format(name=name, digest=digest))
+
+  @contextlib.contextmanager
+  def lock(self, mirror_path, exclusive):
+    """Holds a file lock on the mirror for the duration of the block.
+
+    Args:
+      mirror_path: [string] The mirror to lock.
+      exclusive: [bool] True to modify the mirror, False to read from it.
+    """
+    ensure_dir_exists(self.__mirror_dir)
+    with open(mirror_path + '.lock', 'a') as stream:
+      fcntl.flock(stream.fileno(),
+                  fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+      try:
+        yield mirror_path
+      finally:
+        fcntl.flock(stream.fileno(), fcntl.LOCK_UN)
+
+  def refresh(self, url):
+    """Creates or fetches the mirror of url unless already done.
+
+    Returns:
+      The path to the mirror.
+    """
+    mirror_path = self.mirror_path(url)
+    with GitMirrorCache.__refresh_locks_mutex:
+      refresh_lock = GitMirrorCache.__refresh_locks.setdefault(
+          mirror_path, threading.Lock())
+
+    with refresh_lock:
+      if mirror_path in GitMirrorCache.__refreshed_paths:
+        return mirror_path
+      with self.lock(mirror_path, exclusive=True):
+        if os.path.exists(mirror_path):
+          logging.debug('Refreshing mirror of %s in %s', url, mirror_path)
+          self.__git.check_run(mirror_path, 'fetch --prune --quiet origin')
+        else:
+          self.__create(url, mirror_path)
+      GitMirrorCache.__refreshed_paths.add(mirror_path)
+    return mirror_path
+
+  def __create(self, url, mirror_path):
+    logging.info('Creating mirror of %s in %s', url, mirror_path)
+    tmp_path = tempfile.mkdtemp(
+        prefix=os.path.basename(mirror_path) + '.', suffix='.tmp',
+        dir=self.__mirror_dir)
+    try:
+      self.__git.check_run(
+          self.__mirror_dir,
+          'clone --mirror --quiet {url} "{path}"'.format(
+              url=url, path=tmp_path))
+      self.__git.check_run(tmp_path, 'config gc.pruneExpire never')
+      os.rename(tmp_path, mirror_path)
+    except:
+      shutil.rmtree(tmp_path, ignore_errors=True)
+      raise
+
+
+def directory_bytes(path):
+  """Returns the total size of the files under path."""
+  total = 0
+  for dirpath, _, filenames in os.walk(path):
+    for name in filenames:
+      try:
+        total += os.path.getsize(os.path.join(dirpath, name))
+      except OSError:
+        pass  # Removed by git while we were walking.
+  return total
+
+
+class GitObject(
+    collections.namedtuple('GitObject',
+                           ['object_id', 'object_type', 'size', 'content'])):
+  """An object read by GitObjectReader.
+
+  The content is None when only the object's type and size were asked for.
+  """
+
+
+class GitTreeEntry(
+    collections.namedtuple('GitTreeEntry', ['mode', 'name', 'object_id'])):
+  """An entry in a tree object.
+
+  The mode is the octal string git records, such as "100644" for a file,
+  "100755" for an executable file, "120000" for a symbolic link and "40000"
+  for a directory.
+  """
+
+  @property
+  def is_blob(self):
+    """Whether this is a regular or executable file."""
+    return self.mode in ('100644', '100755')
+
+  @property
+  def is_tree(self):
+    """Whether this is a directory."""
+    return self.mode == '40000'
+
+  @staticmethod
+  def make_list(tree_id, content):
+    """Create the entries from the raw content of a tree object.
+
+    Each entry is "<mode> <name>" and a NUL followed by the binary object id,
+    which is as long as the hex tree_id encodes.
+    """
+    id_bytes = len(tree_id) // 2
+    result = []
+    offset = 0
+    while offset < len(content):
+      end = content.index(b'\0', offset)
+      mode, _, name = content[offset:end].decode('utf-8').partition(' ')
+      object_id = binascii.hexlify(content[end + 1:end + 1 + id_bytes])
+      result.append(GitTreeEntry(mode, name, object_id.decode('ascii')))
+      offset = end + 1 + id_bytes
+    return result
+
+
+class GitCommitObject(
+    collections.namedtuple('GitCommitObject',
+                           ['commit_id', 'tree_id', 'parent_ids',
+                            'author', 'committer', 'message'])):
+  """The headers and message of a commit object."""
+
+  @staticmethod
+  def make(commit_id, content):
+    """Create a new instance from the raw content of a commit object."""
+    header_text, _, message = content.partition('\n\n')
+    headers = {}
+    parent_ids = []
+    for line in header_text.split('\n'):
+      if line.startswith(' '):
+        continue  # Continues a multi-line header such as gpgsig.
+      name, _, value = line.partition(' ')
+      if name == 'parent':
+        parent_ids.append(value)
+      else:
+        headers[name] = value
+    return GitCommitObject(commit_id, headers.get('tree'), tuple(parent_ids),
+                           headers.get('author'), headers.get('committer'),
+                           message)
+
+
+class GitObjectReader(object):
+  """Reads objects through long-lived "git cat-file" processes.
+
+  Each request is written as a line to the process and the answer read back,
+  so repeated lookups in the same repository do not each spawn git.
+  A "--batch-check" process answers the type and size of objects and a
+  "--batch" process also returns their content. Each is started when first
+  needed and kept until close().
+
+  Objects can be named by anything "git rev-parse" accepts for a single
+  object, such as "HEAD", "refs/tags/<tag>^{commit}" or "<commit>:<path>".
+  """
+
+  @property
+  def git_dir(self):
+    """The repository objects are read from."""
+    return self.__git_dir
+
+  def __init__(self, git_dir, start_hook=None):
+    """Constructor.
+
+    Args:
+      git_dir: [path] The repository to read from.
+      start_hook: [callable] If provided, called with the git command
+         before starting each process.
+    """
+    self.__git_dir = git_dir
+    self.__start_hook = start_hook
+    self.__mutex = threading.Lock()
+    self.__processes = {}  # Keyed by the cat-file batch option.
+
+  def __get_process(self, option):
+    process = self.__processes.get(option)
+    if process is not None and process.poll() is None:
+      return process
+
+    command = 'cat-file ' + option
+    if self.__start_hook:
+      self.__start_hook(command)
+    with open(os.devnull, 'w') as devnull:
+      process = start_subprocess(
+          'git -C "{dir}" {command}'.format(dir=self.__git_dir,
+                                            command=command),
+          stdin=subprocess.PIPE, stderr=devnull)
+    self.__processes[option] = process
+    return process
+
+  def __request(self, option, name):
+    if '\n' in name:
+      raise_and_log_error(
+          ConfigError('Object name {0!r} contains a newline'.format(name)))
+
+    with self.__mutex:
+      process = self.__get_process(option)
+      try:
+        process.stdin.write(name.encode('utf-8') + b'\n')
+        process.stdin.flush()
+        header = process.stdout.readline().decode('utf-8')
+      except (IOError, OSError):
+        header = ''
+      if not header:
+        self.__stop(option)
+        raise_and_log_error(
+            ExecutionError('git cat-file {option} failed in {dir}'.format(
+                option=option, dir=self.__git_dir), program='git'))
+
+      header = header.rstrip('\n')
+      if header.endswith(' missing') or header.endswith(' ambiguous'):
+        return None
+      object_id, object_type, size = header.split(' ')
+      content = None
+      if option == '--batch':
+        content = process.stdout.read(int(size))
+        process.stdout.read(1)  # The newline terminating the content.
+      return GitObject(object_id, object_type, int(size), content)
+
+  def lookup_or_none(self, name):
+    """Returns the GitObject without content for name, or None if unknown."""
+    return self.__request('--batch-check', name)
+
+  def read_or_none(self, name):
+    """Returns the GitObject with its bytes content, or None if unknown."""
+    return self.__request('--batch', name)
+
+  def __stop(self, option):
+    process = self.__processes.pop(option, None)
+    if process is None:
+      return
+    try:
+      process.stdin.close()
+    except (IOError, OSError):
+      pass  # It already exited.
+    wait_subprocess(process)
+    process.stdout.close()
+
+  def close(self):
+    """Stops the processes. The reader restarts them if used again."""
+    with self.__mutex:
+      for option in list(self.__processes.keys()):
+        self.__stop(option)
+
+
+class GitRefTransaction(object):
+  """A set of ref changes for GitRunner.commit_ref_transaction.
+
+  The changes are applied together by a single "git update-ref --stdin"
+  so either all of them are made or none are, and the cost does not depend
+  on how many refs change.
+
+  Refs are fully qualified, such as "refs/tags/<tag>". Values can be
+  anything git accepts as an object name, such as "HEAD". A later change to
+  the same ref replaces the earlier one.
+  """
+
+  @property
+  def refs(self):
+    """The refs being changed, in the order they were added."""
+    return list(self.__changes.keys())
+
+  def __init__(self):
+    self.__changes = collections.OrderedDict()  # ref to (verb, new, old)
+
+  def __len__(self):
+    return len(self.__changes)
+
+  def create(self, ref, new_value):
+    """Adds the ref, failing the transaction if it already exists.
+
+    If the ref is also being deleted then it is moved instead.
+    """
+    verb = ('update' if self.__changes.get(ref, (None,))[0] == 'delete'
+            else 'create')
+    self.__changes[ref] = (verb, new_value, None)
+
+  def update(self, ref, new_value, old_value=None):
+    """Sets the ref, failing the transaction if it is not at old_value."""
+    self.__changes[ref] = ('update', new_value, old_value)
+
+  def delete(self, ref, old_value=None):
+    """Removes the ref, failing the transaction if it is not at old_value."""
+    self.__changes[ref] = ('delete', None, old_value)
+
+  def to_stdin_text(self):
+    """Returns the "git update-ref --stdin" input making the changes."""
+    lines = []
+    for ref, (verb, new_value, old_value) in self.__changes.items():
+      args = [verb, ref]
+      if verb != 'delete':
+        args.append(new_value)
+      if old_value:
+        args.append(old_value)
+      lines.append(' '.join(args) + '\n')
+    return ''.join(lines)
+
+
 class GitRunner(object):
   """Helper class for interacting with Git"""
 
   __GITHUB_TOKEN = None
 
+  # The GitObjectReader for each repository, shared by all instances.
+  __object_readers = {}
+  __object_readers_mutex = threading.Lock()
+  __object_readers_registered_atexit = False
+
+  # The "git clone" arguments for each --git_clone_strategy.
+  # Shallow clones still fetch every branch and tag tip so that they are
+  # known to the commit graph, just not their history.
+  CLONE_STRATEGY_FLAGS = collections.OrderedDict([
+      ('full', ''),
+      ('blobless', ' --filter=blob:none'),
+      ('shallow', ' --depth 1 --no-single-branch'),
+  ])
+
+  # The successive "git fetch --deepen" amounts to try before giving up
+  # and fetching all the remaining history of a shallow clone.
+  HISTORY_DEEPEN_STEPS = [100, 1000]
+
   @staticmethod
   def add_parser_args(parser, defaults):
     """Add standard parser options used by GitRunner."""
@@ -655,6 +1388,33 @@ class GitRunner(object):
         help='If True then do not require a baseline tag when searching back'
              ' from a commit to the previous version. Normally this would not'
              ' be allowed.')
+    add_parser_argument(
+        parser, 'summary_cache', defaults, None,
+        help='If set, a directory in which to cache repository summaries'
+             ' so they need not be recomputed if the repository HEAD and'
+             ' version tags have not changed. This can be shared among'
+             ' commands and concurrent processes.')
+    add_parser_argument(
+        parser, 'summary_cache_max_entries', defaults, 1000, type=int,
+        help='The maximum number of entries to keep in the --summary_cache'
+             ' before evicting the least recently used ones.')
+    add_parser_argument(
+        parser, 'git_mirror_dir', defaults, None,
+        help='If set, a directory in which to keep a bare mirror of each'
+             ' repository cloned. The mirror is refreshed once per command'
+             ' and new clones share its objects rather than fetching them'
+             ' again. This can be shared among commands and concurrent'
+             ' processes. The clones depend on the mirror so it should'
+             ' not be removed while they are in use.')
+    add_parser_argument(
+        parser, 'git_clone_strategy', defaults, 'full',
+        choices=list(GitRunner.CLONE_STRATEGY_FLAGS.keys()),
+        help='How much of each repository to clone. "full" clones all the'
+             ' history. "blobless" clones all the commits but only fetches'
+             ' file contents when they are checked out. "shallow" clones'
+             ' only the commits at the branch and tag tips, deepening the'
+             ' history later only if determining the version needs it.'
+             ' This is ignored when using --git_mirror_dir.')
 
   @staticmethod
   def add_publishing_parser_args(parser, defaults):
@@ -736,6 +1496,37 @@ class GitRunner(object):
     if GitRunner.__GITHUB_TOKEN:
       self.__auth_env['GITHUB_TOKEN'] = GitRunner.__GITHUB_TOKEN
 
+    # Repositories are typically processed concurrently in different threads
+    # so keep the subprocess counts per thread to attribute them properly.
+    self.__thread_local = threading.local()
+
+    summary_cache_dir = getattr(options, 'summary_cache', None)
+    self.__summary_cache = (
+        RepositorySummaryCache(
+            summary_cache_dir,
+            max_entries=getattr(options, 'summary_cache_max_entries', 1000))
+        if summary_cache_dir else None)
+
+    mirror_dir = getattr(options, 'git_mirror_dir', None)
+    self.__mirror_cache = (GitMirrorCache(mirror_dir, self)
+                           if mirror_dir else None)
+
+  @property
+  def mirror_cache(self):
+    """The GitMirrorCache or None if not mirroring."""
+    return self.__mirror_cache
+
+  @property
+  def thread_subprocess_count(self):
+    """The number of git subprocesses spawned by the calling thread."""
+    return getattr(self.__thread_local, 'subprocess_count', 0)
+
+  def __count_subprocess(self, command):
+    """Record that we are about to spawn a git subprocess for command."""
+    self.__thread_local.subprocess_count = self.thread_subprocess_count + 1
+    MetricsManager.singleton().inc_counter(
+        'GitSubprocess', {'git_command': command.split(' ', 1)[0]})
+
   def __inject_auth(self, keyword_args_to_modify):
     """Inject the configured git authentication environment variables.
 
@@ -754,6 +1545,7 @@ class GitRunner(object):
   def run_git(self, git_dir, command, **kwargs):
     """Wrapper around run_subprocess."""
     self.__inject_auth(kwargs)
+    self.__count_subprocess(command)
     return run_subprocess(
         'git -C "{dir}" {command}'.format(dir=git_dir, command=command),
         **kwargs)
@@ -761,10 +1553,35 @@ class GitRunner(object):
   def check_run(self, git_dir, command, **kwargs):
     """Wrapper around check_subprocess."""
     self.__inject_auth(kwargs)
+    self.__count_subprocess(command)
     return check_subprocess(
         'git -C "{dir}" {command}'.format(dir=git_dir, command=command),
         **kwargs)
 
+  def run_git_async(self, git_dir, command, **kwargs):
+    """Wrapper around run_subprocess_async."""
+    self.__inject_auth(kwargs)
+    self.__count_subprocess(command)
+    return run_subprocess_async(
+        'git -C "{dir}" {command}'.format(dir=git_dir, command=command),
+        **kwargs)
+
+  def check_run_async(self, git_dir, command, **kwargs):
+    """Wrapper around check_subprocess_async."""
+    self.__inject_auth(kwargs)
+    self.__count_subprocess(command)
+    return check_subprocess_async(
+        'git -C "{dir}" {command}'.format(dir=git_dir, command=command),
+        **kwargs)
+
+  def check_run_lines(self, git_dir, command, **kwargs):
+    """Wrapper around check_subprocess_lines."""
+    self.__inject_auth(kwargs)
+    self.__count_subprocess(command)
+    return check_subprocess_lines(
+        'git -C "{dir}" {command}'.format(dir=git_dir, command=command),
+        **kwargs)
+
   def check_run_sequence(self, git_dir, commands):
     """Check a sequence of git commands.
 
@@ -788,8 +1605,66 @@ class GitRunner(object):
       raise_and_log_error(ExecutionError('git failed.'))
     return stdout
 
+  def load_commit_graph(self, git_dir):
+    """Returns a GitCommitGraph snapshot of the local repository at git_dir.
+
+    This costs two git subprocesses regardless of how many tags and branches
+    the repository has.
+    """
+    return self.load_commit_graph_from_refs(
+        git_dir, self.query_show_refs(git_dir))
+
+  def query_show_refs(self, git_dir):
+    """Returns the "git show-ref --head -d" output for git_dir."""
+    retcode, refs_text = self.run_git(git_dir, 'show-ref --head -d')
+    if retcode and refs_text:
+      raise_and_log_error(
+          ExecutionError('git failed in %s' % git_dir, program='git'),
+          'git -C "%s" show-ref --head -d: %s' % (git_dir, refs_text))
+    return refs_text
+
+  def load_commit_graph_from_refs(self, git_dir, refs_text):
+    """Returns a GitCommitGraph from previously queried refs_text.
+
+    Args:
+      git_dir: [path] The local repository to load the history from.
+      refs_text: [string] The result of query_show_refs on git_dir.
+    """
+    history_text = self.check_run(
+        git_dir, 'rev-list --parents --timestamp --all')
+    shallow_text = ''
+    if self.is_shallow_repository(git_dir):
+      with open(os.path.join(git_dir, '.git', 'shallow'), 'r') as stream:
+        shallow_text = stream.read()
+    return GitCommitGraph.make_from_result(
+        refs_text, history_text, shallow_text=shallow_text)
+
+  def load_history_for_version(self, git_dir, graph, tag_pattern):
+    """Deepens a shallow clone until it can determine the version at HEAD.
+
+    Args:
+      git_dir: [path] The local repository graph was loaded from.
+      graph: [GitCommitGraph] The current graph for git_dir.
+      tag_pattern: [string] Regex for the version tags.
+
+    Returns:
+      The GitCommitGraph to use, which is graph if it was already sufficient.
+    """
+    attempt = 0
+    while graph.shallow_commits:
+      self.find_newest_tag_and_common_commit_from_id(
+          git_dir, graph.head_commit, graph.commit_tags(tag_pattern),
+          commit_graph=graph)
+      if not graph.missing_history:
+        break
+      if not self.deepen_history(git_dir, attempt):
+        break
+      attempt += 1
+      graph = self.load_commit_graph(git_dir)
+    return graph
+
   def find_newest_tag_and_common_commit_from_id(
-      self, git_dir, commit_id, commit_tags):
+      self, git_dir, commit_id, commit_tags, commit_graph=None):
     """Returns most recent tag and common commit to a given commit_id.
 
     So if we have this:
@@ -806,21 +1681,22 @@ class GitRunner(object):
     though it is not directly in <id>'s hierarchy.
 
     Args:
-      base_commit_id [string]: If base_commit_id is provided then rather than
-          use it ias the base commit id for determining recent commits.
+      commit_graph: [GitCommitGraph] If provided then use this rather than
+          loading a new one from the git_dir.
     """
+    graph = commit_graph or self.load_commit_graph(git_dir)
+
     # Find the starting commit, which is most recent tag in our direct history.
     # For the example in the function docs, this would be tag 0.1.0
-    retcode, most_recent_ancestor_tag = self.run_git(
-        git_dir, 'describe --abbrev=0 --tags --match version-* ' + commit_id)
-    if retcode != 0:
+    most_recent_ancestor_tag = graph.describe_tag(commit_id, 'version-*')
+    if most_recent_ancestor_tag is None:
       start_tag = 'version-0.0.0'
       logging.warning('No baseline tag for "%s", assuming this is first one.',
                       git_dir)
-      start_commit = self.check_run(git_dir, 'rev-list --max-parents=0 HEAD')
+      start_commit = graph.root_commits(commit_id)[-1]
     else:
       start_tag = most_recent_ancestor_tag
-      start_commit = self.check_run(git_dir, 'rev-list -n 1 ' + start_tag)
+      start_commit = graph.tag_commit_or_none(start_tag)
 
     if start_commit == commit_id:
       logging.debug(
@@ -830,19 +1706,20 @@ class GitRunner(object):
     # Get the master commit so we can use it in the merge-base call below.
     # If we checked out some branch other than master, we might not have
     # the actual branch so cannot use the symbolic name.
-    master_commit = self.check_run(git_dir, 'show-ref master').split(' ')[0]
+    master_commit = graph.ref_commit_or_none('master')
+    if master_commit is None:
+      raise_and_log_error(
+          UnexpectedError('{0} has no "master" ref'.format(git_dir)))
     logging.debug('  master_commit=%s may be used to locate the branch.', master_commit)
 
     # Find branch our commit is on. There could be multiple branches.
     # We'll remember them all. These should be the same in practice, but
     # could be different if a branch spawned another for some reason.
-    # We use -r here because the branches arent known to the original git clone.
-    remote_commit_branches = self.check_run(
-        git_dir, 'branch -r --contains {id}'.format(id=commit_id))
+    # We use remote branches because they arent known to the original clone.
+    remote_commit_branches = graph.remote_branches_containing(commit_id)
 
     commit_branch_nodes = set([])
-    for remote_commit_branch in remote_commit_branches.split('\n'):
-      remote_commit_branch = remote_commit_branch.strip()
+    for remote_commit_branch in remote_commit_branches:
       if not remote_commit_branch.startswith('origin/release-'):
         logging.debug('   skipping non-release branch %r', remote_commit_branch)
         continue
@@ -850,9 +1727,9 @@ class GitRunner(object):
       # Find place our branch diverges from master. We'll be using this to
       # detect if a tag we consider was after our branch. We'll do this by
       # checking if the common point between us is it is here.
-      node = self.check_run(
-          git_dir, 'merge-base {branch} {master}'.format(
-              branch=remote_commit_branch, master=master_commit))
+      node = graph.merge_base(
+          graph.ref_commit_or_none('refs/remotes/' + remote_commit_branch),
+          master_commit)
       commit_branch_nodes.add(node)
       logging.debug('   adding branching node=%r', node)
 
@@ -861,16 +1738,15 @@ class GitRunner(object):
 
     # Now there could be other versions that were created in branches between
     # that first commit and our commit, such as tag 0.2.0 in the above.
-    start_version = LooseVersion(start_tag)
+    start_version = loose_version(start_tag)
     for tag_entry in reversed(sorted(commit_tags)):
       tag = tag_entry.tag
-      if LooseVersion(tag) <= start_version:
+      if loose_version(tag) <= start_version:
         logging.debug('tag %s <= %s', tag, start_tag)
         break
 
       # Find where in our commit history the branch this tag is on intersects
-      tag_intersect = self.check_run(git_dir, 'merge-base {id} {tag}'.format(
-          id=commit_id, tag=tag))
+      tag_intersect = graph.merge_base(commit_id, graph.tag_commit_or_none(tag))
       if tag_intersect in commit_branch_nodes:
         logging.debug('tag %s intersects branch at %s', tag, tag_intersect)
         continue
@@ -880,19 +1756,20 @@ class GitRunner(object):
     return start_tag, start_commit
 
   def query_local_repository_commits_to_existing_tag_from_id(
-      self, git_dir, commit_id, commit_tags, base_commit_id=None):
+      self, git_dir, commit_id, commit_tags, base_commit_id=None,
+      commit_graph=None):
     """Returns the list of commit messages to the local repository."""
     # pylint: disable=invalid-name
 
     tag, found_commit = self.find_newest_tag_and_common_commit_from_id(
-        git_dir, commit_id, commit_tags)
+        git_dir, commit_id, commit_tags, commit_graph=commit_graph)
 
     base_commit = base_commit_id or found_commit
-    commit_history = self.check_run(
+    commit_history = self.check_run_lines(
         git_dir,
         'log --pretty=medium {base_commit}..{id}'.format(
             base_commit=base_commit, id=commit_id))
-    messages = CommitMessage.make_list_from_result(commit_history)
+    messages = list(CommitMessage.iter_from_lines(commit_history))
     return tag, messages
 
   def query_commit_at_tag(self, git_dir, tag):
@@ -908,9 +1785,96 @@ class GitRunner(object):
 
   def query_local_repository_commit_id(self, git_dir):
     """Returns the current commit for the repository at git_dir."""
-    result = self.check_run(git_dir, 'rev-parse HEAD')
+    result = self.resolve_object_id_or_none(git_dir, 'HEAD')
+    if result is None:
+      # Let git explain, such as there not being any commits yet.
+      result = self.check_run(git_dir, 'rev-parse HEAD')
     return result
 
+  def object_reader(self, git_dir):
+    """Returns the GitObjectReader for git_dir, creating one if needed.
+
+    The readers are shared by all instances and stopped by
+    close_object_readers.
+    """
+    git_dir = os.path.abspath(git_dir)
+    with GitRunner.__object_readers_mutex:
+      reader = GitRunner.__object_readers.get(git_dir)
+      if reader is None:
+        if not GitRunner.__object_readers_registered_atexit:
+          # In case the command is run other than through main().
+          atexit.register(GitRunner.close_object_readers)
+          GitRunner.__object_readers_registered_atexit = True
+        reader = GitObjectReader(git_dir, start_hook=self.__count_subprocess)
+        GitRunner.__object_readers[git_dir] = reader
+    return reader
+
+  @staticmethod
+  def close_object_readers():
+    """Stops all the GitObjectReader processes.
+
+    This is called when the command finishes.
+    """
+    with GitRunner.__object_readers_mutex:
+      readers = list(GitRunner.__object_readers.values())
+      GitRunner.__object_readers.clear()
+    for reader in readers:
+      reader.close()
+
+  def __discard_object_reader(self, git_dir):
+    """Stops the reader for git_dir because the repository is being replaced."""
+    with GitRunner.__object_readers_mutex:
+      reader = GitRunner.__object_readers.pop(os.path.abspath(git_dir), None)
+    if reader is not None:
+      reader.close()
+
+  def resolve_object_id_or_none(self, git_dir, name):
+    """Returns the object id that name refers to or None if not known.
+
+    Args:
+      git_dir: [path] The local repository.
+      name: [string] A ref, commit or other name "git rev-parse" accepts.
+    """
+    found = self.object_reader(git_dir).lookup_or_none(name)
+    return found.object_id if found else None
+
+  def query_commit_object_or_none(self, git_dir, name='HEAD'):
+    """Returns the GitCommitObject that name refers to or None if not known."""
+    found = self.object_reader(git_dir).read_or_none(name + '^{commit}')
+    if found is None:
+      return None
+    return GitCommitObject.make(found.object_id,
+                                found.content.decode('utf-8', 'replace'))
+
+  def read_file_at_commit_or_none(self, git_dir, commit, path):
+    """Returns the bytes content of the file at the commit or None if missing.
+
+    Args:
+      git_dir: [path] The local repository.
+      commit: [string] The commit, branch or tag to read the file from.
+      path: [string] The path of the file relative to the repository root.
+    """
+    found = self.object_reader(git_dir).read_or_none(
+        '{commit}:{path}'.format(commit=commit, path=path))
+    if found is None or found.object_type != 'blob':
+      return None
+    return found.content
+
+  def list_tree_at_commit_or_none(self, git_dir, commit, path):
+    """Returns the GitTreeEntry list of a directory or None if missing.
+
+    Args:
+      git_dir: [path] The local repository.
+      commit: [string] The commit, branch or tag to list the directory at.
+      path: [string] The path of the directory relative to the repository
+         root, or '' for the root itself.
+    """
+    found = self.object_reader(git_dir).read_or_none(
+        '{commit}:{path}'.format(commit=commit, path=path))
+    if found is None or found.object_type != 'tree':
+      return None
+    return GitTreeEntry.make_list(found.object_id, found.content)
+
   def query_remote_repository_commit_id(self, url, branch):
     """Returns the current commit for the remote repository."""
     args = {}
@@ -939,10 +1903,15 @@ class GitRunner(object):
     logging.warning('Deleting origin branch="%s" for %s', branch, git_dir)
     self.check_run(git_dir, 'push origin --delete ' + branch)
 
-  def push_branch_to_origin(self, git_dir, branch, force=False):
+  def push_branch_to_origin(self, git_dir, branch, force=False, tags=None):
     """Push the given local repository back up to the origin.
 
     This has no effect if the repository is not in the given branch.
+
+    Args:
+      force: [bool] Replace the origin branch even if it diverged.
+      tags: [list of string] Tags to push along with the branch. Either
+         the branch and all the tags are pushed or none of them are.
     """
     if self.options.git_never_push:
       logging.warning(
@@ -958,20 +1927,47 @@ class GitRunner(object):
                       git_dir, branch, in_branch)
       return
 
-    force_flag = ' -f' if force else ''
-    self.check_run(git_dir, 'push origin ' + branch + force_flag)
+    refspecs = [('+' if force else '') + branch]
+    refspecs.extend(['refs/tags/' + tag for tag in tags or []])
+    self.push_refs_to_origin(git_dir, refspecs)
 
   def push_tag_to_origin(self, git_dir, tag):
     """Push the given tag back up to the origin."""
+    logging.debug('Pushing tag "%s" and pushing to origin in %s', tag, git_dir)
+    self.push_refs_to_origin(git_dir, ['refs/tags/' + tag])
+
+  def push_refs_to_origin(self, git_dir, refspecs):
+    """Push the refspecs to the origin in a single "git push --atomic".
+
+    Either all the refs are updated in the origin or none of them are.
+
+    Args:
+      git_dir: [path] The local repository to push from.
+      refspecs: [list of string] The refspecs to push. A leading '+'
+         replaces the ref even if the change is not a fast-forward.
+    """
+    command = 'push --atomic origin ' + ' '.join(refspecs)
     if self.options.git_never_push:
       logging.warning(
-          'SKIP pushing tag because --git_never_push=true.'
+          'SKIP pushing refs because --git_never_push=true.'
           '\nCommand would have been: %s',
-          'git -C "{dir}" push origin {tag}'.format(dir=git_dir, tag=tag))
+          'git -C "{dir}" {command}'.format(dir=git_dir, command=command))
       return
 
-    logging.debug('Pushing tag "%s" and pushing to origin in %s', tag, git_dir)
-    self.check_run(git_dir, 'push origin ' + tag)
+    self.check_run(git_dir, command)
+
+  def commit_ref_transaction(self, git_dir, transaction):
+    """Applies the GitRefTransaction to the local repository.
+
+    Returns:
+      False if the transaction had no changes.
+    """
+    if not transaction:
+      return False
+    logging.debug('Changing %d refs in %s', len(transaction), git_dir)
+    self.check_run(git_dir, 'update-ref --stdin',
+                   input=transaction.to_stdin_text())
+    return True
 
   def fetch_tags(self, git_dir, remote_name='origin'):
     """Fetches the tags in the given remote as a list.
@@ -1033,6 +2029,85 @@ class GitRunner(object):
           'WARNING {name} branch={branch} is not known to {which}.\n'
           .format(name=repository.name, branch=branch, which=remote_name))
 
+  def is_repository_corrupt(self, git_dir):
+    """Determine if git_dir is not a usable git repository."""
+    retcode, stdout = self.run_git(
+        git_dir, 'fsck --connectivity-only --no-progress')
+    if retcode:
+      logging.warning('%s is corrupt:\n%s', git_dir, stdout)
+    return retcode != 0
+
+  def fetch_and_reset(self, git_dir, commit=None, branches=None):
+    """Updates an existing clone to the current commit or branch of origin.
+
+    Only objects not already present are fetched. Local changes are
+    discarded.
+
+    Args:
+      git_dir: [path] The local repository to update.
+      commit: [string] The commit to reset to, if any.
+      branches: [list of string] Otherwise the branches to try in order,
+         as with clone_repository_to_path.
+
+    Returns:
+      The number of bytes added to the repository.
+    """
+    if (commit is None) == (not branches):
+      raise_and_log_error(
+          ConfigError('Exactly one of commit or branches must be specified.'))
+    start_bytes = directory_bytes(os.path.join(git_dir, '.git'))
+
+    if commit:
+      have_commit = 'cat-file -e {commit}^{{commit}}'.format(commit=commit)
+      if self.run_git(git_dir, have_commit)[0]:
+        # Ask for only the commit rather than every branch.
+        retcode, stdout = self.run_git(git_dir, 'fetch -q origin ' + commit)
+        if retcode:
+          # Servers may refuse commits that are not named by a ref.
+          logging.warning('Could not fetch %s directly into %s:\n%s\n'
+                          'Fetching the origin branches and tags instead.',
+                          commit, git_dir, stdout)
+          self.check_run(git_dir, 'fetch -q --tags origin')
+      self.check_run(git_dir, 'checkout -q --force --detach ' + commit)
+    else:
+      remaining_branches = list(branches)
+      while True:
+        branch = remaining_branches.pop(0)
+        retcode, stdout = self.run_git(
+            git_dir,
+            'fetch -q --tags origin'
+            ' +refs/heads/{branch}:refs/remotes/origin/{branch}'.format(
+                branch=branch))
+        if not retcode:
+          break
+        if not remaining_branches or stdout.find(
+            "couldn't find remote ref") < 0:
+          raise_and_log_error(
+              ExecutionError('git fetch failed in %s' % git_dir, program='git'),
+              'git -C "{dir}" fetch failed with:\n{output}'.format(
+                  dir=git_dir, output=stdout))
+        logging.warning('Branch %s does not exist in origin of %s.'
+                        ' Retry with %s',
+                        branch, git_dir, remaining_branches[0])
+      self.check_run(
+          git_dir, 'checkout -q --force -B {branch} origin/{branch}'.format(
+              branch=branch))
+
+    fetched_bytes = max(
+        0, directory_bytes(os.path.join(git_dir, '.git')) - start_bytes)
+    logging.info('Refreshed %s to %s fetching %d bytes',
+                 git_dir, commit or branch, fetched_bytes)
+    MetricsManager.singleton().inc_counter(
+        'GitRefreshBytes', {'repository': os.path.basename(git_dir)},
+        amount=fetched_bytes)
+    return fetched_bytes
+
+  def __clone(self, remote_url, base_dir, clone_command, branches):
+    if branches:
+      self.__check_clone_branch(remote_url, base_dir, clone_command, branches)
+    else:
+      self.check_run(base_dir, clone_command)
+
   def __check_clone_branch(self, remote_url, base_dir, clone_command, branches):
     remaining_branches = list(branches)
     while True:
@@ -1062,20 +2137,32 @@ class GitRunner(object):
       raise_and_log_error(ConfigError('Branches {0} do not exist in {1}.'
                                       .format(branches, remote_url)))
 
-  def remove_all_non_version_tags(self, repository, git_dir=None):
+  def remove_all_non_version_tags(self, repository, git_dir=None,
+                                  transaction=None):
     """Removes tags from the repository that confuse nebula.
 
     This confusion is because nebula is assuming Netflix policies and tags,
     but the OSS build has different policies and different tags to avoid
     conflicts with Netflix internal usage.
+
+    Args:
+      transaction: [GitRefTransaction] If provided then add the removals to
+         it for the caller to commit rather than removing the tags now.
     """
     tag_matcher = re.compile(r'^version-[0-9]+\.[0-9]+\.[0-9]+$')
     git_dir = git_dir or repository.git_dir
 
     logging.debug('Clearing all non-version tags from %s', git_dir)
-    all_tags = self.check_run(git_dir, 'tag').split('\n')
+    all_tags = [tag for tag in self.check_run(git_dir, 'tag').split('\n')
+                if tag]
     tags_to_remove = [tag for tag in all_tags if not tag_matcher.match(tag)]
-    self.check_run(git_dir, 'tag -d ' + ' '.join(tags_to_remove))
+    commit_now = transaction is None
+    if commit_now:
+      transaction = GitRefTransaction()
+    for tag in tags_to_remove:
+      transaction.delete('refs/tags/' + tag)
+    if commit_now:
+      self.commit_ref_transaction(git_dir, transaction)
     logging.debug('%d of %d tags removed', len(tags_to_remove), len(all_tags))
 
   def determine_pull_url(self, repository):
@@ -1095,11 +2182,16 @@ class GitRunner(object):
     return repository.origin
 
   def clone_repository_to_path(
-      self, repository, commit=None, branch=None, default_branch=None):
+      self, repository, commit=None, branch=None, default_branch=None,
+      strategy=None):
     """Clone the remote repository at the given commit or branch.
 
     If requesting a branch and it is not found, then settle for the default
     branch, if one was explicitly specified.
+
+    Args:
+      strategy: [string] The CLONE_STRATEGY_FLAGS key to clone with,
+          overriding --git_clone_strategy.
     """
     # pylint: disable=too-many-arguments
 
@@ -1107,23 +2199,55 @@ class GitRunner(object):
       raise_and_log_error(
           ConfigError('At most one of commit or branch can be specified.'))
 
+    strategy = (strategy
+                or getattr(self.__options, 'git_clone_strategy', None)
+                or 'full')
+    if strategy not in self.CLONE_STRATEGY_FLAGS:
+      raise_and_log_error(
+          ConfigError('Unknown clone strategy "{0}"'.format(strategy)))
+
     pull_url = self.determine_pull_url(repository)
     git_dir = repository.git_dir
     logging.debug('Begin cloning %s', pull_url)
+    self.__discard_object_reader(git_dir)
     parent_dir = os.path.dirname(git_dir)
     ensure_dir_exists(parent_dir)
 
-    clone_command = 'clone ' + pull_url
+    branches = []
     if branch:
       branches = [branch]
       if default_branch:
         branches.append(default_branch)
-      self.__check_clone_branch(pull_url, parent_dir, clone_command, branches)
+
+    start_time = time.time()
+    if self.__mirror_cache:
+      strategy = 'mirror'
+      mirror_path = self.__mirror_cache.refresh(pull_url)
+      # --shared borrows the mirror's objects through alternates rather than
+      # copying or hardlinking them as a local clone otherwise would.
+      clone_command = 'clone --shared "{mirror}" "{dir}"'.format(
+          mirror=mirror_path, dir=git_dir)
+      with self.__mirror_cache.lock(mirror_path, exclusive=False):
+        self.__clone(pull_url, parent_dir, clone_command, branches)
+      self.check_run(git_dir, 'remote set-url origin ' + pull_url)
+    elif strategy != 'full':
+      # Git ignores --depth and --filter when cloning a local path directly.
+      source_url = ('file://' + os.path.abspath(pull_url)
+                    if os.path.exists(pull_url) else pull_url)
+      clone_command = 'clone{flags} {url} "{dir}"'.format(
+          flags=self.CLONE_STRATEGY_FLAGS[strategy],
+          url=source_url, dir=git_dir)
+      self.__clone(pull_url, parent_dir, clone_command, branches)
+      if source_url != pull_url:
+        self.check_run(git_dir, 'remote set-url origin ' + pull_url)
     else:
-      self.check_run(parent_dir, clone_command)
+      self.__clone(pull_url, parent_dir, 'clone ' + pull_url, branches)
+    self.__record_clone_metrics(git_dir, strategy, time.time() - start_time)
     logging.info('Cloned %s into %s', pull_url, parent_dir)
 
     if commit:
+      if strategy == 'shallow':
+        self.__ensure_shallow_commit(git_dir, commit)
       self.check_run(git_dir, 'checkout -q ' + commit, echo=True)
 
     upstream = repository.upstream_or_none()
@@ -1148,9 +2272,81 @@ class GitRunner(object):
 
     logging.debug('Finished cloning %s', pull_url)
 
-  def tag_head(self, git_dir, tag):
-    """Add tag to the local repository HEAD."""
-    self.check_run(git_dir, 'tag {tag} HEAD'.format(tag=tag))
+  def __record_clone_metrics(self, git_dir, strategy, seconds):
+    clone_bytes = directory_bytes(os.path.join(git_dir, '.git'))
+    logging.debug('Cloned %d bytes into %s in %.1f secs using %s strategy',
+                  clone_bytes, git_dir, seconds, strategy)
+    metrics = MetricsManager.singleton()
+    labels = {'strategy': strategy}
+    metrics.observe_timer('GitClone', labels, seconds)
+    metrics.inc_counter('GitCloneBytes', labels, amount=clone_bytes)
+
+  def __ensure_shallow_commit(self, git_dir, commit):
+    """Fetches the commit into a shallow clone if it is not a tip."""
+    def have_commit():
+      retcode, _ = self.run_git(
+          git_dir, 'cat-file -e {commit}^{{commit}}'.format(commit=commit))
+      return retcode == 0
+
+    if have_commit():
+      return
+    # Servers need not allow fetching arbitrary commits, so deepen if not.
+    retcode, _ = self.run_git(git_dir, 'fetch -q --depth 1 origin ' + commit)
+    attempt = 0
+    while (retcode or not have_commit()) and self.deepen_history(
+        git_dir, attempt):
+      retcode = 0
+      attempt += 1
+
+  def is_shallow_repository(self, git_dir):
+    """Determine if the local repository is a shallow clone."""
+    return os.path.exists(os.path.join(git_dir, '.git', 'shallow'))
+
+  def deepen_history(self, git_dir, attempt=0):
+    """Fetches more history into a shallow clone.
+
+    Args:
+      git_dir: [path] The local repository to deepen.
+      attempt: [int] The number of times this was already called on git_dir.
+         Each attempt deepens further than the last, per HISTORY_DEEPEN_STEPS,
+         after which the remaining history is fetched.
+
+    Returns:
+      False if the repository already had all its history.
+    """
+    if not self.is_shallow_repository(git_dir):
+      return False
+    if attempt < len(self.HISTORY_DEEPEN_STEPS):
+      step = str(self.HISTORY_DEEPEN_STEPS[attempt])
+      command = 'fetch -q --deepen=' + step
+    else:
+      step = 'unshallow'
+      command = 'fetch -q --unshallow'
+    logging.info('Fetching more history into shallow %s (%s)', git_dir, step)
+    start_bytes = directory_bytes(os.path.join(git_dir, '.git'))
+    self.check_run(git_dir, command + ' origin')
+    MetricsManager.singleton().inc_counter(
+        'GitDeepenHistory',
+        {'repository': os.path.basename(git_dir), 'step': step})
+    MetricsManager.singleton().inc_counter(
+        'GitDeepenHistoryBytes', {'step': step},
+        amount=max(0, directory_bytes(os.path.join(git_dir, '.git'))
+                   - start_bytes))
+    return True
+
+  def tag_head(self, git_dir, tag, transaction=None):
+    """Add tag to the local repository HEAD.
+
+    Args:
+      transaction: [GitRefTransaction] If provided then add the tag to it
+         for the caller to commit rather than tagging now.
+    """
+    commit_now = transaction is None
+    if commit_now:
+      transaction = GitRefTransaction()
+    transaction.create('refs/tags/' + tag, 'HEAD')
+    if commit_now:
+      self.commit_ref_transaction(git_dir, transaction)
 
   def query_tag_commits(self, git_dir, tag_pattern):
     """Collect the TagCommit for each tag matching the pattern.
@@ -1185,15 +2381,45 @@ class GitRunner(object):
                              origin=origin_url,
                              upstream=remote_urls.get('upstream'))
 
-  def collect_repository_summary(self, git_dir, base_commit_id=None):
-    """Collects RepsitorySummary from local repository directory."""
+  def collect_repository_summary(self, git_dir, base_commit_id=None,
+                                 refs_text=None):
+    """Collects RepsitorySummary from local repository directory.
+
+    Args:
+      git_dir: [path] The local repository to summarize.
+      base_commit_id: [string] If provided, summarize relative to this commit.
+      refs_text: [string] The result of query_show_refs on git_dir if the
+         caller already has it, otherwise it is queried here.
+    """
     start_time = time.time()
+    start_subprocess_count = self.thread_subprocess_count
     logging.debug('Begin analyzing %s', git_dir)
-    all_tags = self.query_tag_commits(
-        git_dir, r'^version-[0-9]+\.[0-9]+\.[0-9]+$')
-    current_id = self.query_local_repository_commit_id(git_dir)
+    if refs_text is None:
+      refs_text = self.query_show_refs(git_dir)
+    repository_name = os.path.basename(git_dir)
+
+    cache_key = None
+    if self.__summary_cache:
+      cache_key = self.__summary_cache.make_key(
+          repository_name, refs_text, base_commit_id=base_commit_id)
+      summary = self.__summary_cache.lookup_or_none(cache_key)
+      MetricsManager.singleton().inc_counter(
+          'RepositorySummaryCache',
+          {'repository': repository_name, 'hit': summary is not None})
+      if summary is not None:
+        logging.debug('Using cached summary for %s at %s',
+                      git_dir, summary.commit_id)
+        return summary
+
+    tag_pattern = r'^version-[0-9]+\.[0-9]+\.[0-9]+$'
+    graph = self.load_history_for_version(
+        git_dir, self.load_commit_graph_from_refs(git_dir, refs_text),
+        tag_pattern)
+    all_tags = graph.commit_tags(tag_pattern)
+    current_id = graph.head_commit
     tag, msgs = self.query_local_repository_commits_to_existing_tag_from_id(
-        git_dir, current_id, all_tags, base_commit_id=base_commit_id)
+        git_dir, current_id, all_tags, base_commit_id=base_commit_id,
+        commit_graph=graph)
 
     if not tag:
       current_semver = SemanticVersion.make('version-0.0.0')
@@ -1212,10 +2438,18 @@ class GitRunner(object):
       use_version = current_semver.to_version()
 
     total_ms = int((time.time() - start_time) * 1000)
-    logging.debug('Finished analyzing %s in %d ms', git_dir, total_ms)
-    return RepositorySummary(current_id, use_tag, use_version,
-                             current_semver.to_version(),
-                             msgs)
+    subprocess_count = self.thread_subprocess_count - start_subprocess_count
+    logging.debug('Finished analyzing %s in %d ms using %d git subprocesses',
+                  git_dir, total_ms, subprocess_count)
+    MetricsManager.singleton().inc_counter(
+        'GitRepositorySummarySubprocess',
+        {'repository': repository_name}, amount=subprocess_count)
+    summary = RepositorySummary(current_id, use_tag, use_version,
+                                current_semver.to_version(),
+                                msgs)
+    if cache_key:
+      self.__summary_cache.store(cache_key, summary)
+    return summary
 
   def delete_local_branch_if_exists(self, git_dir, branch):
     """Delete the branch from git_dir if one exists.
@@ -19,17 +19,13 @@ import logging
 import os
 import re
 
-try:
-  from urllib2 import urlopen, Request
-  from urllib2 import HTTPError
-except ImportError:
-  from urllib.request import urlopen, Request
-  from urllib.error import HTTPError
-
 from buildtool import (
     RepositoryCommandFactory,
     RepositoryCommandProcessor,
+    GitRefTransaction,
     GitRunner,
+    HttpClient,
+    HttpStatusError,
 
     add_parser_argument,
     check_subprocesses_to_logfile,
@@ -205,13 +201,13 @@ class GradleRunner(object):
             package=package_name, repo=repo, version=build_version))
     return 'https://api.bintray.com/' + bintray_path
 
-  def __add_bintray_auth_header(self, request):
-    """Adds bintray authentication header to the request."""
+  def __make_bintray_auth_headers(self):
+    """Returns the bintray authentication headers for a request."""
     user = os.environ['BINTRAY_USER']
     password = os.environ['BINTRAY_KEY']
     encoded_auth = base64.encodestring(str.encode('{user}:{password}'.format(
         user=user, password=password)))[:-1]  # strip eoln
-    request.add_header('Authorization', 'Basic ' + bytes.decode(encoded_auth))
+    return {'Authorization': 'Basic ' + bytes.decode(encoded_auth)}
 
   def bintray_repo_has_version(self, repo, package_name, repository,
                                build_version):
@@ -220,19 +216,17 @@ class GradleRunner(object):
       bintray_url = self.__to_bintray_url(repo, package_name, repository,
                                           build_version)
       logging.debug('Checking for %s', bintray_url)
-      request = Request(url=bintray_url)
-      self.__add_bintray_auth_header(request)
-      urlopen(request)
+      HttpClient.singleton().get(
+          bintray_url, headers=self.__make_bintray_auth_headers(),
+          endpoint='bintray.check')
       return True
-    except HTTPError as ex:
+    except HttpStatusError as ex:
       if ex.code == 404:
         return False
       raise_and_log_error(
           ResponseError('Bintray failure: {}'.format(ex),
                         server='bintray.check'),
           'Failed on url=%s: %s' % (bintray_url, exception_to_message(ex)))
-    except Exception as ex:
-      raise
 
 
   def consider_debian_on_bintray(self, repository, build_version):
@@ -287,19 +281,20 @@ class GradleRunner(object):
       bintray_url = self.__to_bintray_url(repo, package_name, repository,
                                           build_version)
       logging.debug('Checking for %s', bintray_url)
-      request = Request(url=bintray_url)
-      request.get_method = lambda: 'DELETE'
-      self.__add_bintray_auth_header(request)
-
       labels = {
           'repo': repo,
           'repository': repository.name,
           'artifact': 'debian'
       }
+      # count_call passes its kwargs to the counter too, so bind them here.
       self.__metrics.count_call(
-          'DeleteArtifact', labels, urlopen, request)
+          'DeleteArtifact', labels,
+          lambda: HttpClient.singleton().request(
+              'DELETE', bintray_url,
+              headers=self.__make_bintray_auth_headers(),
+              endpoint='bintray.delete'))
       return True
-    except HTTPError as ex:
+    except HttpStatusError as ex:
       if ex.code == 404:
         return True
       raise_and_log_error(
@@ -386,7 +381,8 @@ class GradleRunner(object):
         check_subprocesses_to_logfile,
         name + ' gradle ' + context, logfile, [cmd], cwd=gradle_dir,
         postprocess_hook=GradleMetricsUpdater(self.__metrics,
-                                              repository, target))
+                                              repository, target),
+        resource_labels=labels)
 
   def __is_plugin_version_6(self, repository):
     return not self.__has_init_publish_file(
@@ -406,7 +402,9 @@ class GradleRunner(object):
     """
     git_dir = gradle_dir or repository.git_dir
     self.__scm.ensure_local_repository(repository)
-    self.__git.remove_all_non_version_tags(repository, git_dir=git_dir)
+    transaction = GitRefTransaction()
+    self.__git.remove_all_non_version_tags(
+        repository, git_dir=git_dir, transaction=transaction)
 
     if not build_number:
       build_number = self.__scm.determine_build_number(repository)
@@ -420,7 +418,8 @@ class GradleRunner(object):
 
     logging.debug('Tagging repository %s with "%s" for nebula',
                   git_dir, build_version)
-    self.__git.tag_head(git_dir, build_version)
+    self.__git.tag_head(git_dir, build_version, transaction=transaction)
+    self.__git.commit_ref_transaction(git_dir, transaction)
     return build_number
 
 
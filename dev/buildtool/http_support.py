@@ -0,0 +1,293 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A shared HTTP client that keeps connections alive between requests."""
+
+import collections
+import logging
+import socket
+import threading
+import time
+
+try:
+  from httplib import HTTPConnection, HTTPSConnection, HTTPException
+  from urlparse import urljoin, urlsplit
+except ImportError:
+  from http.client import HTTPConnection, HTTPSConnection, HTTPException
+  from urllib.parse import urljoin, urlsplit
+
+
+class HttpRequestError(IOError):
+  """The request could not be completed."""
+
+  def __init__(self, message, url=None):
+    super(HttpRequestError, self).__init__(message)
+    self.url = url
+
+
+class HttpStatusError(HttpRequestError):
+  """The server responded with an unsuccessful status code.
+
+  Attributes:
+    code: [int] The HTTP status code.
+    headers: [dict] The response headers keyed by lower-case name.
+    body: [bytes] The response body.
+  """
+
+  def __init__(self, url, code, reason, headers, body):
+    super(HttpStatusError, self).__init__(
+        'HTTP Error {code}: {reason}'.format(code=code, reason=reason),
+        url=url)
+    self.code = code
+    self.headers = headers
+    self.body = body
+
+
+class HttpResponse(
+    collections.namedtuple('HttpResponse', ['status', 'headers', 'body'])):
+  """A successful response from HttpClient.
+
+  Attributes:
+    status: [int] The HTTP status code.
+    headers: [dict] The response headers keyed by lower-case name.
+    body: [bytes] The response body.
+  """
+
+
+_RawResponse = collections.namedtuple(
+    '_RawResponse', ['status', 'reason', 'headers', 'body'])
+
+
+class HttpClient(object):
+  """Issues HTTP requests over pooled keep-alive connections.
+
+  Connections are pooled per scheme and host and at most
+  max_connections_per_host requests are outstanding to any one host.
+  Requests failing with a transient error (429, 5xx or a dropped connection)
+  are retried with exponential backoff.
+
+  Metrics:
+    HttpRequest: Timer of each attempt by endpoint, method and status.
+    HttpHandshake: Timer of each new connection by host.
+    HttpRetry: Counter of retried attempts by endpoint and method.
+  """
+
+  RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+  REDIRECT_STATUS_CODES = (301, 302, 303, 307, 308)
+  MAX_REDIRECTS = 5
+
+  __singleton = None
+  __singleton_lock = threading.Lock()
+
+  @staticmethod
+  def singleton():
+    """Returns the client shared by buildtool commands."""
+    with HttpClient.__singleton_lock:
+      if HttpClient.__singleton is None:
+        HttpClient.__singleton = HttpClient()
+      return HttpClient.__singleton
+
+  def __init__(self, max_connections_per_host=8, max_retries=4,
+               backoff_secs=0.5, timeout_secs=60, metrics_registry=None):
+    """Constructor.
+
+    Args:
+      max_connections_per_host: [int] Bounds concurrent requests per host.
+      max_retries: [int] How many times to retry a transient failure.
+      backoff_secs: [float] The delay before the first retry. This doubles
+         with each subsequent retry unless the server specifies Retry-After.
+      timeout_secs: [float] The socket timeout for each attempt.
+      metrics_registry: [BaseMetricsRegistry] Where to record metrics.
+         If None then use the MetricsManager singleton.
+    """
+    self.__max_connections_per_host = max_connections_per_host
+    self.__max_retries = max_retries
+    self.__backoff_secs = backoff_secs
+    self.__timeout_secs = timeout_secs
+    self.__metrics_registry = metrics_registry
+    self.__lock = threading.Lock()
+    self.__idle_connections = {}
+    self.__host_semaphores = {}
+
+  @property
+  def metrics(self):
+    """The metrics registry to record into."""
+    if self.__metrics_registry is None:
+      # Imported here because the metrics module depends on this one.
+      from buildtool.metrics import MetricsManager
+      return MetricsManager.singleton()
+    return self.__metrics_registry
+
+  def get(self, url, headers=None, endpoint=None):
+    """Issues a GET request. See request()."""
+    return self.request('GET', url, headers=headers, endpoint=endpoint)
+
+  def request(self, method, url, body=None, headers=None, endpoint=None):
+    """Issues an HTTP request, following redirects.
+
+    Args:
+      method: [string] The HTTP method.
+      url: [string] The URL to request.
+      body: [bytes] The request body, if any.
+      headers: [dict] Additional request headers.
+      endpoint: [string] A low cardinality name for the request in metrics.
+         Defaults to the host.
+
+    Returns:
+      HttpResponse
+
+    Raises:
+      HttpStatusError if the final response was not successful.
+      HttpRequestError if the request could not be completed.
+    """
+    for _ in range(self.MAX_REDIRECTS + 1):
+      response = self.__request_with_retries(
+          method, url, body, headers, endpoint)
+      location = response.headers.get('location')
+      if response.status not in self.REDIRECT_STATUS_CODES or not location:
+        break
+      logging.debug('%s %s redirected to %s', method, url, location)
+      url = urljoin(url, location)
+      if response.status == 303:
+        method, body = 'GET', None
+    else:
+      raise HttpRequestError('Too many redirects', url=url)
+
+    if response.status >= 400:
+      raise HttpStatusError(url, response.status, response.reason,
+                            response.headers, response.body)
+    return HttpResponse(response.status, response.headers, response.body)
+
+  def __request_with_retries(self, method, url, body, headers, endpoint):
+    """Returns the final raw response after retrying transient failures."""
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+      raise HttpRequestError('Unsupported url', url=url)
+    host_key = (parts.scheme, parts.netloc)
+    path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    labels = {'endpoint': endpoint or parts.netloc, 'method': method}
+
+    attempt = 0
+    while True:
+      response = None
+      error = None
+      with self.__get_host_semaphore(host_key):
+        start_time = time.time()
+        try:
+          response = self.__send(host_key, method, path, body, headers or {})
+          status = response.status
+        except (HTTPException, socket.error) as ex:
+          error = ex
+          status = 'error'
+        elapsed_secs = time.time() - start_time
+
+      metric_labels = dict(labels)
+      metric_labels['status'] = status
+      self.metrics.observe_timer('HttpRequest', metric_labels, elapsed_secs)
+
+      if response is not None and status not in self.RETRYABLE_STATUS_CODES:
+        return response
+      if attempt >= self.__max_retries:
+        if response is not None:
+          return response
+        raise HttpRequestError(
+            'Failed after {n} attempts: {error}'.format(
+                n=attempt + 1, error=error),
+            url=url)
+
+      delay = self.__backoff_secs * (2 ** attempt)
+      if response is not None:
+        retry_after = response.headers.get('retry-after', '')
+        if retry_after.isdigit():
+          delay = int(retry_after)
+      logging.warning('%s %s failed with %s -- retrying in %.1f secs',
+                      method, url, status if response else error, delay)
+      self.metrics.inc_counter('HttpRetry', labels)
+      time.sleep(delay)
+      attempt += 1
+
+  def __get_host_semaphore(self, host_key):
+    with self.__lock:
+      semaphore = self.__host_semaphores.get(host_key)
+      if semaphore is None:
+        semaphore = threading.BoundedSemaphore(
+            self.__max_connections_per_host)
+        self.__host_semaphores[host_key] = semaphore
+      return semaphore
+
+  def __acquire_idle_connection_or_none(self, host_key):
+    with self.__lock:
+      idle = self.__idle_connections.get(host_key)
+      return idle.pop() if idle else None
+
+  def __new_connection(self, host_key):
+    scheme, netloc = host_key
+    klass = HTTPSConnection if scheme == 'https' else HTTPConnection
+    connection = klass(netloc, timeout=self.__timeout_secs)
+    start_time = time.time()
+    connection.connect()
+    self.metrics.observe_timer(
+        'HttpHandshake', {'host': netloc}, time.time() - start_time)
+    return connection
+
+  def __release_connection(self, host_key, connection):
+    """Returns the connection to the pool for reuse."""
+    with self.__lock:
+      self.__idle_connections.setdefault(host_key, []).append(connection)
+
+  def __send(self, host_key, method, path, body, headers):
+    """Performs a single attempt of the request."""
+    connection = self.__acquire_idle_connection_or_none(host_key)
+    if connection is not None:
+      try:
+        return self.__send_on_connection(
+            host_key, connection, method, path, body, headers)
+      except (HTTPException, socket.error) as ex:
+        # The server may have dropped the idle connection, so try again
+        # immediately on a new one rather than treating this as a failure.
+        logging.debug('Reused connection to %s failed with %s',
+                      host_key[1], ex)
+
+    return self.__send_on_connection(
+        host_key, self.__new_connection(host_key),
+        method, path, body, headers)
+
+  def __send_on_connection(
+      self, host_key, connection, method, path, body, headers):
+    try:
+      connection.request(method, path, body=body, headers=headers)
+      response = connection.getresponse()
+      payload = response.read()
+    except:
+      connection.close()
+      raise
+
+    if response.will_close:
+      connection.close()
+    else:
+      self.__release_connection(host_key, connection)
+
+    return _RawResponse(
+        response.status, response.reason,
+        {key.lower(): value for key, value in response.getheaders()},
+        payload)
+
+  def close(self):
+    """Closes all the idle connections."""
+    with self.__lock:
+      idle_connections = self.__idle_connections
+      self.__idle_connections = {}
+    for connections in idle_connections.values():
+      for connection in connections:
+        connection.close()
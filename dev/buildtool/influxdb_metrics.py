@@ -31,22 +31,33 @@ To create a database:
 """
 
 
+import collections
 import datetime
+import gzip
+import io
 import logging
+import os
+import threading
+import time
 
-try:
-  from urllib2 import urlopen, Request
-except ImportError:
-  from urllib.request import urlopen, Request
+from buildtool import (
+    add_parser_argument,
+    ensure_dir_exists)
+from buildtool.base_metrics import MetricFamily
+from buildtool.http_support import (
+    HttpClient,
+    HttpRequestError,
+    HttpStatusError)
+from buildtool.inmemory_metrics import (
+    EPOCH,
+    InMemoryMetricsRegistry)
 
-from buildtool import add_parser_argument
-from buildtool.inmemory_metrics import InMemoryMetricsRegistry
 
-
-EPOCH = datetime.datetime(1970, 1, 1)
 SECONDS_PER_DAY = 24 * 60 * 60
 NANOS_PER_SECOND = 1000000000
 
+DEFAULT_MAX_BATCH_BYTES = 512 * 1024
+
 def to_timestamp(utc):
   """Convert UTC datetime into epoch timestamp in nanoseconds for influxdb."""
   time_delta = utc - EPOCH
@@ -55,6 +66,294 @@ def to_timestamp(utc):
   return epoch_nanos
 
 
+def gzip_bytes(data):
+  """Returns the data gzip-encoded."""
+  buf = io.BytesIO()
+  with gzip.GzipFile(fileobj=buf, mode='wb') as stream:
+    stream.write(data)
+  return buf.getvalue()
+
+
+def split_into_batches(lines, max_batch_bytes):
+  """Joins line-protocol lines into batches of at most max_batch_bytes.
+
+  A line longer than max_batch_bytes is put into a batch of its own.
+  """
+  batches = []
+  batch = []
+  batch_bytes = 0
+  for line in lines:
+    line_bytes = len(line) + 1
+    if batch and batch_bytes + line_bytes > max_batch_bytes:
+      batches.append('\n'.join(batch))
+      batch = []
+      batch_bytes = 0
+    batch.append(line)
+    batch_bytes += line_bytes
+  if batch:
+    batches.append('\n'.join(batch))
+  return batches
+
+
+class InfluxDbWriter(object):
+  """Writes line-protocol points to influxdb from a background thread.
+
+  Points are split into size-bounded batches which are gzip-encoded when
+  posted. Batches that cannot be written are appended to a local spool file
+  and retried with exponential backoff. While there are spooled batches, new
+  batches are spooled behind them so that the points are written in order.
+  Writing never blocks the caller; when too many batches are pending they
+  go directly to the spool. Batches left in the spool by an earlier writer
+  are retried as soon as this one starts.
+
+  Metrics:
+    InfluxDbPointsWritten: Counter of points accepted by the server.
+    InfluxDbPointsSpooled: Counter of points spooled for a later retry.
+    InfluxDbPointsDropped: Counter of points rejected by the server or
+       that did not fit in the spool.
+  """
+
+  # Separates the batches in the spool file.
+  # This cannot occur within a batch because points are single lines.
+  SPOOL_SEPARATOR = '\n\n'
+
+  @property
+  def spool_path(self):
+    return self.__spool_path
+
+  def __init__(self, url, spool_path, metrics_registry, http_client=None,
+               max_batch_bytes=DEFAULT_MAX_BATCH_BYTES, use_gzip=True,
+               max_pending_batches=100, max_spool_bytes=64 * 1024 * 1024,
+               backoff_secs=1, max_backoff_secs=300):
+    """Constructor.
+
+    Args:
+      url: [string] The influxdb write url including the database.
+      spool_path: [string] The file to spool failed batches into.
+         If it already exists, its batches are sent before any new ones.
+      metrics_registry: [BaseMetricsRegistry] Where to record metrics.
+      http_client: [HttpClient] The client to post with. By default this
+         is a client that does not retry since retries are done here.
+      max_batch_bytes: [int] The maximum size of each posted batch.
+      use_gzip: [bool] Whether to gzip-encode the posted batches.
+      max_pending_batches: [int] The number of batches to queue for the
+         background thread before spooling them instead.
+      max_spool_bytes: [int] Batches are dropped rather than spooled
+         once the spool file is this large.
+      backoff_secs: [float] The delay before the first retry of the spool.
+         This doubles with each failed retry up to max_backoff_secs.
+      max_backoff_secs: [float] The longest delay between retries.
+    """
+    self.__url = url
+    self.__spool_path = spool_path
+    self.__http_client = http_client or HttpClient(
+        max_retries=0, metrics_registry=metrics_registry)
+    self.__max_batch_bytes = max_batch_bytes
+    self.__use_gzip = use_gzip
+    self.__max_pending_batches = max_pending_batches
+    self.__max_spool_bytes = max_spool_bytes
+    self.__min_backoff_secs = backoff_secs
+    self.__max_backoff_secs = max_backoff_secs
+    self.__backoff_secs = backoff_secs
+    self.__next_retry_time = None
+
+    self.__written = metrics_registry.bind(
+        MetricFamily.COUNTER, 'InfluxDbPointsWritten')
+    self.__spooled = metrics_registry.bind(
+        MetricFamily.COUNTER, 'InfluxDbPointsSpooled')
+    self.__dropped = metrics_registry.bind(
+        MetricFamily.COUNTER, 'InfluxDbPointsDropped')
+
+    self.__condition = threading.Condition()
+    self.__pending = collections.deque()
+    self.__busy = False
+    self.__stopping = False
+    self.__spool_mutex = threading.Lock()
+    self.__spool_bytes = 0
+    if os.path.exists(spool_path):
+      self.__spool_bytes = os.path.getsize(spool_path)
+    if self.__spool_bytes:
+      logging.info('Replaying %d bytes of influxdb points left in %s',
+                   self.__spool_bytes, spool_path)
+      self.__next_retry_time = time.time()
+    self.__thread = threading.Thread(name='InfluxDbWriter', target=self.__run)
+    self.__thread.daemon = True
+    self.__thread.start()
+
+  def write(self, lines):
+    """Queues the line-protocol lines to be written."""
+    batches = split_into_batches(lines, self.__max_batch_bytes)
+    with self.__condition:
+      if not self.__stopping:
+        room = self.__max_pending_batches - len(self.__pending)
+        self.__pending.extend(batches[:max(room, 0)])
+        batches = batches[max(room, 0):]
+        self.__condition.notify()
+    if batches:
+      logging.warning('Spooling %d influxdb batches that could not be queued.',
+                      len(batches))
+      for batch in batches:
+        self.__spool(batch)
+      with self.__condition:
+        # Wake the thread to schedule the retry.
+        self.__condition.notify()
+
+  def flush(self, timeout_secs):
+    """Waits for the queued batches to be sent.
+
+    Spooled batches are not waited for.
+
+    Returns:
+      True if the queue was drained or False on timeout.
+    """
+    deadline = time.time() + timeout_secs
+    with self.__condition:
+      while self.__pending or self.__busy:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return False
+        self.__condition.wait(remaining)
+    return True
+
+  def close(self, timeout_secs):
+    """Sends the queued batches then stops the background thread.
+
+    The spool is retried once more before stopping. Anything that is still
+    spooled remains in the spool file.
+    """
+    with self.__condition:
+      self.__stopping = True
+      self.__condition.notify()
+    self.__thread.join(timeout_secs)
+    if self.__thread.is_alive():
+      logging.warning('Gave up waiting for influxdb writes to finish.')
+      return
+
+    self.__http_client.close()
+    if self.__spool_bytes:
+      logging.warning('Unwritten influxdb points remain in %s',
+                      self.__spool_path)
+
+  def __run(self):
+    """The background thread sending the batches."""
+    while True:
+      with self.__condition:
+        while not self.__pending and not self.__stopping:
+          if self.__next_retry_time is None:
+            self.__condition.wait()
+          else:
+            delay = self.__next_retry_time - time.time()
+            if delay <= 0:
+              break
+            self.__condition.wait(delay)
+        batch = self.__pending.popleft() if self.__pending else None
+        stopping = self.__stopping and batch is None
+        self.__busy = batch is not None
+      try:
+        if batch is not None:
+          if self.__spool_bytes or not self.__send(batch):
+            self.__spool(batch)
+        elif stopping:
+          if self.__spool_bytes:
+            self.__retry_spool()
+          return
+        elif (self.__next_retry_time is not None
+              and self.__next_retry_time <= time.time()):
+          self.__retry_spool()
+      finally:
+        with self.__condition:
+          self.__busy = False
+          self.__condition.notify_all()
+
+  def __send(self, batch):
+    """Posts the batch.
+
+    Returns:
+      False if the batch should be retried later.
+    """
+    num_points = batch.count('\n') + 1
+    body = batch.encode('utf-8')
+    headers = {'Content-Type': 'text/plain; charset=utf-8'}
+    if self.__use_gzip:
+      body = gzip_bytes(body)
+      headers['Content-Encoding'] = 'gzip'
+    try:
+      self.__http_client.request(
+          'POST', self.__url, body=body, headers=headers, endpoint='influxdb')
+    except HttpStatusError as ex:
+      if ex.code >= 500 or ex.code in HttpClient.RETRYABLE_STATUS_CODES:
+        logging.warning('Cannot write metrics to %s: %s', self.__url, ex)
+        return False
+      logging.error('Dropping %d points rejected by %s: %s\n%s',
+                    num_points, self.__url, ex, ex.body)
+      self.__dropped.inc(amount=num_points)
+      return True
+    except HttpRequestError as ex:
+      logging.warning('Cannot write metrics to %s: %s', self.__url, ex)
+      return False
+
+    logging.debug('Wrote %d points to %s', num_points, self.__url)
+    self.__written.inc(amount=num_points)
+    return True
+
+  def __spool(self, batch):
+    """Appends the batch to the spool file and schedules a retry."""
+    num_points = batch.count('\n') + 1
+    with self.__spool_mutex:
+      data = (batch + self.SPOOL_SEPARATOR).encode('utf-8')
+      if self.__spool_bytes + len(data) > self.__max_spool_bytes:
+        logging.error('Dropping %d points because the spool %s is full.',
+                      num_points, self.__spool_path)
+        self.__dropped.inc(amount=num_points)
+        return
+      ensure_dir_exists(os.path.dirname(self.__spool_path))
+      with open(self.__spool_path, 'ab') as stream:
+        stream.write(data)
+      self.__spool_bytes += len(data)
+      if self.__next_retry_time is None:
+        self.__next_retry_time = time.time() + self.__backoff_secs
+    self.__spooled.inc(amount=num_points)
+
+  def __retry_spool(self):
+    """Sends the spooled batches in order until one fails."""
+    with self.__spool_mutex:
+      with open(self.__spool_path, 'rb') as stream:
+        data = stream.read()
+      batches = [batch for batch in data.decode('utf-8').split(
+          self.SPOOL_SEPARATOR) if batch]
+      os.remove(self.__spool_path)
+      # The batches being retried still count toward max_spool_bytes.
+      retry_bytes = len(data)
+      self.__next_retry_time = None
+
+    for index, batch in enumerate(batches):
+      if not self.__send(batch):
+        break
+    else:
+      logging.info('Wrote %d spooled batches to %s', len(batches), self.__url)
+      with self.__spool_mutex:
+        self.__spool_bytes -= retry_bytes
+        self.__backoff_secs = self.__min_backoff_secs
+      return
+
+    # The remaining batches were already counted when first spooled.
+    remaining = self.SPOOL_SEPARATOR.join(batches[index:])
+    with self.__spool_mutex:
+      data = (remaining + self.SPOOL_SEPARATOR).encode('utf-8')
+      if os.path.exists(self.__spool_path):
+        # Newer batches were spooled while retrying so keep them after.
+        with open(self.__spool_path, 'rb') as stream:
+          data += stream.read()
+      with open(self.__spool_path, 'wb') as stream:
+        stream.write(data)
+      self.__spool_bytes = len(data)
+      self.__backoff_secs = min(self.__backoff_secs * 2,
+                                self.__max_backoff_secs)
+      self.__next_retry_time = time.time() + self.__backoff_secs
+    logging.warning('%d batches remain spooled. Retrying in %.1f secs.',
+                    len(batches) - index, self.__backoff_secs)
+
+
 class InfluxDbMetricsRegistry(InMemoryMetricsRegistry):
   @staticmethod
   def init_argument_parser(parser, defaults):
@@ -70,6 +369,22 @@ class InfluxDbMetricsRegistry(InMemoryMetricsRegistry):
         help='Reiterate gauge values for the specified period of seconds.'
              ' This is because when they get chunked into time blocks, the'
              'values become lost, in particular settling back to 0.')
+    add_parser_argument(
+        parser, 'influxdb_max_batch_bytes', defaults, DEFAULT_MAX_BATCH_BYTES,
+        type=int,
+        help='The maximum size of each batch of points written to influxdb.')
+    add_parser_argument(
+        parser, 'influxdb_gzip', defaults, True, type=bool,
+        help='Gzip-encode the batches written to influxdb.')
+    add_parser_argument(
+        parser, 'influxdb_spool_path', defaults, None,
+        help='The file to spool batches into when they cannot be written to'
+             ' influxdb. Batches left there by an earlier run are written'
+             ' first. The default is a file per command in the metrics'
+             ' directory.')
+    add_parser_argument(
+        parser, 'influxdb_flush_timeout_secs', defaults, 30, type=int,
+        help='How long to wait for the final influxdb writes on shutdown.')
 
   def __init__(self, *pos_args, **kwargs):
     super(InfluxDbMetricsRegistry, self).__init__(*pos_args, **kwargs)
@@ -79,10 +394,31 @@ class InfluxDbMetricsRegistry(InMemoryMetricsRegistry):
         'TIMER': self.__export_timer_points,
     }
     self.__recent_gauges = set([])
+    self.__writer = None
+    if self.options.monitoring_enabled:
+      self.__writer = self.__make_writer(self.options)
+
+  def __make_writer(self, options):
+    url = '{prefix}/write?db={db}'.format(
+        prefix=options.influxdb_url, db=options.influxdb_database)
+    spool_path = getattr(options, 'influxdb_spool_path', None)
+    if not spool_path:
+      dir_path = (options.metrics_dir
+                  or os.path.join(options.output_dir, 'metrics'))
+      spool_path = os.path.join(
+          dir_path,
+          'influxdb_spool__{command}.txt'.format(command=options.command))
+    return InfluxDbWriter(
+        url, spool_path, self,
+        max_batch_bytes=getattr(options, 'influxdb_max_batch_bytes',
+                                DEFAULT_MAX_BATCH_BYTES),
+        use_gzip=getattr(options, 'influxdb_gzip', True))
 
   def _do_flush_final_metrics(self):
     """Implements interface."""
     self.flush_updated_metrics()
+    self.__writer.close(
+        getattr(self.options, 'influxdb_flush_timeout_secs', 30))
 
   def _do_flush_updated_metrics(self, updated_metrics):
     """Implements interface.
@@ -111,16 +447,8 @@ class InfluxDbMetricsRegistry(InMemoryMetricsRegistry):
       logging.debug('No metrics updated.')
       return
 
-    url = '{prefix}/write?db={db}'.format(
-        prefix=self.options.influxdb_url, db=self.options.influxdb_database)
-    payload_text = '\n'.join(payload)
-    request = Request(url, data=str.encode(payload_text))
-    request.get_method = lambda: 'POST'
-    try:
-      urlopen(request)
-      logging.debug('Updated %d metrics to %s', len(payload), url)
-    except IOError as ioex:
-      logging.error('Cannot write metrics to %s:\n%s', url, ioex)
+    logging.debug('Queueing %d metric points for influxdb', len(payload))
+    self.__writer.write(payload)
 
   def __to_label_text(self, metric):
     return ','.join(['%s=%s' % (key, value)
@@ -175,7 +503,8 @@ class InfluxDbMetricsRegistry(InMemoryMetricsRegistry):
   def __export_timer_points(self, name, label_text, metric, payload):
     prev_count = 0
     prev_total = 0
-    for entry in metric.mark_as_delta():
+    entries = metric.mark_as_delta()
+    for entry in entries:
       count = entry.value[0]
       total_secs = entry.value[1]
       delta_count = count - prev_count
@@ -192,3 +521,27 @@ class InfluxDbMetricsRegistry(InMemoryMetricsRegistry):
       payload.append(
           self.__to_payload_line('AvgSecs', name, label_text,
                                  avg_secs, entry.utc))
+    if entries:
+      self.__export_timer_histogram(
+          name, label_text, metric, entries[-1].utc, payload)
+
+  def __export_timer_histogram(self, name, label_text, metric, utc, payload):
+    """Export the histogram bucket and quantile series of a timer.
+
+    The buckets are exported as the number of timings added to each
+    bucket since the last export, tagged with their upper bound "le", so
+    they can be summed across processes like the counters. The quantiles
+    are the current estimates over the lifetime of this process.
+    """
+    bounds = ['%g' % bound for bound in metric.bucket_bounds] + ['+Inf']
+    for bound, delta in zip(bounds, metric.mark_bucket_deltas()):
+      if delta:
+        bucket_label_text = ','.join(
+            [text for text in [label_text, 'le=' + bound] if text])
+        payload.append(
+            self.__to_payload_line('bucket', name, bucket_label_text,
+                                   delta, utc))
+    for quantile, value in sorted(metric.summarize_quantiles().items()):
+      if value is not None:
+        payload.append(
+            self.__to_payload_line(quantile, name, label_text, value, utc))
@@ -28,14 +28,23 @@ files which could help identify the context of the metrics. In addition
 the CLI argv parameters are added into the files to help give context.
 
 All the state changes are recorded and held for the lifetime of the process.
-Although some scripts take a long time to execute, they shouldnt be producing
-many state changes in metrics so this should not be a big deal. Keeping
-all the values is almost as simple as having a single aggregation, but provides
-some insight into sequencing and other flow details. Keeping all the data
-provides high resolution for timing but is motivated by simplicity.
+Keeping all the values is almost as simple as having a single aggregation,
+but provides some insight into sequencing and other flow details. Keeping
+all the data provides high resolution for timing but is motivated by
+simplicity. Since long running commands can produce many thousands of
+changes, each metric keeps them in a compact TimeSeries that downsamples
+the older changes once it reaches --metrics_timeseries_capacity.
+
+Rewriting the whole snapshot on every flush becomes expensive for long
+running processes. With --metrics_journal the data points are instead
+appended to a JSON-lines journal as they are flushed, so each flush only
+costs the new data points. compact_metrics_journal turns a journal back
+into the snapshot that would have been written.
 """
 
 
+from array import array
+import bisect
 import collections
 import datetime
 import json
@@ -46,6 +55,7 @@ import threading
 
 from buildtool import (
     add_parser_argument,
+    ensure_dir_exists,
     write_to_path)
 
 from buildtool.base_metrics import (
@@ -66,6 +76,103 @@ class DataPoint(collections.namedtuple('DataPoint', ['value', 'utc'])):
   pass
 
 
+EPOCH = datetime.datetime(1970, 1, 1)
+DEFAULT_TIMESERIES_CAPACITY = 10000
+
+
+def decode_number(values):
+  """Decodes a single value stored in a TimeSeries."""
+  value = values[0]
+  return int(value) if value.is_integer() else value
+
+
+class TimeSeries(object):
+  """A bounded series of DataPoint stored in parallel arrays.
+
+  The times are stored as epoch seconds and each component of the values
+  in its own array('d'). Once the series grows past its capacity, the oldest
+  half is downsampled by keeping only the points with the minimum, maximum
+  and last value in each bucket of DOWNSAMPLE_BUCKET_SIZE points.
+
+  Named cursors track how far readers such as mark() have consumed the
+  series. They are adjusted when downsampling so that each remaining point
+  is still returned exactly once.
+
+  This is not thread-safe; the metrics guard it with their own mutex.
+  """
+
+  DOWNSAMPLE_BUCKET_SIZE = 16
+
+  def __init__(self, width=1, capacity=None, decode=decode_number):
+    """Constructor.
+
+    Args:
+      width: [int] The number of components in each value.
+      capacity: [int] The number of points to hold before downsampling.
+         None or 0 is unbounded.
+      decode: [callable] Converts the tuple of stored components back into
+         a DataPoint value.
+    """
+    self.__times = array('d')
+    self.__columns = tuple([array('d') for _ in range(width)])
+    self.__capacity = capacity
+    self.__decode = decode
+    self.__cursors = {}
+
+  def __len__(self):
+    return len(self.__times)
+
+  def __getitem__(self, index):
+    return DataPoint(
+        self.__decode([column[index] for column in self.__columns]),
+        EPOCH + datetime.timedelta(seconds=self.__times[index]))
+
+  def append(self, value, utc):
+    """Adds a data point, downsampling the oldest points if full."""
+    self.__times.append((utc - EPOCH).total_seconds())
+    if len(self.__columns) == 1:
+      self.__columns[0].append(value)
+    else:
+      for column, component in zip(self.__columns, value):
+        column.append(component)
+    if self.__capacity and len(self.__times) > self.__capacity:
+      self.__downsample(len(self.__times) // 2)
+
+  def points(self, start=0):
+    """Returns the list of DataPoint from the given position."""
+    return [self[index] for index in range(start, len(self.__times))]
+
+  def take(self, cursor):
+    """Returns the DataPoint since the named cursor then advances it."""
+    start = self.__cursors.get(cursor, 0)
+    self.__cursors[cursor] = len(self.__times)
+    return self.points(start)
+
+  def __downsample(self, end):
+    """Downsamples the points before end."""
+    key = self.__columns[0]
+    size = self.DOWNSAMPLE_BUCKET_SIZE
+    keep = []
+    for start in range(0, end, size):
+      bucket = range(start, min(start + size, end))
+      keep.extend(sorted(set([min(bucket, key=key.__getitem__),
+                              max(bucket, key=key.__getitem__),
+                              bucket[-1]])))
+
+    self.__times = (array('d', [self.__times[index] for index in keep])
+                    + self.__times[end:])
+    self.__columns = tuple([
+        array('d', [column[index] for index in keep]) + column[end:]
+        for column in self.__columns])
+
+    removed = end - len(keep)
+    for cursor, position in self.__cursors.items():
+      if position >= end:
+        self.__cursors[cursor] = position - removed
+      else:
+        self.__cursors[cursor] = bisect.bisect_left(keep, position)
+
+
 class InMemoryCounter(Counter):
   """Specializes for in memory tracking.
 
@@ -84,17 +191,18 @@ class InMemoryCounter(Counter):
 
   def __init__(self, family, labels):
     super(InMemoryCounter, self).__init__(family, labels)
-    self.__timeseries = []
+    self.__timeseries = TimeSeries(
+        capacity=family.registry.timeseries_capacity)
     self.__timeseries_mutex = threading.Lock()
-    self.__mark = (0, 0)
+    self.__mark_value = 0
 
   def mark(self):
     """Return the slice of changes since the last mark."""
     with self.__timeseries_mutex:
-      count = len(self.__timeseries)
-      start = self.__mark[0]
-      self.__mark = (count, self.__timeseries[-1][0])
-    return self.__timeseries[start:count]
+      result = self.__timeseries.take('mark')
+      if result:
+        self.__mark_value = result[-1].value
+    return result
 
   def mark_as_delta(self):
     """Return the slice of changes since the last mark.
@@ -102,7 +210,7 @@ class InMemoryCounter(Counter):
     Return values as delta since previous known value.
     """
     with self.__timeseries_mutex:
-      prev_value = self.__mark[1]
+      prev_value = self.__mark_value
     raw_result = self.mark()
     result = []
     for entry in raw_result:
@@ -111,16 +219,29 @@ class InMemoryCounter(Counter):
 
     return result
 
+  def mark_journal(self):
+    """Return the slice of changes since the last mark_journal.
+
+    This is independent of mark() so both can be used together.
+    """
+    with self.__timeseries_mutex:
+      return self.__timeseries.take('journal')
+
+  @staticmethod
+  def to_snapshot_values(points):
+    """Return the snapshot values for a list of DataPoint."""
+    return [{'time': point.utc.isoformat(), 'value': point.value}
+            for point in points]
+
   def touch(self, utc=None):
     super(InMemoryCounter, self).touch(utc=utc)
     with self.__timeseries_mutex:
-      self.__timeseries.append(DataPoint(self.count, self.last_modified))
+      self.__timeseries.append(self.count, self.last_modified)
 
   def append_to_metrics_snapshot(self, snapshot):
     """Add this counter to the given tsnapshot."""
     with self.__timeseries_mutex:
-      values = [{'time': point.utc.isoformat(), 'value': point.value}
-                for point in self.__timeseries]
+      values = self.to_snapshot_values(self.__timeseries.points())
     family_timeseries = snapshot[self.CATEGORY][self.name]['collectors']
     family_timeseries.append({
         'labels': self.labels,
@@ -140,32 +261,38 @@ class InMemoryGauge(Gauge):
 
   def __init__(self, family, labels):
     super(InMemoryGauge, self).__init__(family, labels)
-    self.__timeseries = []
+    self.__timeseries = TimeSeries(
+        capacity=family.registry.timeseries_capacity)
     self.__timeseries_mutex = threading.Lock()
-    self.__mark = 0
 
   def mark(self):
     """Return the slice of changes since the last mark."""
     with self.__timeseries_mutex:
-      count = len(self.__timeseries)
-      start = self.__mark
-      self.__mark = count
-    return self.__timeseries[start:count]
+      return self.__timeseries.take('mark')
 
   def mark_as_delta(self):
     return self.mark()
 
+  def mark_journal(self):
+    """Return the slice of changes since the last mark_journal."""
+    with self.__timeseries_mutex:
+      return self.__timeseries.take('journal')
+
+  @staticmethod
+  def to_snapshot_values(points):
+    """Return the snapshot values for a list of DataPoint."""
+    return [{'time': point.utc.isoformat(), 'value': point.value}
+            for point in points]
+
   def touch(self, utc=None):
     super(InMemoryGauge, self).touch(utc=utc)
-    data_point = DataPoint(self.value, self.last_modified)
     with self.__timeseries_mutex:
-      self.__timeseries.append(data_point)
+      self.__timeseries.append(self.value, self.last_modified)
 
   def append_to_metrics_snapshot(self, snapshot):
     """Add this gauge to the given snapshot."""
     with self.__timeseries_mutex:
-      values = [{'time': point.utc.isoformat(), 'value': point.value}
-                for point in self.__timeseries]
+      values = self.to_snapshot_values(self.__timeseries.points())
 
     family_timeseries = snapshot[self.CATEGORY][self.name]['collectors']
     family_timeseries.append({
@@ -182,19 +309,20 @@ class InMemoryTimer(Timer):
 
   def __init__(self, family, labels):
     super(InMemoryTimer, self).__init__(family, labels)
-    self.__timeseries = []
+    self.__timeseries = TimeSeries(
+        width=2, capacity=family.registry.timeseries_capacity,
+        decode=lambda values: (int(values[0]), values[1]))
     self.__timeseries_mutex = threading.Lock()
-    self.__mark = (0, 0, 0)
+    self.__mark_value = (0, 0)
+    self.__mark_bucket_counts = [0] * (len(self.bucket_bounds) + 1)
 
   def mark(self):
     """Return the slice of changes since the last mark."""
     with self.__timeseries_mutex:
-      count = len(self.__timeseries)
-      start = self.__mark[0]
-      self.__mark = (count,
-                     self.__timeseries[-1][0][0],
-                     self.__timeseries[-1][0][1])
-    return self.__timeseries[start:count]
+      result = self.__timeseries.take('mark')
+      if result:
+        self.__mark_value = result[-1].value
+    return result
 
   def mark_as_delta(self):
     """Return the slice of changes since the last mark.
@@ -202,8 +330,7 @@ class InMemoryTimer(Timer):
     Return values as delta since previous known value.
     """
     with self.__timeseries_mutex:
-      prev_count = self.__mark[1]
-      prev_total = self.__mark[2]
+      prev_count, prev_total = self.__mark_value
 
     raw_result = self.mark()
     result = []
@@ -214,23 +341,55 @@ class InMemoryTimer(Timer):
 
     return result
 
+  def mark_bucket_deltas(self):
+    """Return the number of timings added to each bucket since the last call.
+    """
+    bucket_counts = self.bucket_counts
+    with self.__timeseries_mutex:
+      result = [count - prev for count, prev
+                in zip(bucket_counts, self.__mark_bucket_counts)]
+      self.__mark_bucket_counts = bucket_counts
+    return result
+
+  def mark_journal(self):
+    """Return the slice of changes since the last mark_journal."""
+    with self.__timeseries_mutex:
+      return self.__timeseries.take('journal')
+
+  def to_snapshot_histogram(self):
+    """Return the histogram and quantile sketch for the snapshot."""
+    with self.mutex:
+      sketch = self.sketch.to_dict()
+    quantiles = self.summarize_quantiles()
+    return {'bucketBounds': self.bucket_bounds,
+            'bucketCounts': self.bucket_counts,
+            'quantiles': {name: quantiles[name] for name, _ in self.QUANTILES},
+            'maxSecs': quantiles['max'],
+            'sketch': sketch}
+
+  @staticmethod
+  def to_snapshot_values(points):
+    """Return the snapshot values for a list of DataPoint."""
+    return [{'time': point.utc.isoformat(),
+             'count': point.value[0],
+             'totalSecs': point.value[1]}
+            for point in points]
+
   def touch(self, utc=None):
     super(InMemoryTimer, self).touch(utc=utc)
     with self.__timeseries_mutex:
-      self.__timeseries.append(DataPoint((self.count, self.total_seconds),
-                                         self.last_modified))
+      self.__timeseries.append((self.count, self.total_seconds),
+                               self.last_modified)
 
   def append_to_metrics_snapshot(self, snapshot):
-    """Add this gauge to the given snapshot."""
+    """Add this timer to the given snapshot."""
     with self.__timeseries_mutex:
-      values = [{'time': point.utc.isoformat(),
-                 'count': point.value[0],
-                 'totalSecs': point.value[1]}
-                for point in self.__timeseries]
+      values = self.to_snapshot_values(self.__timeseries.points())
     family_timeseries = snapshot[self.CATEGORY][self.name]['collectors']
     family_timeseries.append({
         'labels': self.labels,
-        'values': values})
+        'values': values,
+        'histogram': self.to_snapshot_histogram()})
     return len(values)
 
 
@@ -246,10 +405,27 @@ class InMemoryMetricsRegistry(BaseMetricsRegistry):
     add_parser_argument(
         parser, 'metrics_dir', defaults, None,
         help='Path to file to write metrics into')
+    add_parser_argument(
+        parser, 'metrics_timeseries_capacity', defaults,
+        DEFAULT_TIMESERIES_CAPACITY, type=int,
+        help='The number of data points to keep for each metric before'
+             ' downsampling the older ones. 0 keeps every data point.')
+    add_parser_argument(
+        parser, 'metrics_journal', defaults, False, type=bool,
+        help='Append new data points to a JSON-lines journal on each flush'
+             ' rather than rewriting the entire snapshot. Use the'
+             ' compact_metrics_journals command to produce the snapshot.')
     parser.added_inmemory = True
 
+  @property
+  def timeseries_capacity(self):
+    """The capacity of each metric's TimeSeries."""
+    return self.__timeseries_capacity
+
   def __init__(self, options):
     super(InMemoryMetricsRegistry, self).__init__(options)
+    self.__timeseries_capacity = getattr(
+        options, 'metrics_timeseries_capacity', DEFAULT_TIMESERIES_CAPACITY)
     self.__metrics_snapshot_prototype = {
         SNAPSHOT_CATEGORY[MetricFamily.COUNTER]: {},
         SNAPSHOT_CATEGORY[MetricFamily.GAUGE]: {},
@@ -265,6 +441,8 @@ class InMemoryMetricsRegistry(BaseMetricsRegistry):
     self.__known_gauge_families = {}
 
     self.__metrics_path = None
+    self.__journal_path = None
+    self.__journal_mutex = threading.Lock()
     if not options.monitoring_enabled:
       logging.warning('Monitoring is disabled')
       return
@@ -276,7 +454,11 @@ class InMemoryMetricsRegistry(BaseMetricsRegistry):
         dir_path,
         'metrics__{command}__{pid}.json'.format(
             command=options.command, pid=pid))
-    logging.debug('Metrics snapshots will write to %s', self.__metrics_path)
+    if getattr(options, 'metrics_journal', False):
+      self.__journal_path = os.path.splitext(self.__metrics_path)[0] + '.jsonl'
+      logging.debug('Metrics journal will write to %s', self.__journal_path)
+    else:
+      logging.debug('Metrics snapshots will write to %s', self.__metrics_path)
 
   def _do_make_family(
       self, family_type, name, label_names):
@@ -301,16 +483,64 @@ class InMemoryMetricsRegistry(BaseMetricsRegistry):
 
   def __flush_snapshot(self, snapshot):
     """Writes metric snapshot to file."""
-    text = json.JSONEncoder(indent=2, separators=(',', ': ')).encode(snapshot)
+    write_metrics_snapshot(snapshot, self.__metrics_path)
+
+  def __append_to_journal(self, metrics, final_record=None):
+    """Appends the data points not yet in the journal for the given metrics.
 
-    # Use intermediate temp file to not clobber old snapshot metrics on failure.
-    metrics_path = self.__metrics_path
-    tmp_path = metrics_path + '.tmp'
-    write_to_path(text, tmp_path)
-    os.rename(tmp_path, metrics_path)
+    The first record in the journal has the snapshot attributes other than
+    the metrics themselves. Each other record has the new values of one
+    metric since its last mark_journal.
+    """
+    encoder = json.JSONEncoder(separators=(',', ':'))
+    records = []
+    datapoint_count = 0
+    for metric in metrics:
+      points = metric.mark_journal()
+      if not points:
+        continue
+      datapoint_count += len(points)
+      records.append({
+          'journal': 'points',
+          'category': SNAPSHOT_CATEGORY[metric.family.family_type],
+          'name': metric.name,
+          'type': metric.family.family_type,
+          'labels': metric.labels,
+          'values': metric.to_snapshot_values(points)})
+      if metric.family.family_type == MetricFamily.TIMER:
+        records[-1]['histogram'] = metric.to_snapshot_histogram()
+    if final_record:
+      records.append(final_record)
+
+    with self.__journal_mutex:
+      if not os.path.exists(self.__journal_path):
+        header = {key: value
+                  for key, value in self.__metrics_snapshot_prototype.items()
+                  if key not in SNAPSHOT_CATEGORY.values()}
+        header['journal'] = 'header'
+        records.insert(0, header)
+      if not records:
+        return datapoint_count
+      ensure_dir_exists(os.path.dirname(os.path.abspath(self.__journal_path)))
+      with open(self.__journal_path, 'a') as stream:
+        stream.write(''.join([encoder.encode(record) + '\n'
+                              for record in records]))
+    return datapoint_count
 
   def _do_flush_final_metrics(self):
     """Writes metrics to file."""
+    if self.__journal_path:
+      all_metrics = [metric
+                     for family in self.metric_family_list
+                     for metric in family.instance_list]
+      datapoint_count = self.__append_to_journal(
+          all_metrics,
+          final_record={'journal': 'end',
+                        'end_time': datetime.datetime.utcnow().isoformat()})
+      logging.debug('Flushing final %d data points to journal %s',
+                    datapoint_count, self.__journal_path)
+      return
+
     snapshot, metric_count, datapoint_count = self.make_snapshot()
     logging.debug('Flushing final snapshot with %d data points over %d metrics',
                   datapoint_count, metric_count)
@@ -318,6 +548,10 @@ class InMemoryMetricsRegistry(BaseMetricsRegistry):
 
   def _do_flush_updated_metrics(self, updated_metrics):
     """Implements interface."""
+    if self.__journal_path:
+      self.__append_to_journal(updated_metrics)
+      return
+
     snapshot, _, _ = self.make_snapshot()
     self.__flush_snapshot(snapshot)
 
@@ -338,3 +572,54 @@ class InMemoryMetricsRegistry(BaseMetricsRegistry):
     }
     factory = type_to_factory[family_type]
     return MetricFamily(self, name, factory, family_type)
+
+
+def compact_metrics_journal(journal_path):
+  """Returns the metrics snapshot equivalent to a metrics journal.
+
+  This is the snapshot InMemoryMetricsRegistry would have written without
+  --metrics_journal.
+  """
+  snapshot = {category: {} for category in SNAPSHOT_CATEGORY.values()}
+  collectors = {}
+  last_time = None
+  with open(journal_path, 'r') as stream:
+    for line in stream:
+      if not line.strip():
+        continue
+      record = json.loads(line)
+      kind = record.pop('journal')
+      if kind != 'points':
+        snapshot.update(record)
+        continue
+
+      family = snapshot[record['category']].setdefault(
+          record['name'],
+          {'name': record['name'], 'type': record['type'], 'collectors': []})
+      key = (record['category'], record['name'],
+             tuple(sorted(record['labels'].items())))
+      collector = collectors.get(key)
+      if collector is None:
+        collector = {'labels': record['labels'], 'values': []}
+        collectors[key] = collector
+        family['collectors'].append(collector)
+      collector['values'].extend(record['values'])
+      if 'histogram' in record:
+        # Each record has the complete histogram so far.
+        collector['histogram'] = record['histogram']
+      last_time = max(last_time or '', record['values'][-1]['time'])
+
+  if 'end_time' not in snapshot:
+    # The process did not shut down cleanly.
+    snapshot['end_time'] = last_time or snapshot.get('start_time')
+  return snapshot
+
+
+def write_metrics_snapshot(snapshot, path):
+  """Writes a metrics snapshot in the format InMemoryMetricsRegistry does."""
+  text = json.JSONEncoder(indent=2, separators=(',', ': ')).encode(snapshot)
+
+  # Use intermediate temp file to not clobber old snapshot metrics on failure.
+  tmp_path = path + '.tmp'
+  write_to_path(text, tmp_path)
+  os.rename(tmp_path, path)
@@ -54,26 +54,31 @@ import json
 import logging
 import os
 import re
+import shutil
 import sys
 import yaml
 
-try:
-  from urllib2 import urlopen, HTTPError, Request
-except ImportError:
-  from urllib.request import urlopen, Request
-  from urllib.error import HTTPError
-
-
 from buildtool import (
+    BomIndex,
+    BomServiceTable,
     CommandFactory,
     CommandProcessor,
+    HttpClient,
+    HttpStatusError,
     SemanticVersion,
     check_options_set,
     check_path_exists,
     check_subprocess,
+    data_format_for_path,
+    ensure_dir_exists,
     exception_to_message,
+    find_data_path,
+    intermediate_path,
+    load_data_from_path,
     maybe_log_exception,
     raise_and_log_error,
+    run_subprocess,
+    write_data_to_path,
     write_to_path,
     ConfigError,
     UnexpectedError,
@@ -89,6 +94,122 @@ if sys.version_info[0] == 2:
 yaml.Dumper.ignore_aliases = lambda *args: True
 
 
+class BomStorage(object):
+  """Interface to the storage containing the published boms."""
+
+  def list_bom_urls(self, url_prefix):
+    """Returns the urls of all the boms beginning with url_prefix."""
+    return sorted(self.list_bom_generations(url_prefix).keys())
+
+  def list_bom_generations(self, url_prefix):
+    """Returns the generation of each bom beginning with url_prefix.
+
+    The generation is an opaque string that changes whenever the bom does.
+
+    Returns:
+      A dictionary of generation strings keyed by bom url.
+    """
+    raise NotImplementedError()
+
+  def fetch_boms_to_dir(self, urls, local_dir):
+    """Copies all the boms into a local directory in bulk.
+
+    Returns:
+      A dictionary keyed by url of the local path for each bom copied.
+      Urls that could not be copied are omitted.
+    """
+    raise NotImplementedError()
+
+
+class GsutilBomStorage(BomStorage):
+  """Accesses the boms in Google Cloud Storage using gsutil."""
+
+  def list_bom_generations(self, url_prefix):
+    """Implements interface.
+
+    "gsutil ls -L" lists only the live objects, even in versioned buckets,
+    each as a "<url>:" line followed by its indented metadata. The
+    generation is the object's GCS generation, as ha_image_janitor also
+    records it into a shared index.
+    """
+    result = {}
+    url = None
+    for line in check_subprocess('gsutil ls -L ' + url_prefix).split('\n'):
+      if line.startswith('gs://') and line.endswith(':'):
+        url = line[:-1]
+      elif url and line.strip().startswith('Generation:'):
+        if url.startswith(url_prefix) and url.endswith('.yml'):
+          result[url] = line.split(':', 1)[1].strip()
+        url = None
+    return result
+
+  def fetch_boms_to_dir(self, urls, local_dir):
+    """Implements interface.
+
+    This uses a single parallel gsutil rather than one process per bom.
+    """
+    ensure_dir_exists(local_dir)
+    url_list_path = os.path.join(local_dir, 'bom_urls.txt')
+    write_to_path('\n'.join(urls), url_list_path)
+    retcode, stdout = run_subprocess(
+        'gsutil -m -q cp -I "{dir}" < "{list}"'.format(
+            dir=local_dir, list=url_list_path),
+        shell=True)
+    if retcode != 0:
+      logging.warning('Some boms could not be copied:\n%s', stdout)
+
+    result = {}
+    for url in urls:
+      path = os.path.join(local_dir, url[url.rfind('/') + 1:])
+      if os.path.exists(path):
+        result[url] = path
+    return result
+
+
+class FileSystemBomStorage(BomStorage):
+  """Stands in for bom storage using a local directory.
+
+  A "gs://" url corresponds to the path under the root directory.
+  """
+
+  def __init__(self, root_dir):
+    self.__root_dir = root_dir
+
+  def __url_to_path(self, url):
+    return os.path.join(self.__root_dir, url[len('gs://'):])
+
+  def list_bom_generations(self, url_prefix):
+    """Implements interface.
+
+    The generation is derived from the file's modification time and size.
+    """
+    path_prefix = self.__url_to_path(url_prefix)
+    parent_dir = os.path.dirname(path_prefix)
+    if not os.path.isdir(parent_dir):
+      return {}
+    url_dir = url_prefix[:url_prefix.rfind('/') + 1]
+    result = {}
+    for name in os.listdir(parent_dir):
+      path = os.path.join(parent_dir, name)
+      if path.startswith(path_prefix) and name.endswith('.yml'):
+        stat = os.stat(path)
+        result[url_dir + name] = '%.6f:%d' % (stat.st_mtime, stat.st_size)
+    return result
+
+  def fetch_boms_to_dir(self, urls, local_dir):
+    """Implements interface."""
+    ensure_dir_exists(local_dir)
+    result = {}
+    for url in urls:
+      source_path = self.__url_to_path(url)
+      if not os.path.exists(source_path):
+        continue
+      path = os.path.join(local_dir, url[url.rfind('/') + 1:])
+      shutil.copyfile(source_path, path)
+      result[url] = path
+    return result
+
+
 class CollectBomVersions(CommandProcessor):
   """Determine which artifact versions are in use by which boms.
 
@@ -102,7 +223,11 @@ class CollectBomVersions(CommandProcessor):
   released boms and the other unreleased boms. Unreleased boms are not
   necessarily obsolete.
 
+  The analysis of each bom is kept in a BomIndex that persists between runs
+  so only boms that are new or changed since the last run are read again.
+
   Emits files:
+     bom_index.db: The BomIndex unless --bom_index_path says otherwise.
      bom_list.txt: A list of all the boms, released and unreleased
      bad_boms.txt: A list of malformed boms with what makes it malformed.
      all_bom_sevice_map.yml: The inverse service version mapping of all the boms
@@ -132,7 +257,11 @@ class CollectBomVersions(CommandProcessor):
           ConfigError('Either neither or both "bintray_org"'
                       ' and "bintray_debian_repository" should be specified'))
     self.__bad_files = {}
-    self.__non_standard_boms = {}
+    self.__bom_storage = kwargs.pop('bom_storage', None) or GsutilBomStorage()
+    self.__local_bom_paths = {}
+
+    # The (bom_info, services) of each bom analyzed keyed by url.
+    self.__analyzed_boms = {}
 
     # We're going to have a bunch of threads each writing into different keys
     # in order to deconflict with one another lockless. Then we'll aggregate
@@ -150,11 +279,18 @@ class CollectBomVersions(CommandProcessor):
         factory, options, **kwargs)
 
   def load_bom_from_url(self, url):
-    """Returns the bom specification dict from a gcs url."""
+    """Returns the bom specification dict from the local copy of a gcs url.
+
+    The boms should have already been copied by fetch_boms.
+    """
     logging.debug('Loading %s', url)
     try:
-      text = check_subprocess('gsutil cat ' + url)
-      return yaml.safe_load(text)
+      path = self.__local_bom_paths.get(url)
+      if path is None:
+        raise_and_log_error(
+            ResponseError('Could not copy {url}'.format(url=url),
+                          server='gcs'))
+      return load_data_from_path(path)
     except Exception as ex:
       self.__bad_files[self.url_to_bom_name(url)] = exception_to_message(ex)
       maybe_log_exception('load_from_from_url', ex,
@@ -183,12 +319,6 @@ class CollectBomVersions(CommandProcessor):
 
     add_if_nonstandard('dockerRegistry', self.__expect_docker_registry)
     add_if_nonstandard('debianRepository', self.__expect_debian_repository)
-    if len(info) > 2:
-      problems = dict(info)
-      del problems['bom_version']
-      del problems['bom_timestamp']
-      self.__non_standard_boms[bom['version']] = problems
-
     return info
 
   def analyze_bom(self, bom):
@@ -196,6 +326,9 @@ class CollectBomVersions(CommandProcessor):
 
     Boms are processed within a single thread, but multiple boms can be
     processed in different threads.
+
+    Returns:
+      The bom_info identifying the bom.
     """
     tid = current_thread().name
     thread_service_map = self.__per_thread_result_map.get(tid, {})
@@ -205,14 +338,7 @@ class CollectBomVersions(CommandProcessor):
     for name, entry in bom['services'].items():
       if name == 'defaultArtifact':
         continue
-      build_version = entry['version']
-      parts = build_version.split('-', 1)
-      if len(parts) == 1:
-        version = parts[0]
-        buildnum = 'NotRecorded'
-      else:
-        version, buildnum = parts
-
+      version, buildnum = BomIndex.split_build_version(entry['version'])
       commit = entry.get('commit', 'NotRecorded')
       service_record = thread_service_map.get(name)
       if service_record is None:
@@ -233,6 +359,8 @@ class CollectBomVersions(CommandProcessor):
 
       build_list.append(bom_info)
 
+    return bom_info
+
   def ingest_bom(self, line):
     """Function to ingest a single bom into the result map."""
     bom = self.load_bom_from_url(line)
@@ -244,7 +372,8 @@ class CollectBomVersions(CommandProcessor):
         self.__bad_files[self.url_to_bom_name(line.strip())] = message
         logging.warning(message)
         raise_and_log_error(UnexpectedError(message))
-      self.analyze_bom(bom)
+      bom_info = self.analyze_bom(bom)
+      self.__analyzed_boms[line] = (bom_info, bom['services'])
     except Exception as ex:
       self.__bad_files[self.url_to_bom_name(line.strip())] = (
           exception_to_message(ex))
@@ -294,8 +423,18 @@ class CollectBomVersions(CommandProcessor):
       join_results(thread_results, result_map)
     return result_map
 
+  def fetch_boms(self, bom_list):
+    """Copy all the boms in the list into a local mirror directory."""
+    mirror_dir = os.path.join(self.get_output_dir(), 'bom_mirror')
+    logging.info('Copying %d boms into %s', len(bom_list), mirror_dir)
+    self.__local_bom_paths = self.__bom_storage.fetch_boms_to_dir(
+        bom_list, mirror_dir)
+
   def ingest_bom_list(self, bom_list):
     """Ingest each of the boms."""
+    if not bom_list:
+      return self.join_result_maps()
+    self.fetch_boms(bom_list)
     max_threads = 1 if self.options.one_at_a_time else 64
     pool = ThreadPool(min(max_threads, len(bom_list)))
     pool.map(self.ingest_bom, bom_list)
@@ -305,9 +444,43 @@ class CollectBomVersions(CommandProcessor):
 
   def list_bom_urls(self, gcs_dir_url_prefix):
     """Get a list of all the bom versions that exist."""
-    result = check_subprocess('gsutil ls ' + gcs_dir_url_prefix)
-    return [line for line in result.split('\n')
-            if line.startswith(gcs_dir_url_prefix) and line.endswith('.yml')]
+    return self.__bom_storage.list_bom_urls(gcs_dir_url_prefix)
+
+  def open_bom_index(self):
+    """Opens the persistent BomIndex."""
+    path = (self.options.bom_index_path
+            or os.path.join(self.get_output_dir(), 'bom_index.db'))
+    logging.debug('Opening BOM index %s', path)
+    return BomIndex(path, discard_incompatible=True)
+
+  def update_bom_index(self, index, url_prefix):
+    """Bring the index up to date with the boms beginning with url_prefix.
+
+    Only boms that are new or whose generation changed are ingested.
+
+    Returns:
+      The sorted list of bom urls.
+    """
+    logging.debug('Listing BOM urls')
+    generations = self.__bom_storage.list_bom_generations(url_prefix)
+    removed = index.remove_missing_boms(url_prefix, generations.keys())
+    stale_urls = index.find_stale_urls(generations)
+    logging.info('Ingesting %d new or changed boms of %d (%d removed)',
+                 len(stale_urls), len(generations), removed)
+
+    self.ingest_bom_list(stale_urls)
+    for url in stale_urls:
+      analysis = self.__analyzed_boms.get(url)
+      if analysis is not None:
+        index.add_bom(url, generations[url], analysis[0], analysis[1])
+      elif url in self.__local_bom_paths:
+        # Boms that could not be copied are not remembered as bad
+        # so that they are retried next time.
+        index.add_bad_bom(
+            url, generations[url],
+            self.__bad_files.get(self.url_to_bom_name(url), 'Unknown'))
+    index.commit()
+    return sorted(generations.keys())
 
   def _do_command(self):
     """Reads the list of boms, then concurrently processes them.
@@ -318,52 +491,70 @@ class CollectBomVersions(CommandProcessor):
     url_prefix = 'gs://%s/bom/' % options.halyard_bom_bucket
     if options.version_name_prefix:
       url_prefix += options.version_name_prefix
-    logging.debug('Listing BOM urls')
-    results = self.list_bom_urls(url_prefix)
-    write_to_path('\n'.join(sorted(results)),
+    index = self.open_bom_index()
+    try:
+      results = self.update_bom_index(index, url_prefix)
+      result_map = index.to_service_map(url_prefix)
+      bad_files = index.bad_boms(url_prefix)
+      bad_files.update(self.__bad_files)
+      non_standard_boms = index.nonstandard_boms(url_prefix)
+    finally:
+      index.close()
+
+    write_to_path('\n'.join(results),
                   os.path.join(self.get_output_dir(), 'bom_list.txt'))
-    result_map = self.ingest_bom_list(results)
 
-    path = os.path.join(self.get_output_dir(), 'all_bom_service_map.yml')
+    path = intermediate_path(
+        os.path.join(self.get_output_dir(), 'all_bom_service_map.yml'))
     logging.info('Writing bom analysis to %s', path)
-    write_to_path(yaml.safe_dump(result_map, default_flow_style=False), path)
+    write_data_to_path(result_map, path)
 
     partition_names = ['released', 'unreleased']
     partitions = self.partition_service_map(result_map)
     for index, data in enumerate(partitions):
-      path = os.path.join(self.get_output_dir(),
-                          partition_names[index] + '_bom_service_map.yml')
+      path = intermediate_path(
+          os.path.join(self.get_output_dir(),
+                       partition_names[index] + '_bom_service_map.yml'))
       logging.info('Writing bom analysis to %s', path)
-      write_to_path(yaml.safe_dump(data, default_flow_style=False), path)
+      write_data_to_path(data, path)
 
-    if self.__bad_files:
-      path = os.path.join(self.get_output_dir(), 'bad_boms.txt')
-      logging.warning('Writing %d bad URLs to %s', len(self.__bad_files), path)
+    # The output directory is kept between runs along with the index
+    # so remove any files left over from a previous run.
+    path = os.path.join(self.get_output_dir(), 'bad_boms.txt')
+    if bad_files:
+      logging.warning('Writing %d bad URLs to %s', len(bad_files), path)
       write_to_path(
-          yaml.safe_dump(self.__bad_files, default_flow_style=False),
+          yaml.safe_dump(bad_files, default_flow_style=False),
           path)
+    elif os.path.exists(path):
+      os.remove(path)
 
-    if self.__non_standard_boms:
-      path = os.path.join(self.get_output_dir(), 'nonstandard_boms.txt')
+    path = os.path.join(self.get_output_dir(), 'nonstandard_boms.txt')
+    if non_standard_boms:
       logging.warning('Writing %d nonstandard boms to %s',
-                      len(self.__non_standard_boms), path)
+                      len(non_standard_boms), path)
       write_to_path(
-          yaml.safe_dump(self.__non_standard_boms, default_flow_style=False),
+          yaml.safe_dump(non_standard_boms, default_flow_style=False),
           path)
+    elif os.path.exists(path):
+      os.remove(path)
 
     config = {
+        'bom_url_prefix': url_prefix,
         'halyard_bom_bucket': options.halyard_bom_bucket
     }
     path = os.path.join(self.get_output_dir(), 'config.yml')
     logging.info('Writing to %s', path)
     write_to_path(yaml.safe_dump(config, default_flow_style=False), path)
 
-  def partition_service_map(self, result_map):
+  @staticmethod
+  def partition_service_map(result_map):
+    """Split a service map into (released, unreleased) service maps."""
     def partition_info_list(info_list):
       released = []
       unreleased = []
       for info in info_list:
-        if self.RELEASED_VERSION_MATCHER.match(info['bom_version']):
+        if CollectBomVersions.RELEASED_VERSION_MATCHER.match(info['bom_version']):
           released.append(info)
         else:
           unreleased.append(info)
@@ -441,6 +632,10 @@ class CollectBomVersionsFactory(CommandFactory):
     self.add_argument(
         parser, 'bintray_debian_repository', defaults, None,
         help='The expected bintray debian repository in boms.')
+    self.add_argument(
+        parser, 'bom_index_path', defaults, None,
+        help='The path to the persistent index of analyzed boms.'
+             ' The default is bom_index.db in the command output directory.')
 
 
 class CollectArtifactVersions(CommandProcessor):
@@ -476,22 +671,19 @@ class CollectArtifactVersions(CommandProcessor):
       self.__basic_auth = None
 
   def fetch_bintray_url(self, bintray_url):
-    request = Request(bintray_url)
+    headers = {}
     if self.__basic_auth:
-      request.add_header('Authorization', self.__basic_auth)
+      headers['Authorization'] = self.__basic_auth
     try:
-      response = urlopen(request)
-      headers = response.info()
-      payload = response.read()
-      content = json.JSONDecoder().decode(payload.decode())
-    except HTTPError as ex:
+      response = HttpClient.singleton().get(
+          bintray_url, headers=headers, endpoint='bintray.api')
+      content = json.JSONDecoder().decode(response.body.decode())
+    except HttpStatusError as ex:
       raise_and_log_error(
           ResponseError('Bintray failure: {}'.format(ex),
                         server='bintray.api'),
           'Failed on url=%s: %s' % (bintray_url, exception_to_message(ex)))
-    except Exception as ex:
-      raise
-    return headers, content
+    return response.headers, content
 
   def list_bintray_packages(self, subject_repo):
     path = 'repos/%s/packages' % subject_repo
@@ -501,7 +693,7 @@ class CollectArtifactVersions(CommandProcessor):
       url = base_url + '?start_pos=%d' % len(result)
       headers, content = self.fetch_bintray_url(url)
       # logging.debug('Bintray responded with headers\n%s', headers)
-      total = headers.get('X-RangeLimit-Total', 0)
+      total = int(headers.get('x-rangelimit-total', 0))
       result.extend(['%s/%s' % (subject_repo, entry['name'])
                      for entry in content])
       if len(result) >= total:
@@ -576,13 +768,11 @@ class CollectArtifactVersions(CommandProcessor):
         package_map[name] = versions
       results.append(package_map)
 
-      path = os.path.join(
+      path = intermediate_path(os.path.join(
           self.get_output_dir(),
-          '%s__%s_versions.yml' % (bintray_repo, repo_type))
+          '%s__%s_versions.yml' % (bintray_repo, repo_type)))
       logging.info('Writing %s versions to %s', bintray_repo, path)
-      write_to_path(yaml.safe_dump(package_map,
-                                   allow_unicode=True,
-                                   default_flow_style=False), path)
+      write_data_to_path(package_map, path)
     return results[0], results[1]
 
   def query_gcr_image_versions(self, image):
@@ -619,13 +809,11 @@ class CollectArtifactVersions(CommandProcessor):
     for name, versions in image_versions:
       image_map[name] = versions
 
-    path = os.path.join(
+    path = intermediate_path(os.path.join(
         self.get_output_dir(),
-        options.docker_registry.replace('/', '__') + '__gcb_versions.yml')
+        options.docker_registry.replace('/', '__') + '__gcb_versions.yml'))
     logging.info('Writing %s versions to %s', options.docker_registry, path)
-    write_to_path(yaml.safe_dump(image_map,
-                                 allow_unicode=True,
-                                 default_flow_style=False), path)
+    write_data_to_path(image_map, path)
     return image_map
 
   def collect_gce_image_versions(self):
@@ -657,12 +845,10 @@ class CollectArtifactVersions(CommandProcessor):
       version_list.append('{}.{}.{}-{}'.format(*parts))
       image_map[module] = version_list
 
-    path = os.path.join(
-        self.get_output_dir(), project + '__gce_image_versions.yml')
+    path = intermediate_path(os.path.join(
+        self.get_output_dir(), project + '__gce_image_versions.yml'))
     logging.info('Writing gce image versions to %s', path)
-    write_to_path(yaml.safe_dump(image_map,
-                                 allow_unicode=True,
-                                 default_flow_style=False), path)
+    write_data_to_path(image_map, path)
     return image_map
 
   def _do_command(self):
@@ -773,13 +959,16 @@ class AuditArtifactVersions(CommandProcessor):
     image_paths = []
     for filename in os.listdir(artifact_data_dir):
       path = os.path.join(artifact_data_dir, filename)
-      if filename.endswith('__gcb_versions.yml'):
+      if data_format_for_path(filename) is None:
+        continue
+      stem = os.path.splitext(filename)[0]
+      if stem.endswith('__gcb_versions'):
         gcr_paths.append(path)
-      elif filename.endswith('__jar_versions.yml'):
+      elif stem.endswith('__jar_versions'):
         jar_paths.append(path)
-      elif filename.endswith('__debian_versions.yml'):
+      elif stem.endswith('__debian_versions'):
         debian_paths.append(path)
-      elif filename.endswith('__gce_image_versions.yml'):
+      elif stem.endswith('__gce_image_versions'):
         image_paths.append(path)
 
     for name, found in [('jar', jar_paths), ('debian', debian_paths),
@@ -790,70 +979,46 @@ class AuditArtifactVersions(CommandProcessor):
                 'Expected 1 %s version files in "%s": %s' % (
                     name, artifact_data_dir, found)))
 
-    logging.debug('Loading container image versions from "%s"', gcr_paths[0])
-    with open(gcr_paths[0], 'r') as stream:
-      self.__container_versions = yaml.safe_load(stream.read())
-    with open(jar_paths[0], 'r') as stream:
-      self.__jar_versions = yaml.safe_load(stream.read())
-    with open(debian_paths[0], 'r') as stream:
-      self.__debian_versions = yaml.safe_load(stream.read())
-    with open(image_paths[0], 'r') as stream:
-      self.__gce_image_versions = yaml.safe_load(stream.read())
-
-  def __extract_all_bom_versions(self, bom_map):
-    result = set([])
-    for versions in bom_map.values():
-      if not versions:
-        continue
-      for commits in versions.values():
-        for buildnum in commits.values():
-          for info_list in buildnum.values():
-            for info in info_list:
-              result.add(info['bom_version'])
-    return result
-
-  def __remove_old_bom_versions(self, min_semver, version_to_commit_boms):
-    """Remove references to older boms in collected bom info.
-
-    Args:
-      min_semver: [SemanticVersion] minimally acceptable semantic version
-      version_to_commit_boms: [dict of {commit_id, build_info}]
-         where build_info is a dictionary mapping buildnum to list of
-         bom_metadata dictionaries.
+    def load_version_sets(path):
+      return {name: set(versions or [])
+              for name, versions in load_data_from_path(path).items()}
 
-    Returns:
-      copy of versions but without build_info referencing older bom_versions.
+    logging.debug('Loading container image versions from "%s"', gcr_paths[0])
+    self.__container_versions = load_version_sets(gcr_paths[0])
+    self.__jar_versions = load_version_sets(jar_paths[0])
+    self.__debian_versions = load_version_sets(debian_paths[0])
+    self.__gce_image_versions = load_version_sets(image_paths[0])
+
+  def __load_bom_table(self, bom_data_dir):
+    """Load the BomServiceTable of all the boms.
+
+    This comes from the BomIndex maintained by collect_bom_versions if it
+    is available, otherwise from the all_bom_service_map.yml it wrote.
+    The index is limited to the boms that collect_bom_versions collected
+    since it can also hold others.
     """
-    def list_of_current_bom_meta(min_semver, all_bom_meta):
-      good_bom_meta = []
-      for bom_meta in all_bom_meta:
-        semver = SemanticVersion.make('ignored-' + bom_meta['bom_version'])
-        if SemanticVersion.compare(semver, min_semver) >= 0:
-          good_bom_meta.append(bom_meta)
-      return good_bom_meta
-
-    def commit_to_current_bom_meta(min_semver, build_map):
-      build_info = {}
-      for buildnum, all_bom_meta in build_map.items():
-        good_bom_meta = list_of_current_bom_meta(min_semver, all_bom_meta)
-        if good_bom_meta:
-          build_info[buildnum] = good_bom_meta
-      return build_info
+    index_path = (self.options.bom_index_path
+                  or os.path.join(bom_data_dir, 'bom_index.db'))
+    if os.path.exists(index_path):
+      config_path = os.path.join(bom_data_dir, 'config.yml')
+      url_prefix = None
+      if os.path.exists(config_path):
+        with open(config_path, 'r') as stream:
+          url_prefix = (yaml.safe_load(stream) or {}).get('bom_url_prefix')
+      logging.debug('Loading bom analysis for "%s" from "%s"',
+                    url_prefix or 'all boms', index_path)
+      index = BomIndex(index_path)
+      try:
+        self.__bom_urls = index.list_bom_urls(url_prefix)
+        return BomServiceTable.from_rows(
+            index.iter_service_rows(url_prefix=url_prefix),
+            index.nonstandard_boms(url_prefix))
+      finally:
+        index.close()
 
-    result = {}
-    for version, commit_build_map in version_to_commit_boms.items():
-      commit_map = {}
-      for commit_id, orig_build_map in commit_build_map.items():
-        build_map = commit_to_current_bom_meta(min_semver, orig_build_map)
-        if build_map:
-          commit_map[commit_id] = build_map
-      if commit_map:
-        result[version] = commit_map
-      else:
-        logging.info(
-            'Dropping version=%s because it bom versions are all too old.',
-            version)
-    return result
+    path = os.path.join(bom_data_dir, 'all_bom_service_map.yml')
+    check_path_exists(find_data_path(path) or path, 'bom analysis')
+    return BomServiceTable.from_service_map(load_data_from_path(path))
 
   def __init__(self, factory, options, **kwargs):
     if options.prune_min_buildnum_prefix is not None:
@@ -870,35 +1035,22 @@ class AuditArtifactVersions(CommandProcessor):
       min_version += '.0' * (3 - len(min_parts))
     self.__min_semver = SemanticVersion.make('ignored-' + min_version)
 
-    bom_data_dir = os.path.join(base_path, 'collect_bom_versions')
-    path = os.path.join(bom_data_dir, 'released_bom_service_map.yml')
-    check_path_exists(path, 'released bom analysis')
-    with open(path, 'r') as stream:
-      self.__all_released_boms = {}      # forever
-      self.__current_released_boms = {}  # since min_version to audit
-      for service, versions in yaml.safe_load(stream.read()).items():
-        if not versions:
-          # e.g. this service has not yet been released.
-          logging.info('No versions for service=%s', service)
-          continue
-
-        self.__all_released_boms[service] = versions
-        self.__current_released_boms[service] = versions
-        stripped_versions = self.__remove_old_bom_versions(
-            self.__min_semver, versions)
-        if stripped_versions:
-          self.__current_released_boms[service] = stripped_versions
-
-    path = os.path.join(bom_data_dir, 'unreleased_bom_service_map.yml')
-    check_path_exists(path, 'unreleased bom analysis')
-    with open(path, 'r') as stream:
-      self.__unreleased_boms = yaml.safe_load(stream.read())
+    # The bom urls are only known here when loaded from the BomIndex.
+    self.__bom_urls = None
+    self.__bom_table = self.__load_bom_table(
+        os.path.join(base_path, 'collect_bom_versions'))
+    self.__all_bom_versions = self.__bom_table.bom_versions()
+
+    # As with CollectBomVersions.partition_service_map, builds that were
+    # released are not considered part of any unreleased bom.
+    is_released = lambda bom_version: bool(
+        CollectBomVersions.RELEASED_VERSION_MATCHER.match(bom_version))
+    self.__all_released_boms = self.__bom_table.select_boms(is_released)
+    self.__unreleased_boms = self.__bom_table.select_boms(
+        lambda bom_version: not is_released(bom_version)).exclude_builds(
+            self.__all_released_boms)
 
     self.__only_bad_and_invalid_boms = False
-    self.__all_bom_versions = self.__extract_all_bom_versions(
-        self.__all_released_boms)
-    self.__all_bom_versions.update(
-        self.__extract_all_bom_versions(self.__unreleased_boms))
 
     self.__missing_debians = {}
     self.__missing_jars = {}
@@ -1007,16 +1159,20 @@ class AuditArtifactVersions(CommandProcessor):
     return buildnum < self.options.prune_min_buildnum_prefix
 
   def determine_bom_candidates(self):
-    path = os.path.join(os.path.dirname(self.get_output_dir()),
-                        'collect_bom_versions', 'bom_list.txt')
+    bom_urls = self.__bom_urls
+    if bom_urls is None:
+      path = os.path.join(os.path.dirname(self.get_output_dir()),
+                          'collect_bom_versions', 'bom_list.txt')
+      with open(path, 'r') as stream:
+        bom_urls = stream.read().split('\n')
+
     candidates = []
-    with open(path, 'r') as stream:
-      for line in stream.read().split('\n'):
-        if line.endswith('-latest-unvalidated.yml'):
-          continue
-        bom = CollectBomVersions.url_to_bom_name(line)
-        if not CollectBomVersions.RELEASED_VERSION_MATCHER.match(bom):
-          candidates.append(line)
+    for line in bom_urls:
+      if line.endswith('-latest-unvalidated.yml'):
+        continue
+      bom = CollectBomVersions.url_to_bom_name(line)
+      if not CollectBomVersions.RELEASED_VERSION_MATCHER.match(bom):
+        candidates.append(line)
 
     return candidates
 
@@ -1061,8 +1217,7 @@ class AuditArtifactVersions(CommandProcessor):
 
         # We're going to keep malformed versions. These are rare so
         # we'll leave it to manual cleanup.
-        pruned = [version
-                  for version in candidates if not version in skip_versions]
+        pruned = set(candidates) - set(skip_versions)
         if pruned:
           prune_map[name] = sorted(pruned)
 
@@ -1212,56 +1367,31 @@ class AuditArtifactVersions(CommandProcessor):
     logging.warning('Missing %s debian %s', key, build_version)
     return False
 
-  def package_in_bom_map(self, service, version, buildnum, service_map):
-    version_map = service_map.get(service)
-    if version_map is None:
-      return False
-    commit_map = version_map.get(version)
-    if commit_map is None:
-      return False
-    for _, buildnums in commit_map.items():
-      if buildnum in buildnums:
-        return True
-    return False
-
-  def audit_package_helper(self, package, version, buildnum, which):
-    if package in self.__all_released_boms or package in self.__unreleased_boms:
-      name = package
-    elif package.startswith('spinnaker-'):
-      name = package[package.find('-') + 1:]
-    else:
-      return False
-
-    is_released = self.package_in_bom_map(
-        name, version, buildnum, self.__all_released_boms)
-    is_unreleased = self.package_in_bom_map(
-        name, version, buildnum, self.__unreleased_boms)
-    if is_released or is_unreleased:
-      return True
-
-    data_list = which.get(package, [])
-    if buildnum:
-      data_list.append('%s-%s' % (version, buildnum))
-    else:
-      data_list.append(version)
-    which[package] = data_list
-    return False
-
   def audit_package(self, kind, packages, which):
+    """Record the package versions not referenced by any bom into which."""
     logging.info('Auditing %s packages', kind)
     for package, versions in packages.items():
       if package == 'halyard':
         logging.warning('Skipping halyard.')
         continue
+      if self.__bom_table.has_service(package):
+        name = package
+      elif package.startswith('spinnaker-'):
+        name = package[package.find('-') + 1:]
+      else:
+        continue
+
+      build_versions = set([])
       for build_version in versions:
-        parts = build_version.split('-', 1)
-        if len(parts) == 1:
+        if '-' not in build_version:
           logging.warning('Unexpected %s version %s', package, build_version)
           continue
-        version, buildnum = parts
-        self.audit_package_helper(package, version, buildnum, which)
+        build_versions.add(build_version)
+      unused = build_versions - self.__bom_table.build_versions(name)
+      if unused:
+        which[package] = which.get(package, []) + sorted(unused)
 
-  def audit_bom_services(self, bom_services, title):
+  def audit_bom_services(self, bom_table, title):
     def add_invalid_boms(jar_ok, deb_ok, container_ok, image_ok,
                          service, version_buildnum, info_list, invalid_boms):
       if jar_ok and deb_ok and container_ok and image_ok:
@@ -1279,30 +1409,24 @@ class AuditArtifactVersions(CommandProcessor):
             bom_record[kind] = problems
         invalid_boms[bom_version] = bom_record
 
-    def audit_service(service, versions):
-      for version, commits in versions.items():
-        for _, buildnums in commits.items():
-          for buildnum, info_list in buildnums.items():
-            version_buildnum = '%s-%s' % (version, buildnum)
-            if service in ['monitoring-daemon', 'monitoring-third-party']:
-              # Uses debians, but not jars so missing jars is ok.
-              jar_ok = True
-            else:
-              jar_ok = self.audit_jar(service, version_buildnum, info_list)
-            deb_ok = self.audit_debian(service, version_buildnum, info_list)
-            gcr_ok = self.audit_container(service, version_buildnum, info_list)
-            image_ok = self.audit_image(service, version_buildnum, info_list)
-
-            add_invalid_boms(jar_ok, deb_ok, gcr_ok, image_ok,
-                             service, version_buildnum,
-                             info_list, self.__invalid_boms)
+    def audit_service(service, builds):
+      for version_buildnum, info_list in sorted(builds.items()):
+        if service in ['monitoring-daemon', 'monitoring-third-party']:
+          # Uses debians, but not jars so missing jars is ok.
+          jar_ok = True
+        else:
+          jar_ok = self.audit_jar(service, version_buildnum, info_list)
+        deb_ok = self.audit_debian(service, version_buildnum, info_list)
+        gcr_ok = self.audit_container(service, version_buildnum, info_list)
+        image_ok = self.audit_image(service, version_buildnum, info_list)
+
+        add_invalid_boms(jar_ok, deb_ok, gcr_ok, image_ok,
+                         service, version_buildnum,
+                         info_list, self.__invalid_boms)
 
     logging.debug('Auditing %s BOMs', title)
-    for service, versions in bom_services.items():
-      if not versions:
-        logging.debug('No versions for %s', service)
-        continue
-      audit_service(service, versions)
+    for service in sorted(bom_table.service_names()):
+      audit_service(service, bom_table.service_builds(service))
 
 
 class AuditArtifactVersionsFactory(CommandFactory):
@@ -1323,6 +1447,10 @@ class AuditArtifactVersionsFactory(CommandFactory):
         parser, 'prune_keep_latest_version', defaults, False, type=bool,
         help='If true, suggest only artifacts whose version is not the most'
              ' recent version among the boms surveyed.')
+    self.add_argument(
+        parser, 'bom_index_path', defaults, None,
+        help='The path to the index written by collect_bom_versions.'
+             ' The default is bom_index.db in its output directory.')
 
 def register_commands(registry, subparsers, defaults):
   CollectBomVersionsFactory().register(registry, subparsers, defaults)
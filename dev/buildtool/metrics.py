@@ -15,16 +15,24 @@
 """Metrics support manager."""
 
 import logging
+import os
 
 from buildtool import add_parser_argument
+from buildtool.base_metrics import DEFAULT_TIMER_BUCKETS
 from buildtool.inmemory_metrics import InMemoryMetricsRegistry
 from buildtool.influxdb_metrics import InfluxDbMetricsRegistry
+from buildtool.prometheus_metrics import PrometheusMetricsRegistry
+from buildtool.tracing import (
+    TRACE_FORMATS,
+    Tracer)
 
 
 class MetricsManager(object):
   """Acts as factory for specialized BaseMetricsRegistry singleton."""
 
   __metrics_registry = None
+  __trace_path_prefix = None
+  __trace_formats = []
 
   @staticmethod
   def singleton():
@@ -38,6 +46,7 @@ class MetricsManager(object):
     """Init argparser with metrics-related options."""
     InMemoryMetricsRegistry.init_argument_parser(parser, defaults)
     InfluxDbMetricsRegistry.init_argument_parser(parser, defaults)
+    PrometheusMetricsRegistry.init_argument_parser(parser, defaults)
     add_parser_argument(
         parser, 'monitoring_enabled', defaults, False, type=bool,
         help='Enable monitoring to stackdriver.')
@@ -46,28 +55,60 @@ class MetricsManager(object):
         help='Frequency at which to push metrics in seconds.')
     add_parser_argument(
         parser, 'monitoring_system', defaults, 'file',
-        choices=['file', 'influxdb'],
+        choices=['file', 'influxdb', 'prometheus'],
         help='Where to store metrics.')
+    add_parser_argument(
+        parser, 'metrics_timer_buckets', defaults, DEFAULT_TIMER_BUCKETS,
+        help='The histogram buckets for timers as <start>,<factor>,<count>'
+             ' where bucket i holds timings up to start * factor^i seconds.')
     add_parser_argument(
         parser, 'monitoring_context_labels', defaults, None,
         help='A comma-separated list of additional name=value'
              ' labels to add to each event to associate them together.'
              ' (e.g. version=release-1.2.x)')
+    add_parser_argument(
+        parser, 'metrics_trace_formats', defaults, 'chrome',
+        help='A comma-separated list of formats to write trace spans into'
+             ' the metrics directory when monitoring is enabled.'
+             ' The formats are {formats}. An empty value disables tracing.'
+             .format(formats=', '.join(TRACE_FORMATS)))
 
   @staticmethod
   def startup_metrics(options):
     """Startup metrics module with concrete system."""
     monitoring_systems = {
         'file': InMemoryMetricsRegistry,
-        'influxdb': InfluxDbMetricsRegistry
+        'influxdb': InfluxDbMetricsRegistry,
+        'prometheus': PrometheusMetricsRegistry
     }
     klas = monitoring_systems[options.monitoring_system]
     logging.debug('Initializing monitoring with system="%s"', klas.__name__)
     MetricsManager.__metrics_registry = klas(options)
     if options.monitoring_enabled and options.monitoring_flush_frequency > 0:
       MetricsManager.__metrics_registry.start_pusher_thread()
+    MetricsManager.__startup_tracing(options)
     return MetricsManager.__metrics_registry
 
+  @staticmethod
+  def __startup_tracing(options):
+    formats = [name for name in (
+        getattr(options, 'metrics_trace_formats', None) or '').split(',')
+               if name]
+    for name in formats:
+      if name not in TRACE_FORMATS:
+        raise ValueError('Unknown metrics_trace_formats "{name}"'.format(
+            name=name))
+    if not options.monitoring_enabled or not formats:
+      return
+
+    dir_path = (options.metrics_dir
+                or os.path.join(options.output_dir, 'metrics'))
+    MetricsManager.__trace_path_prefix = os.path.join(
+        dir_path, 'trace__{command}__{pid}'.format(
+            command=options.command, pid=os.getpid()))
+    MetricsManager.__trace_formats = formats
+    Tracer.singleton().set_enabled(True)
+
   @staticmethod
   def shutdown_metrics():
     """Write final metrics out to metrics server."""
@@ -75,3 +116,6 @@ class MetricsManager(object):
     registry.stop_pusher_thread()
     registry.flush_updated_metrics()
     registry.flush_final_metrics()
+    if MetricsManager.__trace_formats:
+      Tracer.singleton().write(MetricsManager.__trace_path_prefix,
+                               MetricsManager.__trace_formats)
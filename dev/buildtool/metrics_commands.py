@@ -0,0 +1,123 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Implements commands for managing the metrics written by buildtool."""
+
+import errno
+import json
+import logging
+import os
+import re
+
+from buildtool import (
+    CommandFactory,
+    CommandProcessor,
+    check_path_exists)
+
+from buildtool.inmemory_metrics import (
+    compact_metrics_journal,
+    write_metrics_snapshot)
+
+
+def is_process_alive(pid):
+  """Determine whether the process with the given pid is still running."""
+  try:
+    os.kill(pid, 0)
+  except OSError as ex:
+    return ex.errno == errno.EPERM
+  return True
+
+
+def is_journal_finished(journal_path):
+  """Determine whether the journal has the end record written at shutdown."""
+  with open(journal_path, 'rb') as stream:
+    stream.seek(0, os.SEEK_END)
+    stream.seek(max(0, stream.tell() - 4096))
+    lines = [line for line in stream.read().split(b'\n') if line.strip()]
+  if not lines:
+    return False
+  try:
+    return json.loads(lines[-1].decode('utf-8')).get('journal') == 'end'
+  except ValueError:
+    return False
+
+
+class CompactMetricsJournalsCommand(CommandProcessor):
+  """Writes the metrics snapshot for each metrics journal."""
+
+  def determine_journal_paths(self):
+    """Returns the journals to compact.
+
+    Journals still being written by a running process, including our own,
+    are skipped. Those from processes that died without finishing them are
+    compacted with what they have.
+    """
+    options = self.options
+    if options.journal_path:
+      check_path_exists(options.journal_path, why='journal_path')
+      return [options.journal_path]
+
+    metrics_dir = (options.metrics_dir
+                   or os.path.join(options.output_dir, 'metrics'))
+    if not os.path.isdir(metrics_dir):
+      return []
+
+    matcher = re.compile(r'^metrics__.+__([0-9]+)\.jsonl$')
+    result = []
+    for name in sorted(os.listdir(metrics_dir)):
+      match = matcher.match(name)
+      if not match:
+        continue
+      path = os.path.join(metrics_dir, name)
+      if (not is_journal_finished(path)
+          and is_process_alive(int(match.group(1)))):
+        logging.info('Skipping %s because it is still being written', path)
+        continue
+      result.append(path)
+    return result
+
+  def _do_command(self):
+    """Implements CommandProcessor interface."""
+    snapshot_paths = []
+    for journal_path in self.determine_journal_paths():
+      snapshot_path = os.path.splitext(journal_path)[0] + '.json'
+      logging.info('Compacting %s into %s', journal_path, snapshot_path)
+      write_metrics_snapshot(compact_metrics_journal(journal_path),
+                             snapshot_path)
+      if not self.options.keep_journals:
+        os.remove(journal_path)
+      snapshot_paths.append(snapshot_path)
+    return snapshot_paths
+
+
+class CompactMetricsJournalsFactory(CommandFactory):
+  def __init__(self):
+    super(CompactMetricsJournalsFactory, self).__init__(
+        'compact_metrics_journals', CompactMetricsJournalsCommand,
+        'Write the metrics snapshot files from --metrics_journal journals.')
+
+  def init_argparser(self, parser, defaults):
+    super(CompactMetricsJournalsFactory, self).init_argparser(
+        parser, defaults)
+    self.add_argument(
+        parser, 'journal_path', defaults, None,
+        help='The journal to compact. The default is every journal in the'
+             ' --metrics_dir, or output_dir/metrics.')
+    self.add_argument(
+        parser, 'keep_journals', defaults, True, type=bool,
+        help='Keep the journals after writing their snapshots.')
+
+
+def register_commands(registry, subparsers, defaults):
+  CompactMetricsJournalsFactory().register(registry, subparsers, defaults)
@@ -0,0 +1,396 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Profiles the python side of a buildtool command.
+
+A profiler runs the command and writes what it found into
+<output_dir>/profile/<command> as
+   profile.pstats: Readable with the standard pstats module or snakeviz.
+   profile.collapsed: Collapsed stacks for flamegraph.pl or speedscope.
+
+The "cprofile" mode instruments every call on the main thread and on any
+thread started while the command runs, such as ThreadPool workers, then
+merges them into one profile. The flamegraph stacks are apportioned from
+the caller/callee times so are approximate.
+
+The "sampling" mode periodically captures the stack of every thread. It has
+a bounded overhead so is better suited to long runs, but only sees calls
+that last longer than the sampling interval. The pstats are derived from
+the samples so call counts are sample counts.
+"""
+
+import cProfile
+import logging
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from buildtool import (
+    ensure_dir_exists,
+    write_to_path)
+
+
+PROFILE_MODES = ['cprofile', 'sampling']
+
+
+def _frame_label(func):
+  """Returns the flamegraph frame name for a pstats function key."""
+  filename, line, name = func
+  if filename == '~':
+    label = name
+  else:
+    label = '{0}:{1}:{2}'.format(os.path.basename(filename), line, name)
+  return label.replace(';', ':')
+
+
+def _collapse_stacks(stacks):
+  """Returns the collapsed-stack text for a dict of stack tuples to counts."""
+  lines = ['{0} {1}'.format(';'.join(_frame_label(func) for func in stack),
+                            count)
+           for stack, count in stacks.items() if count > 0]
+  return '\n'.join(sorted(lines)) + '\n'
+
+
+class CommandProfiler(object):
+  """Base class for profiling a command and writing the results.
+
+  Derived classes collect the profile between start() and stop(), then
+  provide it as pstats data and flamegraph stacks.
+  """
+
+  @property
+  def mode(self):
+    """The PROFILE_MODES value this profiler implements."""
+    raise NotImplementedError(self.__class__.__name__)
+
+  @property
+  def profile_dir(self):
+    """The directory that the profile files are written to."""
+    return self.__profile_dir
+
+  @property
+  def overhead_secs(self):
+    """The estimated time the profiler added to the command."""
+    raise NotImplementedError(self.__class__.__name__)
+
+  def __init__(self, command_name, output_dir):
+    self.__command_name = command_name
+    self.__profile_dir = os.path.join(output_dir, 'profile', command_name)
+    self.__wall_secs = 0
+
+  def start(self):
+    """Starts profiling the current and subsequently started threads."""
+    raise NotImplementedError(self.__class__.__name__)
+
+  def stop(self):
+    """Stops profiling."""
+    raise NotImplementedError(self.__class__.__name__)
+
+  def to_pstats_dict(self):
+    """Returns the profile in the marshalled pstats dictionary format."""
+    raise NotImplementedError(self.__class__.__name__)
+
+  def to_collapsed_stacks(self):
+    """Returns a dict of stacks, as tuples of pstats keys, to counts."""
+    raise NotImplementedError(self.__class__.__name__)
+
+  def profile_call(self, func, *pos_args, **kwargs):
+    """Calls func while profiling, then writes the profile.
+
+    The profile is written even if func raises.
+    """
+    start_time = time.time()
+    self.start()
+    try:
+      return func(*pos_args, **kwargs)
+    finally:
+      self.stop()
+      self.__wall_secs = time.time() - start_time
+      self.write()
+
+  def write(self):
+    """Writes the pstats and collapsed stack files into the profile_dir."""
+    ensure_dir_exists(self.__profile_dir)
+    pstats_path = os.path.join(self.__profile_dir, 'profile.pstats')
+    with open(pstats_path, 'wb') as stream:
+      marshal.dump(self.to_pstats_dict(), stream)
+    collapsed_path = os.path.join(self.__profile_dir, 'profile.collapsed')
+    write_to_path(_collapse_stacks(self.to_collapsed_stacks()),
+                  collapsed_path)
+    logging.info('Wrote %s profile to %s and %s'
+                 ' (overhead %.3fs of %.3fs)',
+                 self.mode, pstats_path, collapsed_path,
+                 self.overhead_secs, self.__wall_secs)
+
+  def record_metrics(self, metrics):
+    """Records the profiling overhead so it can be discounted."""
+    labels = {'command': self.__command_name, 'mode': self.mode}
+    metrics.observe_timer('Profile_Overhead', labels, self.overhead_secs)
+    metrics.observe_timer('Profile_WallTime', labels, self.__wall_secs)
+
+
+class CProfileProfiler(CommandProfiler):
+  """Profiles every call using cProfile on each thread."""
+
+  # The number of calls to time when estimating the per-call overhead.
+  CALIBRATION_CALLS = 10000
+
+  @property
+  def mode(self):
+    return 'cprofile'
+
+  @property
+  def overhead_secs(self):
+    calls = sum(entry[1] for entry in self.__get_stats().values())
+    return calls * self.__call_overhead_secs
+
+  def __init__(self, command_name, output_dir):
+    super(CProfileProfiler, self).__init__(command_name, output_dir)
+    self.__lock = threading.Lock()
+    self.__profiles = []
+    self.__call_overhead_secs = 0
+    self.__stats = None
+
+  def __calibrate(self):
+    """Estimates the time cProfile adds to each call."""
+    def noop():
+      pass
+    def time_calls():
+      start = time.time()
+      for _ in range(self.CALIBRATION_CALLS):
+        noop()
+      return time.time() - start
+
+    baseline_secs = time_calls()
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+      profiled_secs = time_calls()
+    finally:
+      profile.disable()
+    self.__call_overhead_secs = max(
+        0, (profiled_secs - baseline_secs) / self.CALIBRATION_CALLS)
+
+  def __add_profile(self):
+    """Starts and keeps a new profile for the current thread."""
+    profile = cProfile.Profile()
+    try:
+      profile.enable()
+    except ValueError as ex:
+      # Python 3.12+ only allows one active profiler.
+      logging.warning('Cannot profile thread %s: %s',
+                      threading.current_thread().name, ex)
+      return None
+    with self.__lock:
+      self.__profiles.append(profile)
+    return profile
+
+  def __start_thread(self, *unused_args):
+    """Installed as the threading profile function for new threads.
+
+    This is called on the first event in each new thread. It replaces
+    itself with a cProfile profiler for that thread.
+    """
+    sys.setprofile(None)
+    self.__add_profile()
+
+  def start(self):
+    self.__calibrate()
+    self.__add_profile()
+    threading.setprofile(self.__start_thread)
+
+  def stop(self):
+    threading.setprofile(None)
+    with self.__lock:
+      profiles = list(self.__profiles)
+    # The first profile is the current thread's, and disable only affects
+    # the current thread. Worker threads have usually finished by now and
+    # any still running are snapshotted as is.
+    if profiles:
+      profiles[0].disable()
+
+  def __get_stats(self):
+    """Returns the pstats dictionary merged across all the threads."""
+    if self.__stats is None:
+      with self.__lock:
+        profiles = list(self.__profiles)
+      merged = pstats.Stats(profiles[0]) if profiles else None
+      for profile in profiles[1:]:
+        merged.add(profile)
+      self.__stats = merged.stats if merged else {}
+    return self.__stats
+
+  def to_pstats_dict(self):
+    return self.__get_stats()
+
+  def to_collapsed_stacks(self, max_depth=64, min_secs=0.000001):
+    """Apportions the cumulative times down the call graph.
+
+    The time of each caller/callee edge is scaled by the fraction of the
+    caller's cumulative time that the stack being expanded accounts for.
+    Counts are in microseconds.
+    """
+    stats = self.__get_stats()
+    callees = defaultdict(dict)
+    roots = []
+    for func, (_, _, _, _, callers) in stats.items():
+      callers = {caller: edge for caller, edge in callers.items()
+                 if caller in stats}
+      if not callers:
+        roots.append(func)
+      for caller, edge in callers.items():
+        callees[caller][func] = edge[3]
+
+    stacks = defaultdict(int)
+    def expand(stack, secs):
+      func = stack[-1]
+      total_secs = stats[func][3]
+      if total_secs <= 0:
+        return
+      scale = min(1.0, secs / total_secs)
+      stacks[stack] += int(stats[func][2] * scale * 1000000)
+      if len(stack) >= max_depth:
+        return
+      for callee, edge_secs in callees[func].items():
+        if callee not in stack and edge_secs * scale >= min_secs:
+          expand(stack + (callee,), edge_secs * scale)
+
+    for root in roots:
+      expand((root,), stats[root][3])
+    return stacks
+
+
+class SamplingProfiler(CommandProfiler):
+  """Periodically samples the stacks of all the threads."""
+
+  # The pseudo function used as the root of stacks on non-main threads.
+  WORKER_ROOT = ('~', 0, '<worker threads>')
+
+  @property
+  def mode(self):
+    return 'sampling'
+
+  @property
+  def overhead_secs(self):
+    return self.__overhead_secs
+
+  @property
+  def num_samples(self):
+    """The number of stacks sampled."""
+    return sum(self.__stacks.values())
+
+  def __init__(self, command_name, output_dir, interval_secs=0.005):
+    super(SamplingProfiler, self).__init__(command_name, output_dir)
+    self.__interval_secs = interval_secs
+    self.__stacks = defaultdict(int)
+    self.__overhead_secs = 0
+    self.__stop_event = threading.Event()
+    self.__thread = None
+
+  def __sample(self, ignore_thread_id, main_thread_id):
+    """Adds the current stack of each thread to the samples."""
+    # pylint: disable=protected-access
+    for thread_id, frame in sys._current_frames().items():
+      if thread_id == ignore_thread_id:
+        continue
+      stack = []
+      while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+        frame = frame.f_back
+      if thread_id != main_thread_id:
+        stack.append(self.WORKER_ROOT)
+      self.__stacks[tuple(reversed(stack))] += 1
+
+  def __run(self, main_thread_id):
+    ignore_thread_id = threading.current_thread().ident
+    while not self.__stop_event.wait(self.__interval_secs):
+      start = time.time()
+      self.__sample(ignore_thread_id, main_thread_id)
+      self.__overhead_secs += time.time() - start
+
+  def start(self):
+    self.__stop_event.clear()
+    self.__thread = threading.Thread(
+        name='SamplingProfiler', target=self.__run,
+        args=[threading.current_thread().ident])
+    self.__thread.daemon = True
+    self.__thread.start()
+
+  def stop(self):
+    self.__stop_event.set()
+    self.__thread.join()
+
+  def to_collapsed_stacks(self):
+    return dict(self.__stacks)
+
+  def to_pstats_dict(self):
+    """Derives pstats from the samples.
+
+    Each sample counts as a call of every function on its stack lasting
+    the sampling interval.
+    """
+    interval = self.__interval_secs
+    entries = {}
+    def get_entry(func):
+      if func not in entries:
+        entries[func] = [0, 0, 0.0, 0.0, defaultdict(lambda: [0, 0, 0.0, 0.0])]
+      return entries[func]
+
+    for stack, count in self.__stacks.items():
+      stack = tuple(func for func in stack if func != self.WORKER_ROOT)
+      if not stack:
+        continue
+      get_entry(stack[-1])[2] += count * interval
+      seen = set()
+      for index, func in enumerate(stack):
+        caller = stack[index - 1] if index else None
+        if (caller, func) in seen:
+          continue
+        entry = get_entry(func)
+        if func not in seen:
+          entry[0] += count
+          entry[1] += count
+          entry[3] += count * interval
+        if caller is not None:
+          edge = entry[4][caller]
+          edge[0] += count
+          edge[1] += count
+          edge[3] += count * interval
+          if index == len(stack) - 1:
+            edge[2] += count * interval
+        seen.add(func)
+        seen.add((caller, func))
+
+    return {func: (cc, nc, tt, ct,
+                   {caller: tuple(edge) for caller, edge in callers.items()})
+            for func, (cc, nc, tt, ct, callers) in entries.items()}
+
+
+def make_profiler(options):
+  """Returns the CommandProfiler for the options or None if not profiling."""
+  mode = getattr(options, 'profile', None)
+  if not mode:
+    return None
+  if mode == 'cprofile':
+    return CProfileProfiler(options.command, options.output_dir)
+  if mode == 'sampling':
+    return SamplingProfiler(
+        options.command, options.output_dir,
+        interval_secs=getattr(options, 'profile_interval_ms', 5) / 1000.0)
+  raise ValueError('Unknown profile mode "{0}"'.format(mode))
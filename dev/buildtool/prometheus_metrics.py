@@ -0,0 +1,338 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Metrics support via prometheus.
+
+https://prometheus.io/docs/instrumenting/exposition_formats/
+
+The metrics are kept as their current values only, not as timeseries, and
+are exposed in the prometheus text format. They can be scraped from an
+in-process HTTP endpoint (--prometheus_port) and/or pushed to a pushgateway
+(--prometheus_pushgateway_url) on each flush.
+
+Counters are exposed as <name>_total, gauges as <name>, and timers as a
+<name>_seconds histogram along with a <name>_seconds_quantile gauge of the
+estimated quantiles.
+
+Each metric's text is cached and only re-encoded when the metric changes,
+so the cost of a flush depends on the number of series and what changed
+since the last flush, not on how long the command has been running.
+"""
+
+import logging
+import re
+import threading
+
+try:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from SocketServer import ThreadingMixIn
+  from urllib import quote
+except ImportError:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+  from urllib.parse import quote
+
+from buildtool import add_parser_argument
+from buildtool.base_metrics import (
+    BaseMetricsRegistry,
+    Counter,
+    Gauge,
+    MetricFamily,
+    Timer)
+from buildtool.http_support import (
+    HttpClient,
+    HttpRequestError)
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_INVALID_NAME_CHARS = re.compile(r'[^a-zA-Z0-9_:]')
+_INVALID_LABEL_CHARS = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def to_metric_name(name):
+  """Returns the name with characters prometheus does not allow replaced."""
+  name = _INVALID_NAME_CHARS.sub('_', name)
+  return '_' + name if name[:1].isdigit() else name
+
+
+def to_label_text(labels):
+  """Returns the labels in the {name="value",...} form or ''."""
+  if not labels:
+    return ''
+  bindings = []
+  for key, value in sorted(labels.items()):
+    value = (str(value).replace('\\', r'\\')
+             .replace('\n', r'\n').replace('"', r'\"'))
+    bindings.append('{key}="{value}"'.format(
+        key=_INVALID_LABEL_CHARS.sub('_', key), value=value))
+  return '{' + ','.join(bindings) + '}'
+
+
+def to_value_text(value):
+  """Returns the number as prometheus expects it."""
+  if value is None:
+    return 'NaN'
+  if isinstance(value, bool):
+    return '1' if value else '0'
+  if value == float('inf'):
+    return '+Inf'
+  return repr(value) if isinstance(value, float) else str(value)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+
+class PrometheusMetricsRegistry(BaseMetricsRegistry):
+  """Implements MetricsRegistry by exposing the metrics to prometheus."""
+
+  @staticmethod
+  def init_argument_parser(parser, defaults):
+    """Initialize argument parser with prometheus parameters."""
+    add_parser_argument(
+        parser, 'prometheus_port', defaults, None, type=int,
+        help='If set then serve the metrics for prometheus to scrape from'
+             ' http://<prometheus_listen_address>:<port>/metrics.'
+             ' A port of 0 picks an unused port.')
+    add_parser_argument(
+        parser, 'prometheus_listen_address', defaults, 'localhost',
+        help='The interface to serve prometheus metrics on.')
+    add_parser_argument(
+        parser, 'prometheus_pushgateway_url', defaults, None,
+        help='If set then push the metrics to this prometheus pushgateway'
+             ' on each flush.')
+    add_parser_argument(
+        parser, 'prometheus_job', defaults, 'buildtool',
+        help='The job name to push metrics to the pushgateway under.'
+             ' The command and parent_invocation_id are also part of the'
+             ' grouping key.')
+
+  @property
+  def http_port(self):
+    """The port metrics are served on or None."""
+    return self.__server.server_port if self.__server else None
+
+  @property
+  def push_url(self):
+    """The pushgateway url including the grouping key or None."""
+    return self.__push_url
+
+  def __init__(self, options, http_client=None):
+    super(PrometheusMetricsRegistry, self).__init__(options)
+    self.__encode_func_map = {
+        MetricFamily.COUNTER: self.__encode_counter,
+        MetricFamily.GAUGE: self.__encode_gauge,
+        MetricFamily.TIMER: self.__encode_timer,
+    }
+    self.__encode_mutex = threading.Lock()
+    self.__dirty_mutex = threading.Lock()
+    self.__dirty_metrics = set([])
+    # Keyed by family, values keyed by metric. Each metric's text is a
+    # list with the samples for each of the family's headers.
+    self.__family_text = {}
+    self.__http_client = http_client
+    self.__push_url = None
+    self.__server = None
+    self.__server_thread = None
+    if not options.monitoring_enabled:
+      logging.warning('Monitoring is disabled')
+      return
+
+    gateway_url = getattr(options, 'prometheus_pushgateway_url', None)
+    if gateway_url:
+      self.__push_url = '/'.join([
+          gateway_url.rstrip('/'), 'metrics',
+          'job', quote(getattr(options, 'prometheus_job', None)
+                       or 'buildtool', safe=''),
+          'command', quote(options.command, safe=''),
+          'invocation', quote(
+              str(getattr(options, 'parent_invocation_id', 'none')),
+              safe='')])
+      if self.__http_client is None:
+        self.__http_client = HttpClient(max_retries=1, metrics_registry=self)
+
+    port = getattr(options, 'prometheus_port', None)
+    if port is not None:
+      self.__start_server(
+          getattr(options, 'prometheus_listen_address', 'localhost'), port)
+
+  def __start_server(self, address, port):
+    registry = self
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+      """Serves the metrics text on GET."""
+      # pylint: disable=invalid-name
+
+      def log_message(self, *pos_args):
+        pass
+
+      def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+          self.send_error(404)
+          return
+        body = registry.encode().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    self.__server = _ThreadingHTTPServer((address, port), MetricsHandler)
+    self.__server_thread = threading.Thread(
+        name='PrometheusServer', target=self.__server.serve_forever)
+    self.__server_thread.daemon = True
+    self.__server_thread.start()
+    logging.info('Serving prometheus metrics on http://%s:%d/metrics',
+                 address, self.http_port)
+
+  def _do_make_family(self, family_type, name, label_names):
+    """Implements interface."""
+    # pylint: disable=unused-argument
+    type_to_factory = {
+        MetricFamily.COUNTER: Counter,
+        MetricFamily.GAUGE: Gauge,
+        MetricFamily.TIMER: Timer,
+    }
+    return MetricFamily(self, name, type_to_factory[family_type], family_type)
+
+  def queue_update(self, metric):
+    """Extends the base class to note the metric needs re-encoding."""
+    super(PrometheusMetricsRegistry, self).queue_update(metric)
+    with self.__dirty_mutex:
+      self.__dirty_metrics.add(metric)
+
+  def encode(self):
+    """Returns the current metrics in the prometheus text format.
+
+    Only the metrics that changed since the last call are re-encoded.
+    """
+    with self.__dirty_mutex:
+      dirty = self.__dirty_metrics
+      self.__dirty_metrics = set([])
+
+    with self.__encode_mutex:
+      for metric in dirty:
+        family_text = self.__family_text.get(metric.family)
+        if family_text is None:
+          family_text = {}
+          self.__family_text[metric.family] = family_text
+        encode = self.__encode_func_map[metric.family.family_type]
+        family_text[metric] = encode(metric)
+
+      parts = []
+      for family in sorted(self.__family_text.keys(),
+                           key=lambda family: family.name):
+        # All the samples of a prometheus family must follow its header.
+        metric_text = list(self.__family_text[family].values())
+        for index, header in enumerate(self.__encode_headers(family)):
+          parts.append(header)
+          parts.extend(text[index] for text in metric_text)
+      return ''.join(parts)
+
+  def __encode_headers(self, family):
+    """Returns the headers of the prometheus families the family exports."""
+    name = to_metric_name(family.name)
+    if family.family_type == MetricFamily.COUNTER:
+      return ['# TYPE {0}_total counter\n'.format(name)]
+    if family.family_type == MetricFamily.GAUGE:
+      return ['# TYPE {0} gauge\n'.format(name)]
+    return ['# TYPE {0}_seconds histogram\n'.format(name),
+            '# TYPE {0}_seconds_quantile gauge\n'.format(name)]
+
+  def __encode_counter(self, metric):
+    return ['{name}_total{labels} {value}\n'.format(
+        name=to_metric_name(metric.name),
+        labels=to_label_text(metric.labels),
+        value=to_value_text(metric.count))]
+
+  def __encode_gauge(self, metric):
+    return ['{name}{labels} {value}\n'.format(
+        name=to_metric_name(metric.name),
+        labels=to_label_text(metric.labels),
+        value=to_value_text(metric.value))]
+
+  def __encode_timer(self, metric):
+    """Encodes the histogram and quantile series of a timer.
+
+    The quantiles are a separate gauge family because a prometheus metric
+    cannot be both a histogram and a summary.
+
+    Returns:
+      The histogram text and the quantile text, as separate families.
+    """
+    name = to_metric_name(metric.name) + '_seconds'
+    lines = []
+    cumulative = 0
+    bounds = list(metric.bucket_bounds) + [float('inf')]
+    for bound, count in zip(bounds, metric.bucket_counts):
+      cumulative += count
+      labels = dict(metric.labels, le=to_value_text(float(bound)))
+      lines.append('{name}_bucket{labels} {value}\n'.format(
+          name=name, labels=to_label_text(labels), value=cumulative))
+    label_text = to_label_text(metric.labels)
+    lines.append('{name}_sum{labels} {value}\n'.format(
+        name=name, labels=label_text,
+        value=to_value_text(float(metric.total_seconds))))
+    lines.append('{name}_count{labels} {value}\n'.format(
+        name=name, labels=label_text, value=metric.count))
+
+    quantile_lines = []
+    quantiles = metric.summarize_quantiles()
+    for quantile, fraction in Timer.QUANTILES + [('max', 1.0)]:
+      value = quantiles[quantile]
+      if value is None:
+        continue
+      labels = dict(metric.labels, quantile=to_value_text(fraction))
+      quantile_lines.append('{name}_quantile{labels} {value}\n'.format(
+          name=name, labels=to_label_text(labels),
+          value=to_value_text(value)))
+    return [''.join(lines), ''.join(quantile_lines)]
+
+  def push(self):
+    """Replaces the metrics in the pushgateway with the current ones.
+
+    Returns:
+      True if the metrics were pushed.
+    """
+    if not self.__push_url:
+      return False
+    body = self.encode().encode('utf-8')
+    try:
+      self.__http_client.request(
+          'PUT', self.__push_url, body=body,
+          headers={'Content-Type': CONTENT_TYPE}, endpoint='pushgateway')
+    except HttpRequestError as ex:
+      logging.warning('Cannot push metrics to %s: %s', self.__push_url, ex)
+      return False
+    logging.debug('Pushed %d bytes of metrics to %s',
+                  len(body), self.__push_url)
+    return True
+
+  def _do_flush_updated_metrics(self, updated_metrics):
+    """Implements interface."""
+    if self.__push_url:
+      self.push()
+    else:
+      self.encode()
+
+  def _do_flush_final_metrics(self):
+    """Implements interface."""
+    self.flush_updated_metrics()
+    if self.__server:
+      self.__server.shutdown()
+      self.__server.server_close()
+      self.__server = None
+    if self.__http_client and self.__push_url:
+      self.__http_client.close()
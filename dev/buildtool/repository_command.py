@@ -21,6 +21,8 @@ from buildtool import (
     CommandProcessor,
     CommandFactory,
     maybe_log_exception)
+from buildtool.base_metrics import MetricFamily
+from buildtool.tracing import Tracer
 
 
 def _do_call_do_repository(repository, command):
@@ -33,10 +35,13 @@ def _do_call_do_repository(repository, command):
   try:
     metric_labels = command.determine_metric_labels()
     metric_labels['repository'] = repository.name
-    result = command.metrics.track_and_time_call(
-        'RunRepositoryCommand',
-        metric_labels, command.metrics.default_determine_outcome_labels,
-        command._do_repository_wrapper, repository)
+    with Tracer.singleton().span(
+        repository.name, 'repository',
+        {'command': command.name, 'repository': repository.name}):
+      result = command.metrics.track_and_time_call(
+          'RunRepositoryCommand',
+          metric_labels, command.metrics.default_determine_outcome_labels,
+          command._do_repository_wrapper, repository)
     logging.info('%s finished %s', command.name, repository.name)
     return result
   except Exception as ex:
@@ -146,6 +151,15 @@ class RepositoryCommandProcessor(CommandProcessor):
         self.source_repositories, _do_call_do_repository, self)
     return self._do_postprocess(result_dict)
 
+  def process_repository(self, repository):
+    """Process an individual repository as _do_command would.
+
+    This is for callers scheduling the repositories themselves, such as
+    run_flow. They are responsible for calling _do_preprocess before and
+    _do_postprocess after processing all the repositories.
+    """
+    return _do_call_do_repository(repository, self)
+
   def _do_preprocess(self):
     """Prepares the command with any pre-requisites that can be factored out."""
     pass
@@ -167,9 +181,9 @@ class RepositoryCommandProcessor(CommandProcessor):
     This is for instrumentation purposes.
     """
     if self._do_can_skip_repository(repository):
-      self.metrics.inc_counter(
-          'SkipRepositoryCommand',
-          {'command': self.name, 'repository': repository.name})
+      self.metrics.bind(
+          MetricFamily.COUNTER, 'SkipRepositoryCommand',
+          command=self.name, repository=repository.name).inc()
       logging.debug('Skipping repository %s', repository.name)
       return None
 
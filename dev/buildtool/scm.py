@@ -23,7 +23,6 @@ from multiprocessing.pool import ThreadPool
 import collections
 import logging
 import os
-import yaml
 
 # pylint: disable=relative-import
 from buildtool import (
@@ -33,9 +32,13 @@ from buildtool import (
 
     add_parser_argument,
     check_kwargs_empty,
+    intermediate_path,
+    load_data_from_path,
+    map_async,
     raise_and_log_error,
-    write_to_path,
+    write_data_to_path,
     UnexpectedError)
+from buildtool.tracing import Tracer
 
 
 class SourceInfo(
@@ -65,10 +68,15 @@ class RepositoryWorker(object):
     self.__pargs = pargs
     self.__kwargs = kwargs
 
+    # The call is made within the span current when the worker was created
+    # so that the spans in the pool threads have the right parent.
+    self.__parent_span = Tracer.singleton().current_span()
+
   def __call__(self, repository):
     """Call the bound function with the repository plus bound args."""
     name = repository.name
-    return name, self.__fn(repository, *self.__pargs, **self.__kwargs)
+    with Tracer.singleton().activate(self.__parent_span):
+      return name, self.__fn(repository, *self.__pargs, **self.__kwargs)
 
 
 class SpinnakerSourceCodeManager(object):
@@ -182,6 +190,13 @@ class SpinnakerSourceCodeManager(object):
     """
     raise NotImplementedError(self.__class__.__name__)
 
+  def refresh_git_path(self, repository):
+    """Update an existing checkout to where ensure_git_path would clone it.
+
+    Returns: The number of bytes fetched.
+    """
+    raise NotImplementedError(self.__class__.__name__)
+
   def ensure_local_repository(self, repository, commit=None):
     """Make sure local repository directory exists, and make it so if not."""
     git_dir = repository.git_dir
@@ -192,7 +207,7 @@ class SpinnakerSourceCodeManager(object):
     else:
       self.ensure_git_path(repository)
 
-  def refresh_source_info(self, repository, build_number):
+  def refresh_source_info(self, repository, build_number, refs_text=None):
     """Extract the source info from repository and cache with build number.
 
     We associate the build number because the different builds
@@ -203,8 +218,12 @@ class SpinnakerSourceCodeManager(object):
     We extract out the repository summary info, particularly the commit it is
     at, to ensure that future operations are consistent and operating on the
     same commit.
+
+    The refs_text is the repository's query_show_refs result if the caller
+    has already queried it, such as with foreach_source_repository_async.
     """
-    summary = self.__git.collect_repository_summary(repository.git_dir)
+    summary = self.__git.collect_repository_summary(
+        repository.git_dir, refs_text=refs_text)
     expect_build_number = (self.__options.build_number
                            if hasattr(self.__options, 'build_number')
                            else build_number)
@@ -212,11 +231,11 @@ class SpinnakerSourceCodeManager(object):
 
     filename = repository.name + '-meta.yml'
     dir_path = os.path.join(self.__options.output_dir, 'source_info')
-    cache_path = os.path.join(dir_path, filename)
+    cache_path = intermediate_path(os.path.join(dir_path, filename))
     logging.debug(
         'Refreshing source info for %s and caching to %s for buildnum=%s',
         repository.name, cache_path, build_number)
-    write_to_path(info.summary.to_yaml(), cache_path)
+    write_data_to_path(info.summary.to_dict(), cache_path)
     return info
 
   def lookup_source_info(self, repository):
@@ -224,10 +243,10 @@ class SpinnakerSourceCodeManager(object):
     filename = repository.name + '-meta.yml'
     dir_path = os.path.join(self.__options.output_dir, 'source_info')
     build_number = self.determine_build_number(repository)
-    with open(os.path.join(dir_path, filename), 'r') as stream:
-      return SourceInfo(
-          build_number,
-          RepositorySummary.from_dict(yaml.safe_load(stream.read())))
+    return SourceInfo(
+        build_number,
+        RepositorySummary.from_dict(
+            load_data_from_path(os.path.join(dir_path, filename))))
 
   def check_source_info(self, repository):
     """Ensure cached source info is consistent with current repository."""
@@ -272,6 +291,24 @@ class SpinnakerSourceCodeManager(object):
       }
     return result
 
+  def foreach_source_repository_async(
+      self, all_repos, call_function, *posargs, **kwargs):
+    """Call the asynchronous function on each of the SourceRepository instances.
+
+    Rather than dedicating a thread to each repository, the call_function
+    returns an asyncio future (e.g. from GitRunner.check_run_async) and all
+    the repositories are driven from a single event loop. Up to max_threads
+    repositories are in progress at a time.
+    """
+    logging.info('Mapping %d/%s asynchronously',
+                 len(all_repos), [repo.name for repo in all_repos])
+    values = map_async(
+        lambda repository: call_function(repository, *posargs, **kwargs),
+        all_repos, max_concurrent=self.__max_threads)
+    logging.info('Finished mapping')
+    return {repository.name: value
+            for repository, value in zip(all_repos, values)}
+
   def push_to_origin_if_not_upstream(self, repository, branch):
     """Push the local repository back to the origin, but not upstream."""
     git_dir = repository.git_dir
@@ -27,8 +27,10 @@ from buildtool import (
     RepositoryCommandFactory,
     RepositoryCommandProcessor,
 
+    is_async_supported,
     raise_and_log_error,
-    ConfigError)
+    ConfigError,
+    ExecutionError)
 
 
 class FetchSourceCommand(RepositoryCommandProcessor):
@@ -50,15 +52,29 @@ class FetchSourceCommand(RepositoryCommandProcessor):
       if options.delete_existing:
         logging.warning('Deleting existing %s', repository.git_dir)
         shutil.rmtree(repository.git_dir)
+      elif options.refresh_existing:
+        self.__refresh_existing(repository)
       elif options.skip_existing:
         logging.debug('Skipping existing %s', repository.git_dir)
       else:
         raise_and_log_error(
-            ConfigError('"{dir}" already exists.'
-                        ' Enable "skip_existing" or "delete_existing".'
+            ConfigError('"{dir}" already exists. Enable "skip_existing",'
+                        ' "refresh_existing" or "delete_existing".'
                         .format(dir=repository.git_dir)))
+    # This verifies existing directories are now current.
     super(FetchSourceCommand, self).ensure_local_repository(repository)
 
+  def __refresh_existing(self, repository):
+    """Update the existing repository, removing it if it is corrupt."""
+    git_dir = repository.git_dir
+    try:
+      self.source_code_manager.refresh_git_path(repository)
+    except ExecutionError:
+      if not self.git.is_repository_corrupt(git_dir):
+        raise
+      logging.warning('Deleting corrupt %s to clone it again', git_dir)
+      shutil.rmtree(git_dir)
+
   def _do_repository(self, repository):
     """Implements RepositoryCommandProcessor interface."""
     pass
@@ -82,14 +98,47 @@ class FetchSourceCommandFactory(RepositoryCommandFactory):
     self.add_argument(
         parser, 'skip_existing', defaults, False, type=bool,
         help='Ignore directories that are already present.')
+    self.add_argument(
+        parser, 'refresh_existing', defaults, False, type=bool,
+        help='Update directories that are already present by fetching from'
+             ' the origin and resetting them to the branch or commit being'
+             ' fetched, discarding local changes. Directories that are'
+             ' corrupt are cloned again.')
 
 
 class ExtractSourceInfoCommand(RepositoryCommandProcessor):
   """Get the Git metadata for each repository, and associate a build number."""
+
+  def __init__(self, factory, options, **kwargs):
+    super(ExtractSourceInfoCommand, self).__init__(factory, options, **kwargs)
+    self.__refs_text = {}
+
+  def _do_preprocess(self):
+    """Implements RepositoryCommandProcessor interface.
+
+    Queries the refs of all the existing repositories from a single event
+    loop rather than a subprocess at a time from each repository's thread.
+    When the summaries are cached, this is all the git work there is.
+    """
+    if not is_async_supported():
+      return
+    repositories = [repository for repository in self.source_repositories
+                    if os.path.exists(repository.git_dir)]
+    results = self.source_code_manager.foreach_source_repository_async(
+        repositories,
+        lambda repository: self.git.run_git_async(
+            repository.git_dir, 'show-ref --head -d'))
+
+    # Failures are left for refresh_source_info to query again and report.
+    self.__refs_text = {name: refs_text
+                        for name, (retcode, refs_text) in results.items()
+                        if not (retcode and refs_text)}
+
   def _do_repository(self, repository):
     """Implements RepositoryCommandProcessor interface."""
     self.source_code_manager.refresh_source_info(
-        repository, self.options.build_number)
+        repository, self.options.build_number,
+        refs_text=self.__refs_text.get(repository.name))
 
 
 class ExtractSourceInfoCommandFactory(RepositoryCommandFactory):
@@ -133,7 +133,9 @@ class BuildSpinCommand(RepositoryCommandProcessor):
       self.metrics.time_call(
           'GoGet', labels, self.metrics.default_determine_outcome_labels,
           check_subprocesses_to_logfile, 'Fetching Go packages ' + context,
-          logfile, [cmd], cwd=gopath, env=env)
+          logfile, [cmd], cwd=gopath, env=env,
+          resource_labels={'repository': repository.name,
+                           'context': context, 'target': 'go-get'})
 
     for dist_arch in DIST_ARCH_LIST:
       # GCS sub-directory the binaries are stored in are specified by
@@ -163,7 +165,9 @@ class BuildSpinCommand(RepositoryCommandProcessor):
       self.metrics.time_call(
           'GoBuild', labels, self.metrics.default_determine_outcome_labels,
           check_subprocesses_to_logfile, 'Building spin ' + context, logfile,
-          [cmd], cwd=config_root, env=env)
+          [cmd], cwd=config_root, env=env,
+          resource_labels={'repository': repository.name,
+                           'context': context, 'target': 'go-build'})
 
       spin_path = '{}/{}'.format(config_root, dist_arch.filename)
       self.__gcs_uploader.upload_from_filename(
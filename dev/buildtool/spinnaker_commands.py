@@ -88,19 +88,19 @@ class InitiateReleaseBranchCommand(RepositoryCommandProcessor):
     branch = self.options.spinnaker_version
 
     logging.debug('Checking for branch="%s" in "%s"', branch, git_dir)
-    remote_branches = [
-        line.strip()
-        for line in self.__git.check_run(git_dir, 'branch -r').split('\n')]
-
-    if 'origin/' + branch in remote_branches:
+    replace_existing = False
+    if self.__git.resolve_object_id_or_none(
+        git_dir, 'refs/remotes/origin/' + branch):
       if self.options.skip_existing:
         logging.info('Branch "%s" already exists in "%s" -- skip',
                      branch, repository.origin)
         return
       elif self.options.delete_existing:
-        logging.warning('Branch "%s" already exists in "%s" -- delete',
+        # Force pushing replaces it in one step, so the origin is never
+        # left without the branch if the push fails.
+        logging.warning('Branch "%s" already exists in "%s" -- replace',
                         branch, repository.origin)
-        self.__git.delete_branch_on_origin(git_dir, branch)
+        replace_existing = True
       else:
         raise_and_log_error(
             ConfigError(
@@ -111,7 +111,7 @@ class InitiateReleaseBranchCommand(RepositoryCommandProcessor):
     logging.info('Creating and pushing branch "%s" to "%s"',
                  branch, repository.origin)
     self.__git.check_run(git_dir, 'checkout -b ' + branch)
-    self.__git.push_branch_to_origin(git_dir, branch)
+    self.__git.push_branch_to_origin(git_dir, branch, force=replace_existing)
 
 
 class PublishSpinnakerFactory(CommandFactory):
@@ -252,19 +252,18 @@ class PublishSpinnakerCommand(CommandProcessor):
     if self.__already_have_tag(repository, tag):
       return False
 
-    self.__git.check_run(repository.git_dir, 'tag ' + tag)
+    self.__git.tag_head(repository.git_dir, tag)
     return True
 
   def __push_branch_and_maybe_tag_repository(self, repository, branch, version,
                                              also_tag):
     """Push the branch and version tag to the origin."""
     tag = 'version-' + version
-    self.__git.push_branch_to_origin(repository.git_dir, branch)
-    if also_tag:
-      self.__git.push_tag_to_origin(repository.git_dir, tag)
-    else:
+    if not also_tag:
       logging.info('%s was already tagged with "%s" -- skip',
                    repository.git_dir, tag)
+    self.__git.push_branch_to_origin(repository.git_dir, branch,
+                                     tags=[tag] if also_tag else None)
 
   def _do_command(self):
     """Implements CommandProcessor interface."""
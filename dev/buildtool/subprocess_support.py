@@ -14,23 +14,37 @@
 
 """Support for running subprocess commands."""
 
+import codecs
+import collections
 import io
 import datetime
+import errno
 import logging
 import os
 import shlex
 import subprocess
+import sys
+import tempfile
+import threading
 import time
 
+try:
+  import asyncio
+except ImportError:
+  # The *_async functions are only available on python3.
+  asyncio = None
+
 from buildtool import (
     ensure_dir_exists,
     log_embedded_output,
     log_timestring,
     raise_and_log_error,
     timedelta_string,
-    ExecutionError)
+    ExecutionError,
+    UnexpectedError)
 
 from buildtool.base_metrics import BaseMetricsRegistry
+from buildtool.tracing import Tracer
 
 
 # Directory where error logfiles are copied to.
@@ -38,6 +52,103 @@ from buildtool.base_metrics import BaseMetricsRegistry
 # this module does not offer encapsulated configuration.
 ERROR_LOGFILE_DIR = 'errors'
 
+# The maximum number of subprocesses that the *_async functions will run
+# at the same time if not otherwise given an explicit SubprocessLimiter.
+ASYNC_SUBPROCESS_LIMIT = 64
+
+# How often the *_async functions flush output to streams.
+ASYNC_STREAM_FLUSH_SECS = 1.0
+
+
+class ResourceUsage(
+    collections.namedtuple(
+        'ResourceUsage',
+        ['user_secs', 'system_secs', 'max_rss_kb',
+         'block_input_ops', 'block_output_ops',
+         'voluntary_switches', 'involuntary_switches'])):
+  """The resources used by a finished subprocess."""
+
+  @staticmethod
+  def from_rusage(rusage):
+    """Returns the ResourceUsage from an os.wait4 rusage."""
+    max_rss_kb = rusage.ru_maxrss
+    if sys.platform == 'darwin':
+      # This is in bytes on MacOS rather than kilobytes.
+      max_rss_kb //= 1024
+    return ResourceUsage(
+        rusage.ru_utime, rusage.ru_stime, max_rss_kb,
+        rusage.ru_inblock, rusage.ru_oublock,
+        rusage.ru_nvcsw, rusage.ru_nivcsw)
+
+  def to_attributes(self):
+    """Returns the usage as a dictionary for trace span attributes."""
+    return dict(self._asdict())
+
+  def __str__(self):
+    return ('user {user:.2f} secs, system {system:.2f} secs,'
+            ' max rss {rss:.1f} MB, block ops {inblock} in/{outblock} out,'
+            ' context switches {vol} voluntary/{invol} involuntary'.format(
+                user=self.user_secs, system=self.system_secs,
+                rss=self.max_rss_kb / 1024.0,
+                inblock=self.block_input_ops, outblock=self.block_output_ops,
+                vol=self.voluntary_switches,
+                invol=self.involuntary_switches))
+
+
+def _wait_for_exit(process):
+  """Waits for the process to exit.
+
+  Returns:
+    The ResourceUsage of the process, or None if it was not available
+    such as when the process had already been reaped.
+  """
+  if process.returncode is None and hasattr(os, 'wait4'):
+    try:
+      _, status, rusage = os.wait4(process.pid, 0)
+    except OSError as ex:
+      if ex.errno != errno.ECHILD:
+        raise
+    else:
+      # pylint: disable=protected-access
+      process._handle_exitstatus(status)
+      return ResourceUsage.from_rusage(rusage)
+  process.wait()
+  return None
+
+
+def record_subprocess_resource_usage(usage, labels):
+  """Records the ResourceUsage of a subprocess into metrics.
+
+  Args:
+    usage: [ResourceUsage] The usage to record.
+    labels: [dict] Identifies the subprocess, such as by the repository,
+       context and target.
+  """
+  # Imported here because the metrics module depends on this one.
+  from buildtool.base_metrics import MetricFamily
+  from buildtool.metrics import MetricsManager
+  metrics = MetricsManager.singleton()
+
+  def inc_counter(name, extra_labels, amount):
+    metric_labels = dict(labels)
+    metric_labels.update(extra_labels)
+    metrics.bind_labels(
+        MetricFamily.COUNTER, name, metric_labels).inc(amount=amount)
+
+  inc_counter('SubprocessCpuSecs', {'mode': 'user'}, usage.user_secs)
+  inc_counter('SubprocessCpuSecs', {'mode': 'system'}, usage.system_secs)
+  inc_counter('SubprocessBlockOps', {'direction': 'in'},
+              usage.block_input_ops)
+  inc_counter('SubprocessBlockOps', {'direction': 'out'},
+              usage.block_output_ops)
+  inc_counter('SubprocessContextSwitches', {'kind': 'voluntary'},
+              usage.voluntary_switches)
+  inc_counter('SubprocessContextSwitches', {'kind': 'involuntary'},
+              usage.involuntary_switches)
+  metrics.bind_labels(
+      MetricFamily.GAUGE, 'SubprocessMaxRssKb', labels).set(usage.max_rss_kb)
+
+
 def start_subprocess(cmd, stream=None, stdout=None, echo=False, **kwargs):
   """Starts a subprocess and returns handle to it."""
   split_cmd = shlex.split(cmd)
@@ -55,24 +166,41 @@ def start_subprocess(cmd, stream=None, stdout=None, echo=False, **kwargs):
         time=log_timestring(now=start_date), cmd=cmd, extra=extra_log_info))
     stream.flush()
 
-  process = subprocess.Popen(
-      actual_command,
-      close_fds=True,
-      stdout=stdout or subprocess.PIPE,
-      stderr=subprocess.STDOUT,
-      **kwargs)
+  span = Tracer.singleton().start_span(
+      os.path.basename(split_cmd[0]), 'subprocess',
+      {'cmd': cmd, 'cwd': kwargs.get('cwd', '')})
+  try:
+    process = subprocess.Popen(
+        actual_command,
+        close_fds=True,
+        stdout=stdout or subprocess.PIPE,
+        stderr=kwargs.pop('stderr', subprocess.STDOUT),
+        **kwargs)
+  except Exception as ex:
+    span.end({'exception_type': ex.__class__.__name__})
+    raise
   logging.log(log_level, 'Running %s as pid %s', split_cmd[0], process.pid)
   process.start_date = start_date
+  span.attributes['pid'] = process.pid
+  process.trace_span = span
 
   time.sleep(0) # yield this thread
   return process
 
 
-def wait_subprocess(process, stream=None, echo=False, postprocess_hook=None):
+def wait_subprocess(process, stream=None, echo=False, postprocess_hook=None,
+                    resource_labels=None):
   """Waits for subprocess to finish and returns (final status, stdout).
 
   This will also consume the remaining output to return it.
 
+  The ResourceUsage of the process is left in its resource_usage attribute
+  and written into the stream footer.
+
+  Args:
+    resource_labels: [dict] If provided then record the resources used by
+       the process into the Subprocess* metrics with these labels.
+
   Returns:
     Process exit code, stdout remaining in process prior to this invocation.
     Any previously read output from the process will not be included.
@@ -89,7 +217,7 @@ def wait_subprocess(process, stream=None, echo=False, postprocess_hook=None):
         stream.write(decoded_line)
         stream.flush()
    
-  process.wait()
+  process.resource_usage = _wait_for_exit(process)
   if stream is None and process.stdout is not None:
     # Close stdout pipe if we didnt give a stream.
     # Otherwise caller owns the stream.
@@ -103,20 +231,30 @@ def wait_subprocess(process, stream=None, echo=False, postprocess_hook=None):
 
   returncode = process.returncode
   stdout = ''.join(text_lines)
+  usage = process.resource_usage
+  if hasattr(process, 'trace_span'):
+    attributes = {'exit_code': returncode}
+    if usage:
+      attributes.update(usage.to_attributes())
+    process.trace_span.end(attributes)
+  if usage and resource_labels is not None:
+    record_subprocess_resource_usage(usage, resource_labels)
 
   if stream:
     stream.write(
         u'\n\n----\n{time} Spawned process completed'
-        u' with returncode {returncode} in {delta_time}.\n'
+        u' with returncode {returncode} in {delta_time}{usage}.\n'
         .format(time=log_timestring(now=end_date), returncode=returncode,
-                delta_time=delta_time_str))
+                delta_time=delta_time_str,
+                usage=u' using {0}'.format(usage) if usage else u''))
     stream.flush()
 
   if echo:
     logging.info('%s returned %d with output:\n%s',
                  process.pid, returncode, stdout)
-  logging.debug('Finished %s with returncode=%d in %s',
-                process.pid, returncode, delta_time_str)
+  logging.debug('Finished %s with returncode=%d in %s%s',
+                process.pid, returncode, delta_time_str,
+                ' using {0}'.format(usage) if usage else '')
 
   if postprocess_hook:
     postprocess_hook(returncode, stdout)
@@ -124,12 +262,48 @@ def wait_subprocess(process, stream=None, echo=False, postprocess_hook=None):
   return returncode, stdout.strip()
 
 
+def _write_subprocess_input(process, input_text):
+  """Writes the input_text to the process stdin then closes it."""
+  try:
+    process.stdin.write(input_text.encode('utf-8'))
+  except (IOError, OSError):
+    pass  # The process exited early. Its returncode will say why.
+  finally:
+    try:
+      process.stdin.close()
+    except (IOError, OSError):
+      pass
+
+
 def run_subprocess(cmd, stream=None, echo=False, **kwargs):
-  """Returns retcode, stdout."""
+  """Returns retcode, stdout.
+
+  If an "input" string is provided then it is written to the stdin of the
+  subprocess, which is then closed.
+  """
   postprocess_hook = kwargs.pop('postprocess_hook', None)
+  resource_labels = kwargs.pop('resource_labels', None)
+  input_text = kwargs.pop('input', None)
+  if input_text is not None:
+    kwargs['stdin'] = subprocess.PIPE
   process = start_subprocess(cmd, stream=stream, echo=echo, **kwargs)
-  return wait_subprocess(process, stream=stream, echo=echo,
-                         postprocess_hook=postprocess_hook)
+
+  writer = None
+  if input_text is not None:
+    # Written from another thread so that a process writing output before
+    # reading all its input cannot deadlock waiting on us to read it.
+    writer = threading.Thread(name='SubprocessInput',
+                              target=_write_subprocess_input,
+                              args=(process, input_text))
+    writer.daemon = True
+    writer.start()
+  try:
+    return wait_subprocess(process, stream=stream, echo=echo,
+                           postprocess_hook=postprocess_hook,
+                           resource_labels=resource_labels)
+  finally:
+    if writer:
+      writer.join()
 
 
 def check_subprocess(cmd, stream=None, **kwargs):
@@ -139,7 +313,11 @@ def check_subprocess(cmd, stream=None, **kwargs):
   retcode, stdout = run_subprocess(cmd, stream=stream, **kwargs)
   if retcode == 0:
     return stdout.strip()
+  _raise_check_subprocess_failure(cmd, stdout, embed_errors)
+
 
+def _raise_check_subprocess_failure(cmd, stdout, embed_errors):
+  """Log the output of a failed command then raise an ExecutionError."""
   if embed_errors:
     log_embedded_output(logging.ERROR, 'command output', stdout)
     logging.error('Command failed. See embedded output above.')
@@ -155,6 +333,42 @@ def check_subprocess(cmd, stream=None, **kwargs):
   raise_and_log_error(ExecutionError(program + ' failed.', program=program))
 
 
+def check_subprocess_lines(cmd, **kwargs):
+  """Run a subprocess and yield each line of its stdout as it is produced.
+
+  Unlike check_subprocess, the output is never accumulated so this is suitable
+  for commands whose output is very large. stderr is kept separately and
+  ExecutionError is raised after the final line if the command failed.
+  If the caller stops iterating early then the subprocess is killed.
+  """
+  with tempfile.TemporaryFile() as stderr:
+    process = start_subprocess(cmd, stderr=stderr, **kwargs)
+    completed = False
+    try:
+      for raw_line in iter(process.stdout.readline, b''):
+        yield raw_line.decode(encoding='utf-8')
+      completed = True
+    finally:
+      if not completed and process.poll() is None:
+        process.kill()
+      process.stdout.close()
+      process.wait()
+
+    logging.debug('Finished %s with returncode=%d in %s',
+                  process.pid, process.returncode,
+                  timedelta_string(datetime.datetime.now()
+                                   - process.start_date))
+    if process.returncode == 0:
+      return
+
+    stderr.seek(0)
+    log_embedded_output(logging.ERROR, 'command error output',
+                        stderr.read().decode(encoding='utf-8'))
+
+  program = os.path.basename(shlex.split(cmd)[0])
+  raise_and_log_error(ExecutionError(program + ' failed.', program=program))
+
+
 def check_subprocess_sequence(cmd_list, stream=None, **kwargs):
   """Run multiple commands until one fails.
 
@@ -187,7 +401,8 @@ def check_subprocesses_to_logfile(what, logfile, cmds, append=False, **kwargs):
     logfile: [path] The logfile to write to.
     cmds: [list of string] A list of commands to run.
     append: [boolean] Open the log file as append if true, write new default.
-    kwargs: [kwargs] Additional keyword arguments to pass to check_subprocess.
+    kwargs: [kwargs] Additional keyword arguments to pass to check_subprocess,
+       such as resource_labels.
   """
   mode = 'a' if append else 'w'
   how = 'Appending' if append else 'Logging'
@@ -219,8 +434,343 @@ def check_subprocesses_to_logfile(what, logfile, cmds, append=False, **kwargs):
       raise
 
 
+class SubprocessLimiter(object):
+  """Bounds the number of *_async subprocesses running concurrently.
+
+  This can be shared among event loops in different threads.
+  """
+
+  def __init__(self, max_concurrent):
+    self.__lock = threading.Lock()
+    self.__available = max_concurrent
+    self.__waiting = []
+
+  def acquire(self, loop):
+    """Returns a future on loop that completes once a slot is available."""
+    future = loop.create_future()
+    with self.__lock:
+      if self.__available > 0:
+        self.__available -= 1
+        future.set_result(None)
+      else:
+        self.__waiting.append((loop, future))
+    return future
+
+  def release(self):
+    """Release a previously acquired slot to the next waiter, if any."""
+    with self.__lock:
+      while self.__waiting:
+        loop, future = self.__waiting.pop(0)
+        if not future.cancelled():
+          loop.call_soon_threadsafe(self.__grant, future)
+          return
+      self.__available += 1
+
+  def __grant(self, future):
+    """Hands a released slot to the future on its own loop."""
+    if future.cancelled():
+      self.release()
+    else:
+      future.set_result(None)
+
+
+_DEFAULT_LIMITER_LOCK = threading.Lock()
+_DEFAULT_LIMITER = None
+
+
+def _get_default_subprocess_limiter():
+  """Returns the SubprocessLimiter used by *_async if none is given."""
+  # pylint: disable=global-statement
+  global _DEFAULT_LIMITER
+  with _DEFAULT_LIMITER_LOCK:
+    if _DEFAULT_LIMITER is None:
+      _DEFAULT_LIMITER = SubprocessLimiter(ASYNC_SUBPROCESS_LIMIT)
+    return _DEFAULT_LIMITER
+
+
+class _AsyncSubprocessProtocol(
+    asyncio.SubprocessProtocol if asyncio else object):
+  """Collects the output from an *_async subprocess.
+
+  Output arrives in whatever sized chunks the event loop reads from the pipe
+  and is decoded incrementally rather than line by line. Streams are flushed
+  at most every ASYNC_STREAM_FLUSH_SECS rather than after every line.
+  """
+
+  def __init__(self, loop, stream, done_future):
+    self.__loop = loop
+    self.__stream = stream
+    self.__done_future = done_future
+    self.__decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    self.__chunks = []
+    self.__transport = None
+    self.__exited = False
+    self.__pipe_closed = False
+    self.__flush_handle = None
+
+  def connection_made(self, transport):
+    self.__transport = transport
+
+  def pipe_data_received(self, fd, data):
+    self.__add_text(self.__decoder.decode(data))
+
+  def pipe_connection_lost(self, fd, exc):
+    self.__pipe_closed = True
+    self.__maybe_finish()
+
+  def process_exited(self):
+    self.__exited = True
+    self.__maybe_finish()
+
+  def __add_text(self, text):
+    if not text:
+      return
+    self.__chunks.append(text)
+    if self.__stream:
+      self.__stream.write(text)
+      if self.__flush_handle is None:
+        self.__flush_handle = self.__loop.call_later(
+            ASYNC_STREAM_FLUSH_SECS, self.__flush)
+
+  def __flush(self):
+    self.__flush_handle = None
+    self.__stream.flush()
+
+  def __maybe_finish(self):
+    # The process can exit before we have finished reading its output.
+    if not (self.__exited and self.__pipe_closed):
+      return
+    if self.__done_future.done():
+      return
+
+    self.__add_text(self.__decoder.decode(b'', final=True))
+    if self.__flush_handle is not None:
+      self.__flush_handle.cancel()
+      self.__flush()
+    returncode = self.__transport.get_returncode()
+    self.__transport.close()
+    self.__done_future.set_result((returncode, ''.join(self.__chunks)))
+
+
+def is_async_supported():
+  """Returns whether the *_async functions are available."""
+  return asyncio is not None
+
+
+def _check_async_supported():
+  if not is_async_supported():
+    raise_and_log_error(
+        UnexpectedError('The *_async subprocess functions require python3.'))
+
+
+def run_subprocess_async(cmd, stream=None, echo=False, **kwargs):
+  """An asyncio variant of run_subprocess.
+
+  Args:
+    cmd: [string] The command to run as with run_subprocess.
+    stream: [stream] If provided then also write output to this stream.
+    echo: [boolean] If true then log the command and output at INFO level.
+    loop: [asyncio loop] The event loop to run on, or the current loop.
+    limiter: [SubprocessLimiter] Bounds concurrent subprocesses.
+       Defaults to a shared limit of ASYNC_SUBPROCESS_LIMIT.
+    postprocess_hook: [callable] As with run_subprocess.
+    kwargs: [kwargs] Additional arguments for the subprocess such as cwd.
+
+  Returns:
+    An asyncio future whose result is (retcode, stdout) as with run_subprocess.
+  """
+  _check_async_supported()
+  loop = kwargs.pop('loop', None) or asyncio.get_event_loop()
+  limiter = kwargs.pop('limiter', None) or _get_default_subprocess_limiter()
+  postprocess_hook = kwargs.pop('postprocess_hook', None)
+  shell = kwargs.pop('shell', False)
+
+  # Parse before waiting for a slot so a bad command fails here
+  # as it would with run_subprocess.
+  split_cmd = shlex.split(cmd)
+  result_future = loop.create_future()
+
+  log_level = logging.INFO if echo else logging.DEBUG
+  extra_log_info = ''
+  if 'cwd' in kwargs:
+    extra_log_info += ' in cwd="%s"' % kwargs['cwd']
+  start_date = []
+  span = []
+  parent_span = Tracer.singleton().current_span()
+
+  def finish(done_future):
+    limiter.release()
+    if done_future.exception() is not None:
+      span[0].end({'exception_type':
+                   done_future.exception().__class__.__name__})
+      result_future.set_exception(done_future.exception())
+      return
+
+    returncode, stdout = done_future.result()
+    span[0].end({'exit_code': returncode})
+    end_date = datetime.datetime.now()
+    delta_time_str = timedelta_string(end_date - start_date[0])
+    if stream:
+      stream.write(
+          u'\n\n----\n{time} Spawned process completed'
+          u' with returncode {returncode} in {delta_time}.\n'
+          .format(time=log_timestring(now=end_date), returncode=returncode,
+                  delta_time=delta_time_str))
+      stream.flush()
+    if echo:
+      logging.info('%r returned %d with output:\n%s', cmd, returncode, stdout)
+    logging.debug('Finished %r with returncode=%d in %s',
+                  cmd, returncode, delta_time_str)
+
+    try:
+      if postprocess_hook:
+        postprocess_hook(returncode, stdout)
+      result_future.set_result((returncode, stdout.strip()))
+    except Exception as ex:
+      result_future.set_exception(ex)
+
+  def start(acquired_future):
+    if acquired_future.cancelled():
+      return
+    try:
+      spawn_process()
+    except Exception as ex:
+      limiter.release()
+      if span:
+        span[0].end({'exception_type': ex.__class__.__name__})
+      result_future.set_exception(ex)
+
+  def spawn_process():
+    logging.log(log_level, 'Running %s%s...', repr(cmd), extra_log_info)
+    start_date.append(datetime.datetime.now())
+    span.append(Tracer.singleton().start_span(
+        os.path.basename(split_cmd[0]), 'subprocess',
+        {'cmd': cmd, 'cwd': kwargs.get('cwd', '')}, parent=parent_span))
+    if stream:
+      stream.write(u'{time} Spawning {cmd!r}{extra}\n----\n\n'.format(
+          time=log_timestring(now=start_date[0]), cmd=cmd,
+          extra=extra_log_info))
+      stream.flush()
+
+    done_future = loop.create_future()
+    done_future.add_done_callback(finish)
+    protocol_factory = lambda: _AsyncSubprocessProtocol(
+        loop, stream, done_future)
+    if shell:
+      spawn = loop.subprocess_shell(
+          protocol_factory, cmd, stdin=subprocess.DEVNULL,
+          stderr=subprocess.STDOUT, **kwargs)
+    else:
+      spawn = loop.subprocess_exec(
+          protocol_factory, *split_cmd, stdin=subprocess.DEVNULL,
+          stderr=subprocess.STDOUT, **kwargs)
+
+    def spawned(spawn_future):
+      if spawn_future.exception() is not None:
+        done_future.set_exception(spawn_future.exception())
+        return
+      transport, _ = spawn_future.result()
+      span[0].attributes['pid'] = transport.get_pid()
+    asyncio.ensure_future(spawn, loop=loop).add_done_callback(spawned)
+
+  limiter.acquire(loop).add_done_callback(start)
+  return result_future
+
+
+def check_subprocess_async(cmd, stream=None, **kwargs):
+  """An asyncio variant of check_subprocess.
+
+  Returns:
+    An asyncio future whose result is the stdout from the command, or
+    an ExecutionError if the command failed.
+  """
+  embed_errors = kwargs.pop('embed_errors', True)
+  run_future = run_subprocess_async(cmd, stream=stream, **kwargs)
+  loop = kwargs.get('loop') or asyncio.get_event_loop()
+  result_future = loop.create_future()
+
+  def check(_):
+    if run_future.exception() is not None:
+      result_future.set_exception(run_future.exception())
+      return
+    retcode, stdout = run_future.result()
+    if retcode == 0:
+      result_future.set_result(stdout)
+      return
+    try:
+      _raise_check_subprocess_failure(cmd, stdout, embed_errors)
+    except Exception as ex:
+      result_future.set_exception(ex)
+
+  run_future.add_done_callback(check)
+  return result_future
+
+
+def map_async(func, items, max_concurrent=None):
+  """Maps func over the items from a single new event loop.
+
+  This is the bridge for synchronous callers into the *_async functions.
+
+  Args:
+    func: [callable] Given an item, returns an asyncio future or coroutine
+       for its result. This is called from within the event loop.
+    items: [list] The items to map over.
+    max_concurrent: [int] If set, the maximum number of func futures
+       that are outstanding at any time.
+
+  Returns:
+    A list of the results for each item, in order. If any failed then
+    the first exception is raised once all of them have finished.
+  """
+  _check_async_supported()
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  limiter = SubprocessLimiter(max_concurrent) if max_concurrent else None
+
+  def start_item(item):
+    if limiter is None:
+      return asyncio.ensure_future(func(item), loop=loop)
+
+    result_future = loop.create_future()
+    def finished(item_future):
+      limiter.release()
+      if item_future.exception() is not None:
+        result_future.set_exception(item_future.exception())
+      else:
+        result_future.set_result(item_future.result())
+
+    def start(_):
+      try:
+        item_future = asyncio.ensure_future(func(item), loop=loop)
+      except Exception as ex:
+        limiter.release()
+        result_future.set_exception(ex)
+        return
+      item_future.add_done_callback(finished)
+
+    limiter.acquire(loop).add_done_callback(start)
+    return result_future
+
+  try:
+    all_futures = [start_item(item) for item in items]
+    results = loop.run_until_complete(
+        asyncio.gather(*all_futures, return_exceptions=True))
+  finally:
+    asyncio.set_event_loop(None)
+    loop.close()
+
+  for result in results:
+    if isinstance(result, Exception):
+      raise result
+  return results
+
+
 def determine_subprocess_outcome_labels(result, labels):
-  """For determining outcome labels when timing calls to subprocesses."""
+  """For determining outcome labels when timing calls to subprocesses.
+
+  When used with a MetricHandle the labels are empty so that only the
+  outcome labels are returned and keyed within the handle.
+  """
   if result is None:
     return BaseMetricsRegistry.default_determine_outcome_labels(
         result, labels)
@@ -0,0 +1,296 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Lightweight trace spans showing where buildtool spends its time.
+
+Spans nest commands, the repositories they process and the subprocesses
+run for them. The current span is tracked per thread and is handed to
+worker threads with Tracer.activate or Tracer.wrap so their spans have the
+right parent.
+
+The finished spans are exported as Chrome trace-event JSON, which can be
+opened in chrome://tracing or https://ui.perfetto.dev, and optionally as
+OTLP-compatible JSON.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+from buildtool import write_to_path
+
+
+TRACE_FORMATS = ['chrome', 'otlp']
+
+
+class Span(object):
+  """A named interval of work within a trace.
+
+  Attributes:
+    name: [string] What the span is for, such as a command name.
+    category: [string] The kind of span, such as "repository".
+    span_id: [string] 16 hex digits identifying the span.
+    parent_id: [string] The span_id of the parent span or None.
+    start_time: [float] When the span started in epoch seconds.
+    end_time: [float] When the span ended in epoch seconds or None.
+    thread_id: [int] The thread that started the span.
+    thread_name: [string] The name of the thread that started the span.
+    attributes: [dict] Additional details such as a pid or exit code.
+  """
+
+  @property
+  def duration_secs(self):
+    """The span duration or None if it has not ended."""
+    if self.end_time is None:
+      return None
+    return self.end_time - self.start_time
+
+  def __init__(self, tracer, name, category, parent, attributes):
+    self.__tracer = tracer
+    self.name = name
+    self.category = category
+    self.span_id = '%016x' % random.getrandbits(64)
+    self.parent_id = parent.span_id if parent else None
+    thread = threading.current_thread()
+    self.thread_id = thread.ident
+    self.thread_name = thread.name
+    self.attributes = dict(attributes or {})
+    self.start_time = time.time()
+    self.end_time = None
+
+  def end(self, attributes=None):
+    """Ends the span, adding any additional attributes."""
+    if self.end_time is not None:
+      return
+    self.end_time = time.time()
+    if attributes:
+      self.attributes.update(attributes)
+    self.__tracer.record(self)
+
+
+class Tracer(object):
+  """Creates spans and collects the finished ones for export."""
+
+  __singleton = None
+  __singleton_lock = threading.Lock()
+
+  @staticmethod
+  def singleton():
+    """Returns the tracer shared by buildtool commands."""
+    with Tracer.__singleton_lock:
+      if Tracer.__singleton is None:
+        Tracer.__singleton = Tracer()
+      return Tracer.__singleton
+
+  @property
+  def trace_id(self):
+    """32 hex digits identifying this trace."""
+    return self.__trace_id
+
+  @property
+  def enabled(self):
+    """Whether finished spans are kept for export."""
+    return self.__enabled
+
+  @property
+  def finished_spans(self):
+    with self.__lock:
+      return list(self.__finished_spans)
+
+  def __init__(self, enabled=False):
+    self.__trace_id = '%032x' % random.getrandbits(128)
+    self.__enabled = enabled
+    self.__lock = threading.Lock()
+    self.__finished_spans = []
+    self.__local = threading.local()
+
+  def set_enabled(self, enabled):
+    """Starts or stops keeping the finished spans."""
+    self.__enabled = enabled
+
+  def current_span(self):
+    """Returns the innermost active span on this thread or None."""
+    return getattr(self.__local, 'span', None)
+
+  def start_span(self, name, category='', attributes=None, parent=None):
+    """Starts a span without making it the current one.
+
+    This is for spans whose start and end are not within a single block,
+    such as a subprocess. The caller must end the span.
+
+    Args:
+      name: [string] The name of the span.
+      category: [string] The kind of span.
+      attributes: [dict] Additional details for the span.
+      parent: [Span] The parent span. Defaults to the current span.
+    """
+    return Span(self, name, category, parent or self.current_span(),
+                attributes)
+
+  @contextlib.contextmanager
+  def span(self, name, category='', attributes=None, parent=None):
+    """Runs the block within a new span that is current on this thread.
+
+    If the block raises, the span records the exception type.
+    """
+    span = self.start_span(name, category, attributes, parent)
+    with self.activate(span):
+      try:
+        yield span
+      except:
+        span.end({'exception_type': sys.exc_info()[0].__name__})
+        raise
+      finally:
+        span.end()
+
+  @contextlib.contextmanager
+  def activate(self, span):
+    """Makes the span current on this thread for the duration of the block.
+
+    This is how a worker thread continues the span of the thread that
+    gave it the work.
+    """
+    prev = self.current_span()
+    self.__local.span = span
+    try:
+      yield span
+    finally:
+      self.__local.span = prev
+
+  def wrap(self, func):
+    """Returns func bound to run within the current span on any thread."""
+    parent = self.current_span()
+    def run_in_parent(*pos_args, **kwargs):
+      with self.activate(parent):
+        return func(*pos_args, **kwargs)
+    return run_in_parent
+
+  def record(self, span):
+    """Called when a span ends to keep it for export."""
+    if not self.__enabled:
+      return
+    with self.__lock:
+      self.__finished_spans.append(span)
+
+  def to_chrome_trace(self):
+    """Returns the finished spans as a Chrome trace-event JSON object.
+
+    Each span is a complete ("X") event on the thread that started it.
+    Spans whose parent is on another thread are linked to it by a flow
+    event so the viewer draws an arrow from the parent.
+    """
+    pid = os.getpid()
+    spans = self.finished_spans
+    by_id = {span.span_id: span for span in spans}
+    thread_names = {span.thread_id: span.thread_name for span in spans}
+
+    events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+               'args': {'name': name}}
+              for tid, name in sorted(thread_names.items())]
+    for span in sorted(spans, key=lambda span: span.start_time):
+      args = dict(span.attributes)
+      args['span_id'] = span.span_id
+      if span.parent_id:
+        args['parent_id'] = span.parent_id
+      events.append({
+          'name': span.name,
+          'cat': span.category,
+          'ph': 'X',
+          'ts': int(span.start_time * 1000000),
+          'dur': int((span.end_time - span.start_time) * 1000000),
+          'pid': pid,
+          'tid': span.thread_id,
+          'args': args})
+
+      parent = by_id.get(span.parent_id)
+      if parent is not None and parent.thread_id != span.thread_id:
+        flow = {'name': 'spawn', 'cat': 'flow', 'id': span.span_id,
+                'pid': pid, 'ts': int(span.start_time * 1000000)}
+        events.append(dict(flow, ph='s', tid=parent.thread_id))
+        events.append(dict(flow, ph='f', bp='e', tid=span.thread_id))
+
+    return {'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'trace_id': self.__trace_id}}
+
+  def to_otlp(self):
+    """Returns the finished spans as OTLP/JSON ExportTraceServiceRequest."""
+    def to_any_value(value):
+      if isinstance(value, bool):
+        return {'boolValue': value}
+      if isinstance(value, int):
+        return {'intValue': str(value)}
+      if isinstance(value, float):
+        return {'doubleValue': value}
+      return {'stringValue': str(value)}
+
+    def to_attributes(attributes):
+      return [{'key': key, 'value': to_any_value(value)}
+              for key, value in sorted(attributes.items())]
+
+    otlp_spans = []
+    for span in self.finished_spans:
+      otlp_span = {
+          'traceId': self.__trace_id,
+          'spanId': span.span_id,
+          'name': span.name,
+          'kind': 1,  # SPAN_KIND_INTERNAL
+          'startTimeUnixNano': str(int(span.start_time * 1000000000)),
+          'endTimeUnixNano': str(int(span.end_time * 1000000000)),
+          'attributes': to_attributes(
+              dict(span.attributes, category=span.category,
+                   thread_id=span.thread_id)),
+          # STATUS_CODE_ERROR or STATUS_CODE_UNSET
+          'status': {'code': 2 if 'exception_type' in span.attributes else 0}
+      }
+      if span.parent_id:
+        otlp_span['parentSpanId'] = span.parent_id
+      otlp_spans.append(otlp_span)
+
+    return {
+        'resourceSpans': [{
+            'resource': {'attributes': to_attributes({
+                'service.name': 'buildtool',
+                'process.pid': os.getpid(),
+                'process.command_line': ' '.join(sys.argv)})},
+            'scopeSpans': [{
+                'scope': {'name': 'buildtool.tracing'},
+                'spans': otlp_spans
+            }]
+        }]
+    }
+
+  def write(self, path_prefix, formats):
+    """Writes the finished spans in each of the formats.
+
+    Args:
+      path_prefix: [string] The path of the files without the extension.
+      formats: [list of string] The TRACE_FORMATS to write.
+    """
+    for trace_format in formats:
+      if trace_format == 'chrome':
+        path = path_prefix + '.json'
+        data = self.to_chrome_trace()
+      elif trace_format == 'otlp':
+        path = path_prefix + '.otlp.json'
+        data = self.to_otlp()
+      else:
+        raise ValueError('Unknown trace format "{0}"'.format(trace_format))
+      write_to_path(json.dumps(data, separators=(',', ':')), path)
+      logging.info('Wrote %s trace to %s', trace_format, path)
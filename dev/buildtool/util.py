@@ -14,11 +14,19 @@
 
 """Common helper functions across buildtool modules."""
 
+import collections
 import datetime
 import io
+import json
 import logging
 import os
 import socket
+import yaml
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
 
 
 # The build number to use if not otherwise explicitly specified
@@ -28,6 +36,23 @@ DEFAULT_BUILD_NUMBER = str(os.environ.get(
     'BUILD_NUMBER', '{:%Y%m%d%H%M%S}'.format(datetime.datetime.utcnow())))
 
 
+# The libyaml bindings are an order of magnitude faster when installed.
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# The file extension denoting each of the supported data formats.
+DATA_FORMAT_EXTENSIONS = collections.OrderedDict([
+    ('yaml', '.yml'),
+    ('json', '.json'),
+    ('jsonl', '.jsonl'),
+    ('msgpack', '.msgpack')
+])
+
+# The data format for intermediate files passed between commands.
+# This is set from the --intermediate_format option.
+_INTERMEDIATE_FORMAT = 'yaml'
+
+
 def add_parser_argument(parser, name, defaults, default_value, **kwargs):
   """Helper function for adding parser.add_argument with a default value.
 
@@ -115,3 +140,143 @@ def write_to_path(content, path):
   else:
     with io.open(path, 'w', encoding='utf-8') as f:
       f.write(content)
+
+
+def available_data_formats():
+  """Returns the names of the data formats that can be used here."""
+  return [name for name in DATA_FORMAT_EXTENSIONS.keys()
+          if name != 'msgpack' or msgpack is not None]
+
+
+def set_intermediate_format(data_format):
+  """Sets the data format for intermediate files passed between commands."""
+  # pylint: disable=global-statement
+  global _INTERMEDIATE_FORMAT
+  if data_format not in available_data_formats():
+    raise ValueError('Unsupported data format "{0}"'.format(data_format))
+  _INTERMEDIATE_FORMAT = data_format
+
+
+def get_intermediate_format():
+  """Returns the data format for intermediate files."""
+  return _INTERMEDIATE_FORMAT
+
+
+def intermediate_path(path):
+  """Returns the path with the extension for the intermediate format."""
+  return (os.path.splitext(path)[0]
+          + DATA_FORMAT_EXTENSIONS[_INTERMEDIATE_FORMAT])
+
+
+def data_format_for_path(path):
+  """Returns the data format implied by the path's extension, if any."""
+  extension = os.path.splitext(path)[1]
+  if extension == '.yaml':
+    return 'yaml'
+  for name, format_extension in DATA_FORMAT_EXTENSIONS.items():
+    if extension == format_extension:
+      return name
+  return None
+
+
+def encode_data(data, data_format):
+  """Serializes data into bytes using the given data format.
+
+  The "jsonl" format writes one JSON document per line. A dictionary is
+  written as a {"jsonl": "dict"} header followed by a [key, value] per line
+  and a list as a {"jsonl": "list"} header followed by an element per line.
+  """
+  if data_format == 'yaml':
+    text = yaml.dump(data, Dumper=YAML_DUMPER, default_flow_style=False,
+                     allow_unicode=True)
+  elif data_format == 'json':
+    text = json.dumps(data, sort_keys=True, separators=(',', ':'))
+  elif data_format == 'jsonl':
+    if isinstance(data, dict):
+      records = [[key, value] for key, value in sorted(data.items())]
+      header = {'jsonl': 'dict'}
+    elif isinstance(data, list):
+      records = data
+      header = {'jsonl': 'list'}
+    else:
+      records = []
+      header = data
+    text = '\n'.join([json.dumps(record, sort_keys=True,
+                                  separators=(',', ':'))
+                       for record in [header] + records]) + '\n'
+  elif data_format == 'msgpack' and msgpack is not None:
+    return msgpack.packb(data, use_bin_type=True)
+  else:
+    raise ValueError('Unsupported data format "{0}"'.format(data_format))
+  return text if isinstance(text, bytes) else text.encode('utf-8')
+
+
+def decode_data(content, data_format):
+  """Deserializes bytes written by encode_data."""
+  if data_format == 'msgpack' and msgpack is not None:
+    return msgpack.unpackb(content, raw=False)
+
+  text = content.decode('utf-8') if isinstance(content, bytes) else content
+  if data_format == 'yaml':
+    return yaml.load(text, Loader=YAML_LOADER)
+  if data_format == 'json':
+    return json.loads(text)
+  if data_format == 'jsonl':
+    lines = text.splitlines()
+    header = json.loads(lines[0]) if lines else None
+    records = [json.loads(line) for line in lines[1:] if line]
+    if header == {'jsonl': 'dict'}:
+      return {key: value for key, value in records}
+    if header == {'jsonl': 'list'}:
+      return records
+    return header
+  raise ValueError('Unsupported data format "{0}"'.format(data_format))
+
+
+def write_data_to_path(data, path):
+  """Serialize data into the file at path in the format of its extension.
+
+  This will create the parent directory if needed. Any file with the same
+  data in another format is removed so that it cannot be loaded instead.
+  """
+  data_format = data_format_for_path(path)
+  if data_format is None:
+    raise ValueError('Unknown data format for "{0}"'.format(path))
+  ensure_dir_exists(os.path.dirname(os.path.abspath(path)))
+  with open(path, 'wb') as f:
+    f.write(encode_data(data, data_format))
+
+  base = os.path.splitext(path)[0]
+  for extension in list(DATA_FORMAT_EXTENSIONS.values()) + ['.yaml']:
+    if base + extension != path and os.path.exists(base + extension):
+      os.remove(base + extension)
+
+
+def find_data_path(path):
+  """Find the file holding the data for path in any data format.
+
+  Returns:
+    The existing path differing from path only by the extension of a data
+    format, preferring the intermediate format then path itself.
+    None if there is no such file.
+  """
+  base = os.path.splitext(path)[0]
+  candidates = [base + DATA_FORMAT_EXTENSIONS[_INTERMEDIATE_FORMAT], path]
+  candidates.extend([base + extension
+                     for extension in DATA_FORMAT_EXTENSIONS.values()])
+  for candidate in candidates:
+    if os.path.exists(candidate):
+      return candidate
+  return None
+
+
+def load_data_from_path(path):
+  """Load the data from path as written by write_data_to_path.
+
+  The same path in the intermediate format is loaded in preference to path,
+  and if neither exist then the path in another data format, so existing
+  YAML files continue to load.
+  """
+  found_path = find_data_path(path) or path
+  with open(found_path, 'rb') as f:
+    return decode_data(f.read(), data_format_for_path(found_path) or 'yaml')
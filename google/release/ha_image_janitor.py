@@ -23,7 +23,7 @@ import sys
 import yaml
 
 from google.cloud import storage
-from buildtool import check_subprocess, run_subprocess
+from buildtool import BomIndex, check_subprocess, run_subprocess
 
 
 """Provides a utility to clean up the Google Cloud VM images produced during a
@@ -53,7 +53,7 @@ SERVICES = [
 PUBLISHED_TAG_KEY = 'published'
 
 
-def __partition_boms(gcs_client, bucket_name):
+def __partition_boms(gcs_client, bucket_name, bom_index_path):
   def __bom_to_tag(bom_blob):
     name = os.path.basename(bom_blob.name)
     return RELEASED_VERSION_MATCHER.match(name)
@@ -63,11 +63,57 @@ def __partition_boms(gcs_client, bucket_name):
 
   bucket = gcs_client.get_bucket(bucket_name)
   all_bom_blobs = [b for b in bucket.list_blobs(prefix='bom') if b.name.endswith('.yml')]
-  bom_contents_by_name = {__bom_to_version(b): b.download_as_string() for b in all_bom_blobs}
+  if bom_index_path:
+    services_by_name = __index_bom_services(bucket_name, all_bom_blobs, bom_index_path)
+  else:
+    services_by_name = {__bom_to_version(b): __bom_service_versions(b.download_as_string())
+                        for b in all_bom_blobs}
 
   versions_to_tag = [__bom_to_version(bom) for bom in all_bom_blobs if __bom_to_tag(bom)]
   possible_versions_to_delete = [__bom_to_version(bom) for bom in all_bom_blobs if not __bom_to_tag(bom)]
-  return (versions_to_tag, possible_versions_to_delete, bom_contents_by_name)
+  return (versions_to_tag, possible_versions_to_delete, services_by_name)
+
+
+def __bom_service_versions(bom_content_str):
+  bom_dict = yaml.safe_load(bom_content_str)
+  if not isinstance(bom_dict, dict) or not bom_dict.get('services'):
+    return {}
+  return {name: entry['version'] for name, entry in bom_dict['services'].items()}
+
+
+def __index_bom_services(bucket_name, bom_blobs, bom_index_path):
+  """Returns the service versions of each bom using a persistent BomIndex.
+
+  Only the boms that are new or changed since the index was last updated
+  are downloaded. The generations are the GCS object generations, as
+  collect_bom_versions records them, so the index can be shared with it.
+  Boms that cannot be read are recorded as bad and have no services.
+  """
+  url_prefix = 'gs://{bucket}/bom'.format(bucket=bucket_name)
+  blob_by_url = {'gs://{bucket}/{name}'.format(bucket=bucket_name, name=b.name): b
+                 for b in bom_blobs}
+  generations = {url: str(b.generation) for url, b in blob_by_url.items()}
+
+  index = BomIndex(bom_index_path)
+  try:
+    index.remove_missing_boms(url_prefix, generations.keys())
+    stale_urls = index.find_stale_urls(generations)
+    print 'Downloading {} new or changed boms.'.format(len(stale_urls))
+    for url in stale_urls:
+      bom_dict = yaml.safe_load(blob_by_url[url].download_as_string())
+      if (not isinstance(bom_dict, dict)
+          or 'version' not in bom_dict or not bom_dict.get('services')):
+        print 'Ignoring malformed bom {}.'.format(url)
+        index.add_bad_bom(url, generations[url], 'Missing version or services')
+        continue
+      bom_info = {'bom_version': bom_dict['version'],
+                  'bom_timestamp': bom_dict.get('timestamp', 'NotRecorded')}
+      index.add_bom(url, generations[url], bom_info, bom_dict['services'])
+    index.commit()
+    return {os.path.basename(url).replace('.yml', ''): index.lookup_bom_services(url)
+            for url in blob_by_url.keys()}
+  finally:
+    index.close()
 
 
 def __image_age_days(image_json):
@@ -79,10 +125,10 @@ def __image_age_days(image_json):
   return (now - time_created).days
 
 
-def __tag_images(versions_to_tag, project, account, project_images, bom_contents_by_name):
+def __tag_images(versions_to_tag, project, account, project_images, services_by_name):
   images_to_tag = set([])
   for bom_version in versions_to_tag:
-    to_tag = [i for i in __derive_images_from_bom(bom_version, bom_contents_by_name) if i in project_images]
+    to_tag = [i for i in __derive_images_from_bom(bom_version, services_by_name) if i in project_images]
     images_to_tag.update(to_tag)
   for image in images_to_tag:
     return_code, stdout = run_subprocess(
@@ -100,11 +146,11 @@ def __tag_images(versions_to_tag, project, account, project_images, bom_contents
 
 
 def __write_image_delete_script(possible_versions_to_delete, days_before, project,
-                                account, project_images, bom_contents_by_name):
+                                account, project_images, services_by_name):
   images_to_delete = set([])
   print 'Calculating images for {} versions to delete.'.format(len(possible_versions_to_delete))
   for bom_version in possible_versions_to_delete:
-    deletable = [i for i in __derive_images_from_bom(bom_version, bom_contents_by_name) if i in project_images]
+    deletable = [i for i in __derive_images_from_bom(bom_version, services_by_name) if i in project_images]
     images_to_delete.update(deletable)
   delete_script_lines = []
   for image in images_to_delete:
@@ -134,15 +180,18 @@ def __write_image_delete_script(possible_versions_to_delete, days_before, projec
   print 'Wrote image janitor script to {}'.format(script_name)
 
 
-def __derive_images_from_bom(bom_version, contents_by_name):
-  bom_content_str = contents_by_name[bom_version]
-  bom_dict = yaml.safe_load(bom_content_str)
-  service_entries = bom_dict['services']
-  return [__format_image_name(s, service_entries) for s in SERVICES]
+def __derive_images_from_bom(bom_version, services_by_name):
+  service_versions = services_by_name.get(bom_version)
+  if not service_versions:
+    # Such as boms that collect_bom_versions recorded as invalid.
+    print 'Skipping bom {} without any services.'.format(bom_version)
+    return []
+  return [__format_image_name(s, service_versions) for s in SERVICES
+          if s in service_versions]
 
 
-def __format_image_name(service_name, service_entries):
-  service_version = service_entries[service_name]['version']
+def __format_image_name(service_name, service_versions):
+  service_version = service_versions[service_name]
   dash_version = service_version.replace('.', '-')
   return 'spinnaker-{service}-{version}'.format(service=service_name,
                                                 version=dash_version)
@@ -154,7 +203,8 @@ def __delete_unused_bom_images(options):
     client = storage.Client.from_service_account_json(options.json_path)
   else:
     client = storage.Client()
-  versions_to_tag, possible_versions_to_delete, bom_contents_by_name = __partition_boms(client, options.bom_bucket_name)
+  versions_to_tag, possible_versions_to_delete, services_by_name = __partition_boms(
+      client, options.bom_bucket_name, options.bom_index_path)
   if options.additional_boms_to_tag:
     additional_boms_to_tag = options.additional_boms_to_tag.split(',')
     print('Adding additional BOM versions to tag: {}'.format(additional_boms_to_tag))
@@ -169,10 +219,10 @@ def __delete_unused_bom_images(options):
   image_list = json.loads(image_list_str)
   project_images = set([image['name'] for image in image_list])
   __tag_images(versions_to_tag, project, service_account, project_images,
-               bom_contents_by_name)
+               services_by_name)
   __write_image_delete_script(possible_versions_to_delete, options.days_before, project,
                               service_account, project_images,
-                              bom_contents_by_name)
+                              services_by_name)
 
 
 def init_argument_parser(parser):
@@ -181,6 +231,9 @@ def init_argument_parser(parser):
                       'to avoid deletion.')
   parser.add_argument('--bom_bucket_name', default='halconfig',
                       help='The name of the Halyard bucket storing the BOMs.')
+  parser.add_argument('--bom_index_path', default='',
+                      help='Path to a persistent BOM index so that only new or changed'
+                      ' BOMs are downloaded.')
   parser.add_argument('--days_before', default=14,
                       help='Max age in days of nightly build BOMs to save.')
   parser.add_argument('--json_path', default='',
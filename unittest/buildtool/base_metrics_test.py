@@ -0,0 +1,237 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=missing-docstring
+
+import random
+import unittest
+from multiprocessing.pool import ThreadPool
+from mock import patch
+
+from buildtool.base_metrics import (
+    MetricFamily,
+    QuantileSketch,
+    exponential_bucket_bounds)
+from buildtool.influxdb_metrics import (
+    InfluxDbMetricsRegistry,
+    InfluxDbWriter)
+from buildtool.inmemory_metrics import InMemoryMetricsRegistry
+
+from test_util import init_runtime
+
+
+class Options(object):
+  pass
+
+
+def make_options(**kwargs):
+  options = Options()
+  options.monitoring_enabled = False
+  for key, value in kwargs.items():
+    setattr(options, key, value)
+  return options
+
+
+class TestQuantileSketch(unittest.TestCase):
+  def test_quantiles_within_accuracy(self):
+    rand = random.Random(123)
+    values = sorted([rand.expovariate(0.1) for _ in range(10000)])
+    sketch = QuantileSketch(relative_accuracy=0.01)
+    for value in values:
+      sketch.add(value)
+    for fraction in [0.5, 0.9, 0.99]:
+      expect = values[int(fraction * (len(values) - 1))]
+      self.assertAlmostEqual(expect, sketch.quantile(fraction),
+                             delta=expect * 0.01)
+    self.assertEqual(values[-1], sketch.max)
+    self.assertAlmostEqual(values[-1], sketch.quantile(1),
+                           delta=values[-1] * 0.01)
+
+  def test_merge(self):
+    first = QuantileSketch()
+    second = QuantileSketch()
+    for value in range(1, 51):
+      first.add(value)
+      second.add(value + 50)
+    first.add(0)
+    first.merge(second)
+    self.assertEqual(101, first.count)
+    self.assertEqual(100, first.max)
+    self.assertEqual(0, first.quantile(0))
+    self.assertAlmostEqual(50, first.quantile(0.5), delta=0.5)
+
+    with self.assertRaises(ValueError):
+      first.merge(QuantileSketch(relative_accuracy=0.05))
+
+  def test_to_dict(self):
+    sketch = QuantileSketch()
+    for value in [0.5, 1, 2, 30]:
+      sketch.add(value)
+    copy = QuantileSketch.from_dict(sketch.to_dict())
+    self.assertEqual(sketch.to_dict(), copy.to_dict())
+    self.assertEqual(sketch.quantile(0.9), copy.quantile(0.9))
+
+  def test_empty(self):
+    self.assertIsNone(QuantileSketch().quantile(0.5))
+
+
+class TestTimerHistogram(unittest.TestCase):
+  def test_exponential_bucket_bounds(self):
+    self.assertEqual([0.5, 1, 2, 4], exponential_bucket_bounds(0.5, 2, 4))
+
+  def test_observe(self):
+    registry = InMemoryMetricsRegistry(
+        make_options(metrics_timer_buckets='1,10,3'))
+    for seconds in [0.5, 1, 5, 50, 500, 5000]:
+      timer = registry.observe_timer('TestTimer', {}, seconds)
+    self.assertEqual([1, 10, 100], timer.bucket_bounds)
+    self.assertEqual([2, 1, 1, 2], timer.bucket_counts)
+    self.assertEqual(6, timer.count)
+    self.assertEqual(5000, timer.max_seconds)
+    self.assertAlmostEqual(5, timer.quantile(0.5), delta=0.05)
+
+    snapshot, _, _ = registry.make_snapshot()
+    histogram = snapshot['timers']['TestTimer']['collectors'][0]['histogram']
+    self.assertEqual([2, 1, 1, 2], histogram['bucketCounts'])
+    self.assertEqual(5000, histogram['maxSecs'])
+    self.assertEqual(['p50', 'p90', 'p99'],
+                     sorted(histogram['quantiles'].keys()))
+
+  def test_time_call(self):
+    registry = InMemoryMetricsRegistry(make_options())
+    registry.time_call('TestTimer', {}, registry.default_determine_outcome_labels,
+                       lambda: None)
+    timer = next(iter(
+        registry.lookup_family_or_none('TestTimer').instance_list))
+    self.assertEqual(1, sum(timer.bucket_counts))
+    self.assertEqual(21, len(timer.bucket_counts))
+
+  def test_influxdb_exports_buckets(self):
+    options = make_options(metrics_timer_buckets='1,10,2',
+                           monitoring_enabled=True,
+                           command='test_command',
+                           output_dir='/tmp/base_metrics_test',
+                           metrics_dir=None,
+                           influxdb_url='http://localhost:0',
+                           influxdb_database='test',
+                           influxdb_reiterate_gauge_secs=60)
+    registry = InfluxDbMetricsRegistry(options)
+    registry.observe_timer('TestTimer', {'command': 'x'}, 2)
+    registry.observe_timer('TestTimer', {'command': 'x'}, 200)
+
+    with patch.object(InfluxDbWriter, 'write') as mock_write:
+      with patch.object(InMemoryMetricsRegistry,
+                        '_do_flush_updated_metrics'):
+        registry.flush_updated_metrics()
+    lines = mock_write.call_args[0][0]
+    series = sorted(line.split(' ')[0] + ' ' + line.split(' ')[1]
+                    for line in lines if '__bucket' in line)
+    self.assertEqual(['TestTimer__bucket,command=x,le=+Inf value=1',
+                      'TestTimer__bucket,command=x,le=10 value=1'],
+                     series)
+    self.assertTrue([line for line in lines
+                     if line.startswith('TestTimer__max,command=x value=200')])
+
+
+class TestMetricHandle(unittest.TestCase):
+  def test_bind_is_cached(self):
+    registry = InMemoryMetricsRegistry(
+        make_options(monitoring_context_labels='version=1.2'))
+    handle = registry.bind(MetricFamily.COUNTER, 'TestCounter', command='x')
+    self.assertIs(handle, registry.bind(MetricFamily.COUNTER, 'TestCounter',
+                                        command='x'))
+    self.assertIsNot(handle, registry.bind(MetricFamily.COUNTER, 'TestCounter',
+                                           command='y'))
+    self.assertEqual({'command': 'x', 'version': '1.2'}, handle.labels)
+
+  def test_handle_cache_is_bounded(self):
+    registry = InMemoryMetricsRegistry(make_options())
+    registry.MAX_CACHED_HANDLES = 10
+    first = registry.bind(MetricFamily.COUNTER, 'TestCounter', repository='0')
+    first.inc()
+    for index in range(1, 25):
+      registry.bind(MetricFamily.COUNTER, 'TestCounter',
+                    repository=str(index)).inc()
+
+    # The handle is made again but for the same metric.
+    again = registry.bind(MetricFamily.COUNTER, 'TestCounter', repository='0')
+    self.assertIsNot(first, again)
+    self.assertIs(first.get(), again.get())
+    self.assertEqual(
+        25, len(registry.lookup_family_or_none('TestCounter').instance_list))
+
+  def test_registry_time_call_uses_handle(self):
+    registry = InMemoryMetricsRegistry(make_options())
+    labels = {'repository': 'r'}
+    label_func = registry.default_determine_outcome_labels
+    registry.time_call('TestTimer', labels, label_func, lambda: None)
+    with patch.object(InMemoryMetricsRegistry, 'get_metric') as mock_get:
+      registry.time_call('TestTimer', labels, label_func, lambda: None)
+    self.assertEqual(0, mock_get.call_count)
+    timer = registry.bind(MetricFamily.TIMER, 'TestTimer', **labels).get(
+        {'success': True, 'exception_type': ''})
+    self.assertEqual(2, timer.count)
+
+  def test_shares_instances_with_registry(self):
+    registry = InMemoryMetricsRegistry(make_options())
+    handle = registry.bind(MetricFamily.COUNTER, 'TestCounter',
+                           command='x', repository='r')
+    handle.inc()
+    counter = registry.inc_counter('TestCounter',
+                                   {'repository': 'r', 'command': 'x'})
+    self.assertIs(counter, handle.get())
+    self.assertEqual(2, counter.count)
+    self.assertEqual(
+        1, len(registry.lookup_family_or_none('TestCounter').instance_list))
+
+  def test_wrong_family_type(self):
+    registry = InMemoryMetricsRegistry(make_options())
+    registry.inc_counter('TestMetric', {})
+    with self.assertRaises(TypeError):
+      registry.bind(MetricFamily.TIMER, 'TestMetric').observe(1)
+
+  def test_time_call_outcomes(self):
+    registry = InMemoryMetricsRegistry(make_options())
+    handle = registry.bind(MetricFamily.TIMER, 'TestTimer', command='x')
+    label_func = registry.default_determine_outcome_labels
+    handle.time_call(label_func, lambda: None)
+    handle.time_call(label_func, lambda: None)
+    def fail():
+      raise KeyError('test')
+    with self.assertRaises(KeyError):
+      handle.time_call(label_func, fail)
+
+    found = {(timer.labels['success'], timer.labels['exception_type']):
+             timer.count
+             for timer in registry.lookup_family_or_none(
+                 'TestTimer').instance_list}
+    self.assertEqual({(True, ''): 2, (False, 'KeyError'): 1}, found)
+    self.assertIs(handle.get({'success': True, 'exception_type': ''}),
+                  registry.get_metric(
+                      MetricFamily.TIMER, 'TestTimer',
+                      {'command': 'x', 'success': True, 'exception_type': ''}))
+
+  def test_shared_across_threads(self):
+    registry = InMemoryMetricsRegistry(make_options())
+    handle = registry.bind(MetricFamily.COUNTER, 'TestCounter')
+    pool = ThreadPool(8)
+    pool.map(lambda _: handle.inc(), range(1000))
+    pool.close()
+    pool.join()
+    self.assertEqual(1000, handle.get().count)
+
+
+if __name__ == '__main__':
+  init_runtime()
+  unittest.main(verbosity=2)
@@ -0,0 +1,239 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares auditing nested bom service maps against a BomServiceTable.
+
+A synthetic history of boms is generated where each bom picks up new builds
+of a few services and shares the rest with the previous bom. Each variant
+loads the history, partitions it into released and unreleased boms, and
+determines which of the artifact versions are not referenced by any bom.
+
+The "rows" variants build their structures from rows already in memory.
+The "file" variants load them the way AuditArtifactVersions does, from
+all_bom_service_map.yml before and from the BomIndex now.
+
+Each variant runs in its own forked process so its peak memory can be
+measured independently.
+
+Usage:
+  PYTHONPATH=dev python unittest/buildtool/benchmarks/bom_table_benchmark.py
+      [--boms=5000]
+"""
+
+# pylint: disable=missing-docstring
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+import yaml
+
+from buildtool import (
+    BomIndex,
+    BomServiceRow,
+    BomServiceTable)
+from buildtool.inspection_commands import CollectBomVersions
+
+
+SERVICES = ['clouddriver', 'deck', 'echo', 'fiat', 'front50', 'gate',
+            'igor', 'kayenta', 'orca', 'rosco', 'monitoring-daemon',
+            'monitoring-third-party']
+
+
+def iter_synthetic_rows(num_boms):
+  rand = random.Random(num_boms)
+  builds = {service: [1, 0, 0] for service in SERVICES}
+  for bom_index in range(num_boms):
+    if bom_index % 50 == 49:
+      bom_version = '1.%d.%d' % (bom_index // 500, (bom_index // 50) % 10)
+    else:
+      bom_version = 'master-%08d' % bom_index
+    timestamp = '2018-%02d-%02d %05d' % (
+        1 + bom_index // 1000, 1 + bom_index % 28, bom_index)
+    for service in rand.sample(SERVICES, 3):
+      build = builds[service]
+      build[2] += 1
+      build[1] += 1 if build[2] % 20 == 0 else 0
+    for service in SERVICES:
+      major, minor, buildnum = builds[service]
+      version = '%d.%d.0' % (major, minor)
+      yield BomServiceRow(
+          bom_version, timestamp, service, version,
+          '%040x' % hash((service, buildnum)), '%08d' % buildnum,
+          '%s-%08d' % (version, buildnum))
+
+
+def make_artifact_versions(num_boms):
+  # Every referenced build plus as many again that are not referenced.
+  versions = {}
+  for row in iter_synthetic_rows(num_boms):
+    versions.setdefault(row.service, set([])).add(row.build_version)
+  for service, builds in versions.items():
+    builds.update(['0.0.%d-%08d' % (index, index)
+                   for index in range(len(builds))])
+  return versions
+
+
+def make_service_map(rows):
+  service_map = {}
+  for row in rows:
+    info = {'bom_version': row.bom_version, 'bom_timestamp': row.bom_timestamp}
+    (service_map.setdefault(row.service, {})
+     .setdefault(row.version, {})
+     .setdefault(row.commit, {})
+     .setdefault(row.buildnum, [])
+     .append(info))
+  return service_map
+
+
+def write_files(num_boms, temp_dir):
+  yaml_path = os.path.join(temp_dir, 'all_bom_service_map.yml')
+  with open(yaml_path, 'w') as stream:
+    yaml.safe_dump(make_service_map(iter_synthetic_rows(num_boms)), stream,
+                   default_flow_style=False)
+
+  index = BomIndex(os.path.join(temp_dir, 'bom_index.db'))
+  services_by_bom = {}
+  for row in iter_synthetic_rows(num_boms):
+    bom = services_by_bom.setdefault(
+        row.bom_version, ({'bom_version': row.bom_version,
+                           'bom_timestamp': row.bom_timestamp}, {}))
+    bom[1][row.service] = {'version': row.build_version, 'commit': row.commit}
+  for bom_version, (bom_info, services) in services_by_bom.items():
+    index.add_bom('gs://bucket/bom/%s.yml' % bom_version, 1,
+                  bom_info, services)
+  index.close()
+  return yaml_path, index.path
+
+
+def audit_nested(rows, artifact_versions):
+  # This is how AuditArtifactVersions processed the boms before the table.
+  return audit_service_map(make_service_map(rows), artifact_versions)
+
+
+def audit_nested_file(path, artifact_versions):
+  with open(path, 'r') as stream:
+    return audit_service_map(yaml.safe_load(stream), artifact_versions)
+
+
+def audit_service_map(service_map, artifact_versions):
+  released, unreleased = CollectBomVersions.partition_service_map(service_map)
+
+  def in_bom_map(service, version, buildnum, service_map):
+    for buildnums in ((service_map.get(service) or {}).get(version) or {}
+                     ).values():
+      if buildnum in buildnums:
+        return True
+    return False
+
+  unused = 0
+  for service, versions in artifact_versions.items():
+    for build_version in versions:
+      version, buildnum = build_version.split('-', 1)
+      if not (in_bom_map(service, version, buildnum, released)
+              or in_bom_map(service, version, buildnum, unreleased)):
+        unused += 1
+
+  infos = 0
+  for bom_map in [released, unreleased]:
+    for versions in bom_map.values():
+      for commits in (versions or {}).values():
+        for buildnums in commits.values():
+          for info_list in buildnums.values():
+            infos += len(info_list)
+  return unused, infos
+
+
+def audit_table(rows, artifact_versions):
+  return audit_bom_table(BomServiceTable.from_rows(rows), artifact_versions)
+
+
+def audit_table_file(path, artifact_versions):
+  index = BomIndex(path)
+  table = BomServiceTable.from_rows(index.iter_service_rows(),
+                                    index.nonstandard_boms())
+  index.close()
+  return audit_bom_table(table, artifact_versions)
+
+
+def audit_bom_table(table, artifact_versions):
+  is_released = lambda version: bool(
+      CollectBomVersions.RELEASED_VERSION_MATCHER.match(version))
+  released = table.select_boms(is_released)
+  unreleased = table.select_boms(
+      lambda version: not is_released(version)).exclude_builds(released)
+
+  unused = 0
+  for service, versions in artifact_versions.items():
+    unused += len(versions - table.build_versions(service))
+
+  infos = 0
+  for bom_table in [released, unreleased]:
+    for service in bom_table.service_names():
+      for info_list in bom_table.service_builds(service).values():
+        infos += len(info_list)
+  return unused, infos
+
+
+def measure(name, func, make_source, artifact_versions):
+  start = time.time()
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_fd)
+    result = func(make_source(), artifact_versions)
+    os.write(write_fd, repr(result).encode('utf-8'))
+    os._exit(0)  # pylint: disable=protected-access
+
+  os.close(write_fd)
+  result = os.read(read_fd, 1024).decode('utf-8')
+  os.close(read_fd)
+  _, status, rusage = os.wait4(pid, 0)
+  secs = time.time() - start
+  if status != 0:
+    raise ValueError('{name} failed'.format(name=name))
+
+  # ru_maxrss is in kilobytes on linux.
+  print('{name:>12}: {secs:7.3f} s  peak rss {mb:8.1f} MB  (unused, infos)={result}'
+        .format(name=name, secs=secs, mb=rusage.ru_maxrss / 1024.0,
+                result=result))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--boms', default=5000, type=int)
+  options = parser.parse_args()
+
+  artifact_versions = make_artifact_versions(options.boms)
+  make_rows = lambda: iter_synthetic_rows(options.boms)
+  print('Auditing {count} boms of {services} services'.format(
+      count=options.boms, services=len(SERVICES)))
+  measure('nested_rows', audit_nested, make_rows, artifact_versions)
+  measure('table_rows', audit_table, make_rows, artifact_versions)
+
+  temp_dir = tempfile.mkdtemp(prefix='bom_table_benchmark')
+  try:
+    yaml_path, index_path = write_files(options.boms, temp_dir)
+    measure('nested_file', audit_nested_file, lambda: yaml_path,
+            artifact_versions)
+    measure('table_file', audit_table_file, lambda: index_path,
+            artifact_versions)
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+  main()
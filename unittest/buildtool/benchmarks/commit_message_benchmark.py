@@ -0,0 +1,102 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares parsing a full "git log" result against streaming it.
+
+Each variant runs in its own forked process so its peak memory can be
+measured independently.
+
+Usage:
+  PYTHONPATH=dev python unittest/buildtool/benchmarks/commit_message_benchmark.py
+      [--commits=50000]
+"""
+
+# pylint: disable=missing-docstring
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from buildtool import (
+    CommitMessage,
+    check_subprocess,
+    check_subprocess_lines)
+
+
+def write_synthetic_log(path, num_commits):
+  with open(path, 'w') as stream:
+    for index in range(num_commits):
+      stream.write(
+          'commit {id:040x}\n'
+          'Author: Some Author <author{index}@example.com>\n'
+          'Date:   Mon Jan 8 12:{minute:02d}:00 2018 +0000\n'
+          '\n'
+          '    fix(component{index}): Fixed something in component {index}\n'
+          '\n'
+          '    This is the longer description of what happened to fix it.\n'
+          '    It takes a few lines to explain in order to be realistic.\n'
+          '\n'.format(id=index, index=index, minute=index % 60))
+
+
+def parse_all_text(path):
+  # This is how the log was processed before it was streamed.
+  text = check_subprocess('cat "{path}"'.format(path=path))
+  all_entries = ('\n' + text.strip()).split('\ncommit ')[1:]
+  return [CommitMessage.make(entry) for entry in all_entries]
+
+
+def parse_streamed(path):
+  return list(CommitMessage.iter_from_lines(
+      check_subprocess_lines('cat "{path}"'.format(path=path))))
+
+
+def measure(name, func, path, expect_count):
+  start = time.time()
+  pid = os.fork()
+  if pid == 0:
+    count = len(func(path))
+    os._exit(0 if count == expect_count else 1)  # pylint: disable=protected-access
+
+  _, status, rusage = os.wait4(pid, 0)
+  secs = time.time() - start
+  if status != 0:
+    raise ValueError('{name} did not parse {count} commits'.format(
+        name=name, count=expect_count))
+
+  # ru_maxrss is in kilobytes on linux.
+  print('{name:>10}: {secs:7.3f} s  peak rss {mb:8.1f} MB'.format(
+      name=name, secs=secs, mb=rusage.ru_maxrss / 1024.0))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--commits', default=50000, type=int)
+  options = parser.parse_args()
+
+  temp_dir = tempfile.mkdtemp(prefix='commit_message_benchmark')
+  try:
+    path = os.path.join(temp_dir, 'git.log')
+    write_synthetic_log(path, options.commits)
+    print('Parsing {count} commits ({mb:.1f} MB of log)'.format(
+        count=options.commits, mb=os.path.getsize(path) / (1024.0 * 1024)))
+    measure('all_text', parse_all_text, path, options.commits)
+    measure('streamed', parse_streamed, path, options.commits)
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,99 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the cost of flushing metrics snapshots against the journal.
+
+A long running command is simulated by updating a set of metrics between
+each periodic flush. The snapshot rewrites every data point on each flush
+so its cost grows with the history, while the journal only appends the new
+points.
+
+Usage:
+  PYTHONPATH=dev python unittest/buildtool/benchmarks/metrics_journal_benchmark.py
+      [--flushes=200] [--updates_per_flush=100]
+"""
+
+# pylint: disable=missing-docstring
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from buildtool.inmemory_metrics import (
+    InMemoryMetricsRegistry,
+    compact_metrics_journal)
+
+
+class Options(object):
+  pass
+
+
+def measure(name, journal, options):
+  temp_dir = tempfile.mkdtemp(prefix='metrics_journal_benchmark')
+  try:
+    registry_options = Options()
+    registry_options.command = name
+    registry_options.output_dir = temp_dir
+    registry_options.metrics_dir = None
+    registry_options.metrics_journal = journal
+    registry_options.monitoring_enabled = True
+    registry = InMemoryMetricsRegistry(registry_options)
+
+    flush_secs = 0
+    last_flush_secs = 0
+    for flush in range(options.flushes):
+      for update in range(options.updates_per_flush):
+        labels = {'repository': 'repo%d' % (update % 20)}
+        registry.inc_counter('BenchmarkCounter', labels)
+        registry.observe_timer('BenchmarkTimer', labels, flush * 0.01)
+      start = time.time()
+      registry.flush_updated_metrics()
+      last_flush_secs = time.time() - start
+      flush_secs += last_flush_secs
+
+    start = time.time()
+    registry.flush_final_metrics()
+    final_secs = time.time() - start
+
+    metrics_dir = os.path.join(temp_dir, 'metrics')
+    path = os.path.join(metrics_dir, os.listdir(metrics_dir)[0])
+    start = time.time()
+    if journal:
+      compact_metrics_journal(path)
+    compact_secs = time.time() - start
+
+    print('{name:>8}: flushes {flush:7.3f} s  last flush {last:7.4f} s'
+          '  final {final:7.4f} s  compact {compact:7.3f} s'.format(
+              name=name, flush=flush_secs, last=last_flush_secs,
+              final=final_secs, compact=compact_secs))
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--flushes', default=200, type=int)
+  parser.add_argument('--updates_per_flush', default=100, type=int)
+  options = parser.parse_args()
+
+  print('{flushes} flushes of {updates} counter and timer updates each'.format(
+      flushes=options.flushes, updates=options.updates_per_flush))
+  measure('snapshot', False, options)
+  measure('journal', True, options)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,110 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the round trip cost of each intermediate data format.
+
+The data is a synthetic bom service map shaped like the
+all_bom_service_map written by collect_bom_versions. The "safe_yaml"
+row is the pure python yaml.safe_dump/safe_load previously used.
+
+Usage:
+  PYTHONPATH=dev python unittest/buildtool/benchmarks/serialization_benchmark.py
+      [--boms=2000]
+"""
+
+# pylint: disable=missing-docstring
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import yaml
+
+from buildtool import (
+    DATA_FORMAT_EXTENSIONS,
+    available_data_formats,
+    load_data_from_path,
+    write_data_to_path)
+
+
+SERVICES = ['clouddriver', 'deck', 'echo', 'fiat', 'front50', 'gate',
+            'igor', 'kayenta', 'orca', 'rosco']
+
+
+def make_service_map(num_boms):
+  service_map = {}
+  for bom_index in range(num_boms):
+    info = {'bom_version': 'master-%08d' % bom_index,
+            'bom_timestamp': '2018-01-01 %05d' % bom_index}
+    for service_index, service in enumerate(SERVICES):
+      buildnum = bom_index // (service_index + 2)
+      (service_map.setdefault(service, {})
+       .setdefault('1.%d.0' % (buildnum // 20), {})
+       .setdefault('%040x' % buildnum, {})
+       .setdefault('%08d' % buildnum, [])
+       .append(dict(info)))
+  return service_map
+
+
+def write_safe_yaml(data, path):
+  with open(path, 'w') as stream:
+    yaml.safe_dump(data, stream, default_flow_style=False)
+
+
+def load_safe_yaml(path):
+  with open(path, 'r') as stream:
+    return yaml.safe_load(stream)
+
+
+def measure(name, write_func, load_func, path, data):
+  start = time.time()
+  write_func(data, path)
+  write_secs = time.time() - start
+
+  start = time.time()
+  loaded = load_func(path)
+  load_secs = time.time() - start
+  if loaded != data:
+    raise ValueError('{name} did not round trip'.format(name=name))
+
+  print('{name:>10}: write {write:7.3f} s  load {load:7.3f} s'
+        '  size {mb:7.2f} MB'.format(
+            name=name, write=write_secs, load=load_secs,
+            mb=os.path.getsize(path) / (1024.0 * 1024)))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--boms', default=2000, type=int)
+  options = parser.parse_args()
+
+  data = make_service_map(options.boms)
+  print('Round trip of a service map of {count} boms'.format(
+      count=options.boms))
+  temp_dir = tempfile.mkdtemp(prefix='serialization_benchmark')
+  try:
+    measure('safe_yaml', write_safe_yaml, load_safe_yaml,
+            os.path.join(temp_dir, 'safe.yml'), data)
+    for data_format in available_data_formats():
+      measure(data_format, write_data_to_path, load_data_from_path,
+              os.path.join(temp_dir,
+                           'data' + DATA_FORMAT_EXTENSIONS[data_format]),
+              data)
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,88 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures how long buildtool takes to start before running a command.
+
+Each variant runs buildtool in a new process with --help so that it exits
+once the command line has been parsed.
+
+The "all commands" variant has no command, so every command module is
+imported and every parser built, which is what every invocation used to
+do. The other variants import only the module for their command.
+
+The "import buildtool" variant imports the package and nothing else.
+
+Usage:
+  python unittest/buildtool/benchmarks/startup_benchmark.py
+      [--runs=10] [--max_secs=<fail if a command's median exceeds this>]
+"""
+
+# pylint: disable=missing-docstring
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+DEV_DIR = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', '..', '..', 'dev'))
+MAIN_PATH = os.path.join(DEV_DIR, 'buildtool', '__main__.py')
+
+COMMANDS = ['extract_source_info', 'fetch_source', 'build_bom', 'run_flow']
+
+
+def run_once(args):
+  env = dict(os.environ)
+  env['PYTHONPATH'] = DEV_DIR
+  with open(os.devnull, 'w') as devnull:
+    start = time.time()
+    subprocess.call([sys.executable] + args, env=env,
+                    stdout=devnull, stderr=devnull)
+    return time.time() - start
+
+
+def measure(name, args, runs):
+  times = sorted(run_once(args) for _ in range(runs))
+  median = times[len(times) // 2]
+  print('{name:>24}: median {median:6.3f} s  min {min:6.3f} s'.format(
+      name=name, median=median, min=times[0]))
+  return median
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--runs', default=10, type=int)
+  parser.add_argument('--max_secs', default=None, type=float)
+  options = parser.parse_args()
+
+  print('Median of {runs} runs each'.format(runs=options.runs))
+  measure('python', ['-c', 'pass'], options.runs)
+  measure('import buildtool', ['-c', 'import buildtool'], options.runs)
+  measure('all commands', [MAIN_PATH, '--help'], options.runs)
+  slow = []
+  for command in COMMANDS:
+    median = measure(command, [MAIN_PATH, command, '--help'], options.runs)
+    if options.max_secs is not None and median > options.max_secs:
+      slow.append(command)
+
+  if slow:
+    print('Startup exceeded {secs}s for {commands}'.format(
+        secs=options.max_secs, commands=', '.join(slow)))
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
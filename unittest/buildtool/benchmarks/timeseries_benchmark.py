@@ -0,0 +1,108 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the memory used by the in-memory metric time series.
+
+Each variant records the given number of observations into a gauge the way
+track_and_time_call does, then reports how much the peak memory grew.
+The "list" variant is the list of DataPoint previously used.
+
+Each variant runs in its own forked process so its peak memory can be
+measured independently.
+
+Usage:
+  PYTHONPATH=dev python unittest/buildtool/benchmarks/timeseries_benchmark.py
+      [--observations=100000]
+"""
+
+# pylint: disable=missing-docstring
+
+import argparse
+import datetime
+import os
+import resource
+import time
+
+from buildtool.inmemory_metrics import (
+    DataPoint,
+    InMemoryMetricsRegistry)
+
+
+class Options(object):
+  pass
+
+
+def record_list(count):
+  points = []
+  value = 0
+  for index in range(count):
+    value += 1 if index % 2 == 0 else -1
+    points.append(DataPoint(value, datetime.datetime.utcnow()))
+  return len(points)
+
+
+def make_record_registry(capacity):
+  def record(count):
+    options = Options()
+    options.monitoring_enabled = False
+    options.metrics_timeseries_capacity = capacity
+    registry = InMemoryMetricsRegistry(options)
+    for _ in range(count // 2):
+      registry.track_call('BenchmarkGauge', {}, lambda: None)
+    family = registry.lookup_family_or_none('BenchmarkGauge')
+    return len(next(iter(family.instance_list)).timeseries)
+  return record
+
+
+def measure(name, func, count):
+  start = time.time()
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_fd)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    kept = func(count)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    os.write(write_fd, '{0} {1}'.format(kept, after - before).encode('utf-8'))
+    os._exit(0)  # pylint: disable=protected-access
+
+  os.close(write_fd)
+  kept, growth = [int(value)
+                  for value in os.read(read_fd, 1024).decode('utf-8').split()]
+  os.close(read_fd)
+  _, status = os.waitpid(pid, 0)
+  secs = time.time() - start
+  if status != 0:
+    raise ValueError('{name} failed'.format(name=name))
+
+  # ru_maxrss is in kilobytes on linux.
+  print('{name:>10}: {secs:7.3f} s  peak rss growth {mb:7.2f} MB'
+        '  points kept {kept}'.format(
+            name=name, secs=secs, mb=growth / 1024.0, kept=kept))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--observations', default=100000, type=int)
+  options = parser.parse_args()
+
+  print('Recording {count} gauge observations'.format(
+      count=options.observations))
+  measure('list', record_list, options.observations)
+  measure('unbounded', make_record_registry(0), options.observations)
+  measure('bounded', make_record_registry(10000), options.observations)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,116 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=missing-docstring
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from buildtool import BomIndex, ConfigError
+
+from test_util import init_runtime
+
+
+URL_PREFIX = 'gs://test-bucket/bom/'
+
+
+class TestBomIndex(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(prefix='bom_index_test')
+    self.path = os.path.join(self.temp_dir, 'index', 'bom_index.db')
+    self.index = BomIndex(self.path)
+    self.index.add_bom(
+        URL_PREFIX + '1.0.0.yml', 1,
+        {'bom_version': '1.0.0', 'bom_timestamp': '2018-01-02'},
+        {'gate': {'version': '1.0.0-20180101', 'commit': 'abc'},
+         'deck': {'version': '2.0.0'},
+         'defaultArtifact': {}})
+    self.index.add_bom(
+        URL_PREFIX + 'master-latest.yml', 2,
+        {'bom_version': 'master-latest', 'bom_timestamp': '2018-01-01',
+         'dockerRegistry': 'other-registry'},
+        {'gate': {'version': '1.0.0-20180101', 'commit': 'abc'}})
+    self.index.add_bad_bom(URL_PREFIX + 'bogus.yml', 3, 'Malformed')
+
+  def tearDown(self):
+    self.index.close()
+    shutil.rmtree(self.temp_dir)
+
+  def test_split_build_version(self):
+    self.assertEqual(('1.2.3', '20180101'),
+                     BomIndex.split_build_version('1.2.3-20180101'))
+    self.assertEqual(('1.2.3', 'NotRecorded'),
+                     BomIndex.split_build_version('1.2.3'))
+
+  def test_persists_between_instances(self):
+    self.index.close()
+    self.index = BomIndex(self.path)
+    self.assertEqual(
+        [URL_PREFIX + name
+         for name in ['1.0.0.yml', 'bogus.yml', 'master-latest.yml']],
+        self.index.list_bom_urls())
+    self.assertEqual(set(['1.0.0', 'master-latest']),
+                     self.index.list_bom_versions())
+    self.assertEqual({'bogus': 'Malformed'}, self.index.bad_boms())
+    self.assertEqual({'master-latest': {'dockerRegistry': 'other-registry'}},
+                     self.index.nonstandard_boms())
+
+  def test_incompatible_schema(self):
+    self.index.close()
+    db = sqlite3.connect(self.path)
+    db.execute('PRAGMA user_version = 99')
+    db.commit()
+    db.close()
+
+    # Readers do not discard an index they cannot use.
+    with self.assertRaises(ConfigError):
+      BomIndex(self.path)
+    self.index = BomIndex(self.path, discard_incompatible=True)
+    self.assertEqual([], self.index.list_bom_urls())
+
+  def test_find_stale_urls(self):
+    self.assertEqual(
+        [URL_PREFIX + 'bogus.yml', URL_PREFIX + 'new.yml'],
+        self.index.find_stale_urls({URL_PREFIX + '1.0.0.yml': '1',
+                                    URL_PREFIX + 'bogus.yml': '4',
+                                    URL_PREFIX + 'new.yml': '1'}))
+
+  def test_remove_missing_boms(self):
+    self.assertEqual(
+        0, self.index.remove_missing_boms('gs://other/', []))
+    self.assertEqual(
+        2, self.index.remove_missing_boms(URL_PREFIX, [URL_PREFIX + '1.0.0.yml']))
+    self.assertEqual([URL_PREFIX + '1.0.0.yml'], self.index.list_bom_urls())
+    self.assertEqual(['deck', 'gate'],
+                     sorted(self.index.to_service_map().keys()))
+
+  def test_to_service_map(self):
+    self.assertEqual(
+        {'gate': {'1.0.0': {'abc': {'20180101': [
+            {'bom_version': 'master-latest', 'bom_timestamp': '2018-01-01',
+             'dockerRegistry': 'other-registry'},
+            {'bom_version': '1.0.0', 'bom_timestamp': '2018-01-02'}]}}},
+         'deck': {'2.0.0': {'NotRecorded': {'NotRecorded': [
+             {'bom_version': '1.0.0', 'bom_timestamp': '2018-01-02'}]}}}},
+        self.index.to_service_map())
+    self.assertEqual({'deck': '2.0.0', 'gate': '1.0.0-20180101'},
+                     self.index.lookup_bom_services(URL_PREFIX + '1.0.0.yml'))
+
+
+if __name__ == '__main__':
+  init_runtime()
+  unittest.main(verbosity=2)
@@ -0,0 +1,113 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=missing-docstring
+
+import unittest
+
+from buildtool import (
+    BomServiceRow,
+    BomServiceTable,
+    StringPool)
+
+from test_util import init_runtime
+
+
+SERVICE_MAP = {
+    'gate': {
+        '1.0.0': {
+            'abc': {
+                '20180101': [
+                    {'bom_version': '1.0.0', 'bom_timestamp': '2018-01-01'},
+                    {'bom_version': 'master-latest',
+                     'bom_timestamp': '2018-01-03',
+                     'dockerRegistry': 'other-registry'}]}}},
+    'deck': {
+        '2.0.0': {
+            'def': {
+                '20180102': [
+                    {'bom_version': 'master-latest',
+                     'bom_timestamp': '2018-01-03',
+                     'dockerRegistry': 'other-registry'}]}},
+        '2.0.1': {
+            'fed': {
+                '20180102': [
+                    {'bom_version': '1.0.0', 'bom_timestamp': '2018-01-01'}]}}}
+}
+
+
+class TestStringPool(unittest.TestCase):
+  def test_intern(self):
+    pool = StringPool()
+    self.assertEqual(0, pool.intern('a'))
+    self.assertEqual(1, pool.intern('b'))
+    self.assertEqual(0, pool.intern('a'))
+    self.assertEqual('b', pool[1])
+    self.assertEqual(2, len(pool))
+    self.assertEqual(None, pool.lookup_or_none('c'))
+
+
+class TestBomServiceTable(unittest.TestCase):
+  def setUp(self):
+    self.table = BomServiceTable.from_service_map(SERVICE_MAP)
+
+  def test_round_trip(self):
+    self.assertEqual(4, len(self.table))
+    self.assertEqual(SERVICE_MAP, self.table.to_service_map())
+
+  def test_from_rows(self):
+    table = BomServiceTable.from_rows(
+        [BomServiceRow('1.0.0', '2018-01-01', 'gate',
+                       '1.0.0', 'abc', '20180101', '1.0.0-20180101')],
+        {'1.0.0': {'dockerRegistry': 'other-registry'}})
+    self.assertEqual(
+        {'1.0.0-20180101': [{'bom_version': '1.0.0',
+                             'bom_timestamp': '2018-01-01',
+                             'dockerRegistry': 'other-registry'}]},
+        table.service_builds('gate'))
+
+  def test_queries(self):
+    self.assertEqual(set(['gate', 'deck']), self.table.service_names())
+    self.assertEqual(set(['1.0.0', 'master-latest']),
+                     self.table.bom_versions())
+    self.assertTrue(self.table.has_service('deck'))
+    self.assertFalse(self.table.has_service('echo'))
+    self.assertEqual(set(['2.0.0-20180102', '2.0.1-20180102']),
+                     self.table.build_versions('deck'))
+    self.assertEqual(set([]), self.table.build_versions('echo'))
+    self.assertEqual(
+        ['1.0.0', 'master-latest'],
+        [info['bom_version']
+         for info in self.table.service_builds('gate')['1.0.0-20180101']])
+
+  def test_select_and_exclude(self):
+    released = self.table.select_boms(lambda version: version == '1.0.0')
+    self.assertEqual(set(['1.0.0']), released.bom_versions())
+    self.assertEqual(2, len(released))
+
+    unreleased = self.table.select_boms(
+        lambda version: version != '1.0.0').exclude_builds(released)
+    self.assertEqual(
+        {'deck': {'2.0.0': {'def': {'20180102': [
+            {'bom_version': 'master-latest', 'bom_timestamp': '2018-01-03',
+             'dockerRegistry': 'other-registry'}]}}}},
+        unreleased.to_service_map())
+
+    with self.assertRaises(ValueError):
+      unreleased.exclude_builds(BomServiceTable.from_service_map(SERVICE_MAP))
+
+
+if __name__ == '__main__':
+  init_runtime()
+  unittest.main(verbosity=2)
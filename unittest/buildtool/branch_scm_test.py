@@ -19,6 +19,7 @@ import argparse
 import logging
 import os
 import shutil
+import sys
 import tempfile
 import unittest
 
@@ -189,6 +190,44 @@ class TestSourceCodeManager(unittest.TestCase):
         all_repos, _foreach_func, *pos_args, **kwargs)
     self.assertEqual(expect, got)
 
+  @unittest.skipIf(sys.version_info[0] < 3, 'asyncio requires python3')
+  def test_foreach_repo_async(self):
+    test_root = os.path.join(self.base_temp_dir, 'foreach_async_test')
+    num_repos = 60
+    scm = SpinnakerSourceCodeManager(self.options, test_root, max_threads=8)
+    all_repos = [scm.make_repository_spec('Repo%d' % index, origin=None)
+                 for index in range(num_repos)]
+    for repository in all_repos:
+      git_dir = repository.git_dir
+      check_subprocess_sequence([
+          'git init -q "{dir}"'.format(dir=git_dir),
+          'git -C "{dir}" commit -q --allow-empty -m "feat(test): {name}"'
+          .format(dir=git_dir, name=repository.name)])
+    expect = {repository.name: scm.git.check_run(repository.git_dir,
+                                                 'rev-parse HEAD')
+              for repository in all_repos}
+
+    got = scm.foreach_source_repository_async(
+        all_repos,
+        lambda repository, command: scm.git.check_run_async(
+            repository.git_dir, command),
+        'rev-parse HEAD')
+    self.assertEqual(expect, got)
+
+    # This is how extract_source_info refreshes the source info.
+    all_refs = scm.foreach_source_repository_async(
+        all_repos,
+        lambda repository: scm.git.run_git_async(
+            repository.git_dir, 'show-ref --head -d'))
+    self.assertEqual(num_repos, len(all_refs))
+    for repository in all_repos:
+      retcode, refs_text = all_refs[repository.name]
+      self.assertEqual(0, retcode)
+      self.assertEqual(scm.git.query_show_refs(repository.git_dir), refs_text)
+      info = scm.refresh_source_info(repository, 'async_build_number',
+                                     refs_text=refs_text)
+      self.assertEqual(expect[repository.name], info.summary.commit_id)
+
   def test_check_repository_branch(self):
     self.options.git_branch = UNTAGGED_BRANCH
     
@@ -235,6 +274,63 @@ class TestSourceCodeManager(unittest.TestCase):
     scm.check_repository_is_current(repository)
     self.assertRaises(UnexpectedError, scm.check_repository_is_current,
                       repository_at_commit)
+
+  def test_refresh_git_path(self):
+    self.options.git_branch = UNTAGGED_BRANCH
+    test_root = os.path.join(self.base_temp_dir, 'refresh_test')
+    origin = os.path.join(test_root, 'origin', 'RepoOne')
+    shutil.copytree(self.ORIGIN_URLS['RepoOne'], origin)
+
+    scm = BranchSourceCodeManager(self.options, test_root)
+    repository = scm.make_repository_spec('RepoOne', origin=origin,
+                                          upstream=None)
+    scm.ensure_local_repository(repository)
+    git_dir = repository.git_dir
+
+    # Local changes are discarded and new origin commits are fetched.
+    check_subprocess_sequence([
+        'git -C "{dir}" checkout -q {branch}'.format(
+            dir=origin, branch=UNTAGGED_BRANCH),
+        'touch "{dir}/new_file"'.format(dir=origin),
+        'git -C "{dir}" add new_file'.format(dir=origin),
+        'git -C "{dir}" commit -q -m "feat(new): new file"'.format(dir=origin),
+        'git -C "{dir}" checkout -q master'.format(dir=origin)])
+    with open(os.path.join(git_dir, 'RepoOne-base.txt'), 'w') as stream:
+      stream.write('local change')
+    scm.git.check_run(git_dir, 'commit -q -a -m "local commit"')
+
+    self.assertLess(0, scm.refresh_git_path(repository))
+    scm.check_repository_is_current(repository)
+    self.assertEqual(scm.git.check_run(origin, 'rev-parse ' + UNTAGGED_BRANCH),
+                     scm.git.query_local_repository_commit_id(git_dir))
+    self.assertEqual('', scm.git.check_run(git_dir, 'status --porcelain'))
+
+    # A pinned commit is checked out even if it is not a branch tip.
+    commit = scm.git.check_run(origin, 'rev-parse {0}~1'.format(
+        UNTAGGED_BRANCH))
+    repository_at_commit = scm.make_repository_spec(
+        'RepoOne', origin=origin, upstream=None, commit_id=commit)
+    scm.refresh_git_path(repository_at_commit)
+    scm.check_repository_is_current(repository_at_commit)
+
+    # Only the pinned commit is fetched, not the other origin branches.
+    check_subprocess_sequence([
+        'git -C "{dir}" checkout -q -b unrelated_branch'.format(dir=origin),
+        'git -C "{dir}" commit -q --allow-empty -m "unrelated"'.format(
+            dir=origin),
+        'git -C "{dir}" checkout -q {branch}'.format(
+            dir=origin, branch=UNTAGGED_BRANCH),
+        'git -C "{dir}" commit -q --allow-empty -m "pinned"'.format(
+            dir=origin),
+        'git -C "{dir}" checkout -q master'.format(dir=origin)])
+    commit = scm.git.check_run(origin, 'rev-parse ' + UNTAGGED_BRANCH)
+    repository_at_commit = scm.make_repository_spec(
+        'RepoOne', origin=origin, upstream=None, commit_id=commit)
+    scm.refresh_git_path(repository_at_commit)
+    scm.check_repository_is_current(repository_at_commit)
+    unrelated = scm.git.check_run(origin, 'rev-parse unrelated_branch')
+    self.assertNotEqual(
+        0, scm.git.run_git(git_dir, 'cat-file -e ' + unrelated)[0])
     
 
 if __name__ == '__main__':
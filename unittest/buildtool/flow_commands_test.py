@@ -0,0 +1,287 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=missing-docstring
+
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from collections import namedtuple
+
+import yaml
+
+from buildtool import (
+    CommandFactory,
+    CommandProcessor,
+    ExecutionError,
+    RepositoryCommandFactory,
+    RepositoryCommandProcessor)
+from buildtool.flow_commands import (
+    FlowScheduler,
+    FlowTask,
+    RunFlowFactory,
+    parse_resource_limits)
+
+from test_util import init_runtime
+
+
+FakeRepository = namedtuple('FakeRepository', ['name'])
+
+
+class FakeScm(object):
+  @staticmethod
+  def add_parser_args(parser, defaults):
+    pass
+
+  def __init__(self, options, root_source_dir, max_threads=None):
+    self.options = options
+    self.root_source_dir = root_source_dir
+    self.max_threads = max_threads
+
+  def make_repository_spec(self, name):
+    return FakeRepository(name)
+
+
+class FakeRepositoryCommand(RepositoryCommandProcessor):
+  """Runs a test-supplied hook on each repository."""
+
+  HOOKS = {}
+
+  def __init__(self, factory, options):
+    super(FakeRepositoryCommand, self).__init__(
+        factory, options, source_repository_names=['clouddriver', 'orca'])
+
+  def ensure_local_repository(self, repository):
+    pass
+
+  def _do_repository(self, repository):
+    hook = self.HOOKS.get((self.name, repository.name))
+    if hook:
+      hook()
+    return '{name} {repo} {arg}'.format(
+        name=self.name, repo=repository.name, arg=self.options.fake_arg)
+
+  def _do_postprocess(self, result_dict):
+    return sorted(result_dict.values())
+
+
+class FakeRepositoryCommandFactory(RepositoryCommandFactory):
+  def __init__(self, name):
+    super(FakeRepositoryCommandFactory, self).__init__(
+        name, FakeRepositoryCommand, 'A fake command.', FakeScm)
+
+  def init_argparser(self, parser, defaults):
+    super(FakeRepositoryCommandFactory, self).init_argparser(parser, defaults)
+    self.add_argument(parser, 'fake_arg', defaults, 'default')
+
+
+class FakeReportCommand(CommandProcessor):
+  def _do_command(self):
+    return 'reported'
+
+
+class TestFlowScheduler(unittest.TestCase):
+  def test_starts_dependents_before_unrelated_tasks_finish(self):
+    scheduler = FlowScheduler(4)
+    dependent_started = threading.Event()
+    scheduler.add_task('fetch:orca',
+                       lambda: dependent_started.wait(10) or 'timeout')
+    scheduler.add_task('fetch:clouddriver', lambda: 'fetched')
+    scheduler.add_task('build:clouddriver', dependent_started.set,
+                       requires=['fetch:clouddriver'])
+    tasks = scheduler.run()
+    self.assertEqual(True, tasks['fetch:orca'].result)
+    self.assertEqual(set([FlowTask.SUCCEEDED]),
+                     set([task.state for task in tasks.values()]))
+
+  def test_resource_limits(self):
+    scheduler = FlowScheduler(8, {'gradle': 2})
+    lock = threading.Lock()
+    running = {'gradle': 0, 'git': 0}
+    peak = {'gradle': 0, 'git': 0}
+    barrier = threading.Event()
+
+    def make_func(resource):
+      def func():
+        with lock:
+          running[resource] += 1
+          peak[resource] = max(peak[resource], running[resource])
+          if peak['git'] == 4:
+            barrier.set()
+        barrier.wait(10)
+        with lock:
+          running[resource] -= 1
+      return func
+
+    for index in range(4):
+      for resource in ['gradle', 'git']:
+        scheduler.add_task('{0}{1}'.format(resource, index),
+                           make_func(resource), resources=[resource])
+    scheduler.run()
+    self.assertEqual({'gradle': 2, 'git': 4}, peak)
+
+  def test_skips_dependents_of_failures(self):
+    def fail():
+      raise ValueError('Injected Failure')
+
+    scheduler = FlowScheduler(4)
+    scheduler.add_task('a', fail)
+    scheduler.add_task('b', lambda: 'b', requires=['a'])
+    scheduler.add_task('c', lambda: 'c', requires=['b'])
+    scheduler.add_task('d', lambda: 'd')
+    tasks = scheduler.run()
+    self.assertEqual({'a': FlowTask.FAILED, 'b': FlowTask.SKIPPED,
+                      'c': FlowTask.SKIPPED, 'd': FlowTask.SUCCEEDED},
+                     {name: task.state for name, task in tasks.items()})
+    self.assertTrue(isinstance(tasks['a'].error, ValueError))
+
+  def test_base_exception_does_not_stall(self):
+    def exit_thread():
+      raise SystemExit(1)
+
+    scheduler = FlowScheduler(4)
+    scheduler.add_task('a', exit_thread)
+    scheduler.add_task('b', lambda: 'b', requires=['a'])
+    tasks = scheduler.run()
+    self.assertEqual({'a': FlowTask.FAILED, 'b': FlowTask.SKIPPED},
+                     {name: task.state for name, task in tasks.items()})
+
+  def test_tasks_can_add_tasks(self):
+    scheduler = FlowScheduler(1)
+    def start():
+      scheduler.add_task('unit', lambda: 'unit')
+      scheduler.add_requirements('end', ['unit'])
+    scheduler.add_task('start', start)
+    scheduler.add_task(
+        'end', lambda: scheduler.get_task('unit').result, requires=['start'])
+    tasks = scheduler.run()
+    self.assertEqual('unit', tasks['end'].result)
+
+  def test_parse_resource_limits(self):
+    self.assertEqual({'git': 2, 'gradle': 1},
+                     parse_resource_limits('git=2,gradle=1'))
+    self.assertEqual({}, parse_resource_limits(None))
+
+
+class TestRunFlowCommand(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(prefix='flow_commands_test')
+    FakeRepositoryCommand.HOOKS = {}
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def run_flow(self, flow, repository_command_names=('fetch', 'build')):
+    if isinstance(flow, dict):
+      flow_path = os.path.join(self.temp_dir, 'flow.yml')
+      with open(flow_path, 'w') as stream:
+        yaml.safe_dump(flow, stream)
+    else:
+      flow_path = flow
+
+    registry = {}
+    defaults = {'fake_arg': 'from_defaults'}
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir', default=self.temp_dir)
+    parser.add_argument('--input_dir', default=self.temp_dir)
+    parser.add_argument('--one_at_a_time', default=False)
+    subparsers = parser.add_subparsers(dest='command')
+    for name in repository_command_names:
+      FakeRepositoryCommandFactory(name).register(
+          registry, subparsers, defaults)
+    CommandFactory('report', FakeReportCommand, 'A fake report.').register(
+        registry, subparsers, defaults)
+    RunFlowFactory().register(registry, subparsers, defaults)
+
+    options = parser.parse_args(['run_flow', '--flow_path', flow_path])
+    return registry['run_flow'].make_command(options)()
+
+  def test_run_flow(self):
+    build_started = threading.Event()
+    FakeRepositoryCommand.HOOKS = {
+        ('fetch', 'orca'): lambda: self.assertTrue(build_started.wait(10)),
+        ('build', 'clouddriver'): build_started.set
+    }
+    result = self.run_flow({
+        'stages': [
+            {'command': 'fetch', 'resources': ['git']},
+            {'command': 'build', 'requires': ['fetch'],
+             'args': {'fake_arg': 'from_stage'}},
+            {'command': 'report', 'after': ['build']}]})
+    self.assertEqual(
+        {'fetch': ['fetch clouddriver from_defaults',
+                   'fetch orca from_defaults'],
+         'build': ['build clouddriver from_stage', 'build orca from_stage'],
+         'report': 'reported'},
+        result)
+
+  def test_default_flow_overlaps_repositories(self):
+    flow_path = os.path.join(
+        os.path.dirname(__file__), '..', '..', 'dev', 'buildtool',
+        'build_flow.yml')
+    with open(flow_path, 'r') as stream:
+      stages = yaml.safe_load(stream)['stages']
+    names = [stage['command'] for stage in stages]
+    # As flow_build.sh passes it.
+    self.assertEqual({'git_branch': 'master'},
+                     stages[names.index('build_halyard')]['args'])
+
+    bom_started = threading.Event()
+    publish_started = threading.Event()
+    FakeRepositoryCommand.HOOKS = {
+        ('fetch_source', 'orca'): lambda: self.assertTrue(
+            bom_started.wait(10)),
+        ('build_bom', 'clouddriver'): bom_started.set,
+        ('build_debians', 'orca'): lambda: self.assertTrue(
+            publish_started.wait(10)),
+        ('publish_bom', 'clouddriver'): publish_started.set
+    }
+    result = self.run_flow(flow_path, repository_command_names=names)
+    self.assertEqual(set(names), set(result.keys()))
+
+  def test_failed_repository_skips_dependents(self):
+    def fail():
+      raise ValueError('Injected Failure')
+    FakeRepositoryCommand.HOOKS = {('fetch', 'orca'): fail}
+    with self.assertRaises(ExecutionError):
+      self.run_flow({
+          'stages': [
+              {'command': 'fetch'},
+              {'command': 'build', 'requires': ['fetch']}]})
+
+    from buildtool.metrics import MetricsManager
+    family = MetricsManager.singleton().lookup_family_or_none(
+        'RunRepositoryCommand_Outcome')
+    outcomes = [(metric.labels['command'], metric.labels['repository'],
+                 metric.labels['success'])
+                for metric in family.instance_list
+                if metric.labels['command'] in ['fetch', 'build']]
+    self.assertTrue(('build', 'clouddriver', True) in outcomes)
+    self.assertTrue(('fetch', 'orca', False) in outcomes)
+    self.assertFalse(('build', 'orca', True) in outcomes)
+
+    family = MetricsManager.singleton().lookup_family_or_none(
+        'RunCommand_Outcome')
+    self.assertTrue(
+        [metric for metric in family.instance_list
+         if metric.labels['command'] == 'fetch'
+         and metric.labels['exception_type'] == 'ValueError'])
+
+
+if __name__ == '__main__':
+  init_runtime()
+  unittest.main(verbosity=2)
@@ -19,6 +19,7 @@ import datetime
 import os
 import shutil
 import tempfile
+import threading
 import unittest
 import yaml
 
@@ -26,9 +27,11 @@ import dateutil.parser
 
 from buildtool import (
     CommitMessage,
+    GitRefTransaction,
     GitRepositorySpec,
     GitRunner,
     RepositorySummary,
+    RepositorySummaryCache,
     SemanticVersion,
 
     check_subprocess,
@@ -110,6 +113,7 @@ class TestGitRunner(unittest.TestCase):
 
   @classmethod
   def tearDownClass(cls):
+    GitRunner.close_object_readers()
     shutil.rmtree(cls.base_temp_dir)
 
   def setUp(self):
@@ -384,6 +388,317 @@ class TestGitRunner(unittest.TestCase):
       self.assertEqual(tag.split('-')[1], summary.prev_version)
       self.assertEqual([], summary.commit_messages)
 
+  def test_commit_graph_agrees_with_git(self):
+    graph = self.git.load_commit_graph(self.git_dir)
+    self.assertEqual(self.git.query_local_repository_commit_id(self.git_dir),
+                     graph.head_commit)
+    self.assertEqual(
+        self.git.query_tag_commits(self.git_dir, TAG_VERSION_PATTERN),
+        graph.commit_tags(TAG_VERSION_PATTERN))
+
+    branches = ['master', BRANCH_BASE, BRANCH_A, BRANCH_B, BRANCH_C]
+    commits = {branch: self.run_git('rev-parse ' + branch)
+               for branch in branches}
+    for branch in branches:
+      self.assertEqual(
+          self.run_git('describe --abbrev=0 --tags --match version-* '
+                       + branch),
+          graph.describe_tag(commits[branch], 'version-*'))
+      for other in branches:
+        self.assertEqual(
+            self.run_git('merge-base {0} {1}'.format(branch, other)),
+            graph.merge_base(commits[branch], commits[other]))
+    self.assertTrue(graph.is_ancestor(commits[BRANCH_BASE], commits[BRANCH_A]))
+    self.assertFalse(graph.is_ancestor(commits[BRANCH_C], commits['master']))
+
+  def test_summarize_subprocess_count(self):
+    self.run_git('checkout ' + BRANCH_C)
+    before = self.git.thread_subprocess_count
+    self.git.collect_repository_summary(self.git_dir)
+
+    # Loading the commit graph and the log, independent of tags and branches.
+    self.assertEqual(3, self.git.thread_subprocess_count - before)
+
+  def test_summary_cache(self):
+    options = make_default_options()
+    options.summary_cache = os.path.join(self.base_temp_dir, 'summary_cache')
+    options.summary_cache_max_entries = 2
+    git = GitRunner(options)
+
+    self.run_git('checkout ' + BRANCH_C)
+    before = git.thread_subprocess_count
+    expect = git.collect_repository_summary(self.git_dir)
+    self.assertEqual(3, git.thread_subprocess_count - before)
+
+    before = git.thread_subprocess_count
+    summary = git.collect_repository_summary(self.git_dir)
+    self.assertEqual(1, git.thread_subprocess_count - before)
+    self.assertEqual(expect, summary)
+
+    # Different base commits and HEADs are different entries.
+    git.collect_repository_summary(
+        self.git_dir, base_commit_id=self.git.query_local_repository_commit_id(
+            self.git_dir) + '~1')
+    self.run_git('checkout ' + BRANCH_B)
+    git.collect_repository_summary(self.git_dir)
+    self.assertEqual(2, len(os.listdir(options.summary_cache)))
+
+    # Concurrent stores of the same entry do not collide.
+    cache = RepositorySummaryCache(options.summary_cache)
+    errors = []
+    def store():
+      try:
+        for _ in range(20):
+          cache.store('concurrent', expect)
+      except Exception as ex:
+        errors.append(ex)
+    threads = [threading.Thread(target=store) for _ in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual([], errors)
+    self.assertEqual(expect, cache.lookup_or_none('concurrent'))
+    self.assertFalse([name for name in os.listdir(options.summary_cache)
+                      if name.endswith('.tmp')])
+
+  def test_clone_with_mirror(self):
+    options = make_default_options()
+    options.git_mirror_dir = os.path.join(self.base_temp_dir, 'mirrors')
+    git = GitRunner(options)
+    test_parent = os.path.join(self.base_temp_dir, 'test_mirror')
+
+    subprocess_counts = []
+    for index, branch in enumerate([BRANCH_A, BRANCH_B]):
+      test_dir = os.path.join(test_parent, str(index), TEST_REPO_NAME)
+      repository = GitRepositorySpec(
+          TEST_REPO_NAME, git_dir=test_dir, origin=self.git_dir)
+      before = git.thread_subprocess_count
+      git.clone_repository_to_path(repository, branch=branch)
+      subprocess_counts.append(git.thread_subprocess_count - before)
+      self.assertEqual(branch, git.query_local_repository_branch(test_dir))
+
+      mirror_path = git.mirror_cache.mirror_path(self.git_dir)
+      with open(os.path.join(
+          test_dir, '.git', 'objects', 'info', 'alternates')) as stream:
+        self.assertEqual(os.path.join(mirror_path, 'objects'),
+                         stream.read().strip())
+      self.assertEqual(
+          self.git_dir,
+          check_subprocess('git -C "{dir}" config remote.origin.url'
+                           .format(dir=test_dir)))
+      self.assertEqual(
+          git.query_tag_commits(self.git_dir, TAG_VERSION_PATTERN),
+          git.query_tag_commits(test_dir, TAG_VERSION_PATTERN))
+
+    # The mirror is created once (clone and config) then reused as is.
+    self.assertEqual(2, subprocess_counts[0] - subprocess_counts[1])
+    self.assertEqual(
+        sorted([os.path.basename(mirror_path),
+                os.path.basename(mirror_path) + '.lock']),
+        sorted(os.listdir(options.git_mirror_dir)))
+
+  def test_clone_strategies(self):
+    self.run_git('config uploadpack.allowFilter true')
+    expect = None
+    for strategy in ['full', 'blobless', 'shallow']:
+      test_dir = os.path.join(self.base_temp_dir, 'test_' + strategy,
+                              TEST_REPO_NAME)
+      repository = GitRepositorySpec(
+          TEST_REPO_NAME, git_dir=test_dir, origin=self.git_dir)
+      self.git.clone_repository_to_path(
+          repository, branch=BRANCH_C, strategy=strategy)
+      self.assertEqual(strategy == 'shallow',
+                       self.git.is_shallow_repository(test_dir))
+      self.assertEqual(
+          self.git_dir,
+          check_subprocess('git -C "{dir}" config remote.origin.url'
+                           .format(dir=test_dir)))
+
+      # The shallow clone does not know the tag before HEAD until deepened.
+      summary = self.git.collect_repository_summary(test_dir)
+      self.assertFalse(self.git.is_shallow_repository(test_dir))
+      expect = expect or summary
+      self.assertEqual(expect, summary)
+
+  def test_shallow_clone_deepens_only_when_needed(self):
+    test_dir = os.path.join(self.base_temp_dir, 'test_shallow_tagged',
+                            TEST_REPO_NAME)
+    repository = GitRepositorySpec(
+        TEST_REPO_NAME, git_dir=test_dir, origin=self.git_dir)
+    self.git.clone_repository_to_path(repository, strategy='shallow')
+
+    # HEAD is tagged so no more history is needed.
+    summary = self.git.collect_repository_summary(test_dir)
+    self.assertEqual('version-9.9.9', summary.tag)
+    self.assertTrue(self.git.is_shallow_repository(test_dir))
+
+    graph = self.git.load_commit_graph(test_dir)
+    commits = {branch: self.run_git('rev-parse ' + branch)
+               for branch in ['master', BRANCH_B, BRANCH_C]}
+    self.assertEqual(VERSION_B,
+                     graph.describe_tag(commits[BRANCH_B], 'version-*'))
+    self.assertFalse(graph.missing_history)
+    self.assertIsNone(graph.describe_tag(commits[BRANCH_C], 'version-*'))
+    self.assertTrue(graph.missing_history)
+
+  def test_is_repository_corrupt(self):
+    test_dir = os.path.join(self.base_temp_dir, 'test_corrupt', TEST_REPO_NAME)
+    repository = GitRepositorySpec(
+        TEST_REPO_NAME, git_dir=test_dir, origin=self.git_dir)
+    self.git.clone_repository_to_path(repository)
+    self.assertFalse(self.git.is_repository_corrupt(test_dir))
+
+    # A local clone has the origin's loose objects, so remove HEAD's.
+    commit = self.git.query_local_repository_commit_id(test_dir)
+    os.remove(os.path.join(test_dir, '.git', 'objects', commit[:2], commit[2:]))
+    self.assertTrue(self.git.is_repository_corrupt(test_dir))
+
+  def test_object_reader(self):
+    git = self.git
+    GitRunner.close_object_readers()  # Earlier tests may have used them.
+    before = git.thread_subprocess_count
+    for branch in [BRANCH_A, BRANCH_B, 'master']:
+      self.run_git('checkout ' + branch)
+      self.assertEqual(self.run_git('rev-parse HEAD'),
+                       git.query_local_repository_commit_id(self.git_dir))
+    self.assertEqual(
+        self.run_git('rev-parse {0}^{{commit}}'.format(VERSION_A)),
+        git.resolve_object_id_or_none(self.git_dir,
+                                      'refs/tags/{0}^{{commit}}'.format(
+                                          VERSION_A)))
+    self.assertIsNone(git.resolve_object_id_or_none(self.git_dir, 'unknown'))
+
+    commit = git.query_commit_object_or_none(self.git_dir, BRANCH_B)
+    self.assertEqual(self.run_git('rev-parse ' + BRANCH_B), commit.commit_id)
+    self.assertEqual((self.run_git('rev-parse {0}^'.format(BRANCH_B)),),
+                     commit.parent_ids)
+    self.assertEqual(self.run_git('rev-parse {0}^{{tree}}'.format(BRANCH_B)),
+                     commit.tree_id)
+    self.assertEqual('feat(test): added b_file\n', commit.message)
+
+    self.assertEqual(b'', git.read_file_at_commit_or_none(
+        self.git_dir, BRANCH_A, 'a_file'))
+    self.assertIsNone(git.read_file_at_commit_or_none(
+        self.git_dir, BRANCH_B, 'a_file'))
+
+    entries = git.list_tree_at_commit_or_none(self.git_dir, BRANCH_B, '')
+    self.assertEqual(
+        [tuple(line.replace('\t', ' ').split(' '))
+         for line in self.run_git('ls-tree ' + BRANCH_B).split('\n')],
+        [(entry.mode, 'blob', entry.object_id, entry.name)
+         for entry in entries])
+    self.assertTrue(all(entry.is_blob for entry in entries))
+    self.assertIsNone(git.list_tree_at_commit_or_none(
+        self.git_dir, BRANCH_B, 'b_file'))
+    self.assertIsNone(git.list_tree_at_commit_or_none(
+        self.git_dir, BRANCH_B, 'missing'))
+
+    # Only the two cat-file processes were started for all of that.
+    self.assertEqual(2, git.thread_subprocess_count - before)
+
+    # Closed readers are restarted when used again.
+    GitRunner.close_object_readers()
+    self.assertEqual(self.run_git('rev-parse HEAD'),
+                     git.query_local_repository_commit_id(self.git_dir))
+
+  def test_clone_shallow_at_commit(self):
+    test_dir = os.path.join(self.base_temp_dir, 'test_shallow_commit',
+                            TEST_REPO_NAME)
+    repository = GitRepositorySpec(
+        TEST_REPO_NAME, git_dir=test_dir, origin=self.git_dir)
+    commit = self.run_git('rev-parse {0}~1'.format(BRANCH_C))
+    self.git.clone_repository_to_path(
+        repository, commit=commit, strategy='shallow')
+    self.assertEqual(commit,
+                     self.git.query_local_repository_commit_id(test_dir))
+
+  def test_ref_transaction(self):
+    git = self.git
+    test_dir = os.path.join(self.base_temp_dir, 'test_ref_transaction',
+                            TEST_REPO_NAME)
+    repository = GitRepositorySpec(
+        TEST_REPO_NAME, git_dir=test_dir, origin=self.git_dir)
+    git.clone_repository_to_path(repository, branch=BRANCH_C)
+    run_test_git = lambda command: check_subprocess(
+        'git -C "{dir}" {command}'.format(dir=test_dir, command=command))
+    version_tags = sorted(run_test_git('tag').split('\n'))
+    run_test_git('tag extra-tag origin/master')
+    run_test_git('tag other-tag origin/master')
+
+    transaction = GitRefTransaction()
+    git.remove_all_non_version_tags(repository, transaction=transaction)
+    git.tag_head(test_dir, 'extra-tag', transaction=transaction)
+    self.assertEqual(['refs/tags/extra-tag', 'refs/tags/other-tag'],
+                     sorted(transaction.refs))
+    self.assertEqual('update refs/tags/extra-tag HEAD\n'
+                     'delete refs/tags/other-tag\n',
+                     transaction.to_stdin_text())
+
+    before = git.thread_subprocess_count
+    self.assertTrue(git.commit_ref_transaction(test_dir, transaction))
+    self.assertEqual(1, git.thread_subprocess_count - before)
+    self.assertEqual(sorted(version_tags + ['extra-tag']),
+                     sorted(run_test_git('tag').split('\n')))
+    self.assertEqual(run_test_git('rev-parse HEAD'),
+                     run_test_git('rev-parse extra-tag'))
+    self.assertFalse(git.commit_ref_transaction(test_dir, GitRefTransaction()))
+
+    # Nothing changes if any part of the transaction fails.
+    transaction = GitRefTransaction()
+    transaction.delete('refs/tags/extra-tag')
+    transaction.create('refs/tags/new-tag', 'HEAD')
+    transaction.create('refs/tags/' + VERSION_A, 'HEAD')
+    with self.assertRaises(Exception):
+      git.commit_ref_transaction(test_dir, transaction)
+    self.assertEqual(sorted(version_tags + ['extra-tag']),
+                     sorted(run_test_git('tag').split('\n')))
+
+    git.remove_all_non_version_tags(repository)
+    self.assertEqual(version_tags, sorted(run_test_git('tag').split('\n')))
+
+  def test_push_branch_with_tags(self):
+    options = make_default_options()
+    options.git_never_push = False
+    git = GitRunner(options)
+    test_parent = os.path.join(self.base_temp_dir, 'test_push_with_tags')
+    origin_dir = os.path.join(test_parent, 'origin.git')
+    test_dir = os.path.join(test_parent, TEST_REPO_NAME)
+    check_subprocess('git clone --bare "{source}" "{origin}"'.format(
+        source=self.git_dir, origin=origin_dir))
+    check_subprocess('git clone -b {branch} "{origin}" "{dir}"'.format(
+        branch=BRANCH_C, origin=origin_dir, dir=test_dir))
+    run_origin_git = lambda command: check_subprocess(
+        'git -C "{dir}" {command}'.format(dir=origin_dir, command=command))
+
+    check_subprocess('git -C "{dir}" checkout -b new-branch'.format(
+        dir=test_dir))
+    git.tag_head(test_dir, 'version-9.10.0')
+    before = git.thread_subprocess_count
+    git.push_branch_to_origin(test_dir, 'new-branch', tags=['version-9.10.0'])
+    self.assertEqual(2, git.thread_subprocess_count - before)  # branch, push
+    self.assertEqual(run_origin_git('rev-parse ' + BRANCH_C),
+                     run_origin_git('rev-parse new-branch'))
+    self.assertEqual(run_origin_git('rev-parse ' + BRANCH_C),
+                     run_origin_git('rev-parse version-9.10.0'))
+
+    # The branch is not pushed if a tag is rejected.
+    check_subprocess('git -C "{dir}" reset --hard HEAD~1'.format(dir=test_dir))
+    git.tag_head(test_dir, 'version-9.11.0')
+    check_subprocess('git -C "{dir}" tag -f {tag} HEAD'.format(
+        dir=test_dir, tag=VERSION_A))
+    with self.assertRaises(Exception):
+      git.push_branch_to_origin(test_dir, 'new-branch', force=True,
+                                tags=['version-9.11.0', VERSION_A])
+    self.assertEqual(run_origin_git('rev-parse ' + BRANCH_C),
+                     run_origin_git('rev-parse new-branch'))
+    self.assertEqual('', run_origin_git('tag -l version-9.11.0'))
+
+    git.push_refs_to_origin(test_dir,
+                            ['+new-branch', 'refs/tags/version-9.11.0'])
+    self.assertEqual(run_origin_git('rev-parse {0}~1'.format(BRANCH_C)),
+                     run_origin_git('rev-parse new-branch'))
+
 
 class TestSemanticVersion(unittest.TestCase):
   def test_semver_make_valid(self):
@@ -532,6 +847,35 @@ class TestCommitMessage(unittest.TestCase):
         gitify('commit -a -m "fix(test): Second Fix"'),
     ])
 
+  def test_iter_from_lines(self):
+    log_command = 'log --pretty=medium ' + self.PATCH_MINOR_BRANCH
+    commit_ids = self.run_git(
+        'rev-list ' + self.PATCH_MINOR_BRANCH).split('\n')
+    authors = self.run_git(
+        'log --format="%an <%ae>" ' + self.PATCH_MINOR_BRANCH).split('\n')
+    expect = [
+        CommitMessage(commit_id, author, date, message)
+        for commit_id, author, date, message in zip(
+            commit_ids, authors,
+            self.run_git('log --format=%ad ' + self.PATCH_MINOR_BRANCH)
+            .split('\n'),
+            ['    fix(test): Second Fix',
+             '    fix(test): First Fix',
+             '    feat(test): COMMIT AT TAG',
+             '    feat(testB): added minor_file',
+             '    fix(testA): added patch_file',
+             '    feat(test): added file'])]
+    self.assertEqual(6, len(commit_ids))
+
+    history = self.run_git(log_command)
+    got = list(CommitMessage.iter_from_lines(
+        [line + '\n' for line in history.split('\n')]))
+    self.assertEqual(expect, got)
+
+    got = list(CommitMessage.iter_from_lines(
+        self.git.check_run_lines(self.git_dir, log_command)))
+    self.assertEqual(expect, got)
+
   def test_summarize(self):
     expect_messages = ['feat(testC): added major_file\n'
                        '\nInterestingly enough, this is a BREAKING CHANGE.',
@@ -0,0 +1,143 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=missing-docstring
+
+import threading
+import unittest
+
+try:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from buildtool import (
+    HttpClient,
+    HttpRequestError,
+    HttpStatusError,
+    MetricsManager)
+
+from test_util import init_runtime
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+  # Keep-alive requires HTTP/1.1
+  protocol_version = 'HTTP/1.1'
+
+  # Each path maps to the list of status codes to respond with in turn.
+  responses = {}
+  connections = []
+  requests = []
+
+  def setup(self):
+    BaseHTTPRequestHandler.setup(self)
+    FakeHandler.connections.append(self.client_address)
+
+  def log_message(self, *pos_args):
+    pass
+
+  def __respond(self):
+    FakeHandler.requests.append((self.command, self.path))
+    codes = FakeHandler.responses.get(self.path, [404])
+    code = codes.pop(0) if len(codes) > 1 else codes[0]
+    length = int(self.headers.get('Content-Length', 0))
+    if length:
+      self.rfile.read(length)
+
+    body = ('{"path": "%s"}' % self.path).encode('utf-8')
+    self.send_response(code)
+    if code == 302:
+      self.send_header('Location', '/ok')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    self.__respond()
+
+  def do_POST(self):
+    self.__respond()
+
+
+class TestHttpClient(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.server = HTTPServer(('localhost', 0), FakeHandler)
+    cls.base_url = 'http://localhost:%d' % cls.server.server_port
+    cls.thread = threading.Thread(target=cls.server.serve_forever)
+    cls.thread.daemon = True
+    cls.thread.start()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.server.shutdown()
+    cls.server.server_close()
+
+  def setUp(self):
+    FakeHandler.connections = []
+    FakeHandler.requests = []
+    FakeHandler.responses = {'/ok': [200], '/redirect': [302]}
+    self.client = HttpClient(backoff_secs=0)
+
+  def tearDown(self):
+    self.client.close()
+
+  def test_reuses_connection(self):
+    for _ in range(3):
+      response = self.client.get(self.base_url + '/ok')
+      self.assertEqual(200, response.status)
+      self.assertEqual(b'{"path": "/ok"}', response.body)
+    self.client.request('POST', self.base_url + '/ok', body=b'data')
+    self.assertEqual(1, len(FakeHandler.connections))
+    self.assertEqual(4, len(FakeHandler.requests))
+
+    family = MetricsManager.singleton().lookup_family_or_none('HttpHandshake')
+    self.assertTrue(family is not None)
+
+  def test_retries_transient_errors(self):
+    FakeHandler.responses['/flaky'] = [503, 429, 200]
+    response = self.client.get(self.base_url + '/flaky')
+    self.assertEqual(200, response.status)
+    self.assertEqual([('GET', '/flaky')] * 3, FakeHandler.requests)
+
+  def test_gives_up_after_retries(self):
+    FakeHandler.responses['/down'] = [503]
+    client = HttpClient(max_retries=2, backoff_secs=0)
+    with self.assertRaises(HttpStatusError) as ex:
+      client.get(self.base_url + '/down')
+    self.assertEqual(503, ex.exception.code)
+    self.assertEqual(3, len(FakeHandler.requests))
+    client.close()
+
+  def test_does_not_retry_not_found(self):
+    with self.assertRaises(HttpStatusError) as ex:
+      self.client.get(self.base_url + '/missing')
+    self.assertEqual(404, ex.exception.code)
+    self.assertEqual(1, len(FakeHandler.requests))
+
+  def test_follows_redirect(self):
+    response = self.client.get(self.base_url + '/redirect')
+    self.assertEqual(200, response.status)
+    self.assertEqual([('GET', '/redirect'), ('GET', '/ok')],
+                     FakeHandler.requests)
+
+  def test_connection_refused(self):
+    client = HttpClient(max_retries=1, backoff_secs=0)
+    with self.assertRaises(HttpRequestError):
+      client.get('http://localhost:1/ok')
+
+
+if __name__ == '__main__':
+  init_runtime()
+  unittest.main(verbosity=2)
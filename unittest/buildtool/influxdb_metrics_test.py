@@ -0,0 +1,206 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=missing-docstring
+
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from SocketServer import ThreadingMixIn
+except ImportError:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+
+from buildtool.influxdb_metrics import (
+    InfluxDbWriter,
+    split_into_batches)
+from buildtool.inmemory_metrics import InMemoryMetricsRegistry
+
+from test_util import init_runtime
+
+
+class Options(object):
+  pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+
+class FakeInfluxDbHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  # The status codes to respond with in turn. The last one repeats.
+  codes = [204]
+
+  # The lines of the accepted batches.
+  batches = []
+
+  def log_message(self, *pos_args):
+    pass
+
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    if self.headers.get('Content-Encoding') == 'gzip':
+      body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+    codes = FakeInfluxDbHandler.codes
+    code = codes.pop(0) if len(codes) > 1 else codes[0]
+    if code == 204:
+      FakeInfluxDbHandler.batches.append(body.decode('utf-8').split('\n'))
+    self.send_response(code)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+
+class TestInfluxDbWriter(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.server = ThreadingHTTPServer(('localhost', 0), FakeInfluxDbHandler)
+    cls.url = 'http://localhost:%d/write?db=test' % cls.server.server_port
+    cls.thread = threading.Thread(target=cls.server.serve_forever)
+    cls.thread.daemon = True
+    cls.thread.start()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.server.shutdown()
+    cls.server.server_close()
+
+  def setUp(self):
+    FakeInfluxDbHandler.codes = [204]
+    FakeInfluxDbHandler.batches = []
+    self.temp_dir = tempfile.mkdtemp(prefix='influxdb_metrics_test')
+    self.spool_path = os.path.join(self.temp_dir, 'spool.txt')
+    options = Options()
+    options.monitoring_enabled = False
+    self.registry = InMemoryMetricsRegistry(options)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def make_writer(self, **kwargs):
+    return InfluxDbWriter(self.url, self.spool_path, self.registry, **kwargs)
+
+  def count(self, name):
+    return self.registry.inc_counter(name, {}, amount=0).count
+
+  def wait_for(self, predicate):
+    deadline = time.time() + 10
+    while not predicate() and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertTrue(predicate())
+
+  def test_split_into_batches(self):
+    self.assertEqual(['a\nbb', 'ccc', 'dddddd', 'e'],
+                     split_into_batches(['a', 'bb', 'ccc', 'dddddd', 'e'], 5))
+    self.assertEqual([], split_into_batches([], 5))
+
+  def test_writes_gzipped_batches(self):
+    writer = self.make_writer(max_batch_bytes=20)
+    lines = ['metric__counter value=%d 1' % index for index in range(5)]
+    writer.write(lines)
+    self.assertTrue(writer.flush(10))
+    self.assertEqual([[line] for line in lines], FakeInfluxDbHandler.batches)
+    self.assertEqual(5, self.count('InfluxDbPointsWritten'))
+    self.assertEqual(0, self.count('InfluxDbPointsSpooled'))
+    writer.close(10)
+
+  def test_spools_and_retries(self):
+    FakeInfluxDbHandler.codes = [503, 503, 204]
+    writer = self.make_writer(backoff_secs=0.2)
+    writer.write(['first value=1 1'])
+    self.assertTrue(writer.flush(10))
+    self.assertTrue(os.path.exists(self.spool_path))
+    self.assertEqual(1, self.count('InfluxDbPointsSpooled'))
+
+    # Spooled behind the first batch while waiting to retry.
+    writer.write(['second value=2 2', 'third value=3 3'])
+    self.wait_for(lambda: self.count('InfluxDbPointsWritten') == 3)
+    self.assertEqual([['first value=1 1'],
+                      ['second value=2 2', 'third value=3 3']],
+                     FakeInfluxDbHandler.batches)
+    self.assertEqual(3, self.count('InfluxDbPointsSpooled'))
+    writer.close(10)
+    self.assertFalse(os.path.exists(self.spool_path))
+
+  def test_drops_rejected_points(self):
+    FakeInfluxDbHandler.codes = [400, 204]
+    writer = self.make_writer()
+    writer.write(['bad line', 'another'])
+    writer.write(['good value=1 1'])
+    self.assertTrue(writer.flush(10))
+    self.assertEqual(2, self.count('InfluxDbPointsDropped'))
+    self.assertEqual(1, self.count('InfluxDbPointsWritten'))
+    self.assertEqual([['good value=1 1']], FakeInfluxDbHandler.batches)
+    writer.close(10)
+
+  def test_unreachable_server_keeps_spool(self):
+    writer = InfluxDbWriter('http://localhost:1/write?db=test',
+                            self.spool_path, self.registry,
+                            backoff_secs=60)
+    start = time.time()
+    writer.write(['metric value=1 1'])
+    self.assertLess(time.time() - start, 1)
+    self.assertTrue(writer.flush(10))
+    writer.close(10)
+    with open(self.spool_path) as stream:
+      self.assertEqual('metric value=1 1\n\n', stream.read())
+
+  def test_replays_existing_spool(self):
+    with open(self.spool_path, 'w') as stream:
+      stream.write('old value=1 1\n\nold value=2 2\n\n')
+    writer = self.make_writer(backoff_secs=60)
+    self.wait_for(lambda: self.count('InfluxDbPointsWritten') == 2)
+    writer.write(['new value=3 3'])
+    self.assertTrue(writer.flush(10))
+    self.assertEqual([['old value=1 1'], ['old value=2 2'], ['new value=3 3']],
+                     FakeInfluxDbHandler.batches)
+    writer.close(10)
+    self.assertFalse(os.path.exists(self.spool_path))
+
+  def test_existing_spool_counts_toward_limit(self):
+    with open(self.spool_path, 'w') as stream:
+      stream.write('old value=1 1\n\n')
+    writer = InfluxDbWriter('http://localhost:1/write?db=test',
+                            self.spool_path, self.registry,
+                            max_pending_batches=0, max_spool_bytes=20,
+                            backoff_secs=60)
+    writer.write(['metric value=2 2'])
+    self.assertEqual(0, self.count('InfluxDbPointsSpooled'))
+    self.assertEqual(1, self.count('InfluxDbPointsDropped'))
+    writer.close(10)
+    with open(self.spool_path) as stream:
+      self.assertEqual('old value=1 1\n\n', stream.read())
+
+  def test_full_spool_drops(self):
+    writer = self.make_writer(max_pending_batches=0, max_spool_bytes=20,
+                              backoff_secs=60)
+    writer.write(['metric value=1 1'])
+    writer.write(['metric value=2 2'])
+    self.assertEqual(1, self.count('InfluxDbPointsSpooled'))
+    self.assertEqual(1, self.count('InfluxDbPointsDropped'))
+    writer.close(10)
+
+
+if __name__ == '__main__':
+  init_runtime()
+  unittest.main(verbosity=2)
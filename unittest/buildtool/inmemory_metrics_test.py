@@ -0,0 +1,230 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=missing-docstring
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from buildtool.inmemory_metrics import (
+    InMemoryMetricsRegistry,
+    TimeSeries,
+    compact_metrics_journal)
+from buildtool.metrics_commands import CompactMetricsJournalsFactory
+
+from test_util import init_runtime
+
+
+class Options(object):
+  pass
+
+
+def sorted_collectors(snapshot):
+  result = {}
+  for category in ['counters', 'gauges', 'timers']:
+    for name, family in snapshot[category].items():
+      result[name] = sorted(family['collectors'],
+                            key=lambda collector: sorted(
+                                collector['labels'].items()))
+  return result
+
+
+class TestTimeSeries(unittest.TestCase):
+  START = datetime.datetime(2018, 1, 1, 12, 30, 15, 123456)
+
+  def make_series(self, values, **kwargs):
+    series = TimeSeries(**kwargs)
+    for index, value in enumerate(values):
+      series.append(value, self.START + datetime.timedelta(seconds=index))
+    return series
+
+  def test_round_trip(self):
+    series = self.make_series([3, 1.5])
+    self.assertEqual(2, len(series))
+    self.assertEqual(3, series[0].value)
+    self.assertEqual(self.START, series[0].utc)
+    self.assertEqual([3, 1.5], [point.value for point in series.points()])
+
+    timer = TimeSeries(width=2, decode=lambda values: (int(values[0]),
+                                                        values[1]))
+    timer.append((2, 0.25), self.START)
+    self.assertEqual((2, 0.25), timer[-1].value)
+
+  def test_downsample_keeps_min_max_last(self):
+    size = TimeSeries.DOWNSAMPLE_BUCKET_SIZE
+    values = [5] * size + list(range(size))
+    values[3] = 9
+    values[7] = 1
+    series = self.make_series(values, capacity=len(values) - 1)
+    series.append(100, self.START)
+    # The first bucket of the oldest half is downsampled to its
+    # min, max and last points.
+    self.assertEqual([9, 1, 5] + list(range(size)) + [100],
+                     [point.value for point in series.points()])
+    self.assertEqual(self.START + datetime.timedelta(seconds=3),
+                     series[0].utc)
+
+  def test_take_returns_each_point_once(self):
+    series = TimeSeries(capacity=64)
+    taken = []
+    for value in range(1000):
+      series.append(value, self.START)
+      if value % 7 == 0:
+        taken.extend([point.value for point in series.take('test')])
+    taken.extend([point.value for point in series.take('test')])
+    self.assertTrue(len(series) <= 64)
+    self.assertEqual(1000, len(taken))
+    self.assertEqual(list(range(1000)), taken)
+
+  def test_counter_deltas_survive_downsampling(self):
+    options = Options()
+    options.monitoring_enabled = False
+    options.metrics_timeseries_capacity = 32
+    registry = InMemoryMetricsRegistry(options)
+    total = 0
+    for _ in range(10):
+      for _ in range(50):
+        registry.inc_counter('TestCounter', {})
+      counter = registry.inc_counter('TestCounter', {})
+      # Like the influxdb exporter.
+      prev_value = 0
+      for entry in counter.mark_as_delta():
+        total += entry.value - prev_value
+        prev_value = entry.value
+    self.assertEqual(510, total)
+    self.assertEqual(510, counter.count)
+
+
+class TestMetricsJournal(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(prefix='inmemory_metrics_test')
+    self.options = Options()
+    self.options.command = 'test_command'
+    self.options.output_dir = self.temp_dir
+    self.options.metrics_dir = None
+    self.options.metrics_journal = True
+    self.options.monitoring_enabled = True
+    self.registry = InMemoryMetricsRegistry(self.options)
+    self.journal_path = os.path.join(
+        self.temp_dir, 'metrics',
+        'metrics__test_command__{pid}.jsonl'.format(pid=os.getpid()))
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def read_journal(self):
+    with open(self.journal_path, 'r') as stream:
+      return [json.loads(line) for line in stream]
+
+  def test_appends_only_new_points(self):
+    registry = self.registry
+    registry.inc_counter('TestCounter', {'repository': 'gate'})
+    registry.observe_timer('TestTimer', {}, 1.5)
+    registry.flush_updated_metrics()
+    records = self.read_journal()
+    self.assertEqual(['header', 'points', 'points'],
+                     [record['journal'] for record in records])
+    self.assertEqual(os.getpid(), records[0]['pid'])
+
+    registry.inc_counter('TestCounter', {'repository': 'gate'}, amount=2)
+    registry.flush_updated_metrics()
+    records = self.read_journal()[3:]
+    self.assertEqual(1, len(records))
+    self.assertEqual('TestCounter', records[0]['name'])
+    self.assertEqual([3], [value['value'] for value in records[0]['values']])
+
+  def test_compaction_matches_snapshot(self):
+    registry = self.registry
+    registry.inc_counter('TestCounter', {'repository': 'gate'})
+    registry.flush_updated_metrics()
+    registry.inc_counter('TestCounter', {'repository': 'gate'})
+    registry.inc_counter('TestCounter', {'repository': 'deck'})
+    registry.set('TestGauge', {}, 5)
+    registry.observe_timer('TestTimer', {'command': 'x'}, 1.5)
+    registry.flush_updated_metrics()
+    registry.observe_timer('TestTimer', {'command': 'x'}, 0.5)
+    registry.flush_final_metrics()
+
+    expect, _, _ = registry.make_snapshot()
+    got = compact_metrics_journal(self.journal_path)
+    self.assertEqual(sorted_collectors(expect), sorted_collectors(got))
+    for key in ['argv', 'job', 'pid', 'start_time']:
+      self.assertEqual(expect[key], got[key])
+    self.assertTrue(got['end_time'] >= got['start_time'])
+    self.assertEqual('end', self.read_journal()[-1]['journal'])
+    histogram = got['timers']['TestTimer']['collectors'][0]['histogram']
+    self.assertEqual(2, sum(histogram['bucketCounts']))
+    self.assertEqual(1.5, histogram['maxSecs'])
+
+  def test_compaction_without_end(self):
+    self.registry.inc_counter('TestCounter', {})
+    self.registry.flush_updated_metrics()
+    snapshot = compact_metrics_journal(self.journal_path)
+    self.assertEqual(
+        snapshot['counters']['TestCounter']['collectors'][0]['values'][0]
+        ['time'],
+        snapshot['end_time'])
+
+  def test_compact_command(self):
+    self.registry.inc_counter('TestCounter', {})
+    self.registry.flush_final_metrics()
+
+    options = Options()
+    options.command = 'compact_metrics_journals'
+    options.output_dir = self.temp_dir
+    options.metrics_dir = None
+    options.journal_path = None
+    options.keep_journals = False
+    command = CompactMetricsJournalsFactory().make_command(options)
+    snapshot_path = os.path.splitext(self.journal_path)[0] + '.json'
+    self.assertEqual([snapshot_path], command())
+    self.assertFalse(os.path.exists(self.journal_path))
+    with open(snapshot_path, 'r') as stream:
+      snapshot = json.load(stream)
+    self.assertEqual(
+        [1], [value['value']
+              for value in snapshot['counters']['TestCounter']
+              ['collectors'][0]['values']])
+
+  def test_compact_command_skips_running_journals(self):
+    # Our own journal is still being written.
+    self.registry.inc_counter('TestCounter', {})
+    self.registry.flush_updated_metrics()
+
+    # This one was left by a process that died without finishing it.
+    dead_pid = 2 ** 22 + 1
+    dead_path = os.path.join(
+        self.temp_dir, 'metrics',
+        'metrics__test_command__{pid}.jsonl'.format(pid=dead_pid))
+    shutil.copyfile(self.journal_path, dead_path)
+
+    options = Options()
+    options.command = 'compact_metrics_journals'
+    options.output_dir = self.temp_dir
+    options.metrics_dir = None
+    options.journal_path = None
+    options.keep_journals = False
+    command = CompactMetricsJournalsFactory().make_command(options)
+    self.assertEqual([os.path.splitext(dead_path)[0] + '.json'], command())
+    self.assertTrue(os.path.exists(self.journal_path))
+    self.assertFalse(os.path.exists(dead_path))
+
+
+if __name__ == '__main__':
+  init_runtime()
+  unittest.main(verbosity=2)
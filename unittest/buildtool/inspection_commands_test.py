@@ -0,0 +1,330 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=missing-docstring
+
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+import yaml
+from mock import patch
+
+from buildtool import BomIndex, write_to_path
+from buildtool.inspection_commands import (
+    AuditArtifactVersions,
+    AuditArtifactVersionsFactory,
+    CollectBomVersions,
+    CollectBomVersionsFactory,
+    FileSystemBomStorage,
+    GsutilBomStorage)
+
+from test_util import init_runtime
+
+
+BOM_BUCKET = 'test-bom-bucket'
+DOCKER_REGISTRY = 'test-docker-registry'
+DEBIAN_REPOSITORY = 'https://dl.bintray.com/test-org/test-debian'
+
+
+class RecordingBomStorage(FileSystemBomStorage):
+  """Remembers which boms were fetched."""
+
+  def __init__(self, root_dir):
+    super(RecordingBomStorage, self).__init__(root_dir)
+    self.fetched_urls = []
+
+  def fetch_boms_to_dir(self, urls, local_dir):
+    self.fetched_urls.extend(urls)
+    return super(RecordingBomStorage, self).fetch_boms_to_dir(urls, local_dir)
+
+
+def make_bom(version, services, timestamp='2018-01-02 03:04:05'):
+  return {
+      'version': version,
+      'timestamp': timestamp,
+      'artifactSources': {
+          'dockerRegistry': DOCKER_REGISTRY,
+          'debianRepository': DEBIAN_REPOSITORY
+      },
+      'services': {
+          name: {'version': build, 'commit': commit}
+          for name, (build, commit) in services.items()
+      }
+  }
+
+
+class TestCollectBomVersions(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.base_temp_dir = tempfile.mkdtemp(prefix='inspection_test')
+    cls.bucket_dir = os.path.join(cls.base_temp_dir, 'gcs')
+    bom_dir = os.path.join(cls.bucket_dir, BOM_BUCKET, 'bom')
+    boms = [
+        make_bom('1.0.0', {'clouddriver': ('2.0.0-20180101', 'abc'),
+                           'gate': ('1.0.0-20180101', 'def')},
+                 timestamp='2018-01-01 00:00:00'),
+        make_bom('1.0.1', {'clouddriver': ('2.0.1-20180102', 'abd'),
+                           'gate': ('1.0.0-20180101', 'def')},
+                 timestamp='2018-01-02 00:00:00'),
+        make_bom('master-latest', {'gate': ('1.0.0-20180101', 'def')},
+                 timestamp='2018-01-03 00:00:00'),
+    ]
+    for bom in boms:
+      write_to_path(yaml.safe_dump(bom),
+                    os.path.join(bom_dir, bom['version'] + '.yml'))
+    write_to_path(yaml.safe_dump(make_bom('1.9.9', {})),
+                  os.path.join(bom_dir, 'misnamed.yml'))
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.base_temp_dir)
+
+  def make_command(self, output_dir=None, bom_storage=None):
+    options = argparse.Namespace(
+        command='collect_bom_versions',
+        output_dir=output_dir or os.path.join(self.base_temp_dir, 'output'),
+        halyard_bom_bucket=BOM_BUCKET,
+        version_name_prefix=None,
+        one_at_a_time=False,
+        docker_registry=DOCKER_REGISTRY,
+        bintray_org='test-org',
+        bintray_debian_repository='test-debian',
+        bom_index_path=None)
+    return CollectBomVersions(
+        CollectBomVersionsFactory(), options,
+        bom_storage=bom_storage or FileSystemBomStorage(self.bucket_dir))
+
+  def test_collect_bom_versions(self):
+    command = self.make_command()
+    command()
+    output_dir = command.get_output_dir()
+
+    with open(os.path.join(output_dir, 'bom_list.txt'), 'r') as stream:
+      self.assertEqual(
+          ['gs://%s/bom/%s.yml' % (BOM_BUCKET, name)
+           for name in ['1.0.0', '1.0.1', 'master-latest', 'misnamed']],
+          stream.read().split('\n'))
+
+    with open(os.path.join(output_dir, 'all_bom_service_map.yml')) as stream:
+      service_map = yaml.safe_load(stream)
+    self.assertEqual(
+        {
+            '1.0.0': {
+                'def': {
+                    '20180101': [
+                        {'bom_version': '1.0.0',
+                         'bom_timestamp': '2018-01-01 00:00:00'},
+                        {'bom_version': '1.0.1',
+                         'bom_timestamp': '2018-01-02 00:00:00'},
+                        {'bom_version': 'master-latest',
+                         'bom_timestamp': '2018-01-03 00:00:00'}]}}
+        },
+        service_map['gate'])
+    self.assertEqual(['2.0.0', '2.0.1'],
+                     sorted(service_map['clouddriver'].keys()))
+
+    with open(os.path.join(output_dir, 'bad_boms.txt')) as stream:
+      self.assertEqual(['misnamed'], list(yaml.safe_load(stream).keys()))
+
+  def test_ingests_only_changed_boms(self):
+    bucket_dir = os.path.join(self.base_temp_dir, 'incremental_gcs')
+    output_dir = os.path.join(self.base_temp_dir, 'incremental_output')
+    shutil.copytree(self.bucket_dir, bucket_dir)
+    bom_dir = os.path.join(bucket_dir, BOM_BUCKET, 'bom')
+    url_dir = 'gs://%s/bom/' % BOM_BUCKET
+
+    storage = RecordingBomStorage(bucket_dir)
+    self.make_command(output_dir=output_dir, bom_storage=storage)()
+    self.assertEqual(4, len(storage.fetched_urls))
+
+    # Nothing changed so nothing is fetched.
+    storage = RecordingBomStorage(bucket_dir)
+    self.make_command(output_dir=output_dir, bom_storage=storage)()
+    self.assertEqual([], storage.fetched_urls)
+
+    os.remove(os.path.join(bom_dir, 'misnamed.yml'))
+    write_to_path(
+        yaml.safe_dump(
+            make_bom('master-latest', {'gate': ('1.1.0-20180103', 'fed')},
+                     timestamp='2018-01-04 00:00:00')),
+        os.path.join(bom_dir, 'master-latest.yml'))
+    write_to_path(
+        yaml.safe_dump(make_bom('1.0.2', {'gate': ('1.0.0-20180101', 'def')},
+                                timestamp='2018-01-05 00:00:00')),
+        os.path.join(bom_dir, '1.0.2.yml'))
+
+    storage = RecordingBomStorage(bucket_dir)
+    command = self.make_command(output_dir=output_dir, bom_storage=storage)
+    command()
+    self.assertEqual([url_dir + '1.0.2.yml', url_dir + 'master-latest.yml'],
+                     sorted(storage.fetched_urls))
+
+    command_dir = command.get_output_dir()
+    self.assertFalse(os.path.exists(os.path.join(command_dir, 'bad_boms.txt')))
+    with open(os.path.join(command_dir, 'all_bom_service_map.yml')) as stream:
+      gate_map = yaml.safe_load(stream)['gate']
+    self.assertEqual(['1.0.0', '1.0.1', '1.0.2'],
+                     [info['bom_version']
+                      for info in gate_map['1.0.0']['def']['20180101']])
+    self.assertEqual('master-latest',
+                     gate_map['1.1.0']['fed']['20180103'][0]['bom_version'])
+
+    index = BomIndex(os.path.join(command_dir, 'bom_index.db'))
+    self.assertEqual({'clouddriver': '2.0.1-20180102',
+                      'gate': '1.0.0-20180101'},
+                     index.lookup_bom_services(url_dir + '1.0.1.yml'))
+    self.assertEqual(set(['1.0.0', '1.0.1', '1.0.2', 'master-latest']),
+                     index.list_bom_versions())
+    index.close()
+
+
+class TestAuditArtifactVersions(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.base_temp_dir = tempfile.mkdtemp(prefix='audit_test')
+    bucket_dir = os.path.join(cls.base_temp_dir, 'gcs')
+    bom_dir = os.path.join(bucket_dir, BOM_BUCKET, 'bom')
+    boms = [
+        make_bom('1.0.0', {'clouddriver': ('2.0.0-20180101', 'abc'),
+                           'gate': ('1.0.0-20180101', 'def')},
+                 timestamp='2018-01-01 00:00:00'),
+        make_bom('1.0.1', {'clouddriver': ('2.0.1-20180102', 'abd'),
+                           'gate': ('1.0.0-20180101', 'def')},
+                 timestamp='2018-01-02 00:00:00'),
+        make_bom('master-latest', {'clouddriver': ('2.0.2-20180103', 'abe'),
+                                   'gate': ('1.0.0-20180101', 'def')},
+                 timestamp='2018-01-03 00:00:00'),
+    ]
+    for bom in boms:
+      write_to_path(yaml.safe_dump(bom),
+                    os.path.join(bom_dir, bom['version'] + '.yml'))
+
+    cls.output_dir = os.path.join(cls.base_temp_dir, 'output')
+    options = argparse.Namespace(
+        command='collect_bom_versions',
+        output_dir=cls.output_dir,
+        halyard_bom_bucket=BOM_BUCKET,
+        version_name_prefix=None,
+        one_at_a_time=False,
+        docker_registry=DOCKER_REGISTRY,
+        bintray_org='test-org',
+        bintray_debian_repository='test-debian',
+        bom_index_path=None)
+    CollectBomVersions(CollectBomVersionsFactory(), options,
+                       bom_storage=FileSystemBomStorage(bucket_dir))()
+
+    # The index is shared with boms from elsewhere that are not audited.
+    index = BomIndex(os.path.join(
+        cls.output_dir, 'collect_bom_versions', 'bom_index.db'))
+    index.add_bom(
+        'gs://other-bucket/bom/9.9.9.yml', 1,
+        {'bom_version': '9.9.9', 'bom_timestamp': '2017-12-01 00:00:00'},
+        {'clouddriver': {'version': '1.9.0-20171201', 'commit': 'abf'}})
+    index.close()
+
+    builds = ['2.0.0-20180101', '2.0.1-20180102', '2.0.2-20180103',
+              '1.9.0-20171201']
+    artifact_dir = os.path.join(cls.output_dir, 'collect_artifact_versions')
+    for suffix, versions in [
+        ('jar', {'clouddriver': builds, 'gate': ['1.0.0-20180101']}),
+        ('debian', {'spinnaker-clouddriver': builds,
+                    'spinnaker-gate': ['1.0.0-20180101', '0.9.0-20171201']}),
+        # The 1.0.1 clouddriver container is missing.
+        ('gcb', {'clouddriver': [builds[0], builds[2]],
+                 'gate': ['1.0.0-20180101']}),
+        ('gce_image', {})]:
+      write_to_path(yaml.safe_dump(versions),
+                    os.path.join(artifact_dir,
+                                 'test__%s_versions.yml' % suffix))
+    write_to_path(
+        yaml.safe_dump({'bintray_org': 'test-org',
+                        'bintray_jar_repository': 'test-jar',
+                        'bintray_debian_repository': 'test-debian',
+                        'docker_registry': DOCKER_REGISTRY}),
+        os.path.join(artifact_dir, 'config.yml'))
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.base_temp_dir)
+
+  def load_output(self, command, name):
+    with open(os.path.join(command.get_output_dir(), name)) as stream:
+      return yaml.safe_load(stream)
+
+  def test_audit_artifact_versions(self):
+    options = argparse.Namespace(
+        command='audit_artifact_versions',
+        output_dir=self.output_dir,
+        min_audit_bom_version=None,
+        prune_min_buildnum_prefix=None,
+        prune_keep_latest_version=False,
+        bom_index_path=None)
+    command = AuditArtifactVersions(AuditArtifactVersionsFactory(), options)
+    command()
+
+    self.assertEqual(
+        {'1.0.1': {'containers': {'clouddriver': '2.0.1-20180102'}}},
+        self.load_output(command, 'audit_invalid_boms.yml'))
+    self.assertEqual(['1.0.0', 'master-latest'],
+                     self.load_output(command, 'audit_confirmed_boms.yml'))
+    self.assertEqual({'clouddriver': ['1.9.0-20171201']},
+                     self.load_output(command, 'audit_unused_jars.yml'))
+    self.assertEqual(
+        {'spinnaker-clouddriver': ['1.9.0-20171201'],
+         'spinnaker-gate': ['0.9.0-20171201']},
+        self.load_output(command, 'audit_unused_debians.yml'))
+    self.assertEqual(
+        [{'bom_version': 'master-latest',
+          'bom_timestamp': '2018-01-03 00:00:00'}],
+        self.load_output(command, 'audit_found_jars.yml')[
+            'clouddriver']['2.0.2-20180103'])
+
+    with open(os.path.join(command.get_output_dir(), 'prune_boms.txt')) as f:
+      self.assertEqual('gs://%s/bom/master-latest.yml' % BOM_BUCKET, f.read())
+    with open(os.path.join(command.get_output_dir(), 'prune_jars.txt')) as f:
+      self.assertEqual(
+          'https://api.bintray.com/packages/test-org/test-jar/clouddriver'
+          '/versions/1.9.0-20171201',
+          f.read())
+
+
+class TestGsutilBomStorage(unittest.TestCase):
+  def test_list_bom_generations(self):
+    prefix = 'gs://test-bucket/bom/'
+    listing = '\n'.join([
+        'gs://test-bucket/bom/1.0.0.yml:',
+        '    Creation time:          Tue, 02 Jan 2018 03:04:05 GMT',
+        '    Content-Length:         1234',
+        '    Generation:             1514862245123456',
+        '    Metageneration:         1',
+        'gs://test-bucket/bom/README.md:',
+        '    Generation:             1514948645123456',
+        'gs://test-bucket/bom/1.0.1.yml:',
+        '    Generation:             1515035045123456',
+        'TOTAL: 3 objects, 4146 bytes (4.05 KiB)'])
+    with patch('buildtool.inspection_commands.check_subprocess',
+               return_value=listing) as mock_check:
+      got = GsutilBomStorage().list_bom_generations(prefix)
+    mock_check.assert_called_once_with('gsutil ls -L ' + prefix)
+    self.assertEqual(
+        {prefix + '1.0.0.yml': '1514862245123456',
+         prefix + '1.0.1.yml': '1515035045123456'},
+        got)
+
+
+if __name__ == '__main__':
+  init_runtime()
+  unittest.main(verbosity=2)
@@ -14,10 +14,13 @@
 
 # pylint: disable=missing-docstring
 
+import argparse
 import os
 import tempfile
 import unittest
+from importlib import import_module
 import yaml
+from mock import patch
 
 import buildtool.__main__
 import custom_test_command
@@ -102,6 +105,61 @@ class TestMain(unittest.TestCase):
     self.assertTrue(options.one_at_a_time)
     self.assertEqual('XYZ', vars(options)[custom_test_command.CUSTOM_ARG_NAME])
 
+
+class TestLazyCommandRegistry(unittest.TestCase):
+  def setUp(self):
+    self.imported = []
+
+  def import_func(self, name):
+    self.imported.append(name)
+    if name == 'custom_test_command':
+      return custom_test_command
+    return import_module('buildtool.' + name)
+
+  def test_manifest_matches_modules(self):
+    manifest = buildtool.__main__.COMMAND_MODULE_MANIFEST
+    for module_name in set(manifest.values()):
+      registry = {}
+      subparsers = argparse.ArgumentParser().add_subparsers()
+      self.import_func(module_name).register_commands(registry, subparsers, {})
+      expect = sorted(name for name, module in manifest.items()
+                      if module == module_name)
+      self.assertEqual(expect, sorted(registry.keys()), module_name)
+
+  def test_only_selected_module_loaded(self):
+    manifest = {COMMAND: 'custom_test_command', 'other': 'other_commands'}
+    options, registry = buildtool.__main__.init_options_and_lazy_registry(
+        [COMMAND], manifest, import_func=self.import_func)
+    self.assertEqual(COMMAND, options.command)
+    self.assertEqual(['custom_test_command'], self.imported)
+    self.assertEqual([COMMAND], list(registry.keys()))
+    self.assertIsNone(registry.get('unknown'))
+
+  def test_lookup_loads_module(self):
+    manifest = dict(buildtool.__main__.COMMAND_MODULE_MANIFEST)
+    manifest[COMMAND] = 'custom_test_command'
+    _, registry = buildtool.__main__.init_options_and_lazy_registry(
+        [COMMAND], manifest, import_func=self.import_func)
+    self.assertNotIn('extract_source_info', dict.keys(registry))
+    self.assertTrue('fetch_source' in registry)
+    self.assertEqual('extract_source_info',
+                     registry['extract_source_info'].name)
+    self.assertEqual(['custom_test_command', 'source_commands'],
+                     self.imported)
+    with self.assertRaises(KeyError):
+      registry['unknown']  # pylint: disable=pointless-statement
+
+  def test_no_command_loads_all(self):
+    manifest = {COMMAND: 'custom_test_command',
+                'fetch_source': 'source_commands'}
+    with patch.object(argparse.ArgumentParser, 'print_help'):
+      with self.assertRaises(SystemExit):
+        buildtool.__main__.init_options_and_lazy_registry(
+            ['--help'], manifest, import_func=self.import_func)
+    self.assertEqual(['custom_test_command', 'source_commands'],
+                     sorted(self.imported))
+
+
 if __name__ == '__main__':
   import logging
   logging.basicConfig(
@@ -0,0 +1,152 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=missing-docstring
+
+import os
+import pstats
+import shutil
+import tempfile
+import time
+import unittest
+from multiprocessing.pool import ThreadPool
+
+from buildtool.base_metrics import MetricFamily
+from buildtool.inmemory_metrics import InMemoryMetricsRegistry
+from buildtool.profiling import (
+    CProfileProfiler,
+    SamplingProfiler,
+    make_profiler)
+
+from test_util import init_runtime
+
+
+class Options(object):
+  pass
+
+
+def busy_worker_function(secs):
+  deadline = time.time() + secs
+  count = 0
+  while time.time() < deadline:
+    count += 1
+  return count
+
+
+def run_command():
+  pool = ThreadPool(2)
+  try:
+    return pool.map(busy_worker_function, [0.05, 0.05])
+  finally:
+    pool.close()
+    pool.join()
+
+
+class TestProfiling(unittest.TestCase):
+  def setUp(self):
+    self.output_dir = tempfile.mkdtemp(prefix='profiling_test')
+
+  def tearDown(self):
+    shutil.rmtree(self.output_dir)
+
+  def load_profile(self, profiler):
+    profile_dir = os.path.join(self.output_dir, 'profile', 'test_command')
+    self.assertEqual(profile_dir, profiler.profile_dir)
+    stats = pstats.Stats(os.path.join(profile_dir, 'profile.pstats'))
+    with open(os.path.join(profile_dir, 'profile.collapsed')) as stream:
+      collapsed = stream.read().split('\n')[:-1]
+    return stats, collapsed
+
+  def find_function(self, stats, name):
+    return [entry for func, entry in stats.stats.items() if func[2] == name]
+
+  def test_cprofile_aggregates_threads(self):
+    profiler = CProfileProfiler('test_command', self.output_dir)
+    self.assertEqual(2, len(profiler.profile_call(run_command)))
+    stats, collapsed = self.load_profile(profiler)
+
+    entries = self.find_function(stats, 'busy_worker_function')
+    self.assertEqual(1, len(entries))
+    self.assertEqual(2, entries[0][1])
+    self.assertTrue(self.find_function(stats, 'run_command'))
+
+    for line in collapsed:
+      self.assertTrue(int(line.rsplit(' ', 1)[1]) > 0)
+    self.assertTrue([line for line in collapsed
+                     if 'run_command;' in line])
+    self.assertTrue([line for line in collapsed
+                     if ':busy_worker_function;' in line])
+    self.assertGreaterEqual(profiler.overhead_secs, 0)
+
+  def test_sampling(self):
+    profiler = SamplingProfiler('test_command', self.output_dir,
+                                interval_secs=0.001)
+    profiler.profile_call(run_command)
+    self.assertTrue(profiler.num_samples > 0)
+    self.assertTrue(profiler.overhead_secs > 0)
+    stats, collapsed = self.load_profile(profiler)
+
+    entries = self.find_function(stats, 'busy_worker_function')
+    self.assertEqual(1, len(entries))
+    cc, nc, tt, ct, callers = entries[0]
+    self.assertEqual(cc, nc)
+    self.assertTrue(0 < tt <= ct)
+    self.assertTrue(callers)
+
+    worker_lines = [line for line in collapsed
+                    if line.startswith('<worker threads>;')
+                    and ':busy_worker_function' in line]
+    self.assertTrue(worker_lines)
+    self.assertTrue([line for line in collapsed
+                     if ':run_command;' in line
+                     and not line.startswith('<worker threads>')])
+
+  def test_profile_written_on_error(self):
+    profiler = SamplingProfiler('test_command', self.output_dir)
+    def fail():
+      raise ValueError('test')
+    with self.assertRaises(ValueError):
+      profiler.profile_call(fail)
+    self.assertTrue(os.path.exists(
+        os.path.join(profiler.profile_dir, 'profile.pstats')))
+
+  def test_record_metrics(self):
+    options = Options()
+    options.monitoring_enabled = False
+    registry = InMemoryMetricsRegistry(options)
+    profiler = SamplingProfiler('test_command', self.output_dir)
+    profiler.profile_call(time.sleep, 0.01)
+    profiler.record_metrics(registry)
+    labels = {'command': 'test_command', 'mode': 'sampling'}
+    timer = registry.get_metric(MetricFamily.TIMER, 'Profile_Overhead', labels)
+    self.assertEqual(1, timer.count)
+    wall = registry.get_metric(MetricFamily.TIMER, 'Profile_WallTime', labels)
+    self.assertTrue(wall.total_seconds >= 0.01)
+
+  def test_make_profiler(self):
+    options = Options()
+    options.command = 'test_command'
+    options.output_dir = self.output_dir
+    options.profile = None
+    self.assertIsNone(make_profiler(options))
+    options.profile = 'cprofile'
+    self.assertIsInstance(make_profiler(options), CProfileProfiler)
+    options.profile = 'sampling'
+    options.profile_interval_ms = 10
+    self.assertIsInstance(make_profiler(options), SamplingProfiler)
+
+
+if __name__ == '__main__':
+  init_runtime()
+  unittest.main(verbosity=2)
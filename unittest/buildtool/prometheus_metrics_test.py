@@ -0,0 +1,211 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=missing-docstring
+
+import threading
+import unittest
+from mock import patch
+
+try:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from SocketServer import ThreadingMixIn
+  from urllib2 import urlopen
+except ImportError:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+  from urllib.request import urlopen
+
+from buildtool.base_metrics import MetricFamily
+from buildtool.prometheus_metrics import (
+    PrometheusMetricsRegistry,
+    to_label_text)
+
+from test_util import init_runtime
+
+
+class Options(object):
+  def __init__(self, **kwargs):
+    self.command = 'test_command'
+    self.parent_invocation_id = 'test.123'
+    self.monitoring_enabled = True
+    self.monitoring_context_labels = None
+    self.prometheus_port = None
+    self.prometheus_listen_address = 'localhost'
+    self.prometheus_pushgateway_url = None
+    self.prometheus_job = 'buildtool'
+    self.__dict__.update(kwargs)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+
+class FakePushGatewayHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  # (method, path, body) of each request received.
+  requests = []
+
+  def log_message(self, *pos_args):
+    pass
+
+  def do_PUT(self):
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    FakePushGatewayHandler.requests.append(
+        ('PUT', self.path, body.decode('utf-8')))
+    self.send_response(200)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+
+class TestPrometheusMetricsRegistry(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.server = ThreadingHTTPServer(('localhost', 0), FakePushGatewayHandler)
+    cls.url = 'http://localhost:%d' % cls.server.server_port
+    cls.thread = threading.Thread(target=cls.server.serve_forever)
+    cls.thread.daemon = True
+    cls.thread.start()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.server.shutdown()
+    cls.server.server_close()
+
+  def setUp(self):
+    FakePushGatewayHandler.requests = []
+
+  def make_registry(self, **kwargs):
+    registry = PrometheusMetricsRegistry(Options(**kwargs))
+    self.addCleanup(registry.flush_final_metrics)
+    return registry
+
+  def test_label_text(self):
+    self.assertEqual('', to_label_text({}))
+    self.assertEqual(r'{a="x\"y",b_c="1\\2\n"}',
+                     to_label_text({'b-c': '1\\2\n', 'a': 'x"y'}))
+
+  def test_encode_native_types(self):
+    registry = self.make_registry()
+    registry.inc_counter('Things', {'kind': 'a'}, amount=3)
+    registry.set('InProgress', {}, 2)
+    registry.observe_timer('Call', {'ok': True}, 0.5)
+
+    text = registry.encode()
+    self.assertIn('# TYPE Things_total counter\n'
+                  'Things_total{kind="a"} 3\n', text)
+    self.assertIn('# TYPE InProgress gauge\nInProgress 2\n', text)
+    self.assertIn('# TYPE Call_seconds histogram\n', text)
+    self.assertIn('Call_seconds_bucket{le="+Inf",ok="True"} 1\n', text)
+    self.assertIn('Call_seconds_sum{ok="True"} 0.5\n', text)
+    self.assertIn('Call_seconds_count{ok="True"} 1\n', text)
+    self.assertIn('Call_seconds_quantile{ok="True",quantile="0.5"} ', text)
+
+    buckets = [line for line in text.split('\n')
+               if line.startswith('Call_seconds_bucket')]
+    counts = [int(line.rsplit(' ', 1)[1]) for line in buckets]
+    self.assertEqual(counts, sorted(counts))
+    self.assertEqual(len(registry.timer_bucket_bounds) + 1, len(buckets))
+
+  def test_timer_families_are_grouped(self):
+    registry = self.make_registry()
+    for ok in [True, False]:
+      registry.observe_timer('Call', {'ok': ok}, 0.5)
+    registry.set('Other', {}, 1)
+
+    suffixes = {'counter': ['_total'], 'gauge': [''],
+                'histogram': ['_bucket', '_sum', '_count']}
+    families = []
+    for line in registry.encode().strip().split('\n'):
+      if line.startswith('# TYPE '):
+        _, _, name, family_type = line.split(' ')
+        families.append((name, family_type))
+        continue
+      # Every sample belongs to the family whose header it follows.
+      name, family_type = families[-1]
+      sample_name = line.split('{')[0].split(' ')[0]
+      self.assertIn(sample_name,
+                    [name + suffix for suffix in suffixes[family_type]])
+
+    self.assertEqual([('Call_seconds', 'histogram'),
+                      ('Call_seconds_quantile', 'gauge'),
+                      ('Other', 'gauge')],
+                     families)
+
+  def test_encode_only_changed_metrics(self):
+    registry = self.make_registry()
+    registry.inc_counter('Things', {'kind': 'a'})
+    registry.inc_counter('Things', {'kind': 'b'})
+    registry.encode()
+    with patch('buildtool.prometheus_metrics.to_label_text',
+               wraps=to_label_text) as mock_encode:
+      registry.inc_counter('Things', {'kind': 'a'})
+      text = registry.encode()
+      self.assertEqual(1, mock_encode.call_count)
+    self.assertIn('Things_total{kind="a"} 2\n', text)
+    self.assertIn('Things_total{kind="b"} 1\n', text)
+
+  def test_serves_current_values(self):
+    registry = self.make_registry(prometheus_port=0)
+    registry.set('InProgress', {'command': 'x'}, 1)
+    url = 'http://localhost:%d/metrics' % registry.http_port
+    response = urlopen(url)
+    self.assertIn('text/plain', response.headers['Content-Type'])
+    self.assertIn('InProgress{command="x"} 1\n',
+                  response.read().decode('utf-8'))
+
+    registry.set('InProgress', {'command': 'x'}, 0)
+    self.assertIn('InProgress{command="x"} 0\n',
+                  urlopen(url).read().decode('utf-8'))
+
+  def test_pushes_on_flush(self):
+    registry = self.make_registry(prometheus_pushgateway_url=self.url)
+    self.assertEqual(
+        self.url + '/metrics/job/buildtool/command/test_command'
+        '/invocation/test.123', registry.push_url)
+    registry.inc_counter('Things', {})
+    registry.flush_updated_metrics()
+    registry.inc_counter('Things', {})
+    registry.flush_final_metrics()
+
+    self.assertEqual(2, len(FakePushGatewayHandler.requests))
+    method, path, body = FakePushGatewayHandler.requests[-1]
+    self.assertEqual('PUT', method)
+    self.assertEqual(
+        '/metrics/job/buildtool/command/test_command/invocation/test.123',
+        path)
+    self.assertIn('Things_total 2\n', body)
+
+  def test_push_failure_is_not_fatal(self):
+    registry = self.make_registry(
+        prometheus_pushgateway_url='http://localhost:1')
+    registry.inc_counter('Things', {})
+    self.assertFalse(registry.push())
+
+  def test_disabled(self):
+    registry = PrometheusMetricsRegistry(
+        Options(monitoring_enabled=False, prometheus_port=0,
+                prometheus_pushgateway_url=self.url))
+    self.assertIsNone(registry.http_port)
+    self.assertIsNone(registry.push_url)
+    registry.inc_counter('Things', {})
+    self.assertIn('Things_total 1\n', registry.encode())
+    self.assertEqual(MetricFamily.COUNTER,
+                     registry.lookup_family_or_none('Things').family_type)
+
+
+if __name__ == '__main__':
+  init_runtime()
+  unittest.main(verbosity=2)
@@ -74,7 +74,8 @@ class TestSpinnakerCommandFixture(BaseGitRepoTestFixture):
         GitRunner(options).query_local_repository_commit_id(git_dir),
         self.repo_commit_map[EXTRA_REPO][EXTRA_REPO + '-branch'])
 
-    mock_push_branch.assert_called_once_with(git_dir, 'NewSpinnakerVersion')
+    mock_push_branch.assert_called_once_with(
+        git_dir, 'NewSpinnakerVersion', force=False)
     self.assertEqual(0, mock_push_tag.call_count)
 
 
@@ -18,14 +18,25 @@ import io
 import logging
 import os
 import shutil
+import sys
 import tempfile
+import time
 import unittest
 
 from buildtool import (
     check_subprocess,
+    check_subprocess_async,
+    check_subprocess_lines,
     check_subprocesses_to_logfile,
+    map_async,
     run_subprocess,
-    ExecutionError)
+    run_subprocess_async,
+    start_subprocess,
+    wait_subprocess,
+    ExecutionError,
+    MetricsManager,
+    SubprocessLimiter)
+from buildtool.base_metrics import MetricFamily
 
 from test_util import init_runtime
 
@@ -109,6 +120,67 @@ class TestRunner(unittest.TestCase):
         check_subprocess(test)
       self.assertTrue(hasattr(ex.exception, 'loggedit'))
 
+  def test_check_subprocess_input(self):
+    self.assertEqual('a\nb', check_subprocess('cat', input='a\nb\n'))
+
+    # More than fits in a pipe buffer is echoed back without deadlocking.
+    text = 'x' * 100 + '\n'
+    got = check_subprocess('cat', input=text * 10000)
+    self.assertEqual(len(text) * 10000 - 1, len(got))
+
+  def test_check_subprocess_lines(self):
+    got = list(check_subprocess_lines('/usr/bin/seq 3'))
+    self.assertEqual(['1\n', '2\n', '3\n'], got)
+
+    # Stopping early is fine.
+    lines = check_subprocess_lines('/usr/bin/seq 1000000')
+    self.assertEqual('1\n', next(lines))
+    lines.close()
+
+    with self.assertRaises(ExecutionError) as ex:
+      list(check_subprocess_lines('/bin/ls /abc/def'))
+    self.assertTrue(hasattr(ex.exception, 'loggedit'))
+
+  @unittest.skipIf(sys.version_info[0] < 3, 'asyncio requires python3')
+  def test_subprocess_async(self):
+    stream = io.StringIO()
+    limiter = SubprocessLimiter(2)
+    commands = ['/bin/sleep 0.2'] * 4 + ['/usr/bin/seq 3']
+    start_time = time.time()
+    got = map_async(
+        lambda cmd: run_subprocess_async(cmd, stream=stream, limiter=limiter),
+        commands)
+    self.assertEqual([(0, '')] * 4 + [(0, '1\n2\n3')], got)
+
+    # Only two were allowed to sleep at a time.
+    self.assertTrue(time.time() - start_time >= 0.4)
+    self.assertEqual(5, stream.getvalue().count('Spawned process completed'))
+
+    got = map_async(check_subprocess_async, ['/usr/bin/seq 2'])
+    self.assertEqual(['1\n2'], got)
+    with self.assertRaises(ExecutionError) as ex:
+      map_async(check_subprocess_async, ['/bin/ls /abc/def', '/bin/true'])
+    self.assertTrue(hasattr(ex.exception, 'loggedit'))
+
+  @unittest.skipIf(sys.version_info[0] < 3, 'asyncio requires python3')
+  def test_subprocess_async_start_failure(self):
+    class BrokenStream(object):
+      def write(self, text):
+        raise IOError('Cannot write')
+
+    limiter = SubprocessLimiter(1)
+    with self.assertRaises(ValueError):
+      map_async(lambda cmd: run_subprocess_async(cmd, limiter=limiter),
+                ['/bin/echo "unbalanced'])
+    with self.assertRaises(IOError):
+      map_async(lambda cmd: run_subprocess_async(
+          cmd, stream=BrokenStream(), limiter=limiter), ['/bin/true'])
+
+    # Neither failure kept the only slot.
+    got = map_async(lambda cmd: run_subprocess_async(cmd, limiter=limiter),
+                    ['/usr/bin/seq 2'])
+    self.assertEqual([(0, '1\n2')], got)
+
   def test_check_to_file_subprocess_ok(self):
     path = os.path.join(self.base_temp_dir, 'check_ok.log')
     self.do_run_subprocess_ok(False, logfile=path)
@@ -126,6 +198,35 @@ class TestRunner(unittest.TestCase):
     expect = "/bin/ls: cannot access '/abc/def': No such file or directory"
     self.assertEqual(expect, body)
 
+  def test_wait_subprocess_resource_usage(self):
+    process = start_subprocess(
+        '/bin/sh -c "i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done"')
+    code, _ = wait_subprocess(process)
+    self.assertEqual(0, code)
+    usage = process.resource_usage
+    self.assertGreater(usage.user_secs + usage.system_secs, 0)
+    self.assertGreater(usage.max_rss_kb, 0)
+    self.assertGreaterEqual(usage.voluntary_switches, 0)
+
+  def test_resource_usage_logged_and_recorded(self):
+    path = os.path.join(self.base_temp_dir, 'resource_usage.log')
+    labels = {'repository': 'test', 'context': 'unittest', 'target': 'sh'}
+    check_subprocesses_to_logfile('Test Logfile', path, ['/bin/echo Hello'],
+                                  resource_labels=labels)
+    with open(path, 'r') as stream:
+      footer = stream.read().split('\n')[-2]
+    self.assertIn('with returncode 0 in', footer)
+    self.assertIn(' using user ', footer)
+    self.assertIn(' max rss ', footer)
+
+    metrics = MetricsManager.singleton()
+    family = metrics.lookup_family_or_none('SubprocessCpuSecs')
+    modes = sorted(metric.labels['mode'] for metric in family.instance_list
+                   if metric.labels['repository'] == 'test')
+    self.assertEqual(['system', 'user'], modes)
+    rss = metrics.get_metric(MetricFamily.GAUGE, 'SubprocessMaxRssKb', labels)
+    self.assertGreater(rss.value, 0)
+
   def test_run_subprocess_get_pid(self):
     # See if we can run a job by looking up our job
     # This is also testing parsing command lines.
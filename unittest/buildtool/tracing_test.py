@@ -0,0 +1,188 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=missing-docstring
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from multiprocessing.pool import ThreadPool
+from mock import patch
+
+from buildtool import (
+    Tracer,
+    run_subprocess,
+    run_subprocess_async)
+from buildtool.scm import RepositoryWorker
+
+from test_util import init_runtime
+
+
+class FakeRepository(object):
+  def __init__(self, name):
+    self.name = name
+
+
+class TestTracer(unittest.TestCase):
+  def setUp(self):
+    self.tracer = Tracer(enabled=True)
+    patcher = patch.object(Tracer, 'singleton', return_value=self.tracer)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def spans_by_name(self):
+    return {span.name: span for span in self.tracer.finished_spans}
+
+  def test_nested_spans(self):
+    with self.tracer.span('outer', 'command') as outer:
+      self.assertIs(outer, self.tracer.current_span())
+      with self.tracer.span('inner', 'repository', {'repository': 'x'}):
+        pass
+    self.assertIsNone(self.tracer.current_span())
+
+    spans = self.spans_by_name()
+    self.assertEqual(outer.span_id, spans['inner'].parent_id)
+    self.assertIsNone(spans['outer'].parent_id)
+    self.assertEqual({'repository': 'x'}, spans['inner'].attributes)
+    self.assertLessEqual(spans['outer'].start_time,
+                         spans['inner'].start_time)
+    self.assertGreaterEqual(spans['outer'].end_time, spans['inner'].end_time)
+
+  def test_records_exception(self):
+    with self.assertRaises(KeyError):
+      with self.tracer.span('failed'):
+        raise KeyError('test')
+    self.assertEqual('KeyError',
+                     self.spans_by_name()['failed'].attributes[
+                         'exception_type'])
+
+  def test_disabled_keeps_nothing(self):
+    tracer = Tracer()
+    with tracer.span('ignored'):
+      self.assertIsNotNone(tracer.current_span())
+    self.assertEqual([], tracer.finished_spans)
+
+  def test_repository_worker_propagates_context(self):
+    def work(repository):
+      with self.tracer.span(repository.name, 'repository'):
+        return self.tracer.current_span().thread_id
+
+    pool = ThreadPool(2)
+    try:
+      with self.tracer.span('command') as command:
+        worker = RepositoryWorker(work)
+        pool.map(worker, [FakeRepository('a'), FakeRepository('b')])
+    finally:
+      pool.close()
+      pool.join()
+
+    spans = self.spans_by_name()
+    self.assertEqual(command.span_id, spans['a'].parent_id)
+    self.assertEqual(command.span_id, spans['b'].parent_id)
+
+  def test_wrap(self):
+    pool = ThreadPool(1)
+    try:
+      with self.tracer.span('parent') as parent:
+        found = pool.apply(self.tracer.wrap(self.tracer.current_span))
+    finally:
+      pool.close()
+      pool.join()
+    self.assertIs(parent, found)
+
+  def test_subprocess_span(self):
+    with self.tracer.span('command') as command:
+      run_subprocess('/bin/sh -c "exit 3"')
+    span = self.spans_by_name()['sh']
+    self.assertEqual('subprocess', span.category)
+    self.assertEqual(command.span_id, span.parent_id)
+    self.assertEqual(3, span.attributes['exit_code'])
+    self.assertTrue(span.attributes['pid'] > 0)
+
+  @unittest.skipIf(sys.version_info[0] < 3, 'asyncio requires python3')
+  def test_async_subprocess_span(self):
+    import asyncio
+    loop = asyncio.new_event_loop()
+    try:
+      with self.tracer.span('command') as command:
+        future = run_subprocess_async('/bin/sh -c "exit 0"', loop=loop)
+        loop.run_until_complete(future)
+    finally:
+      loop.close()
+    span = self.spans_by_name()['sh']
+    self.assertEqual(command.span_id, span.parent_id)
+    self.assertEqual(0, span.attributes['exit_code'])
+    self.assertTrue(span.attributes['pid'] > 0)
+
+  def test_chrome_trace(self):
+    def child():
+      with self.tracer.span('child'):
+        pass
+
+    pool = ThreadPool(1)
+    try:
+      with self.tracer.span('command', 'command'):
+        pool.apply(self.tracer.wrap(child))
+    finally:
+      pool.close()
+      pool.join()
+
+    trace = self.tracer.to_chrome_trace()
+    complete = {event['name']: event for event in trace['traceEvents']
+                if event['ph'] == 'X'}
+    self.assertEqual(['child', 'command'], sorted(complete.keys()))
+    self.assertEqual(complete['command']['args']['span_id'],
+                     complete['child']['args']['parent_id'])
+    self.assertNotEqual(complete['command']['tid'], complete['child']['tid'])
+    phases = sorted(event['ph'] for event in trace['traceEvents']
+                    if event.get('cat') == 'flow')
+    self.assertEqual(['f', 's'], phases)
+    self.assertEqual(2, len([event for event in trace['traceEvents']
+                             if event['ph'] == 'M']))
+
+  def test_otlp(self):
+    with self.tracer.span('command', 'command', {'count': 2}):
+      with self.tracer.span('child'):
+        pass
+    otlp = self.tracer.to_otlp()
+    spans = otlp['resourceSpans'][0]['scopeSpans'][0]['spans']
+    by_name = {span['name']: span for span in spans}
+    self.assertEqual(by_name['command']['spanId'],
+                     by_name['child']['parentSpanId'])
+    self.assertNotIn('parentSpanId', by_name['command'])
+    self.assertEqual(self.tracer.trace_id, by_name['child']['traceId'])
+    self.assertIn({'key': 'count', 'value': {'intValue': '2'}},
+                  by_name['command']['attributes'])
+
+  def test_write(self):
+    temp_dir = tempfile.mkdtemp(prefix='tracing_test')
+    try:
+      with self.tracer.span('command'):
+        pass
+      prefix = os.path.join(temp_dir, 'metrics', 'trace')
+      self.tracer.write(prefix, ['chrome', 'otlp'])
+      with open(prefix + '.json') as stream:
+        self.assertTrue(json.loads(stream.read())['traceEvents'])
+      with open(prefix + '.otlp.json') as stream:
+        self.assertTrue(json.loads(stream.read())['resourceSpans'])
+    finally:
+      shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+  init_runtime()
+  unittest.main(verbosity=2)
@@ -22,11 +22,29 @@ import tempfile
 import unittest
 
 from buildtool import (
+    available_data_formats,
+    decode_data,
+    encode_data,
     ensure_dir_exists,
+    find_data_path,
+    get_intermediate_format,
+    intermediate_path,
+    load_data_from_path,
+    set_intermediate_format,
     timedelta_string,
+    write_data_to_path,
     write_to_path)
 
 
+SAMPLE_DATA = {
+    'clouddriver': {'1.2.3': {'abcd': {'20180101': [
+        {'bom_version': '1.0.0', 'bom_timestamp': '2018-01-01'}]}}},
+    'deck': None,
+    'gate': ['1.0.0-20180101', u'1.0.1-20180102'],
+    'count': 3
+}
+
+
 class TestRunner(unittest.TestCase):
   @classmethod
   def setUpClass(cls):
@@ -60,6 +78,65 @@ class TestRunner(unittest.TestCase):
     with open(path, 'r') as f:
       self.assertEqual(content, f.read())
 
+  def test_encode_decode_data(self):
+    for data_format in available_data_formats():
+      for data in [SAMPLE_DATA, ['a', 1], 'scalar']:
+        self.assertEqual(
+            data, decode_data(encode_data(data, data_format), data_format),
+            'format=%s' % data_format)
+    with self.assertRaises(ValueError):
+      encode_data(SAMPLE_DATA, 'unknown')
+
+  def test_jsonl_has_record_per_line(self):
+    lines = encode_data(SAMPLE_DATA, 'jsonl').decode('utf-8').splitlines()
+    self.assertEqual('{"jsonl":"dict"}', lines[0])
+    self.assertEqual('["count",3]', lines[2])
+    self.assertEqual(len(SAMPLE_DATA) + 1, len(lines))
+
+  def test_write_and_load_data(self):
+    dir_path = os.path.join(self.base_temp_dir, 'test_data')
+    for data_format in available_data_formats():
+      set_intermediate_format(data_format)
+      try:
+        path = intermediate_path(os.path.join(dir_path, data_format + '.yml'))
+        write_data_to_path(SAMPLE_DATA, path)
+        self.assertEqual(SAMPLE_DATA, load_data_from_path(path))
+
+        # Readers ask for the original name and find it in another format.
+        self.assertEqual(
+            SAMPLE_DATA,
+            load_data_from_path(os.path.join(dir_path, data_format + '.yml')))
+      finally:
+        set_intermediate_format('yaml')
+
+    self.assertEqual('yaml', get_intermediate_format())
+    with self.assertRaises(ValueError):
+      set_intermediate_format('unknown')
+    with self.assertRaises(ValueError):
+      write_data_to_path(SAMPLE_DATA, os.path.join(dir_path, 'data.txt'))
+
+  def test_stale_data_in_other_format(self):
+    dir_path = os.path.join(self.base_temp_dir, 'test_stale_data')
+    yaml_path = os.path.join(dir_path, 'data.yml')
+    json_path = os.path.join(dir_path, 'data.json')
+    write_data_to_path({'stale': True}, yaml_path)
+
+    set_intermediate_format('json')
+    try:
+      # Writing replaces the data in every other format.
+      write_data_to_path(SAMPLE_DATA, json_path)
+      self.assertEqual(['data.json'], os.listdir(dir_path))
+      self.assertEqual(SAMPLE_DATA, load_data_from_path(yaml_path))
+
+      # The intermediate format is preferred if both are present.
+      with open(yaml_path, 'w') as stream:
+        stream.write('stale: true\n')
+      self.assertEqual(json_path, find_data_path(yaml_path))
+      self.assertEqual(SAMPLE_DATA, load_data_from_path(yaml_path))
+    finally:
+      set_intermediate_format('yaml')
+    self.assertEqual(yaml_path, find_data_path(yaml_path))
+
   def test_deltatime_string(self):
     timedelta = datetime.timedelta
     tests = [